@@ -0,0 +1,80 @@
+"""
+Self-validating session tokens
+A token carries the user id and its expiry, signed with HMAC-SHA256:
+
+    v1.<user_id>.<expires_at>.<signature>
+
+Verifying one is a single HMAC plus a clock check - no database or file lookup,
+so authentication cost stays constant however many users are registered.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from typing import FrozenSet, Optional, Tuple
+
+TOKEN_VERSION = "v1"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _is_ascii_number(value: str) -> bool:
+    return value.isascii() and value.isdigit()
+
+
+class TokenSigner:
+    """Issues and verifies HMAC-signed tokens; thread-safe (holds no mutable state)"""
+
+    def __init__(self, secret: bytes, ttl_seconds: int = 7 * 24 * 3600):
+        if len(secret) < 16:
+            raise ValueError("Token secret must be at least 16 bytes")
+        self._secret = secret
+        self.ttl_seconds = ttl_seconds
+
+    def _sign(self, payload: str) -> str:
+        digest = hmac.new(self._secret, payload.encode("ascii"), hashlib.sha256).digest()
+        return _b64encode(digest)
+
+    def issue(self, user_id: int, now: Optional[float] = None) -> Tuple[str, int]:
+        """Return (token, expires_at) for a user"""
+        expires_at = int(now if now is not None else time.time()) + self.ttl_seconds
+        payload = f"{TOKEN_VERSION}.{int(user_id)}.{expires_at}"
+        return f"{payload}.{self._sign(payload)}", expires_at
+
+    def verify(self, token: str, now: Optional[float] = None) -> Optional[int]:
+        """Return the user id of a valid, unexpired token, else None"""
+        try:
+            version, user_id, expires_at, signature = token.split(".")
+        except (AttributeError, ValueError):
+            return None
+        # str.isdigit() also accepts non-ASCII digits ("²", "٣"), which the ASCII signer cannot encode
+        if version != TOKEN_VERSION or not _is_ascii_number(user_id) or not _is_ascii_number(expires_at):
+            return None
+        expected = self._sign(f"{version}.{user_id}.{expires_at}")
+        if not hmac.compare_digest(signature.encode("ascii", "replace"), expected.encode("ascii")):
+            return None
+        if int(expires_at) <= (now if now is not None else time.time()):
+            return None
+        return int(user_id)
+
+
+def load_token_secret(env_var: str = "AUTH_TOKEN_SECRET") -> bytes:
+    """Signing secret from the environment; a random per-process secret otherwise (tokens die on restart)"""
+    secret = os.getenv(env_var)
+    if secret:
+        return secret.encode("utf-8")
+    print(f"⚠️ {env_var} is not set, using a random secret - issued tokens will not survive a restart")
+    return secrets.token_bytes(32)
+
+
+def load_admin_user_ids(env_var: str = "ADMIN_USER_IDS") -> FrozenSet[int]:
+    """Comma-separated user ids allowed on admin routes; none when unset (admin routes then reject everyone)"""
+    admin_ids = frozenset(int(part) for part in os.getenv(env_var, "").split(",") if part.strip().isdigit())
+    if not admin_ids:
+        print(f"⚠️ {env_var} is not set, admin routes are disabled")
+    return admin_ids
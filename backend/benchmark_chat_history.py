@@ -0,0 +1,225 @@
+"""
+聊天記錄存儲後端基準測試
+比較 JSON 文件、JSONL 追加式與 SQLite (WAL) 後端的消息追加、會話列表與消息讀取耗時；
+--layout-files 比較平鋪目錄與哈希分片目錄在大量會話文件下的查找和遍歷耗時；
+--compression 測量壓縮層節省的空間與讀取壓縮記錄的額外延遲
+
+用法: python benchmark_chat_history.py --sessions 20 --messages 200
+      python benchmark_chat_history.py --layout-files 200000
+      python benchmark_chat_history.py --compression
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from chat_history_manager import ChatHistoryManager
+from chat_history_storage import JSONLFileStorage
+
+
+def _percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run_backend(backend: str, sessions: int, messages: int, user_id: int = 1,
+                agent_type: str = "mental_health") -> Dict[str, Any]:
+    """在臨時目錄中對一個後端執行完整的寫入/讀取負載"""
+    base_dir = tempfile.mkdtemp(prefix=f"chat_bench_{backend}_")
+    try:
+        # 基準測試時屏蔽管理器的逐條日誌輸出
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = ChatHistoryManager(base_dir=base_dir, backend=backend)
+            session_ids = [f"bench-{i}" for i in range(sessions)]
+            for session_id in session_ids:
+                manager.create_session(session_id, user_id, agent_type)
+
+            append_times = []
+            for n in range(messages):
+                for session_id in session_ids:
+                    role = "user" if n % 2 == 0 else "assistant"
+                    started = time.perf_counter()
+                    manager.save_message(session_id, user_id, agent_type, role, f"消息內容 message {n} " * 8)
+                    append_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for _ in range(100):
+                manager.get_sessions(user_id, agent_type)
+            list_time = (time.perf_counter() - started) / 100
+
+            started = time.perf_counter()
+            for session_id in session_ids:
+                manager.get_messages(session_id, user_id, agent_type)
+            read_time = (time.perf_counter() - started) / len(session_ids)
+
+            manager.storage.close()
+
+        return {
+            "backend": backend,
+            "appends": len(append_times),
+            "append_avg_ms": sum(append_times) / len(append_times) * 1000,
+            "append_p95_ms": _percentile(append_times, 0.95) * 1000,
+            "append_last_ms": sum(append_times[-len(session_ids):]) / len(session_ids) * 1000,
+            "list_sessions_ms": list_time * 1000,
+            "read_transcript_ms": read_time * 1000,
+        }
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def run_layout(sharded: bool, files: int, lookups: int = 2000, user_id: int = 1,
+               agent_type: str = "mental_health") -> Dict[str, Any]:
+    """在臨時目錄中生成大量會話文件，測量查找、所在目錄列出和完整遍歷（備份）耗時"""
+    base_dir = tempfile.mkdtemp(prefix=f"chat_layout_{'sharded' if sharded else 'flat'}_")
+    try:
+        storage = JSONLFileStorage(base_dir, sharded=sharded)
+        session_ids = [f"layout-{i:07d}" for i in range(files)]
+        line = b'{"id": 1, "role": "user", "content": "hi", "created_at": "2024-01-01T00:00:00"}\n'
+
+        started = time.perf_counter()
+        for session_id in session_ids:
+            path = storage.transcript_path(session_id, user_id, agent_type)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(line)
+        create_time = time.perf_counter() - started
+
+        sample = random.sample(session_ids, min(lookups, files))
+        started = time.perf_counter()
+        for session_id in sample:
+            storage.load_recent_messages(session_id, user_id, agent_type, 1)
+        lookup_time = (time.perf_counter() - started) / len(sample)
+
+        # 列出單個會話文件所在的目錄（平鋪時是整個 agent_type 目錄）
+        started = time.perf_counter()
+        for session_id in sample[:100]:
+            sum(1 for _ in os.scandir(storage.transcript_path(session_id, user_id, agent_type).parent))
+        list_dir_time = (time.perf_counter() - started) / len(sample[:100])
+
+        started = time.perf_counter()
+        walked = sum(len(names) for _, _, names in os.walk(base_dir))
+        walk_time = time.perf_counter() - started
+
+        return {
+            "layout": "sharded" if sharded else "flat",
+            "files": walked,
+            "create_s": create_time,
+            "lookup_ms": lookup_time * 1000,
+            "list_dir_ms": list_dir_time * 1000,
+            "walk_s": walk_time,
+        }
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def run_compression(backend: str, sessions: int, messages: int, reads: int = 20, user_id: int = 1,
+                    agent_type: str = "mental_health") -> Dict[str, Any]:
+    """寫入會話後全部移入壓縮層，比較壓縮前後的磁盤佔用和整段記錄讀取耗時"""
+    base_dir = tempfile.mkdtemp(prefix=f"chat_compress_{backend}_")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = ChatHistoryManager(base_dir, backend=backend, write_behind=False, transcript_cache_bytes=0)
+            session_ids = [f"compress-{i}" for i in range(sessions)]
+            for session_id in session_ids:
+                manager.create_session(session_id, user_id, agent_type)
+                for i in range(messages):
+                    manager.save_message(session_id, user_id, agent_type, "user" if i % 2 == 0 else "assistant",
+                                         f"今天有點焦慮，第 {i} 條消息，想聊聊最近的學習壓力和睡眠問題。")
+        storage = manager.storage
+
+        def read_all() -> List[float]:
+            timings = []
+            for _ in range(reads):
+                for session_id in session_ids:
+                    started = time.perf_counter()
+                    storage.load_messages(session_id, user_id, agent_type)
+                    timings.append(time.perf_counter() - started)
+            return timings
+
+        plain_reads = read_all()
+        before = after = 0
+        started = time.perf_counter()
+        for session_id in session_ids:
+            result = manager.compress_session(session_id, user_id, agent_type)
+            if result is not None:
+                before += result[0]
+                after += result[1]
+        compress_time = (time.perf_counter() - started) / sessions
+        compressed_reads = read_all()
+
+        # 再次寫入時解壓回明文的耗時
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for session_id in session_ids:
+                manager.save_message(session_id, user_id, agent_type, "user", "又回來了")
+        promote_time = (time.perf_counter() - started) / sessions
+        manager.close()
+
+        return {
+            "backend": backend,
+            "bytes_before": before,
+            "bytes_after": after,
+            "compress_ms": compress_time * 1000,
+            "plain_read_ms": sum(plain_reads) / len(plain_reads) * 1000,
+            "compressed_read_ms": sum(compressed_reads) / len(compressed_reads) * 1000,
+            "compressed_read_p95_ms": _percentile(compressed_reads, 0.95) * 1000,
+            "promote_ms": promote_time * 1000,
+        }
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat history storage backends")
+    parser.add_argument("--sessions", type=int, default=20, help="number of sessions")
+    parser.add_argument("--messages", type=int, default=200, help="messages per session")
+    parser.add_argument("--backends", nargs="+", default=["json", "jsonl", "sqlite"], help="backends to compare")
+    parser.add_argument("--layout-files", type=int, default=0, help="compare flat vs sharded layout with this many transcripts")
+    parser.add_argument("--compression", action="store_true", help="measure space saved and read latency of the compressed tier")
+    args = parser.parse_args()
+
+    if args.compression:
+        print(f"📊 Compressed tier benchmark: {args.sessions} sessions x {args.messages} messages")
+        header = (f"{'backend':<10}{'before':>10}{'after':>10}{'saved':>8}{'compress':>11}"
+                  f"{'read':>10}{'read gz':>10}{'gz p95':>10}{'promote':>11}")
+        print(header)
+        print("-" * len(header))
+        for backend in [b for b in args.backends if b != "sqlite"]:
+            r = run_compression(backend, args.sessions, args.messages)
+            saved = 1 - r["bytes_after"] / r["bytes_before"] if r["bytes_before"] else 0.0
+            print(f"{r['backend']:<10}{r['bytes_before'] // 1024:>8}KB{r['bytes_after'] // 1024:>8}KB{saved:>8.0%}"
+                  f"{r['compress_ms']:>9.3f}ms{r['plain_read_ms']:>8.3f}ms{r['compressed_read_ms']:>8.3f}ms"
+                  f"{r['compressed_read_p95_ms']:>8.3f}ms{r['promote_ms']:>9.3f}ms")
+        return
+
+    if args.layout_files:
+        print(f"📊 Directory layout benchmark: {args.layout_files} transcripts")
+        header = f"{'layout':<10}{'create':>10}{'lookup':>12}{'list dir':>12}{'walk':>10}"
+        print(header)
+        print("-" * len(header))
+        for sharded in (False, True):
+            r = run_layout(sharded, args.layout_files)
+            print(f"{r['layout']:<10}{r['create_s']:>9.2f}s{r['lookup_ms']:>10.3f}ms"
+                  f"{r['list_dir_ms']:>10.3f}ms{r['walk_s']:>9.2f}s")
+        return
+
+    print(f"📊 Chat history benchmark: {args.sessions} sessions x {args.messages} messages")
+    header = f"{'backend':<10}{'append avg':>12}{'append p95':>12}{'append last':>13}{'list':>10}{'read':>10}"
+    print(header)
+    print("-" * len(header))
+    for backend in args.backends:
+        r = run_backend(backend, args.sessions, args.messages)
+        print(f"{r['backend']:<10}{r['append_avg_ms']:>10.3f}ms{r['append_p95_ms']:>10.3f}ms"
+              f"{r['append_last_ms']:>11.3f}ms{r['list_sessions_ms']:>8.3f}ms{r['read_transcript_ms']:>8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
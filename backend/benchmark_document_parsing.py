@@ -0,0 +1,200 @@
+"""
+Document parsing benchmark
+Compares the old in-process PDF extraction (sequential PyPDF2 on the event loop) with
+DocumentParserPool at several worker counts: pages per second, and the longest stall
+of the event loop while parsing (what every chat stream on the server would feel).
+With --pipeline-memory it instead compares the peak Python memory of the whole-text
+ingestion path (join, clean, split into a chunk list) with the streaming page pipeline
+(page spool -> cleaned segments -> chunks -> embedding batches), embedding excluded.
+
+Usage: python benchmark_document_parsing.py --pages 400
+       python benchmark_document_parsing.py --pdf book.pdf --workers 1 2 4
+       python benchmark_document_parsing.py --pages 1000 --pipeline-memory
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+from document_parsing import DocumentParserPool, parse_pdf_pages
+from document_streaming import CLEAN_TEXT_PATTERN, PageSpool, iter_batches, iter_clean_segments, iter_fixed_chunks
+
+SAMPLE_LINE = ("Stress management for students: sleep, exercise, breathing practice and asking "
+               "for help early all reduce anxiety during exams. ")
+
+
+def write_sample_pdf(path: str, pages: int, lines_per_page: int = 45):
+    """Write a text-only PDF (Helvetica, no compression) with `pages` pages"""
+    def escape(text: str) -> str:
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects: List[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # page tree, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(pages):
+        lines = [escape(f"Page {page + 1} line {line + 1}: {SAMPLE_LINE[:90]}") for line in range(lines_per_page)]
+        stream = ("BT /F1 9 Tf 11 TL 40 760 Td " + " T* ".join(f"({line}) Tj" for line in lines) + " ET").encode("latin-1")
+        content_number = len(objects) + 2
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_number} 0 R >>".encode("latin-1")
+        )
+        kids.append(f"{len(objects)} 0 R")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode("latin-1")
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n" % (len(objects) + 1))
+        f.write(b"0000000000 65535 f \n")
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+
+
+def extract_pdf_inline(file_path: str) -> str:
+    """The previous implementation: sequential parsing with string concatenation"""
+    import PyPDF2
+
+    text = ""
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for page in pdf_reader.pages:
+            text += page.extract_text() + "\n"
+    return text
+
+
+async def _measure(parse, interval: float = 0.005) -> Dict[str, Any]:
+    """Run parse() while a heartbeat task records the longest gap between its ticks"""
+    max_lag = 0.0
+    done = False
+
+    async def heartbeat():
+        nonlocal max_lag
+        while not done:
+            before = time.perf_counter()
+            await asyncio.sleep(interval)
+            max_lag = max(max_lag, time.perf_counter() - before - interval)
+
+    ticker = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    text = await parse()
+    elapsed = time.perf_counter() - started
+    done = True
+    await ticker
+    return {"seconds": elapsed, "max_loop_lag_ms": max_lag * 1000, "chars": len(text)}
+
+
+async def run(pdf_path: str, pages: int, worker_counts: List[int], pages_per_task: int) -> List[Dict[str, Any]]:
+    results = []
+
+    async def inline():
+        # Declared async but never awaits inside: exactly how the old _extract_pdf behaved
+        return extract_pdf_inline(pdf_path)
+
+    r = await _measure(inline)
+    results.append({"path": "inline", **r})
+
+    for workers in worker_counts:
+        pool = DocumentParserPool(max_workers=workers, timeout_seconds=600, pages_per_task=pages_per_task)
+        try:
+            # Start the worker processes outside the measurement
+            await pool.extract_pdf(pdf_path)
+            r = await _measure(lambda: pool.extract_pdf(pdf_path))
+            results.append({"path": f"pool x{workers}", **r})
+        finally:
+            pool.close()
+
+    for r in results:
+        r["pages_per_second"] = pages / r["seconds"] if r["seconds"] else 0.0
+    return results
+
+
+async def run_pipeline_memory(pdf_path: str, batch_size: int = 64) -> List[Dict[str, Any]]:
+    """Peak traced memory of each ingestion path; chunks are consumed in batches as the vector DB would"""
+    pool = DocumentParserPool(max_workers=2, timeout_seconds=600)
+
+    async def whole_text():
+        text = await pool.extract_pdf(pdf_path)
+        cleaned = CLEAN_TEXT_PATTERN.sub('', ' '.join(text.split())).strip()
+        chunks = [{"text": chunk, "start_index": start, "end_index": end}
+                  for chunk, start, end, _ in iter_fixed_chunks([cleaned])]
+        return sum(len(batch) for batch in iter_batches(chunks, batch_size))
+
+    async def streaming():
+        spool = PageSpool(os.path.dirname(pdf_path))
+        try:
+            async for page in pool.iter_pdf_pages(pdf_path):
+                spool.append(page)
+            chunks = ({"text": chunk, "start_index": start, "end_index": end}
+                      for chunk, start, end, _ in iter_fixed_chunks(iter_clean_segments(spool)))
+            return sum(len(batch) for batch in iter_batches(chunks, batch_size))
+        finally:
+            spool.close()
+
+    results = []
+    try:
+        # Start the worker processes outside the measurement
+        await pool.extract_pdf(pdf_path)
+        for name, ingest in (("whole text", whole_text), ("streaming", streaming)):
+            tracemalloc.start()
+            started = time.perf_counter()
+            chunk_count = await ingest()
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append({"path": name, "seconds": elapsed, "peak_kb": peak / 1024, "chunks": chunk_count})
+    finally:
+        pool.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PDF parsing: in-process vs process pool")
+    parser.add_argument("--pdf", help="PDF to parse (default: generate a text-only sample)")
+    parser.add_argument("--pages", type=int, default=200, help="pages of the generated sample")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="pool sizes to compare")
+    parser.add_argument("--pages-per-task", type=int, default=16, help="PDF pages per pool task")
+    parser.add_argument("--pipeline-memory", action="store_true", help="compare peak memory of whole-text vs streaming ingestion")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="parse_bench_") as tmp:
+        pdf_path = args.pdf
+        if pdf_path is None:
+            pdf_path = os.path.join(tmp, "sample.pdf")
+            write_sample_pdf(pdf_path, args.pages)
+        pages = parse_pdf_pages(pdf_path, 0, 0)[0]
+
+        if args.pipeline_memory:
+            print(f"📊 Ingestion memory benchmark: {pages} pages, {os.path.getsize(pdf_path) // 1024}KB")
+            header = f"{'path':<12}{'seconds':>10}{'chunks':>10}{'peak memory':>14}"
+            print(header)
+            print("-" * len(header))
+            for r in asyncio.run(run_pipeline_memory(pdf_path)):
+                print(f"{r['path']:<12}{r['seconds']:>10.2f}{r['chunks']:>10}{r['peak_kb']:>12.0f}KB")
+            return
+
+        print(f"📊 PDF parsing benchmark: {pages} pages, {os.path.getsize(pdf_path) // 1024}KB, "
+              f"{os.cpu_count()} CPUs, {args.pages_per_task} pages per task")
+        header = f"{'path':<10}{'seconds':>10}{'pages/s':>10}{'max loop stall':>16}"
+        print(header)
+        print("-" * len(header))
+        for r in asyncio.run(run(pdf_path, pages, args.workers, args.pages_per_task)):
+            print(f"{r['path']:<10}{r['seconds']:>10.2f}{r['pages_per_second']:>10.1f}{r['max_loop_lag_ms']:>14.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Rate limiter benchmark
+Measures the per-request cost of RateLimiter.check for the in-memory and shared SQLite
+bucket stores (single thread and concurrent threads), and checks that the shared store
+enforces one limit across worker processes.
+
+Usage: python benchmark_rate_limiter.py --requests 200000 --identities 10000
+       python benchmark_rate_limiter.py --threads 8 --workers 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List
+
+from rate_limiter import RateLimiter, RateLimitPolicy, MemoryBucketStore, SQLiteBucketStore
+
+ROUTE = "POST /api/v1/chat/stream"
+
+
+def _percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def _make_store(backend: str, db_path: str):
+    return SQLiteBucketStore(db_path) if backend == "sqlite" else MemoryBucketStore()
+
+
+def run_overhead(backend: str, requests: int, identities: int, threads: int, db_path: str) -> Dict[str, Any]:
+    """Time `requests` checks spread over `identities` users/IPs, split across `threads`"""
+    policy = RateLimitPolicy(20, 60)
+    limiter = RateLimiter({ROUTE: {"user": policy, "ip": policy}}, _make_store(backend, db_path))
+    per_thread = requests // threads
+    latencies: List[List[float]] = [[] for _ in range(threads)]
+
+    def worker(index: int):
+        samples = latencies[index]
+        for i in range(per_thread):
+            identity = (index * per_thread + i) % identities
+            started = time.perf_counter()
+            limiter.check(ROUTE, identity, f"10.0.{identity // 256 % 256}.{identity % 256}")
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    samples = [s for thread_samples in latencies for s in thread_samples]
+    return {
+        "backend": backend,
+        "threads": threads,
+        "checks": len(samples),
+        "checks_per_second": len(samples) / elapsed if elapsed else 0.0,
+        "avg_us": sum(samples) / len(samples) * 1e6 if samples else 0.0,
+        "p99_us": _percentile(samples, 0.99) * 1e6,
+    }
+
+
+def _burst(db_path: str, attempts: int, capacity: int, allowed_counter):
+    limiter = RateLimiter({ROUTE: {"user": RateLimitPolicy(capacity, 3600)}}, SQLiteBucketStore(db_path))
+    allowed = sum(1 for _ in range(attempts) if limiter.check(ROUTE, user_id=1).allowed)
+    with allowed_counter.get_lock():
+        allowed_counter.value += allowed
+
+
+def run_shared(workers: int, capacity: int, db_path: str) -> Dict[str, Any]:
+    """Every worker process bursts on the same user; together they must get exactly `capacity` requests"""
+    allowed_counter = multiprocessing.Value("i", 0)
+    processes = [
+        multiprocessing.Process(target=_burst, args=(db_path, capacity, capacity, allowed_counter))
+        for _ in range(workers)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    return {"workers": workers, "attempts": workers * capacity, "allowed": allowed_counter.value, "capacity": capacity}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the token-bucket rate limiter")
+    parser.add_argument("--requests", type=int, default=100_000, help="checks per run")
+    parser.add_argument("--identities", type=int, default=10_000, help="distinct users / IPs")
+    parser.add_argument("--threads", type=int, default=4, help="threads for the concurrent run")
+    parser.add_argument("--workers", type=int, default=4, help="processes for the shared-store check")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="rate_bench_") as tmp:
+        print(f"📊 Rate limiter overhead: {args.requests} checks over {args.identities} identities (user + IP bucket each)")
+        header = f"{'backend':<10}{'threads':>8}{'checks/s':>12}{'avg':>10}{'p99':>10}"
+        print(header)
+        print("-" * len(header))
+        for backend in ("memory", "sqlite"):
+            for threads in (1, args.threads):
+                db_path = os.path.join(tmp, f"{backend}_{threads}.db")
+                r = run_overhead(backend, args.requests, args.identities, threads, db_path)
+                print(f"{r['backend']:<10}{r['threads']:>8}{r['checks_per_second']:>12.0f}"
+                      f"{r['avg_us']:>8.1f}us{r['p99_us']:>8.1f}us")
+
+        r = run_shared(args.workers, 50, os.path.join(tmp, "shared.db"))
+        status = "✅" if r["allowed"] == r["capacity"] else "❌"
+        print(f"{status} Shared SQLite store: {r['workers']} workers made {r['attempts']} requests, "
+              f"{r['allowed']} allowed (capacity {r['capacity']})")
+
+
+if __name__ == "__main__":
+    main()
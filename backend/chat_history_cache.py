@@ -0,0 +1,221 @@
+"""
+聊天記錄內存索引與緩存
+SessionIndex: 按 (user_id, agent_type) 索引會話，會話校驗與列表不再讀磁盤
+TranscriptCache: 按字節數限制大小的 LRU 聊天記錄緩存，活躍會話的讀取不再讀磁盤
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+GroupKey = Tuple[int, str]          # (user_id, agent_type)
+MessageKey = Tuple[str, int, str]   # (session_id, user_id, agent_type)
+SessionCursor = Tuple[str, str]     # (updated_at, session_id)
+
+
+def session_sort_key(session: Dict[str, Any]) -> SessionCursor:
+    """會話排序鍵：updated_at 相同時按 session_id 決勝，分頁遊標與排序一致"""
+    return session.get("updated_at", ""), session.get("session_id", "")
+
+
+class SessionIndex:
+    """
+    會話內存索引 - 首次訪問某個 (user_id, agent_type) 時從存儲載入，之後在創建/刪除/更新時同步維護。
+    以組為單位做 LRU 淘汰，最多保留 max_groups 組，內存有上限。
+
+    索引是進程內的：多個 worker 共用存儲時，其他 worker 創建的會話在 contains 未命中時
+    回查存儲補進索引，不會重複創建；其他 worker 刪除的會話要等該組被淘汰或 invalidate 後才消失。
+    """
+
+    def __init__(self, max_groups: int = 10000):
+        self.max_groups = max_groups
+        self._groups: "OrderedDict[GroupKey, Dict[str, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _group(self, user_id: int, agent_type: str,
+               loader: Callable[[], List[Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+        """獲取（必要時載入）一組會話"""
+        key = (user_id, agent_type)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None:
+                self._groups.move_to_end(key)
+                self.hits += 1
+                return group
+
+            # 在鎖內載入，避免載入期間的創建/刪除被舊數據覆蓋（每組只載入一次）
+            self.misses += 1
+            group = {s["session_id"]: dict(s) for s in loader()}
+            self._groups[key] = group
+            self._evict()
+            return group
+
+    def _evict(self):
+        while len(self._groups) > self.max_groups:
+            self._groups.popitem(last=False)
+
+    def contains(self, session_id: str, user_id: int, agent_type: str,
+                 loader: Callable[[], List[Dict[str, Any]]]) -> bool:
+        """O(1) 判斷會話是否存在；未命中時回查存儲（會話可能由其他 worker 創建）"""
+        group = self._group(user_id, agent_type, loader)
+        if session_id in group:
+            return True
+        stored = {s["session_id"]: s for s in loader()}
+        with self._lock:
+            for sid, session in stored.items():
+                group.setdefault(sid, dict(session))
+        return session_id in stored
+
+    def list(self, user_id: int, agent_type: str,
+             loader: Callable[[], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """會話列表（按 updated_at 倒序）"""
+        group = self._group(user_id, agent_type, loader)
+        with self._lock:
+            sessions = [dict(s) for s in group.values()]
+        sessions.sort(key=session_sort_key, reverse=True)
+        return sessions
+
+    def page(self, user_id: int, agent_type: str, loader: Callable[[], List[Dict[str, Any]]],
+             cursor: Optional[SessionCursor] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """按 (updated_at, session_id) 倒序的一頁會話，從遊標之後開始（updated_at 相同的會話不會被跳過）"""
+        sessions = self.list(user_id, agent_type, loader)
+        if cursor is not None:
+            sessions = [s for s in sessions if session_sort_key(s) < cursor]
+        return sessions[:limit]
+
+    def add(self, session: Dict[str, Any]):
+        """創建會話後同步索引（組未載入時等下次載入即可）"""
+        key = (session["user_id"], session["agent_type"])
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None:
+                group[session["session_id"]] = dict(session)
+
+    def remove(self, session_id: str, user_id: int, agent_type: str):
+        with self._lock:
+            group = self._groups.get((user_id, agent_type))
+            if group is not None:
+                group.pop(session_id, None)
+
+    def touch(self, session_ids: List[str], user_id: int, agent_type: str, updated_at: str):
+        with self._lock:
+            group = self._groups.get((user_id, agent_type))
+            if group is None:
+                return
+            for session_id in session_ids:
+                session = group.get(session_id)
+                if session is not None:
+                    session["updated_at"] = updated_at
+
+    def invalidate(self, user_id: Optional[int] = None, agent_type: Optional[str] = None):
+        """丟棄索引（全部或指定組），下次訪問重新載入"""
+        with self._lock:
+            if user_id is None:
+                self._groups.clear()
+                return
+            self._groups.pop((user_id, agent_type), None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "groups": len(self._groups),
+                "sessions": sum(len(group) for group in self._groups.values()),
+                "max_groups": self.max_groups,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class TranscriptCache:
+    """
+    最近活躍會話的聊天記錄緩存 - 按估算字節數做 LRU 淘汰。
+    保存消息時直接追加到已緩存的記錄（write-through），活躍會話的讀取不再打開文件。
+    """
+
+    # 每條消息除內容外的估算開銷（dict、時間戳、角色等）
+    MESSAGE_OVERHEAD_BYTES = 256
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # 單個記錄最多佔用緩存的四分之一，避免一個超長會話擠掉所有活躍會話
+        self.max_entry_bytes = max_bytes // 4
+        self._entries: "OrderedDict[MessageKey, Tuple[List[Dict[str, Any]], int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def _message_size(cls, message: Dict[str, Any]) -> int:
+        return len(str(message.get("content", "")).encode("utf-8")) + cls.MESSAGE_OVERHEAD_BYTES
+
+    def get(self, key: MessageKey) -> Optional[List[Dict[str, Any]]]:
+        """命中時返回記錄副本，未命中返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[0])
+
+    def put(self, key: MessageKey, messages: List[Dict[str, Any]]):
+        """緩存整個記錄（從存儲讀取後調用）"""
+        size = sum(self._message_size(m) for m in messages)
+        with self._lock:
+            self._discard(key)
+            if size > self.max_entry_bytes:
+                return
+            self._entries[key] = (list(messages), size)
+            self._bytes += size
+            self._evict()
+
+    def append(self, key: MessageKey, messages: List[Dict[str, Any]]):
+        """把新保存的消息追加到已緩存的記錄；未緩存的會話等下次讀取時再載入"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            cached, size = entry
+            cached.extend(messages)
+            added = sum(self._message_size(m) for m in messages)
+            self._entries[key] = (cached, size + added)
+            self._entries.move_to_end(key)
+            self._bytes += added
+            if size + added > self.max_entry_bytes:
+                self._discard(key)
+            self._evict()
+
+    def invalidate(self, key: MessageKey):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: MessageKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "transcripts": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
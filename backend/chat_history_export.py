@@ -0,0 +1,210 @@
+"""
+聊天記錄批量導出
+按用戶、agent_type 和時間範圍流式導出多個會話，輸出 NDJSON 或 zip（每個會話一個 NDJSON 文件）。
+每個記錄只遍歷一次，消息流式讀取並立即輸出，內存佔用與導出規模無關；HTTP 接口直接流式返回，不在磁盤生成臨時文件。
+
+用法: python chat_history_export.py --format ndjson --output export.ndjson --user-id 1
+      python chat_history_export.py --format zip --output export.zip --agent-type mental_health --since 2024-01-01
+"""
+
+import argparse
+import contextlib
+import json
+import sys
+import time
+import zipfile
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+# 每次從存儲讀取的消息數
+EXPORT_CHUNK = 500
+
+EXPORT_FORMATS = ("ndjson", "zip")
+
+
+class _ZipStream:
+    """zipfile 的只寫、不可 seek 輸出對象：寫入的數據暫存在內存，由導出生成器逐塊取走"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ChatExporter:
+    """
+    流式導出器 - 依次遍歷符合條件的會話，消息經存儲的 iter_messages 流式讀取（SQLite 每塊 EXPORT_CHUNK 條）。
+    since / until 按消息 created_at 過濾（since <= created_at < until）；
+    沒有符合條件消息的會話不輸出。導出完成後 report 中記錄數量與吞吐量。
+    """
+
+    def __init__(self, storage, user_ids: Optional[List[int]] = None, agent_type: Optional[str] = None,
+                 since: Optional[str] = None, until: Optional[str] = None):
+        self.storage = storage
+        self.user_ids = set(user_ids) if user_ids else None
+        self.agent_type = agent_type
+        self.since = since
+        self.until = until
+        self.report: Dict[str, Any] = {
+            "sessions": 0,
+            "messages": 0,
+            "bytes": 0,
+            "started_at": None,
+            "duration_ms": 0.0,
+            "messages_per_second": 0.0,
+            "mb_per_second": 0.0,
+        }
+
+    def _sessions(self) -> Iterator[Dict[str, Any]]:
+        for user_id, agent_type in self.storage.list_session_groups():
+            if self.user_ids is not None and user_id not in self.user_ids:
+                continue
+            if self.agent_type is not None and agent_type != self.agent_type:
+                continue
+            for session in self.storage.list_sessions(user_id, agent_type):
+                # 會話最後更新早於 since 或創建不早於 until 時不可能有符合條件的消息
+                if self.since is not None and session.get("updated_at", "") < self.since:
+                    continue
+                if self.until is not None and session.get("created_at", "") >= self.until:
+                    continue
+                session.setdefault("user_id", user_id)
+                session.setdefault("agent_type", agent_type)
+                yield session
+
+    def _messages(self, session: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        # 每個記錄只遍歷一次：SQLite 按主鍵分塊查詢，JSONL 逐行流式解析，JSON 整個文件解析一次
+        for message in self.storage.iter_messages(session["session_id"], session["user_id"],
+                                                  session["agent_type"], EXPORT_CHUNK):
+            created_at = message.get("created_at", "")
+            if self.since is not None and created_at < self.since:
+                continue
+            if self.until is not None and created_at >= self.until:
+                continue
+            yield message
+
+    @staticmethod
+    def _line(record: Dict[str, Any]) -> bytes:
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _session_lines(self, session: Dict[str, Any]) -> Iterator[bytes]:
+        """一個會話的 NDJSON 行：先輸出會話信息（遇到第一條符合條件的消息時），再逐條輸出消息"""
+        header_sent = False
+        for message in self._messages(session):
+            if not header_sent:
+                self.report["sessions"] += 1
+                header_sent = True
+                yield self._line({"type": "session", **session})
+            self.report["messages"] += 1
+            yield self._line({
+                "type": "message",
+                "session_id": session["session_id"],
+                "user_id": session["user_id"],
+                "agent_type": session["agent_type"],
+                **message
+            })
+
+    def _start(self) -> float:
+        self.report["started_at"] = datetime.now().isoformat()
+        return time.perf_counter()
+
+    def _finish(self, started: float) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - started
+        self.report["duration_ms"] = round(elapsed * 1000, 3)
+        if elapsed > 0:
+            self.report["messages_per_second"] = round(self.report["messages"] / elapsed, 1)
+            self.report["mb_per_second"] = round(self.report["bytes"] / elapsed / 1024 / 1024, 3)
+        self.report["filters"] = {
+            "user_ids": sorted(self.user_ids) if self.user_ids is not None else None,
+            "agent_type": self.agent_type,
+            "since": self.since,
+            "until": self.until,
+        }
+        print(f"📤 批量導出: {self.report['sessions']} 個會話, {self.report['messages']} 條消息, "
+              f"{self.report['messages_per_second']:.0f} 條/秒")
+        return self.report
+
+    def iter_ndjson(self) -> Iterator[bytes]:
+        """NDJSON：會話行和消息行交替，最後一行為 type=summary 的導出報告"""
+        started = self._start()
+        for session in self._sessions():
+            for line in self._session_lines(session):
+                self.report["bytes"] += len(line)
+                yield line
+        yield self._line({"type": "summary", **self._finish(started)})
+
+    def iter_zip(self) -> Iterator[bytes]:
+        """zip：每個會話一個 {agent_type}/{user_id}/{session_id}.ndjson，最後寫入 manifest.json"""
+        started = self._start()
+        stream = _ZipStream()
+        with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for session in self._sessions():
+                lines = self._session_lines(session)
+                first = next(lines, None)
+                if first is None:
+                    continue
+                name = f"{session['agent_type']}/{session['user_id']}/{session['session_id']}.ndjson"
+                # 大小未知，使用 zip64 記錄，單個會話超過 2GB 也可寫入
+                with archive.open(name, "w", force_zip64=True) as entry:
+                    entry.write(first)
+                    for line in lines:
+                        entry.write(line)
+                        data = stream.drain()
+                        if data:
+                            self.report["bytes"] += len(data)
+                            yield data
+                data = stream.drain()
+                self.report["bytes"] += len(data)
+                yield data
+            report = self._finish(started)
+            archive.writestr("manifest.json", json.dumps(report, ensure_ascii=False, indent=2))
+        yield stream.drain()
+
+    def iter_bytes(self, export_format: str) -> Iterator[bytes]:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"不支持的導出格式: {export_format}")
+        return self.iter_zip() if export_format == "zip" else self.iter_ndjson()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a bulk export of chat history")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson", help="output format")
+    parser.add_argument("--output", default="-", help="output file ('-' for stdout)")
+    parser.add_argument("--user-id", type=int, action="append", help="only export this user (repeatable)")
+    parser.add_argument("--agent-type", help="only export this agent type")
+    parser.add_argument("--since", help="only messages created at or after this ISO time")
+    parser.add_argument("--until", help="only messages created before this ISO time")
+    args = parser.parse_args()
+
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    # 日誌輸出到 stderr，stdout 只留給導出數據
+    with contextlib.redirect_stdout(sys.stderr):
+        from chat_history_manager import chat_history_manager
+
+        exporter = chat_history_manager.bulk_export(args.user_id, args.agent_type, args.since, args.until)
+        try:
+            for chunk in exporter.iter_bytes(args.format):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        print(json.dumps(exporter.report, ensure_ascii=False, indent=2))
+        chat_history_manager.close()
+
+
+if __name__ == "__main__":
+    main()
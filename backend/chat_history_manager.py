@@ -1,16 +1,54 @@
 import json
 import os
+import threading
 import uuid
+from contextlib import ExitStack
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from pathlib import Path
 
+from chat_history_cache import SessionIndex, TranscriptCache, session_sort_key
+from chat_history_export import ChatExporter
+from chat_history_retention import RetentionIndex, RetentionScheduler
+from chat_history_search import ChatSearchIndex
+from chat_history_stats import create_stats_store
+from chat_history_storage import create_storage
+from chat_history_write_behind import WriteBehindStorage
+
+# 聊天記錄鎖的分段數：不同會話大多落在不同分段，一個大記錄的冷載入不會阻塞其他用戶
+TRANSCRIPT_LOCK_STRIPES = 64
+
 class ChatHistoryManager:
-    """聊天記錄管理器 - 按session_id和user_id分別保存到不同JSON文件"""
+    """聊天記錄管理器 - 按session_id和user_id分別保存，存儲後端可選 JSON 文件或 SQLite"""
     
-    def __init__(self, base_dir: str = "chat_history"):
+    def __init__(self, base_dir: str = "chat_history", backend: str = "json", write_behind: bool = False,
+                 session_index_groups: int = 10000, transcript_cache_bytes: int = 64 * 1024 * 1024,
+                 sharded: bool = False):
         self.base_dir = Path(base_dir)
         self.base_dir.mkdir(exist_ok=True)
+        self.storage = create_storage(backend, self.base_dir, sharded=sharded)
+        self.file_storage = self.storage if backend in ("json", "jsonl") else None
+        
+        # 會話內存索引：校驗與列表不再讀會話列表文件
+        self.session_index = SessionIndex(max_groups=session_index_groups)
+        # 刪除計數：長連接緩存已校驗的會話，計數變化時丟棄緩存重新校驗
+        self.sessions_deleted = 0
+        
+        # 活躍會話聊天記錄緩存（按字節數 LRU），保存消息時同步追加
+        self.transcript_cache = TranscriptCache(max_bytes=transcript_cache_bytes)
+        # 按會話分段串行化「未命中時載入並緩存」與「追加並寫入緩存」，避免緩存到舊記錄
+        self._transcript_lock_stripes = [threading.RLock() for _ in range(TRANSCRIPT_LOCK_STRIPES)]
+        
+        # 增量維護的統計計數器（SQLite 後端時與聊天記錄同庫）；首次啟用時從現有記錄重建
+        self.stats = create_stats_store(backend, self.base_dir, getattr(self.storage, "db_path", None))
+        
+        # 按 updated_at 排序的全局會話索引（保留策略使用，首輪維護時載入）
+        self.retention_index = RetentionIndex()
+        self.maintenance: Optional[RetentionScheduler] = None
+        
+        # 全文搜索索引：SQLite 後端與聊天記錄同庫（FTS5），文件後端使用獨立的索引庫
+        search_db = self.storage.db_path if backend == "sqlite" else self.base_dir / "chat_search.db"
+        self.search_index = ChatSearchIndex(search_db)
         
         # 創建agent_type子目錄
         self.agent_types = [
@@ -20,26 +58,34 @@ class ChatHistoryManager:
             "content_creation"
         ]
         
-        for agent_type in self.agent_types:
-            agent_dir = self.base_dir / agent_type
-            agent_dir.mkdir(exist_ok=True)
-    
-    def _get_chat_file_path(self, session_id: str, user_id: int, agent_type: str) -> Path:
-        """獲取聊天記錄文件路徑"""
-        # 格式: chat_history/{agent_type}/{user_id}_{session_id}.json
-        filename = f"{user_id}_{session_id}.json"
-        return self.base_dir / agent_type / filename
-    
-    def _get_session_file_path(self, user_id: int, agent_type: str) -> Path:
-        """獲取會話列表文件路徑"""
-        # 格式: chat_history/{agent_type}/sessions_{user_id}.json
-        filename = f"sessions_{user_id}.json"
-        return self.base_dir / agent_type / filename
+        if backend in ("json", "jsonl"):
+            for agent_type in self.agent_types:
+                agent_dir = self.base_dir / agent_type
+                agent_dir.mkdir(exist_ok=True)
+        
+        # JSONL後端：後台轉換舊的 .json 聊天記錄
+        if backend == "jsonl":
+            self.storage.start_background_compactor()
+        
+        # 分片目錄：後台把平鋪目錄中的文件移入分片目錄，遷移期間讀取回退到舊路徑
+        if self.file_storage is not None and sharded:
+            self.file_storage.start_background_migration()
+        
+        # 寫後緩衝：請求路徑只寫內存隊列，由後台線程分組落盤
+        if write_behind:
+            self.storage = WriteBehindStorage(self.storage)
+        
+        # 首次部署時在後台重建，完成前統計結果帶 rebuilding=True
+        if not self.stats.exists:
+            self.stats.start_background_rebuild(self.storage)
+        
+        # 首次啟用或上次未正常關閉時，由索引線程從存儲補齊
+        if self.search_index.needs_backfill:
+            self.search_index.enqueue_backfill(self.storage)
     
     def create_session(self, session_id: str, user_id: int, agent_type: str, title: Optional[str] = None) -> Dict[str, Any]:
         """創建新的聊天會話"""
         session_data = {
-            "id": self._get_next_session_id(user_id, agent_type),
             "session_id": session_id,
             "user_id": user_id,
             "agent_type": agent_type,
@@ -48,77 +94,125 @@ class ChatHistoryManager:
             "updated_at": datetime.now().isoformat()
         }
         
-        # 保存到對應的會話文件
-        sessions = self._load_sessions(user_id, agent_type)
-        sessions.append(session_data)
-        self._save_sessions(user_id, agent_type, sessions)
+        # 保存到存儲後端（分配會話ID）
+        session_data = self.storage.insert_session(session_data)
+        self.session_index.add(session_data)
+        self.stats.session_created(session_id, user_id, agent_type, session_data["created_at"])
+        self.retention_index.update(user_id, agent_type, [session_id], session_data["updated_at"])
         
         print(f"✅ 創建會話: {session_id} (用戶: {user_id}, 類型: {agent_type})")
         return session_data
     
     def get_sessions(self, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
         """獲取用戶的聊天會話列表（按時間倒序排序）"""
-        sessions = self._load_sessions(user_id, agent_type)
-        # 按updated_at時間倒序排序，最新的在前面
-        sessions.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
-        return sessions
+        return self.session_index.list(user_id, agent_type, self._session_loader(user_id, agent_type))
+    
+    def get_sessions_page(self, user_id: int, agent_type: str, cursor: Optional[str] = None,
+                          limit: int = 20) -> Dict[str, Any]:
+        """
+        分頁獲取會話列表，遊標為本頁最後一個會話的 "updated_at|session_id"，
+        updated_at 相同的會話按 session_id 決勝，翻頁時不會被跳過
+        """
+        sessions = self.session_index.page(user_id, agent_type, self._session_loader(user_id, agent_type),
+                                           self._parse_session_cursor(cursor), limit + 1)
+        has_more = len(sessions) > limit
+        sessions = sessions[:limit]
+        next_cursor = None
+        if has_more:
+            updated_at, session_id = session_sort_key(sessions[-1])
+            next_cursor = f"{updated_at}|{session_id}"
+        return {
+            "sessions": sessions,
+            "has_more": has_more,
+            "next_cursor": next_cursor
+        }
+
+    @staticmethod
+    def _parse_session_cursor(cursor: Optional[str]) -> Optional[Tuple[str, str]]:
+        if not cursor:
+            return None
+        updated_at, _, session_id = cursor.partition("|")
+        return updated_at, session_id
+    
+    def session_exists(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        """判斷會話是否存在（查內存索引）"""
+        return self.session_index.contains(session_id, user_id, agent_type, self._session_loader(user_id, agent_type))
+    
+    def _transcript_lock(self, *keys: Tuple[str, int, str]) -> ExitStack:
+        """鎖住這些會話所在的分段（按分段順序獲取，多會話操作之間不會死鎖）"""
+        stack = ExitStack()
+        for stripe in sorted({hash(key) % TRANSCRIPT_LOCK_STRIPES for key in keys}):
+            stack.enter_context(self._transcript_lock_stripes[stripe])
+        return stack
+    
+    def _session_loader(self, user_id: int, agent_type: str):
+        return lambda: self.storage.list_sessions(user_id, agent_type)
     
     def get_messages(self, session_id: str, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
-        """獲取會話的聊天記錄"""
-        chat_file = self._get_chat_file_path(session_id, user_id, agent_type)
-        
-        if not chat_file.exists():
-            return []
-        
-        try:
-            with open(chat_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get("messages", [])
-        except Exception as e:
-            print(f"❌ 讀取聊天記錄失敗: {e}")
-            return []
+        """獲取會話的聊天記錄（優先讀緩存，未命中時載入並緩存）"""
+        key = (session_id, user_id, agent_type)
+        messages = self.transcript_cache.get(key)
+        if messages is not None:
+            return messages
+        with self._transcript_lock(key):
+            messages = self.storage.load_messages(session_id, user_id, agent_type)
+            self.transcript_cache.put(key, messages)
+        return list(messages)
+    
+    def get_recent_messages(self, session_id: str, user_id: int, agent_type: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """獲取會話最近的消息（用於會話記憶恢復；整個記錄會被載入緩存，之後的讀取不再讀磁盤）"""
+        messages = self.get_messages(session_id, user_id, agent_type)
+        return messages[-limit:] if limit > 0 else []
+    
+    def get_messages_page(self, session_id: str, user_id: int, agent_type: str,
+                          before_id: Optional[int] = None, limit: int = 50) -> Dict[str, Any]:
+        """分頁獲取消息（從新到舊翻頁，頁內按 id 正序），下一頁以本頁第一條消息的 id 作為遊標"""
+        cached = self.transcript_cache.get((session_id, user_id, agent_type))
+        if cached is not None:
+            messages = [m for m in cached if before_id is None or m.get("id", 0) < before_id][-(limit + 1):]
+        else:
+            messages = self.storage.load_messages_before(session_id, user_id, agent_type, before_id, limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[-limit:] if limit > 0 else []
+        return {
+            "messages": messages,
+            "has_more": has_more,
+            "next_before_id": messages[0]["id"] if has_more and messages else None
+        }
+    
+    def get_messages_since(self, session_id: str, user_id: int, agent_type: str,
+                           after_id: int, limit: int = 200) -> Dict[str, Any]:
+        """增量同步：只返回 id 大於 after_id 的消息"""
+        cached = self.transcript_cache.get((session_id, user_id, agent_type))
+        if cached is not None:
+            messages = [m for m in cached if m.get("id", 0) > after_id][:limit + 1]
+        else:
+            messages = self.storage.load_messages_after(session_id, user_id, agent_type, after_id, limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        return {
+            "messages": messages,
+            "has_more": has_more,
+            "last_id": messages[-1]["id"] if messages else after_id
+        }
     
     def save_message(self, session_id: str, user_id: int, agent_type: str, 
                     role: str, content: str, message_id: Optional[int] = None) -> Dict[str, Any]:
         """保存聊天消息"""
-        chat_file = self._get_chat_file_path(session_id, user_id, agent_type)
-        
-        # 創建聊天記錄目錄（如果不存在）
-        chat_file.parent.mkdir(parents=True, exist_ok=True)
-        
-        # 載入現有聊天記錄
-        if chat_file.exists():
-            try:
-                with open(chat_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            except:
-                data = {"session_id": session_id, "user_id": user_id, "agent_type": agent_type, "messages": []}
-        else:
-            data = {"session_id": session_id, "user_id": user_id, "agent_type": agent_type, "messages": []}
-        
-        # 生成消息ID
-        if message_id is None:
-            message_id = self._get_next_message_id(data.get("messages", []))
-        
         # 創建消息對象
         message = {
-            "id": message_id,
             "session_id": session_id,
             "role": role,
             "content": content,
             "created_at": datetime.now().isoformat()
         }
         
-        # 添加消息到聊天記錄
-        data["messages"].append(message)
-        
         # 保存聊天記錄
         try:
-            with open(chat_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            message = self._append((session_id, user_id, agent_type), [message], first_id=message_id)[0]
         except Exception as e:
             print(f"❌ 保存聊天記錄失敗: {e}")
-            return message
+            return {"id": message_id or 0, **message}
         
         # 更新會話時間
         self._update_session_time(session_id, user_id, agent_type)
@@ -126,6 +220,49 @@ class ChatHistoryManager:
         print(f"💾 保存消息: {role} -> {session_id} (用戶: {user_id})")
         return message
     
+    def save_messages(self, session_id: str, user_id: int, agent_type: str,
+                      messages: List[Tuple[str, str]], update_session: bool = True) -> List[Dict[str, Any]]:
+        """批量保存多條消息（一次寫入存儲後端）"""
+        pending = [
+            {
+                "session_id": session_id,
+                "role": role,
+                "content": content,
+                "created_at": datetime.now().isoformat()
+            }
+            for role, content in messages
+        ]
+        
+        try:
+            saved = self._append((session_id, user_id, agent_type), pending)
+        except Exception as e:
+            print(f"❌ 保存聊天記錄失敗: {e}")
+            return [{"id": 0, **message} for message in pending]
+        
+        if update_session:
+            self._update_session_time(session_id, user_id, agent_type)
+        
+        print(f"💾 批量保存 {len(saved)} 條消息 -> {session_id} (用戶: {user_id})")
+        return saved
+    
+    def _append(self, key: Tuple[str, int, str], messages: List[Dict[str, Any]],
+                first_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """追加到存儲後端並同步寫入緩存"""
+        with self._transcript_lock(key):
+            saved = self.storage.append_messages(*key, messages, first_id=first_id)
+            self.transcript_cache.append(key, saved)
+        self.stats.messages_added(*key, saved)
+        self.search_index.enqueue_messages(*key, saved)
+        return saved
+    
+    def touch_sessions(self, session_ids: List[str], user_id: int, agent_type: str):
+        """批量更新多個會話的時間（只寫一次會話列表）"""
+        if session_ids:
+            updated_at = datetime.now().isoformat()
+            self.storage.touch_sessions(list(session_ids), user_id, agent_type, updated_at)
+            self.session_index.touch(list(session_ids), user_id, agent_type, updated_at)
+            self.retention_index.update(user_id, agent_type, list(session_ids), updated_at)
+    
     def save_user_message(self, session_id: str, user_id: int, agent_type: str, content: str) -> Dict[str, Any]:
         """保存用戶消息"""
         return self.save_message(session_id, user_id, agent_type, "user", content)
@@ -134,105 +271,116 @@ class ChatHistoryManager:
         """保存AI回覆消息"""
         return self.save_message(session_id, user_id, agent_type, "assistant", content)
     
-    def _load_sessions(self, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
-        """載入會話列表"""
-        session_file = self._get_session_file_path(user_id, agent_type)
-        
-        if not session_file.exists():
-            return []
-        
-        try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get("sessions", [])
-        except Exception as e:
-            print(f"❌ 讀取會話列表失敗: {e}")
-            return []
-    
-    def _save_sessions(self, user_id: int, agent_type: str, sessions: List[Dict[str, Any]]):
-        """保存會話列表"""
-        session_file = self._get_session_file_path(user_id, agent_type)
-        
-        # 創建目錄（如果不存在）
-        session_file.parent.mkdir(parents=True, exist_ok=True)
-        
-        data = {
-            "user_id": user_id,
-            "agent_type": agent_type,
-            "sessions": sessions
-        }
-        
-        try:
-            with open(session_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"❌ 保存會話列表失敗: {e}")
-    
     def _update_session_time(self, session_id: str, user_id: int, agent_type: str):
         """更新會話時間"""
-        sessions = self._load_sessions(user_id, agent_type)
-        
-        for session in sessions:
-            if session["session_id"] == session_id:
-                session["updated_at"] = datetime.now().isoformat()
-                self._save_sessions(user_id, agent_type, sessions)
-                break
-    
-    def _get_next_session_id(self, user_id: int, agent_type: str) -> int:
-        """獲取下一個會話ID"""
-        sessions = self._load_sessions(user_id, agent_type)
-        if not sessions:
-            return 1
-        return max(session.get("id", 0) for session in sessions) + 1
-    
-    def _get_next_message_id(self, messages: List[Dict[str, Any]]) -> int:
-        """獲取下一個消息ID"""
-        if not messages:
-            return 1
-        return max(message.get("id", 0) for message in messages) + 1
+        self.touch_sessions([session_id], user_id, agent_type)
     
     def delete_session(self, session_id: str, user_id: int, agent_type: str) -> bool:
         """刪除會話及其聊天記錄"""
         try:
-            # 刪除聊天記錄文件
-            chat_file = self._get_chat_file_path(session_id, user_id, agent_type)
-            if chat_file.exists():
-                chat_file.unlink()
-                print(f"🗑️ 刪除聊天記錄: {session_id}")
-            
-            # 從會話列表中移除
-            sessions = self._load_sessions(user_id, agent_type)
-            sessions = [s for s in sessions if s["session_id"] != session_id]
-            self._save_sessions(user_id, agent_type, sessions)
-            
+            with self._transcript_lock((session_id, user_id, agent_type)):
+                self.storage.delete_session(session_id, user_id, agent_type)
+                self._forget_sessions([session_id], user_id, agent_type)
             print(f"✅ 刪除會話: {session_id}")
             return True
         except Exception as e:
             print(f"❌ 刪除會話失敗: {e}")
             return False
     
-    def get_chat_stats(self, user_id: int, agent_type: str) -> Dict[str, Any]:
-        """獲取聊天統計信息"""
-        sessions = self._load_sessions(user_id, agent_type)
-        total_messages = 0
-        
-        for session in sessions:
-            messages = self.get_messages(session["session_id"], user_id, agent_type)
-            total_messages += len(messages)
-        
-        return {
-            "total_sessions": len(sessions),
-            "total_messages": total_messages,
-            "agent_type": agent_type,
-            "user_id": user_id
+    def delete_sessions(self, session_ids: List[str], user_id: int, agent_type: str) -> int:
+        """批量刪除同一用戶的多個會話（會話列表只重寫一次 / 一個事務），返回刪除數量"""
+        if not session_ids:
+            return 0
+        with self._transcript_lock(*[(session_id, user_id, agent_type) for session_id in session_ids]):
+            deleted = self.storage.delete_sessions(list(session_ids), user_id, agent_type)
+            self._forget_sessions(session_ids, user_id, agent_type)
+        print(f"🗑️ 批量刪除 {len(session_ids)} 個會話 (用戶: {user_id}, 類型: {agent_type})")
+        return deleted
+    
+    def _forget_sessions(self, session_ids: List[str], user_id: int, agent_type: str):
+        """從緩存、索引和統計中移除已刪除的會話"""
+        self.sessions_deleted += len(session_ids)
+        for session_id in session_ids:
+            self.transcript_cache.invalidate((session_id, user_id, agent_type))
+            self.session_index.remove(session_id, user_id, agent_type)
+            self.stats.session_deleted(session_id, user_id, agent_type)
+        self.retention_index.remove(user_id, agent_type, list(session_ids))
+        self.search_index.enqueue_delete(list(session_ids), user_id, agent_type)
+    
+    def compress_session(self, session_id: str, user_id: int, agent_type: str) -> Optional[Tuple[int, int]]:
+        """把閒置會話移入壓縮層（讀取時透明解壓，再次寫入時自動解壓回明文）"""
+        with self._transcript_lock((session_id, user_id, agent_type)):
+            return self.storage.compress_session(session_id, user_id, agent_type)
+    
+    def start_maintenance(self, policies: Dict[str, Optional[int]], interval: float = 3600.0,
+                          is_busy=None, max_deletes_per_second: float = 200.0,
+                          compress_after_days: Optional[int] = None) -> RetentionScheduler:
+        """啟動後台保留策略、冷數據壓縮與存儲整理"""
+        if self.maintenance is None:
+            self.maintenance = RetentionScheduler(
+                self, policies, interval=interval, is_busy=is_busy,
+                max_deletes_per_second=max_deletes_per_second,
+                compress_after_days=compress_after_days
+            )
+            self.maintenance.start()
+        return self.maintenance
+    
+    def flush(self):
+        """把寫後緩衝中的數據立即落盤"""
+        if isinstance(self.storage, WriteBehindStorage):
+            self.storage.flush()
+    
+    def close(self):
+        """關閉存儲（寫後緩衝會先完成落盤）"""
+        if self.maintenance is not None:
+            self.maintenance.stop()
+        self.storage.close()
+        self.stats.close()
+        self.search_index.close()
+    
+    def get_storage_stats(self) -> Dict[str, Any]:
+        """獲取存儲層運行統計"""
+        stats: Dict[str, Any] = {
+            "backend": self.storage.name,
+            "session_index": self.session_index.get_stats(),
+            "transcript_cache": self.transcript_cache.get_stats()
         }
+        if isinstance(self.storage, WriteBehindStorage):
+            stats["write_behind"] = self.storage.get_stats()
+        if self.file_storage is not None and self.file_storage.sharded:
+            stats["shard_migration"] = dict(self.file_storage.migration_progress)
+        if self.file_storage is not None:
+            stats["compression"] = self.file_storage.get_compression_stats()
+        stats["search_index"] = self.search_index.get_stats()
+        return stats
+    
+    def get_chat_stats(self, user_id: int, agent_type: str) -> Dict[str, Any]:
+        """獲取聊天統計信息（讀取增量維護的計數器）"""
+        return self.stats.get(user_id, agent_type)
+    
+    def rebuild_stats(self) -> Dict[str, Any]:
+        """從存儲中的全部記錄重建統計計數器"""
+        return self.stats.rebuild(self.storage)
+    
+    def search_messages(self, user_id: int, query: str, agent_type: Optional[str] = None,
+                        session_id: Optional[str] = None, since: Optional[str] = None,
+                        until: Optional[str] = None, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+        """全文搜索用戶的聊天記錄（索引異步更新，剛保存的消息可能稍後才能搜到）"""
+        return self.search_index.search(user_id, query, agent_type=agent_type, session_id=session_id,
+                                        since=since, until=until, limit=limit, offset=offset)
+    
+    def rebuild_search_index(self) -> Dict[str, Any]:
+        """清空並從存儲完整重建搜索索引，等待完成後返回報告"""
+        self.search_index.enqueue_backfill(self.storage, reset=True)
+        self.search_index.flush()
+        return self.search_index.last_rebuild
     
     def cleanup_old_sessions(self, user_id: int, agent_type: str, days: int = 30):
         """清理舊會話（可選功能）"""
         from datetime import timedelta
         
         cutoff_date = datetime.now() - timedelta(days=days)
-        sessions = self._load_sessions(user_id, agent_type)
+        sessions = self.get_sessions(user_id, agent_type)
         
         sessions_to_remove = []
         for session in sessions:
@@ -243,8 +391,7 @@ class ChatHistoryManager:
             except:
                 continue
         
-        for session_id in sessions_to_remove:
-            self.delete_session(session_id, user_id, agent_type)
+        self.delete_sessions(sessions_to_remove, user_id, agent_type)
         
         print(f"🧹 清理了 {len(sessions_to_remove)} 個舊會話")
     
@@ -283,8 +430,30 @@ class ChatHistoryManager:
             print(f"❌ 導出聊天記錄失敗: {e}")
             return None
 
+    def bulk_export(self, user_ids: Optional[List[int]] = None, agent_type: Optional[str] = None,
+                    since: Optional[str] = None, until: Optional[str] = None) -> ChatExporter:
+        """批量流式導出多個會話（不經過聊天記錄緩存，消息分塊讀取）"""
+        return ChatExporter(self.storage, user_ids=user_ids, agent_type=agent_type, since=since, until=until)
+
+# 存儲後端: "json"（默認，兼容現有數據）、"jsonl"（追加式）或 "sqlite"
+CHAT_HISTORY_BACKEND = "json"
+
+# 是否啟用寫後緩衝（消息先入隊，由後台線程分組寫入）
+CHAT_HISTORY_WRITE_BEHIND = True
+
+# 文件後端是否使用哈希分片目錄（{agent_type}/ab/cd/{user_id}_{session_id}.*）
+CHAT_HISTORY_SHARDED = False
+
+# 活躍會話聊天記錄緩存上限（字節）
+CHAT_TRANSCRIPT_CACHE_BYTES = 64 * 1024 * 1024
+
 # 創建全局實例
-chat_history_manager = ChatHistoryManager()
+chat_history_manager = ChatHistoryManager(
+    backend=CHAT_HISTORY_BACKEND,
+    write_behind=CHAT_HISTORY_WRITE_BEHIND,
+    transcript_cache_bytes=CHAT_TRANSCRIPT_CACHE_BYTES,
+    sharded=CHAT_HISTORY_SHARDED
+)
 
 # 便捷函數
 def create_chat_session(session_id: str, user_id: int, agent_type: str, title: Optional[str] = None):
@@ -295,13 +464,47 @@ def save_chat_message(session_id: str, user_id: int, agent_type: str, role: str,
     """保存聊天消息"""
     return chat_history_manager.save_message(session_id, user_id, agent_type, role, content)
 
-def get_chat_messages(session_id: str, user_id: int, agent_type: str):
-    """獲取聊天記錄"""
+def save_chat_messages(session_id: str, user_id: int, agent_type: str, messages: List[Tuple[str, str]], update_session: bool = True):
+    """批量保存聊天消息"""
+    return chat_history_manager.save_messages(session_id, user_id, agent_type, messages, update_session)
+
+def chat_session_exists(session_id: str, user_id: int, agent_type: str) -> bool:
+    """判斷會話是否存在"""
+    return chat_history_manager.session_exists(session_id, user_id, agent_type)
+
+def touch_chat_sessions(session_ids: List[str], user_id: int, agent_type: str):
+    """批量更新會話時間"""
+    return chat_history_manager.touch_sessions(session_ids, user_id, agent_type)
+
+def chat_sessions_deleted() -> int:
+    """已刪除的會話總數（調用方比較前後兩次的值判斷期間是否有會話被刪除）"""
+    return chat_history_manager.sessions_deleted
+
+def get_recent_chat_messages(session_id: str, user_id: int, agent_type: str, limit: int = 20):
+    """獲取最近的聊天記錄（會話記憶恢復）"""
+    return chat_history_manager.get_recent_messages(session_id, user_id, agent_type, limit)
+
+def get_chat_messages(session_id: str, user_id: int, agent_type: str, before_id: Optional[int] = None,
+                      after_id: Optional[int] = None, limit: Optional[int] = None):
+    """獲取聊天記錄（指定 after_id 為增量同步，指定 before_id 或 limit 為分頁，否則返回全部）"""
+    if after_id is not None:
+        return chat_history_manager.get_messages_since(session_id, user_id, agent_type, after_id, limit or 200)
+    if before_id is not None or limit is not None:
+        return chat_history_manager.get_messages_page(session_id, user_id, agent_type, before_id, limit or 50)
     messages = chat_history_manager.get_messages(session_id, user_id, agent_type)
     return {"messages": messages}
 
-def get_user_sessions(user_id: int, agent_type: str):
-    """獲取用戶會話列表"""
+def search_chat_messages(user_id: int, query: str, agent_type: Optional[str] = None,
+                         session_id: Optional[str] = None, since: Optional[str] = None,
+                         until: Optional[str] = None, limit: int = 20, offset: int = 0):
+    """全文搜索聊天記錄"""
+    return chat_history_manager.search_messages(user_id, query, agent_type, session_id, since, until, limit, offset)
+
+def get_user_sessions(user_id: int, agent_type: str, cursor: Optional[str] = None,
+                      limit: Optional[int] = None):
+    """獲取用戶會話列表（指定 cursor 或 limit 時分頁）"""
+    if cursor is not None or limit is not None:
+        return chat_history_manager.get_sessions_page(user_id, agent_type, cursor, limit or 20)
     sessions = chat_history_manager.get_sessions(user_id, agent_type)
     return {"sessions": sessions}
 
@@ -0,0 +1,428 @@
+"""
+舊版 JSON 聊天數據批量遷移
+把 chat_history/ 下的舊版 JSON 會話文件（平鋪、分片或 .json.gz）和 mental_health_chat_data.json
+遷移到任意存儲後端（JSON / JSONL / SQLite）。
+
+- 流式解析：逐條讀取消息數組，單個文件再大內存也不隨之增長
+- 分批寫入：每個會話按 batch_size 條一批追加
+- 並行：舊版會話文件按 (user_id, agent_type) 分組，由多個線程並行遷移
+- 可恢復、可重複執行：每個會話只追加目標中尚未存在的消息（按消息ID），
+  已校驗且源文件未變化的會話直接跳過；服務不停機時先遷移一遍，切換前再執行一次補齊新消息
+- 校驗：每個會話比對消息數和內容校驗和（SHA-256），結果記入目標目錄下的 migration_state.json
+
+用法: python chat_history_migrate.py --target-backend sqlite --target-dir chat_history_sqlite
+      python chat_history_migrate.py --target-backend jsonl --target-dir chat_history_v2 --sharded --workers 8
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from chat_history_storage import ChatHistoryStorage, create_storage
+from json_stream import JSONStreamReader
+
+# 舊版聊天數據文件中沒有用戶/類型信息時使用的默認值（舊服務固定使用用戶 1）
+LEGACY_DEFAULT_USER_ID = 1
+LEGACY_DEFAULT_AGENT_TYPE = "mental_health"
+
+
+def _open_text(path: Path):
+    if path.name.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def _checksum_update(digest, message: Dict[str, Any]):
+    """按角色、內容和時間計算校驗和（消息ID在 mental_health_chat_data.json 遷移時會重新編號）"""
+    record = [message.get("role"), message.get("content"), message.get("created_at")]
+    digest.update(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+    digest.update(b"\n")
+
+
+def _target_checksum(target: ChatHistoryStorage, session_id: str, user_id: int, agent_type: str,
+                     chunk_size: int = 500) -> Tuple[int, str]:
+    """邊遍歷邊計算目標會話的消息數和校驗和（JSONL/SQLite 分塊讀取，不載入整個記錄）"""
+    digest = hashlib.sha256()
+    count = 0
+    for message in target.iter_messages(session_id, user_id, agent_type, chunk_size):
+        _checksum_update(digest, message)
+        count += 1
+    return count, digest.hexdigest()
+
+
+class LegacyMigration:
+    """一次遷移任務；run() 可重複執行，每次只補齊目標中缺少的會話和消息"""
+
+    def __init__(self, target: ChatHistoryStorage, state_file: Path, source_dir: Optional[Path] = None,
+                 data_file: Optional[Path] = None, workers: int = 4, batch_size: int = 500,
+                 verify: bool = True, progress_interval: float = 5.0):
+        self.target = target
+        self.state_file = Path(state_file)
+        self.source_dir = Path(source_dir) if source_dir else None
+        self.data_file = Path(data_file) if data_file else None
+        self.workers = workers
+        self.batch_size = batch_size
+        self.verify = verify
+        self.progress_interval = progress_interval
+
+        self.state = self._load_state()
+        self._lock = threading.Lock()
+        self.progress: Dict[str, Any] = {
+            "sessions_total": 0,
+            "sessions_done": 0,
+            "sessions_skipped": 0,
+            "messages_copied": 0,
+            "messages_seen": 0,
+            "mismatches": [],
+            "errors": []
+        }
+
+    # ---------- 狀態（斷點） ----------
+
+    def _load_state(self) -> Dict[str, Any]:
+        if self.state_file.exists():
+            try:
+                with open(self.state_file, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                print(f"❌ 讀取遷移狀態失敗，重新開始: {e}")
+        return {"sessions": {}, "data_file": None}
+
+    def _save_state(self):
+        with self._lock:
+            payload = json.dumps(self.state, ensure_ascii=False)
+        tmp_file = self.state_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_file, self.state_file)
+
+    @staticmethod
+    def _session_key(session_id: str, user_id: int, agent_type: str) -> str:
+        return f"{user_id}:{agent_type}:{session_id}"
+
+    @staticmethod
+    def _fingerprint(path: Path) -> List[int]:
+        stat = path.stat()
+        return [stat.st_size, stat.st_mtime_ns]
+
+    # ---------- 寫入目標 ----------
+
+    def _ensure_session(self, session: Dict[str, Any], existing: Dict[str, Dict[str, Any]]):
+        """目標中不存在時創建會話（保留原標題和時間）"""
+        if session["session_id"] in existing:
+            return
+        created = self.target.insert_session({
+            "session_id": session["session_id"],
+            "user_id": session["user_id"],
+            "agent_type": session["agent_type"],
+            "title": session.get("title") or f"對話 {session['session_id'][:8]}",
+            "created_at": session.get("created_at") or datetime.now().isoformat(),
+            "updated_at": session.get("updated_at") or session.get("created_at") or datetime.now().isoformat()
+        })
+        existing[session["session_id"]] = created
+
+    def _copy_messages(self, session_id: str, user_id: int, agent_type: str,
+                       messages: Iterator[Dict[str, Any]]) -> Tuple[int, int, str]:
+        """分批追加目標中尚未存在的消息，返回 (源消息數, 新追加數, 源校驗和)"""
+        recent = self.target.load_recent_messages(session_id, user_id, agent_type, 1)
+        last_id = recent[-1].get("id", 0) if recent else 0
+        digest = hashlib.sha256()
+        seen = copied = 0
+        batch: List[Dict[str, Any]] = []
+        for message in messages:
+            seen += 1
+            _checksum_update(digest, message)
+            if message["id"] <= last_id:
+                continue
+            batch.append(message)
+            if len(batch) >= self.batch_size:
+                self.target.append_messages(session_id, user_id, agent_type, batch)
+                copied += len(batch)
+                batch = []
+        if batch:
+            self.target.append_messages(session_id, user_id, agent_type, batch)
+            copied += len(batch)
+        with self._lock:
+            self.progress["messages_seen"] += seen
+            self.progress["messages_copied"] += copied
+        return seen, copied, digest.hexdigest()
+
+    def _record(self, session_id: str, user_id: int, agent_type: str, count: int, checksum: str,
+                fingerprint: Optional[List[int]] = None):
+        """校驗目標並記錄結果"""
+        key = self._session_key(session_id, user_id, agent_type)
+        verified = True
+        if self.verify:
+            target_count, target_checksum = _target_checksum(self.target, session_id, user_id, agent_type, self.batch_size)
+            verified = target_count == count and target_checksum == checksum
+            if not verified:
+                with self._lock:
+                    self.progress["mismatches"].append({
+                        "session": key, "source_count": count, "target_count": target_count
+                    })
+        with self._lock:
+            self.state["sessions"][key] = {
+                "count": count, "sha256": checksum, "verified": verified, "fingerprint": fingerprint
+            }
+            self.progress["sessions_done"] += 1
+
+    # ---------- 舊版會話文件（chat_history/**.json） ----------
+
+    def _scan_source_dir(self) -> Dict[Tuple[int, str], List[Tuple[str, Path]]]:
+        """按 (user_id, agent_type) 分組列出舊版會話文件"""
+        groups: Dict[Tuple[int, str], List[Tuple[str, Path]]] = {}
+        for root, _, names in os.walk(self.source_dir):
+            for name in names:
+                if name.startswith("sessions_") or name.endswith(".meta.json"):
+                    continue
+                if name.endswith(".json"):
+                    stem = name[:-len(".json")]
+                elif name.endswith(".json.gz"):
+                    stem = name[:-len(".json.gz")]
+                else:
+                    continue
+                user_id, _, session_id = stem.partition("_")
+                path = Path(root) / name
+                parts = path.relative_to(self.source_dir).parts
+                if not user_id.isdigit() or not session_id or len(parts) < 2:
+                    continue
+                groups.setdefault((int(user_id), parts[0]), []).append((session_id, path))
+        return groups
+
+    def _legacy_session_list(self, user_id: int, agent_type: str) -> Dict[str, Dict[str, Any]]:
+        session_file = self.source_dir / agent_type / f"sessions_{user_id}.json"
+        if not session_file.exists():
+            return {}
+        try:
+            with open(session_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            sessions = data.get("sessions", []) if isinstance(data, dict) else data
+            return {s["session_id"]: s for s in sessions if "session_id" in s}
+        except Exception as e:
+            with self._lock:
+                self.progress["errors"].append(f"{session_file}: {e}")
+            return {}
+
+    def _migrate_group(self, user_id: int, agent_type: str, files: List[Tuple[str, Path]]):
+        legacy_sessions = self._legacy_session_list(user_id, agent_type)
+        existing = {s["session_id"]: s for s in self.target.list_sessions(user_id, agent_type)}
+        for session_id, path in files:
+            key = self._session_key(session_id, user_id, agent_type)
+            try:
+                fingerprint = self._fingerprint(path)
+                done = self.state["sessions"].get(key)
+                if done and done.get("verified") and done.get("fingerprint") == fingerprint and session_id in existing:
+                    with self._lock:
+                        self.progress["sessions_skipped"] += 1
+                        self.progress["sessions_done"] += 1
+                    continue
+
+                session = dict(legacy_sessions.get(session_id, {}))
+                session.update({"session_id": session_id, "user_id": user_id, "agent_type": agent_type})
+                self._ensure_session(session, existing)
+
+                def messages() -> Iterator[Dict[str, Any]]:
+                    next_id = 1
+                    with _open_text(path) as f:
+                        for field, value, in_array in JSONStreamReader(f).items():
+                            if field == "messages" and in_array:
+                                message = dict(value)
+                                message.setdefault("id", next_id)
+                                next_id = message["id"] + 1
+                                yield message
+
+                count, _, checksum = self._copy_messages(session_id, user_id, agent_type, messages())
+                self._record(session_id, user_id, agent_type, count, checksum, fingerprint)
+            except Exception as e:
+                with self._lock:
+                    self.progress["errors"].append(f"{key}: {e}")
+
+    def migrate_source_dir(self):
+        groups = self._scan_source_dir()
+        with self._lock:
+            self.progress["sessions_total"] += sum(len(files) for files in groups.values())
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chat-migrate") as pool:
+            futures = [pool.submit(self._migrate_group, user_id, agent_type, files)
+                       for (user_id, agent_type), files in sorted(groups.items())]
+            for future in as_completed(futures):
+                future.result()
+                self._save_state()
+
+    # ---------- mental_health_chat_data.json ----------
+
+    def migrate_data_file(self):
+        """
+        流式遷移 {"sessions": [...], "messages": [...]}。消息ID在舊文件中全局遞增，
+        遷移後按會話內順序重新編號為 1..n，重複執行時順序不變，只追加新增的消息。
+        """
+        fingerprint = self._fingerprint(self.data_file)
+        if self.state.get("data_file") == fingerprint:
+            return
+
+        sessions: Dict[str, Dict[str, Any]] = {}
+        existing: Dict[Tuple[int, str], Dict[str, Dict[str, Any]]] = {}
+        ordinals: Dict[str, int] = {}
+        digests: Dict[str, Any] = {}
+        buffers: Dict[str, List[Dict[str, Any]]] = {}
+        buffered = [0]
+        last_ids: Dict[str, int] = {}
+
+        def session_for(session_id: str) -> Dict[str, Any]:
+            session = sessions.get(session_id)
+            if session is None:
+                session = sessions[session_id] = {
+                    "session_id": session_id,
+                    "user_id": LEGACY_DEFAULT_USER_ID,
+                    "agent_type": LEGACY_DEFAULT_AGENT_TYPE
+                }
+            group = (session["user_id"], session["agent_type"])
+            if group not in existing:
+                existing[group] = {s["session_id"]: s for s in self.target.list_sessions(*group)}
+            if session_id not in ordinals:
+                self._ensure_session(session, existing[group])
+                recent = self.target.load_recent_messages(session_id, *group, 1)
+                last_ids[session_id] = recent[-1].get("id", 0) if recent else 0
+                ordinals[session_id] = 0
+                digests[session_id] = hashlib.sha256()
+                buffers[session_id] = []
+                with self._lock:
+                    self.progress["sessions_total"] += 1
+            return session
+
+        def flush(session_id: str):
+            batch = buffers[session_id]
+            if batch:
+                session = sessions[session_id]
+                self.target.append_messages(session_id, session["user_id"], session["agent_type"], batch)
+                with self._lock:
+                    self.progress["messages_copied"] += len(batch)
+                buffered[0] -= len(batch)
+                buffers[session_id] = []
+
+        with _open_text(self.data_file) as f:
+            for field, value, in_array in JSONStreamReader(f).items():
+                if not in_array or not isinstance(value, dict):
+                    continue
+                if field == "sessions" and value.get("session_id"):
+                    session = dict(value)
+                    session["user_id"] = int(session.get("user_id") or LEGACY_DEFAULT_USER_ID)
+                    session["agent_type"] = session.get("agent_type") or LEGACY_DEFAULT_AGENT_TYPE
+                    sessions.setdefault(session["session_id"], session)
+                elif field == "messages" and value.get("session_id"):
+                    session_id = value["session_id"]
+                    session_for(session_id)
+                    ordinals[session_id] += 1
+                    message = {
+                        "id": ordinals[session_id],
+                        "role": value.get("role", "unknown"),
+                        "content": value.get("content", ""),
+                        "created_at": value.get("created_at") or value.get("timestamp") or ""
+                    }
+                    _checksum_update(digests[session_id], message)
+                    with self._lock:
+                        self.progress["messages_seen"] += 1
+                    if message["id"] > last_ids[session_id]:
+                        buffers[session_id].append(message)
+                        buffered[0] += 1
+                        if len(buffers[session_id]) >= self.batch_size:
+                            flush(session_id)
+                        elif buffered[0] >= self.batch_size * 4:
+                            # 消息在會話間交錯時限制緩衝總量
+                            for pending_id in list(buffers):
+                                flush(pending_id)
+
+        # 沒有消息的會話也要遷移
+        for session_id in list(sessions):
+            session_for(session_id)
+        for session_id, session in sessions.items():
+            flush(session_id)
+            self._record(session_id, session["user_id"], session["agent_type"],
+                         ordinals[session_id], digests[session_id].hexdigest())
+
+        with self._lock:
+            failed = any(not self.state["sessions"][self._session_key(sid, s["user_id"], s["agent_type"])]["verified"]
+                         for sid, s in sessions.items())
+            if not failed:
+                self.state["data_file"] = fingerprint
+        self._save_state()
+
+    # ---------- 執行 ----------
+
+    def _report_progress(self, started: float, stop: threading.Event):
+        while not stop.wait(self.progress_interval):
+            print(self._progress_line(started))
+
+    def _progress_line(self, started: float) -> str:
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        with self._lock:
+            done, total = self.progress["sessions_done"], self.progress["sessions_total"]
+            seen = self.progress["messages_seen"]
+        rate = done / elapsed
+        eta = (total - done) / rate if rate > 0 and total > done else 0.0
+        return (f"🚚 遷移進度: {done}/{total} 個會話, {seen} 條消息, "
+                f"{seen / elapsed:.0f} 條/秒, 預計剩餘 {eta:.0f}s")
+
+    def run(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        stop = threading.Event()
+        reporter = threading.Thread(target=self._report_progress, args=(started, stop), daemon=True)
+        reporter.start()
+        try:
+            if self.source_dir is not None and self.source_dir.exists():
+                self.migrate_source_dir()
+            if self.data_file is not None and self.data_file.exists():
+                self.migrate_data_file()
+        finally:
+            stop.set()
+            self._save_state()
+
+        elapsed = time.perf_counter() - started
+        report = dict(self.progress)
+        report["duration_s"] = round(elapsed, 3)
+        report["messages_per_second"] = round(report["messages_seen"] / elapsed, 1) if elapsed > 0 else 0.0
+        report["verified"] = self.verify and not report["mismatches"] and not report["errors"]
+        print(self._progress_line(started))
+        print(f"✅ 遷移完成: 新增 {report['messages_copied']} 條消息, 跳過 {report['sessions_skipped']} 個未變化的會話, "
+              f"{len(report['mismatches'])} 個校驗不一致, {len(report['errors'])} 個錯誤")
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate legacy JSON chat data to a chat history backend")
+    parser.add_argument("--source-dir", default="chat_history", help="legacy chat_history directory")
+    parser.add_argument("--data-file", default="mental_health_chat_data.json", help="legacy chat data file")
+    parser.add_argument("--target-backend", choices=["json", "jsonl", "sqlite"], required=True)
+    parser.add_argument("--target-dir", required=True, help="target storage directory (must differ from the source)")
+    parser.add_argument("--sharded", action="store_true", help="use the sharded layout for file backends")
+    parser.add_argument("--workers", type=int, default=4, help="parallel session groups")
+    parser.add_argument("--batch-size", type=int, default=500, help="messages per append")
+    parser.add_argument("--no-verify", action="store_true", help="skip count/checksum verification")
+    args = parser.parse_args()
+
+    target_dir = Path(args.target_dir)
+    if Path(args.source_dir).resolve() == target_dir.resolve():
+        parser.error("--target-dir must differ from --source-dir")
+    target_dir.mkdir(parents=True, exist_ok=True)
+    target = create_storage(args.target_backend, target_dir, sharded=args.sharded)
+    migration = LegacyMigration(
+        target, target_dir / "migration_state.json",
+        source_dir=Path(args.source_dir), data_file=Path(args.data_file),
+        workers=args.workers, batch_size=args.batch_size, verify=not args.no_verify
+    )
+    try:
+        report = migration.run()
+    finally:
+        target.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
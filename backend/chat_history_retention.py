@@ -0,0 +1,273 @@
+"""
+聊天記錄保留策略與後台維護
+RetentionIndex: 全部會話按 updated_at 排序的內存索引，查找過期會話不再掃描每個會話列表
+RetentionScheduler: 定期按策略批量刪除過期會話、壓縮閒置會話並整理存儲，限速執行並記錄每輪報告
+"""
+
+import heapq
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+SessionRef = Tuple[int, str, str]  # (user_id, agent_type, session_id)
+
+# 策略中匹配所有 agent_type 的鍵
+ALL_AGENT_TYPES = "*"
+
+
+class RetentionIndex:
+    """
+    按 updated_at 排序的會話索引（最小堆 + 當前時間表）。
+    更新時間只壓入新條目，舊條目在彈出時丟棄；堆中過期條目過多時整體重建。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[str, SessionRef]] = []
+        self._current: Dict[SessionRef, str] = {}
+        self.loaded = False
+
+    def load(self, storage):
+        """從存儲載入全部會話（每個會話列表只讀一次）"""
+        current: Dict[SessionRef, str] = {}
+        for user_id, agent_type in storage.list_session_groups():
+            for session in storage.list_sessions(user_id, agent_type):
+                current[(user_id, agent_type, session["session_id"])] = session.get("updated_at", "")
+        with self._lock:
+            # 載入前後通過 update() 記錄的時間可能比存儲中的新
+            for ref, updated_at in self._current.items():
+                if updated_at > current.get(ref, ""):
+                    current[ref] = updated_at
+            self._current = current
+            self._rebuild_heap()
+            self.loaded = True
+
+    def _rebuild_heap(self):
+        self._heap = [(updated_at, ref) for ref, updated_at in self._current.items()]
+        heapq.heapify(self._heap)
+
+    def update(self, user_id: int, agent_type: str, session_ids: List[str], updated_at: str):
+        with self._lock:
+            for session_id in session_ids:
+                ref = (user_id, agent_type, session_id)
+                self._current[ref] = updated_at
+                heapq.heappush(self._heap, (updated_at, ref))
+            if len(self._heap) > 2 * len(self._current) + 1024:
+                self._rebuild_heap()
+
+    def remove(self, user_id: int, agent_type: str, session_ids: List[str]):
+        with self._lock:
+            for session_id in session_ids:
+                self._current.pop((user_id, agent_type, session_id), None)
+
+    def expired(self, cutoff: str, limit: int,
+                accept: Callable[[SessionRef, str], bool]) -> List[SessionRef]:
+        """按時間從舊到新返回 updated_at < cutoff 且被 accept 接受的會話（不修改索引）"""
+        found: List[SessionRef] = []
+        with self._lock:
+            # 丟棄堆頂的舊條目
+            while self._heap and self._current.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            for updated_at, ref in self._iter_sorted():
+                if updated_at >= cutoff or len(found) >= limit:
+                    break
+                if self._current.get(ref) == updated_at and accept(ref, updated_at):
+                    found.append(ref)
+        return found
+
+    def in_range(self, lower: Optional[str], upper: str) -> List[SessionRef]:
+        """返回 lower <= updated_at < upper 的會話（lower 為 None 時不設下限），按時間從舊到新"""
+        with self._lock:
+            found = [(updated_at, ref) for ref, updated_at in self._current.items()
+                     if updated_at < upper and (lower is None or updated_at >= lower)]
+        found.sort()
+        return [ref for _, ref in found]
+
+    def _iter_sorted(self):
+        """按 updated_at 從小到大遍歷堆（調用方持有鎖，只在需要時展開）"""
+        if not self._heap:
+            return
+        frontier = [(self._heap[0], 0)]
+        while frontier:
+            (entry, index) = heapq.heappop(frontier)
+            yield entry
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+
+    def __len__(self) -> int:
+        return len(self._current)
+
+
+class RetentionScheduler:
+    """
+    後台維護線程 - 每隔 interval 秒執行一輪：按策略找出過期會話，按 (user_id, agent_type) 分組批量刪除，
+    把閒置超過 compress_after_days 天的會話移入壓縮層，然後整理存儲。
+    每批之間按 max_deletes_per_second 限速，is_busy() 為真時暫停，讓出資源給在線請求。
+    """
+
+    def __init__(self, manager, policies: Dict[str, Optional[int]], interval: float = 3600.0,
+                 batch_size: int = 100, max_deletes_per_second: float = 200.0,
+                 is_busy: Optional[Callable[[], bool]] = None, busy_backoff: float = 1.0,
+                 max_busy_wait: float = 300.0, history: int = 20,
+                 compress_after_days: Optional[int] = None):
+        self.manager = manager
+        # {agent_type 或 "*": 保留天數}，None 表示永久保留
+        self.policies = dict(policies)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_deletes_per_second = max_deletes_per_second
+        self.is_busy = is_busy
+        self.busy_backoff = busy_backoff
+        self.max_busy_wait = max_busy_wait
+        self.reports: Deque[Dict[str, Any]] = deque(maxlen=history)
+        # 閒置天數超過此值的會話移入壓縮層，None 表示不壓縮
+        self.compress_after_days = compress_after_days
+        # 上一輪壓縮的截止時間：每輪只處理新跨過閾值的會話（首輪處理全部）
+        self._compressed_until: Optional[str] = None
+
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _cutoffs(self, now: datetime) -> Dict[str, str]:
+        return {
+            agent_type: (now - timedelta(days=days)).isoformat()
+            for agent_type, days in self.policies.items()
+            if days is not None
+        }
+
+    def _throttle(self, deleted: int, report: Dict[str, Any]) -> bool:
+        """批次之間的限速與繁忙退讓，返回 False 表示應停止本輪"""
+        pause = deleted / self.max_deletes_per_second if self.max_deletes_per_second > 0 else 0.0
+        waited = 0.0
+        while self.is_busy is not None and self.is_busy() and waited < self.max_busy_wait:
+            if self._stop.wait(self.busy_backoff):
+                return False
+            waited += self.busy_backoff
+        report["throttled_seconds"] += waited + pause
+        return not self._stop.wait(pause)
+
+    def run_once(self) -> Dict[str, Any]:
+        """執行一輪維護並返回報告"""
+        with self._run_lock:
+            started = time.perf_counter()
+            now = datetime.now()
+            report: Dict[str, Any] = {
+                "started_at": now.isoformat(),
+                "policies": dict(self.policies),
+                "deleted_sessions": 0,
+                "deleted_by_agent_type": {},
+                "batches": 0,
+                "compressed_sessions": 0,
+                "compressed_bytes_saved": 0,
+                "throttled_seconds": 0.0,
+                "compaction": None,
+                "errors": []
+            }
+
+            index = self.manager.retention_index
+            if not index.loaded:
+                index.load(self.manager.storage)
+            report["indexed_sessions"] = len(index)
+
+            cutoffs = self._cutoffs(now)
+            default_cutoff = cutoffs.get(ALL_AGENT_TYPES)
+
+            def accept(ref: SessionRef, updated_at: str) -> bool:
+                cutoff = cutoffs.get(ref[1], default_cutoff)
+                return cutoff is not None and updated_at < cutoff
+
+            skipped: set = set()
+            if cutoffs:
+                max_cutoff = max(cutoffs.values())
+                while not self._stop.is_set():
+                    expired = index.expired(max_cutoff, self.batch_size,
+                                            lambda ref, ts: ref not in skipped and accept(ref, ts))
+                    if not expired:
+                        break
+
+                    # 同一個會話列表文件 / 同一事務中的會話一起刪除
+                    groups: Dict[Tuple[int, str], List[str]] = {}
+                    for user_id, agent_type, session_id in expired:
+                        groups.setdefault((user_id, agent_type), []).append(session_id)
+                    for (user_id, agent_type), session_ids in groups.items():
+                        try:
+                            self.manager.delete_sessions(session_ids, user_id, agent_type)
+                            report["deleted_sessions"] += len(session_ids)
+                            by_type = report["deleted_by_agent_type"]
+                            by_type[agent_type] = by_type.get(agent_type, 0) + len(session_ids)
+                        except Exception as e:
+                            skipped.update((user_id, agent_type, sid) for sid in session_ids)
+                            report["errors"].append(f"{user_id}/{agent_type}: {e}")
+                    report["batches"] += 1
+
+                    if not self._throttle(len(expired), report):
+                        break
+
+            if self.compress_after_days is not None and not self._stop.is_set():
+                self._compress_idle(index, now, skipped, report)
+
+            try:
+                report["compaction"] = self.manager.storage.compact()
+            except Exception as e:
+                report["errors"].append(f"compact: {e}")
+
+            report["throttled_seconds"] = round(report["throttled_seconds"], 3)
+            report["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            report["finished_at"] = datetime.now().isoformat()
+            self.reports.append(report)
+            print(f"🧹 聊天記錄維護: 刪除 {report['deleted_sessions']} 個過期會話, "
+                  f"壓縮 {report['compressed_sessions']} 個閒置會話, "
+                  f"{report['batches']} 批, 耗時 {report['duration_ms']:.0f}ms")
+            return report
+
+    def _compress_idle(self, index: RetentionIndex, now: datetime, skipped: set, report: Dict[str, Any]):
+        """壓縮上一輪之後新變為閒置的會話（之後有寫入的會話已自動解壓，再閒置時會重新進入窗口）"""
+        cutoff = (now - timedelta(days=self.compress_after_days)).isoformat()
+        candidates = [ref for ref in index.in_range(self._compressed_until, cutoff) if ref not in skipped]
+        completed = True
+        for start in range(0, len(candidates), self.batch_size):
+            batch = candidates[start:start + self.batch_size]
+            for user_id, agent_type, session_id in batch:
+                try:
+                    result = self.manager.compress_session(session_id, user_id, agent_type)
+                except Exception as e:
+                    report["errors"].append(f"compress {user_id}/{agent_type}/{session_id}: {e}")
+                    continue
+                if result is not None:
+                    report["compressed_sessions"] += 1
+                    report["compressed_bytes_saved"] += result[0] - result[1]
+            report["batches"] += 1
+            if not self._throttle(len(batch), report):
+                completed = False
+                break
+        # 中途停止時下一輪從頭重試整個窗口（已壓縮的會話會被跳過）
+        if completed:
+            self._compressed_until = cutoff
+
+    def start(self):
+        """啟動後台維護線程"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print(f"❌ 聊天記錄維護失敗: {e}")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="chat-history-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def get_reports(self) -> List[Dict[str, Any]]:
+        return list(self.reports)
@@ -0,0 +1,373 @@
+"""
+聊天記錄全文搜索
+消息內容經 jieba 分詞（中英文混合）後寫入 SQLite FTS5 倒排索引，按 BM25 排序，可按 agent_type、會話和日期過濾。
+SQLite 後端時索引表與聊天記錄在同一個數據庫；JSON / JSONL 後端時使用存儲目錄下獨立的 chat_search.db。
+索引更新只進入隊列，由後台線程批量寫入，不佔用請求路徑；未正常關閉或首次啟用時從存儲增量補齊。
+
+用法: python chat_history_search.py --rebuild
+      python chat_history_search.py --user-id 1 --query "呼吸練習"
+"""
+
+import argparse
+import atexit
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import jieba
+
+# 至少包含一個字母、數字或漢字的詞才進入索引
+_WORD_RE = re.compile(r"\w", re.UNICODE)
+
+# 補齊索引時每次從存儲讀取的消息數
+BACKFILL_CHUNK = 1000
+
+
+def tokenize(text: str, for_query: bool = False) -> List[str]:
+    """
+    jieba 分詞。索引使用搜索引擎模式（長詞同時切出其中的短詞），
+    查詢使用精確模式，查詢詞因此總能命中索引中的長詞或短詞。
+    """
+    words = jieba.cut(text) if for_query else jieba.cut_for_search(text)
+    return [w.strip().lower() for w in words if _WORD_RE.search(w)]
+
+
+def _fts_phrase(token: str) -> str:
+    return '"' + token.replace('"', '""') + '"'
+
+
+class ChatSearchIndex:
+    """
+    聊天記錄倒排索引。search_docs 保存消息及其所屬會話（按會話建索引，刪除會話不掃描全表），
+    search_fts 保存分詞結果和所有者標記（owner 列讓按用戶過濾也走倒排索引）。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS search_docs (
+            rowid INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            agent_type TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_docs_session
+            ON search_docs (user_id, agent_type, session_id, message_id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(tokens, owner, tokenize='unicode61');
+        CREATE TABLE IF NOT EXISTS search_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    SQL_LAST_ID = (
+        "SELECT COALESCE(MAX(message_id), 0) FROM search_docs "
+        "WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    )
+    SQL_INSERT_DOC = (
+        "INSERT INTO search_docs (session_id, user_id, agent_type, message_id, role, content, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+    SQL_INSERT_FTS = "INSERT INTO search_fts (rowid, tokens, owner) VALUES (?, ?, ?)"
+    SQL_DELETE_FTS = (
+        "DELETE FROM search_fts WHERE rowid IN "
+        "(SELECT rowid FROM search_docs WHERE user_id = ? AND agent_type = ? AND session_id = ?)"
+    )
+    SQL_DELETE_DOCS = "DELETE FROM search_docs WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    SQL_SET_META = "INSERT OR REPLACE INTO search_meta (key, value) VALUES (?, ?)"
+    SQL_GET_META = "SELECT value FROM search_meta WHERE key = ?"
+    SQL_COUNT_DOCS = "SELECT COUNT(*) FROM search_docs"
+
+    def __init__(self, db_path: Path, max_batch: int = 500):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_batch = max_batch
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        conn = self._conn()
+        with conn:
+            conn.executescript(self.SCHEMA)
+        # 上次未正常關閉（或首次啟用）時隊列中的更新可能丟失，需要從存儲補齊
+        row = conn.execute(self.SQL_GET_META, ("clean_shutdown",)).fetchone()
+        self.needs_backfill = row is None or row[0] != "1"
+        with conn:
+            conn.execute(self.SQL_SET_META, ("clean_shutdown", "0"))
+
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self.indexed_messages = 0
+        self.last_batch_ms = 0.0
+        self.last_rebuild: Optional[Dict[str, Any]] = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name="chat-search-indexer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _conn(self) -> sqlite3.Connection:
+        """獲取當前線程的連接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    # ---------- 入隊（請求路徑只做這一步） ----------
+
+    def enqueue_messages(self, session_id: str, user_id: int, agent_type: str, messages: List[Dict[str, Any]]):
+        if messages and not self._closed:
+            self._queue.put(("add", session_id, user_id, agent_type, list(messages)))
+
+    def enqueue_delete(self, session_ids: List[str], user_id: int, agent_type: str):
+        if session_ids and not self._closed:
+            self._queue.put(("delete", None, user_id, agent_type, list(session_ids)))
+
+    def enqueue_backfill(self, storage, reset: bool = False):
+        """從存儲補齊索引（reset 時先清空，即完整重建）"""
+        if not self._closed:
+            self._queue.put(("backfill", None, None, None, (storage, reset)))
+
+    def flush(self):
+        """等待隊列中的更新全部寫入索引"""
+        self._queue.join()
+
+    # ---------- 後台寫入 ----------
+
+    def _run(self):
+        held: List[Optional[tuple]] = []
+        while True:
+            op = held.pop() if held else self._queue.get()
+            if op is None:
+                self._queue.task_done()
+                return
+            if op[0] == "backfill":
+                try:
+                    self._backfill(*op[4])
+                except Exception as e:
+                    print(f"❌ 補齊搜索索引失敗: {e}")
+                self._queue.task_done()
+                continue
+
+            # 把隊列中連續的增刪合併為一個事務（遇到補齊或停止時先寫完當前批次）
+            batch = [op]
+            while len(batch) < self.max_batch:
+                try:
+                    nxt = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None or nxt[0] == "backfill":
+                    held.append(nxt)
+                    break
+                batch.append(nxt)
+            self._apply_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _apply_batch(self, batch: List[tuple]):
+        started = time.perf_counter()
+        conn = self._conn()
+        try:
+            with conn:
+                for event, session_id, user_id, agent_type, payload in batch:
+                    if event == "add":
+                        self.indexed_messages += self._index(conn, session_id, user_id, agent_type, payload)
+                    else:
+                        self._delete(conn, payload, user_id, agent_type)
+        except Exception as e:
+            print(f"❌ 更新搜索索引失敗: {e}")
+        self.last_batch_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    def _index(self, conn: sqlite3.Connection, session_id: str, user_id: int, agent_type: str,
+               messages: List[Dict[str, Any]]) -> int:
+        """索引新消息（已索引的消息ID跳過，重放和補齊不會重複）"""
+        last_id = conn.execute(self.SQL_LAST_ID, (user_id, agent_type, session_id)).fetchone()[0]
+        owner = f"u{user_id}"
+        indexed = 0
+        for message in messages:
+            if message.get("id", 0) <= last_id:
+                continue
+            content = str(message.get("content", ""))
+            cursor = conn.execute(self.SQL_INSERT_DOC, (
+                session_id, user_id, agent_type, message.get("id", 0),
+                message.get("role", "unknown"), content, message.get("created_at", "")
+            ))
+            conn.execute(self.SQL_INSERT_FTS, (cursor.lastrowid, " ".join(tokenize(content)), owner))
+            indexed += 1
+        return indexed
+
+    def _delete(self, conn: sqlite3.Connection, session_ids: List[str], user_id: int, agent_type: str):
+        params = [(user_id, agent_type, sid) for sid in session_ids]
+        conn.executemany(self.SQL_DELETE_FTS, params)
+        conn.executemany(self.SQL_DELETE_DOCS, params)
+
+    def _backfill(self, storage, reset: bool) -> Dict[str, Any]:
+        """在索引線程中執行：之後入隊的實時更新按消息ID去重，刪除在補齊完成後照常生效"""
+        started = time.perf_counter()
+        conn = self._conn()
+        if reset:
+            with conn:
+                conn.execute("DELETE FROM search_fts")
+                conn.execute("DELETE FROM search_docs")
+        sessions = indexed = 0
+        for user_id, agent_type in storage.list_session_groups():
+            for session in storage.list_sessions(user_id, agent_type):
+                session_id = session["session_id"]
+                sessions += 1
+                after_id = conn.execute(self.SQL_LAST_ID, (user_id, agent_type, session_id)).fetchone()[0]
+                while True:
+                    # 讀取存儲時不持有索引的寫事務（SQLite 後端同庫，寫後緩衝刷盤會等待同一把寫鎖）
+                    messages = storage.load_messages_after(session_id, user_id, agent_type, after_id, BACKFILL_CHUNK)
+                    if not messages:
+                        break
+                    with conn:
+                        indexed += self._index(conn, session_id, user_id, agent_type, messages)
+                    after_id = messages[-1].get("id", after_id)
+                    if len(messages) < BACKFILL_CHUNK:
+                        break
+        self.indexed_messages += indexed
+        report = {
+            "reset": reset,
+            "sessions": sessions,
+            "indexed_messages": indexed,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3)
+        }
+        self.last_rebuild = report
+        self.needs_backfill = False
+        print(f"🔎 {'重建' if reset else '補齊'}搜索索引: {sessions} 個會話, {indexed} 條消息")
+        return report
+
+    # ---------- 查詢 ----------
+
+    def search(self, user_id: int, query: str, agent_type: Optional[str] = None,
+               session_id: Optional[str] = None, since: Optional[str] = None,
+               until: Optional[str] = None, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+        """
+        搜索用戶的聊天記錄，按 BM25 相關度排序。
+        先要求包含全部查詢詞；沒有結果時退回包含任一查詢詞（自然語言查詢中常有無關詞）。
+        since / until 按消息 created_at 過濾（since <= created_at < until）。
+        """
+        started = time.perf_counter()
+        terms = list(dict.fromkeys(tokenize(query, for_query=True)))
+        result: Dict[str, Any] = {"query": query, "terms": terms, "results": [], "has_more": False, "match": "all"}
+        if not terms:
+            return result
+
+        filters, params = [], []
+        for column, op, value in (("agent_type", "=", agent_type), ("session_id", "=", session_id),
+                                  ("created_at", ">=", since), ("created_at", "<", until)):
+            if value is not None:
+                filters.append(f"d.{column} {op} ?")
+                params.append(value)
+        sql = (
+            "SELECT d.session_id, d.user_id, d.agent_type, d.message_id, d.role, d.content, d.created_at, "
+            "bm25(search_fts, 1.0, 0.0) AS score "
+            "FROM search_fts JOIN search_docs d ON d.rowid = search_fts.rowid "
+            "WHERE search_fts MATCH ?" + "".join(f" AND {f}" for f in filters) +
+            " ORDER BY score LIMIT ? OFFSET ?"
+        )
+
+        conn = self._conn()
+        for mode, joiner in (("all", " AND "), ("any", " OR ")):
+            if mode == "any" and len(terms) == 1:
+                break
+            match = f'owner : "u{int(user_id)}" AND tokens : ({joiner.join(_fts_phrase(t) for t in terms)})'
+            rows = conn.execute(sql, [match, *params, limit + 1, offset]).fetchall()
+            if rows:
+                result["match"] = mode
+                break
+
+        result["has_more"] = len(rows) > limit
+        result["results"] = [{
+            "session_id": row["session_id"],
+            "agent_type": row["agent_type"],
+            "message_id": row["message_id"],
+            "role": row["role"],
+            "created_at": row["created_at"],
+            "score": round(-row["score"], 4),
+            "snippet": self._snippet(row["content"], terms)
+        } for row in rows[:limit]]
+        result["next_offset"] = offset + limit if result["has_more"] else None
+        result["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        return result
+
+    @staticmethod
+    def _snippet(content: str, terms: List[str], before: int = 30, after: int = 90) -> str:
+        """截取第一個命中詞附近的內容"""
+        lowered = content.lower()
+        position = min((p for p in (lowered.find(t) for t in terms) if p >= 0), default=0)
+        start = max(0, position - before)
+        end = min(len(content), position + after)
+        return ("…" if start > 0 else "") + content[start:end] + ("…" if end < len(content) else "")
+
+    # ---------- 運行狀態 ----------
+
+    def get_stats(self) -> Dict[str, Any]:
+        documents = self._conn().execute(self.SQL_COUNT_DOCS).fetchone()[0]
+        return {
+            "db_path": str(self.db_path),
+            "documents": documents,
+            "pending_updates": self._queue.qsize(),
+            "indexed_messages": self.indexed_messages,
+            "last_batch_ms": self.last_batch_ms,
+            "needs_backfill": self.needs_backfill,
+            "last_rebuild": self.last_rebuild
+        }
+
+    def close(self):
+        """寫完隊列中的更新後停止索引線程，並標記為正常關閉"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=30)
+        if not self._thread.is_alive() and not self.needs_backfill:
+            with self._conn() as conn:
+                conn.execute(self.SQL_SET_META, ("clean_shutdown", "1"))
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    # 連接屬於其他線程，由該線程退出時釋放
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat history full-text search index")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the index from the chat history store")
+    parser.add_argument("--user-id", type=int, help="user to search")
+    parser.add_argument("--query", help="search query")
+    parser.add_argument("--agent-type", help="only search this agent type")
+    parser.add_argument("--limit", type=int, default=10, help="number of results")
+    args = parser.parse_args()
+
+    from chat_history_manager import chat_history_manager
+
+    if args.rebuild:
+        report = chat_history_manager.rebuild_search_index()
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.query and args.user_id is not None:
+        chat_history_manager.search_index.flush()
+        result = chat_history_manager.search_messages(args.user_id, args.query, agent_type=args.agent_type,
+                                                      limit=args.limit)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    chat_history_manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,764 @@
+"""
+聊天統計計數器
+按 (user_id, agent_type) 增量維護會話數、消息數、按角色的消息數和最後活動時間，
+統計查詢不再掃描聊天記錄，可從存儲完整重建。
+
+- SQLite 後端：計數器保存在聊天數據庫的 chat_stats_* 表中，更新由後台線程分批以事務累加，
+  多個 worker 共用同一份計數器
+- 文件後端：每個用戶一個快照文件（chat_stats/<user_id>.json），更新先追加到 chat_stats.journal，
+  日誌足夠長時只重寫期間有變化的用戶；內存中只緩存最近使用的用戶（單進程使用）
+
+用法: python chat_history_stats.py --rebuild
+"""
+
+import argparse
+import atexit
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+# 日誌累計這麼多條更新後重寫有變化的用戶快照並清空日誌
+JOURNAL_COMPACT_EVENTS = 10000
+
+
+def _empty_group(user_id: int, agent_type: str) -> Dict[str, Any]:
+    return {
+        "user_id": user_id,
+        "agent_type": agent_type,
+        "total_sessions": 0,
+        "total_messages": 0,
+        "messages_by_role": {},
+        "last_activity": None,
+        # 每個會話按角色的消息數（刪除會話時扣減）和已計數的最大消息ID
+        "sessions": {}
+    }
+
+
+def _public(group: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: (dict(v) if isinstance(v, dict) else v) for k, v in group.items() if k != "sessions"}
+
+
+def _totals(groups: Iterator[Dict[str, Any]]) -> Dict[str, Any]:
+    """匯總多個計數組（管理面板）"""
+    users: Set[int] = set()
+    totals: Dict[str, Any] = {
+        "users": 0,
+        "total_sessions": 0,
+        "total_messages": 0,
+        "messages_by_role": {},
+        "by_agent_type": {},
+        "last_activity": None
+    }
+    for group in groups:
+        users.add(group["user_id"])
+        totals["total_sessions"] += group["total_sessions"]
+        totals["total_messages"] += group["total_messages"]
+        for role, count in group["messages_by_role"].items():
+            totals["messages_by_role"][role] = totals["messages_by_role"].get(role, 0) + count
+        agent_totals = totals["by_agent_type"].setdefault(group["agent_type"], {"total_sessions": 0, "total_messages": 0})
+        agent_totals["total_sessions"] += group["total_sessions"]
+        agent_totals["total_messages"] += group["total_messages"]
+        if group["last_activity"]:
+            totals["last_activity"] = max(totals["last_activity"] or "", group["last_activity"])
+    totals["users"] = len(users)
+    return totals
+
+
+class _ChatStatsBase:
+    """
+    兩種計數器存儲共用的部分：更新記入待寫列表由後台線程定期落盤；
+    重建期間的更新同時記入重建日誌，重建完成後按消息ID重放，掃描已包含的消息不會重複計數
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._journal: Optional[List[tuple]] = None
+        self.rebuilding = False
+        self.last_rebuild: Optional[Dict[str, Any]] = None
+
+    def _start(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-stats-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ---------- 增量更新 ----------
+
+    def session_created(self, session_id: str, user_id: int, agent_type: str, created_at: str):
+        self._record(("created", session_id, user_id, agent_type, created_at))
+
+    def messages_added(self, session_id: str, user_id: int, agent_type: str, messages: List[Dict[str, Any]]):
+        # 計數只用到ID、角色和時間，日誌中不保存消息內容
+        counted = [{"id": m.get("id", 0), "role": m.get("role", "unknown"), "created_at": m.get("created_at", "")}
+                   for m in messages]
+        self._record(("added", session_id, user_id, agent_type, counted))
+
+    def session_deleted(self, session_id: str, user_id: int, agent_type: str):
+        self._record(("deleted", session_id, user_id, agent_type, None))
+
+    def _record(self, event: tuple):
+        raise NotImplementedError
+
+    # ---------- 重建 ----------
+
+    def start_background_rebuild(self, storage):
+        """在後台線程重建計數器（首次部署時不阻塞啟動），完成前統計結果帶 rebuilding=True"""
+        self.rebuilding = True
+        threading.Thread(target=self.rebuild, args=(storage,), name="chat-stats-rebuild", daemon=True).start()
+
+    def rebuild(self, storage) -> Dict[str, Any]:
+        """掃描存儲中的全部會話和消息，從頭重建計數器"""
+        with self._rebuild_lock:
+            self.rebuilding = True
+            try:
+                started = time.perf_counter()
+                with self._lock:
+                    self._journal = []
+                report = self._rebuild(storage)
+                report["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+                self.last_rebuild = report
+                print(f"📊 重建聊天統計: {report['sessions']} 個會話, {report['messages']} 條消息")
+                return report
+            except Exception as e:
+                print(f"❌ 重建聊天統計失敗: {e}")
+                with self._lock:
+                    self._journal = None
+                raise
+            finally:
+                self.rebuilding = False
+
+    def _rebuild(self, storage) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def _take_rebuild_journal(self) -> List[tuple]:
+        """結束重建日誌，返回重建期間的更新（調用方持有 _lock）"""
+        journal, self._journal = self._journal or [], None
+        return journal
+
+    @staticmethod
+    def _scan_users(storage, report: Dict[str, Any]) -> Iterator[Tuple[int, Dict[str, Dict[str, Any]]]]:
+        """按用戶逐個掃描存儲，產出 (user_id, {agent_type: 計數組})，同一時刻只持有一個用戶的計數"""
+        user_groups: Dict[str, Dict[str, Any]] = {}
+        current_user: Optional[int] = None
+        for user_id, agent_type in sorted(storage.list_session_groups()):
+            if user_id != current_user and user_groups:
+                yield current_user, user_groups
+                user_groups = {}
+            current_user = user_id
+            group = user_groups[agent_type] = _empty_group(user_id, agent_type)
+            for session in storage.list_sessions(user_id, agent_type):
+                session_counts = {"roles": {}, "last_id": 0}
+                for message in storage.load_messages(session["session_id"], user_id, agent_type):
+                    role = message.get("role", "unknown")
+                    session_counts["roles"][role] = session_counts["roles"].get(role, 0) + 1
+                    session_counts["last_id"] = max(session_counts["last_id"], message.get("id", 0))
+                    report["messages"] += 1
+                group["sessions"][session["session_id"]] = session_counts
+                group["total_sessions"] += 1
+                for role, count in session_counts["roles"].items():
+                    group["messages_by_role"][role] = group["messages_by_role"].get(role, 0) + count
+                    group["total_messages"] += count
+                activity = session.get("updated_at") or session.get("created_at") or ""
+                group["last_activity"] = max(group["last_activity"] or "", activity) or None
+            report["groups"] += 1
+            report["sessions"] += group["total_sessions"]
+        if user_groups:
+            yield current_user, user_groups
+
+    # ---------- 落盤 ----------
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+class ChatStatsStore(_ChatStatsBase):
+    """
+    文件後端的計數器：每個用戶一個快照文件，更新追加到日誌文件；
+    日誌足夠長時在鎖內複製有變化的用戶、在鎖外寫這些用戶的快照並清空日誌，落盤不阻塞統計更新。
+    內存中只保留最近使用的 max_cached_users 個用戶（尚未寫入快照的用戶不會被淘汰）
+    """
+
+    def __init__(self, data_dir: Path, flush_interval: float = 5.0, max_cached_users: int = 10000):
+        super().__init__(flush_interval)
+        self.data_dir = Path(data_dir)
+        self.journal_file = self.data_dir.with_suffix(".journal")
+        self.legacy_file = self.data_dir.with_suffix(".json")
+        self.max_cached_users = max_cached_users
+        self._users: "OrderedDict[int, Dict[str, Dict[str, Any]]]" = OrderedDict()
+        # 有更新尚未寫入自己快照文件的用戶
+        self._dirty: Set[int] = set()
+        self._journal_events = 0
+        self._snapshot_due = False
+        self._load()
+        self.exists = self.data_dir.exists()
+        self._start()
+
+    def _user_file(self, user_id: int, data_dir: Optional[Path] = None) -> Path:
+        return (data_dir or self.data_dir) / f"{user_id}.json"
+
+    def _read_user_file(self, path: Path) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"❌ 讀取聊天統計失敗 {path.name}: {e}")
+            return {}
+
+    def _load(self):
+        """轉換舊版單文件快照並重放日誌文件（調用時尚未啟動後台線程）"""
+        if self.legacy_file.exists() and not self.data_dir.exists():
+            self._split_legacy_snapshot()
+        if self.journal_file.exists():
+            try:
+                with open(self.journal_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            continue    # 寫入中斷留下的半行
+                        self._apply(*event)
+                        self._journal_events += 1
+            except Exception as e:
+                print(f"❌ 讀取聊天統計日誌失敗: {e}")
+
+    def _split_legacy_snapshot(self):
+        """舊版 chat_stats.json 拆分為按用戶的快照文件"""
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                groups = json.load(f).get("groups", {})
+        except Exception as e:
+            print(f"❌ 讀取聊天統計失敗: {e}")
+            return
+        by_user: Dict[int, Dict[str, Dict[str, Any]]] = {}
+        for group in groups.values():
+            by_user.setdefault(group["user_id"], {})[group["agent_type"]] = group
+        staging_dir = self.data_dir.with_name(self.data_dir.name + ".split")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.mkdir(parents=True)
+        for user_id, user_groups in by_user.items():
+            self._write_json(self._user_file(user_id, staging_dir), user_groups)
+        os.replace(staging_dir, self.data_dir)
+        self.legacy_file.unlink()
+
+    def _user(self, user_id: int) -> Dict[str, Dict[str, Any]]:
+        """獲取用戶的計數組，未緩存時讀取快照文件（調用方持有 _lock）"""
+        groups = self._users.get(user_id)
+        if groups is None:
+            groups = self._users[user_id] = self._read_user_file(self._user_file(user_id))
+            self._evict()
+        else:
+            self._users.move_to_end(user_id)
+        return groups
+
+    def _evict(self):
+        excess = len(self._users) - self.max_cached_users
+        if excess <= 0:
+            return
+        # 剛載入的用戶（最後一個）不淘汰，調用方還要使用它
+        clean = [uid for uid in list(self._users)[:-1] if uid not in self._dirty]
+        for user_id in clean[:excess]:
+            del self._users[user_id]
+
+    def _group(self, user_id: int, agent_type: str) -> Dict[str, Any]:
+        """獲取要修改的計數組並標記用戶待寫（調用方持有 _lock）"""
+        groups = self._user(user_id)
+        group = groups.get(agent_type)
+        if group is None:
+            group = groups[agent_type] = _empty_group(user_id, agent_type)
+        self._dirty.add(user_id)
+        return group
+
+    # ---------- 增量更新 ----------
+
+    def _record(self, event: tuple):
+        with self._lock:
+            self._apply(*event)
+            self._pending.append(event)
+            if self._journal is not None:
+                self._journal.append(event)
+
+    def _apply(self, event: str, session_id: str, user_id: int, agent_type: str, payload: Any):
+        """應用一條更新（調用方持有 _lock）"""
+        if event == "created":
+            self._apply_created(session_id, user_id, agent_type, payload)
+        elif event == "added":
+            self._apply_added(session_id, user_id, agent_type, payload)
+        else:
+            self._apply_deleted(session_id, user_id, agent_type)
+
+    def _apply_created(self, session_id: str, user_id: int, agent_type: str, created_at: str):
+        group = self._group(user_id, agent_type)
+        if session_id not in group["sessions"]:
+            group["sessions"][session_id] = {"roles": {}, "last_id": 0}
+            group["total_sessions"] += 1
+        group["last_activity"] = max(group["last_activity"] or "", created_at)
+
+    def _apply_added(self, session_id: str, user_id: int, agent_type: str, messages: List[Dict[str, Any]]):
+        group = self._group(user_id, agent_type)
+        session_counts = group["sessions"].setdefault(session_id, {"roles": {}, "last_id": 0})
+        for message in messages:
+            if message.get("id", 0) <= session_counts["last_id"]:
+                continue
+            role = message.get("role", "unknown")
+            session_counts["roles"][role] = session_counts["roles"].get(role, 0) + 1
+            session_counts["last_id"] = message.get("id", 0)
+            group["messages_by_role"][role] = group["messages_by_role"].get(role, 0) + 1
+            group["total_messages"] += 1
+            group["last_activity"] = max(group["last_activity"] or "", message.get("created_at", ""))
+
+    def _apply_deleted(self, session_id: str, user_id: int, agent_type: str):
+        group = self._group(user_id, agent_type)
+        session_counts = group["sessions"].pop(session_id, None)
+        if session_counts is None:
+            return
+        group["total_sessions"] = max(0, group["total_sessions"] - 1)
+        for role, count in session_counts["roles"].items():
+            group["messages_by_role"][role] = max(0, group["messages_by_role"].get(role, 0) - count)
+            group["total_messages"] = max(0, group["total_messages"] - count)
+
+    # ---------- 查詢 ----------
+
+    def get(self, user_id: int, agent_type: str) -> Dict[str, Any]:
+        with self._lock:
+            group = self._user(user_id).get(agent_type) or _empty_group(user_id, agent_type)
+            stats = _public(group)
+        stats["rebuilding"] = self.rebuilding
+        return stats
+
+    def get_user(self, user_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [_public(g) for g in self._user(user_id).values()]
+
+    def _iter_all_groups(self) -> Iterator[Dict[str, Any]]:
+        """所有用戶的計數組：緩存中的用戶用內存中的計數，其餘讀快照文件"""
+        with self._lock:
+            cached = {user_id: [_public(g) for g in groups.values()] for user_id, groups in self._users.items()}
+        for groups in cached.values():
+            yield from groups
+        if not self.data_dir.exists():
+            return
+        for path in self.data_dir.glob("*.json"):
+            if path.stem.isdigit() and int(path.stem) not in cached:
+                for group in self._read_user_file(path).values():
+                    yield _public(group)
+
+    def get_totals(self) -> Dict[str, Any]:
+        """所有用戶的匯總（管理面板）"""
+        totals = _totals(self._iter_all_groups())
+        totals["last_rebuild"] = self.last_rebuild
+        totals["rebuilding"] = self.rebuilding
+        return totals
+
+    # ---------- 重建 ----------
+
+    def _rebuild(self, storage) -> Dict[str, Any]:
+        # 新快照寫入臨時目錄，完成後整體替換
+        report: Dict[str, Any] = {"groups": 0, "sessions": 0, "messages": 0}
+        staging_dir = self.data_dir.with_name(self.data_dir.name + ".rebuild")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.mkdir(parents=True)
+        for user_id, user_groups in self._scan_users(storage, report):
+            self._write_json(self._user_file(user_id, staging_dir), user_groups)
+
+        retired_dir = self.data_dir.with_name(self.data_dir.name + ".old")
+        shutil.rmtree(retired_dir, ignore_errors=True)
+        with self._io_lock:
+            with self._lock:
+                journal = self._take_rebuild_journal()
+                if self.data_dir.exists():
+                    os.replace(self.data_dir, retired_dir)
+                os.replace(staging_dir, self.data_dir)
+                self._users.clear()
+                self._dirty.clear()
+                # 新快照已包含重建開始前的更新；重建期間的更新重放後由下一次落盤寫入快照並清空日誌
+                self._pending = []
+                for event in journal:
+                    self._apply(*event)
+                self._snapshot_due = True
+                report["replayed_updates"] = len(journal)
+        shutil.rmtree(retired_dir, ignore_errors=True)
+        self.flush()
+        self.exists = True
+        return report
+
+    # ---------- 落盤 ----------
+
+    def flush(self):
+        """把待寫更新追加到日誌文件；日誌足夠長（或重建之後）改為重寫有變化的用戶快照並清空日誌"""
+        with self._io_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+                snapshot = None
+                if self._snapshot_due or self._journal_events + len(events) >= JOURNAL_COMPACT_EVENTS:
+                    # 鎖內只複製有變化的用戶，序列化在鎖外進行
+                    snapshot = {user_id: {agent_type: self._copy_group(group)
+                                          for agent_type, group in self._users[user_id].items()}
+                                for user_id in self._dirty}
+                    self._dirty = set()
+                    self._snapshot_due = False
+            if snapshot is None and not events:
+                return
+            try:
+                if snapshot is not None:
+                    self._write_snapshots(snapshot)
+                else:
+                    self._append_journal(events)
+            except Exception as e:
+                with self._lock:
+                    if snapshot is not None:
+                        self._dirty |= set(snapshot)
+                        self._snapshot_due = True
+                    else:
+                        self._pending[:0] = events
+                print(f"❌ 保存聊天統計失敗: {e}")
+
+    @staticmethod
+    def _copy_group(group: Dict[str, Any]) -> Dict[str, Any]:
+        copied = dict(group)
+        copied["messages_by_role"] = dict(group["messages_by_role"])
+        copied["sessions"] = {session_id: {"roles": dict(counts["roles"]), "last_id": counts["last_id"]}
+                              for session_id, counts in group["sessions"].items()}
+        return copied
+
+    @staticmethod
+    def _write_json(path: Path, data: Dict[str, Any]):
+        tmp_file = path.with_suffix(".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_file, path)
+
+    def _write_snapshots(self, users: Dict[int, Dict[str, Dict[str, Any]]]):
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        for user_id, user_groups in users.items():
+            self._write_json(self._user_file(user_id), user_groups)
+        # 日誌已併入快照；刪除而不是清空，沒有未壓縮更新時不留下空日誌文件
+        self.journal_file.unlink(missing_ok=True)
+        self._journal_events = 0
+
+    def _append_journal(self, events: List[tuple]):
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events))
+        self._journal_events += len(events)
+
+
+class SQLiteChatStatsStore(_ChatStatsBase):
+    """
+    SQLite 後端的計數器：保存在聊天數據庫中，按組（用戶+類型）和按會話各一張計數表。
+    更新在內存中排隊，由後台線程（或查詢前）在一個 BEGIN IMMEDIATE 事務中以增量方式寫入，
+    多個 worker 各自累加，互不覆蓋；每條更新可重複應用（消息按ID去重），重建期間的重放不會重複計數
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chat_stats_groups (
+            user_id INTEGER NOT NULL,
+            agent_type TEXT NOT NULL,
+            total_sessions INTEGER NOT NULL,
+            total_messages INTEGER NOT NULL,
+            last_activity TEXT,
+            PRIMARY KEY (user_id, agent_type)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chat_stats_group_roles (
+            user_id INTEGER NOT NULL,
+            agent_type TEXT NOT NULL,
+            role TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, agent_type, role)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chat_stats_sessions (
+            user_id INTEGER NOT NULL,
+            agent_type TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, agent_type, session_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chat_stats_session_roles (
+            user_id INTEGER NOT NULL,
+            agent_type TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, agent_type, session_id, role)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chat_stats_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    SQL_ADD_GROUP = (
+        "INSERT INTO chat_stats_groups (user_id, agent_type, total_sessions, total_messages, last_activity) "
+        "VALUES (?, ?, MAX(0, ?), MAX(0, ?), NULLIF(?, '')) ON CONFLICT (user_id, agent_type) DO UPDATE SET "
+        "total_sessions = MAX(0, total_sessions + ?), total_messages = MAX(0, total_messages + ?), "
+        "last_activity = NULLIF(MAX(COALESCE(last_activity, ''), COALESCE(excluded.last_activity, '')), '')"
+    )
+    SQL_ADD_GROUP_ROLE = (
+        "INSERT INTO chat_stats_group_roles (user_id, agent_type, role, count) VALUES (?, ?, ?, MAX(0, ?)) "
+        "ON CONFLICT (user_id, agent_type, role) DO UPDATE SET count = MAX(0, count + ?)"
+    )
+    SQL_ADD_SESSION_ROLE = (
+        "INSERT INTO chat_stats_session_roles (user_id, agent_type, session_id, role, count) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_id, agent_type, session_id, role) DO UPDATE SET count = count + excluded.count"
+    )
+    SQL_INSERT_SESSION = (
+        "INSERT OR IGNORE INTO chat_stats_sessions (user_id, agent_type, session_id, last_id) VALUES (?, ?, ?, 0)"
+    )
+    SQL_SET_SESSION_LAST_ID = (
+        "INSERT INTO chat_stats_sessions (user_id, agent_type, session_id, last_id) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (user_id, agent_type, session_id) DO UPDATE SET last_id = excluded.last_id"
+    )
+    SQL_SESSION_LAST_ID = "SELECT last_id FROM chat_stats_sessions WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    SQL_SESSION_ROLES = (
+        "SELECT role, count FROM chat_stats_session_roles WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    )
+    SQL_DELETE_SESSION = "DELETE FROM chat_stats_sessions WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    SQL_DELETE_SESSION_ROLES = (
+        "DELETE FROM chat_stats_session_roles WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    )
+    SQL_GROUPS_OF_USER = (
+        "SELECT user_id, agent_type, total_sessions, total_messages, last_activity FROM chat_stats_groups "
+        "WHERE user_id = ? ORDER BY agent_type"
+    )
+    SQL_GROUP = (
+        "SELECT user_id, agent_type, total_sessions, total_messages, last_activity FROM chat_stats_groups "
+        "WHERE user_id = ? AND agent_type = ?"
+    )
+    SQL_GROUP_ROLES = "SELECT role, count FROM chat_stats_group_roles WHERE user_id = ? AND agent_type = ?"
+    SQL_ALL_GROUP_KEYS = "SELECT user_id, agent_type FROM chat_stats_groups"
+    SQL_SET_META = "INSERT OR REPLACE INTO chat_stats_meta (key, value) VALUES (?, ?)"
+    SQL_GET_META = "SELECT value FROM chat_stats_meta WHERE key = ?"
+
+    # 重建時替換一個組的全部計數
+    GROUP_TABLES = ("chat_stats_groups", "chat_stats_group_roles", "chat_stats_sessions", "chat_stats_session_roles")
+
+    def __init__(self, db_path: Path, flush_interval: float = 2.0):
+        super().__init__(flush_interval)
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        conn = self._conn()
+        with conn:
+            conn.executescript(self.SCHEMA)
+        self.exists = conn.execute(self.SQL_GET_META, ("built_at",)).fetchone() is not None
+        self._start()
+
+    def _conn(self) -> sqlite3.Connection:
+        """獲取當前線程的連接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    # ---------- 增量更新 ----------
+
+    def _record(self, event: tuple):
+        with self._lock:
+            self._pending.append(event)
+            if self._journal is not None:
+                self._journal.append(event)
+
+    def _apply(self, conn: sqlite3.Connection, event: str, session_id: str, user_id: int, agent_type: str, payload: Any):
+        """在事務中應用一條更新"""
+        if event == "created":
+            created = conn.execute(self.SQL_INSERT_SESSION, (user_id, agent_type, session_id)).rowcount
+            conn.execute(self.SQL_ADD_GROUP, (user_id, agent_type, created, 0, payload or "", created, 0))
+        elif event == "added":
+            row = conn.execute(self.SQL_SESSION_LAST_ID, (user_id, agent_type, session_id)).fetchone()
+            last_id = row[0] if row else 0
+            roles: Dict[str, int] = {}
+            last_activity = ""
+            for message in payload:
+                if message.get("id", 0) <= last_id:
+                    continue
+                role = message.get("role", "unknown")
+                roles[role] = roles.get(role, 0) + 1
+                last_id = message.get("id", 0)
+                last_activity = max(last_activity, message.get("created_at", ""))
+            if not roles:
+                return
+            conn.execute(self.SQL_SET_SESSION_LAST_ID, (user_id, agent_type, session_id, last_id))
+            for role, count in roles.items():
+                conn.execute(self.SQL_ADD_SESSION_ROLE, (user_id, agent_type, session_id, role, count))
+                conn.execute(self.SQL_ADD_GROUP_ROLE, (user_id, agent_type, role, count, count))
+            total = sum(roles.values())
+            conn.execute(self.SQL_ADD_GROUP, (user_id, agent_type, 0, total, last_activity, 0, total))
+        else:
+            roles = dict(conn.execute(self.SQL_SESSION_ROLES, (user_id, agent_type, session_id)).fetchall())
+            if not conn.execute(self.SQL_DELETE_SESSION, (user_id, agent_type, session_id)).rowcount:
+                return
+            conn.execute(self.SQL_DELETE_SESSION_ROLES, (user_id, agent_type, session_id))
+            for role, count in roles.items():
+                conn.execute(self.SQL_ADD_GROUP_ROLE, (user_id, agent_type, role, -count, -count))
+            total = sum(roles.values())
+            conn.execute(self.SQL_ADD_GROUP, (user_id, agent_type, -1, -total, "", -1, -total))
+
+    # ---------- 查詢（先寫入本進程待寫的更新） ----------
+
+    def _group_stats(self, conn: sqlite3.Connection, row: sqlite3.Row) -> Dict[str, Any]:
+        stats = dict(row)
+        stats["messages_by_role"] = dict(conn.execute(self.SQL_GROUP_ROLES, (row["user_id"], row["agent_type"])).fetchall())
+        return stats
+
+    def get(self, user_id: int, agent_type: str) -> Dict[str, Any]:
+        self.flush()
+        conn = self._conn()
+        row = conn.execute(self.SQL_GROUP, (user_id, agent_type)).fetchone()
+        stats = self._group_stats(conn, row) if row else _public(_empty_group(user_id, agent_type))
+        stats["rebuilding"] = self.rebuilding
+        return stats
+
+    def get_user(self, user_id: int) -> List[Dict[str, Any]]:
+        self.flush()
+        conn = self._conn()
+        return [self._group_stats(conn, row) for row in conn.execute(self.SQL_GROUPS_OF_USER, (user_id,)).fetchall()]
+
+    def get_totals(self) -> Dict[str, Any]:
+        """所有用戶的匯總（管理面板），在數據庫中聚合"""
+        self.flush()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT COUNT(DISTINCT user_id), COALESCE(SUM(total_sessions), 0), COALESCE(SUM(total_messages), 0), "
+            "MAX(last_activity) FROM chat_stats_groups"
+        ).fetchone()
+        totals: Dict[str, Any] = {
+            "users": row[0],
+            "total_sessions": row[1],
+            "total_messages": row[2],
+            "messages_by_role": dict(conn.execute(
+                "SELECT role, SUM(count) FROM chat_stats_group_roles GROUP BY role").fetchall()),
+            "by_agent_type": {
+                agent_type: {"total_sessions": sessions, "total_messages": messages}
+                for agent_type, sessions, messages in conn.execute(
+                    "SELECT agent_type, SUM(total_sessions), SUM(total_messages) FROM chat_stats_groups GROUP BY agent_type")
+            },
+            "last_activity": row[3],
+            "last_rebuild": self.last_rebuild,
+            "rebuilding": self.rebuilding
+        }
+        return totals
+
+    # ---------- 重建 ----------
+
+    def _rebuild(self, storage) -> Dict[str, Any]:
+        # 每個組一個短事務替換計數，不長時間佔用聊天數據庫的寫鎖
+        report: Dict[str, Any] = {"groups": 0, "sessions": 0, "messages": 0}
+        conn = self._conn()
+        scanned: Set[Tuple[int, str]] = set()
+        for user_id, user_groups in self._scan_users(storage, report):
+            for agent_type, group in user_groups.items():
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    self._replace_group(conn, user_id, agent_type, group)
+                scanned.add((user_id, agent_type))
+        stale = [tuple(row) for row in conn.execute(self.SQL_ALL_GROUP_KEYS).fetchall() if tuple(row) not in scanned]
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for user_id, agent_type in stale:
+                self._replace_group(conn, user_id, agent_type, None)
+            conn.execute(self.SQL_SET_META, ("built_at", str(time.time())))
+        with self._lock:
+            # 重建期間的更新再應用一次（可重複應用），補上掃描之後才發生的變化
+            journal = self._take_rebuild_journal()
+            self._pending = journal + self._pending
+            report["replayed_updates"] = len(journal)
+        self.flush()
+        self.exists = True
+        return report
+
+    def _replace_group(self, conn: sqlite3.Connection, user_id: int, agent_type: str, group: Optional[Dict[str, Any]]):
+        for table in self.GROUP_TABLES:
+            conn.execute(f"DELETE FROM {table} WHERE user_id = ? AND agent_type = ?", (user_id, agent_type))
+        if group is None:
+            return
+        conn.execute(self.SQL_ADD_GROUP, (user_id, agent_type, group["total_sessions"], group["total_messages"],
+                                          group["last_activity"] or "", 0, 0))
+        conn.executemany(self.SQL_ADD_GROUP_ROLE, [(user_id, agent_type, role, count, 0)
+                                                   for role, count in group["messages_by_role"].items()])
+        conn.executemany(self.SQL_SET_SESSION_LAST_ID, [(user_id, agent_type, session_id, counts["last_id"])
+                                                        for session_id, counts in group["sessions"].items()])
+        conn.executemany(self.SQL_ADD_SESSION_ROLE, [(user_id, agent_type, session_id, role, count)
+                                                     for session_id, counts in group["sessions"].items()
+                                                     for role, count in counts["roles"].items()])
+
+    # ---------- 落盤 ----------
+
+    def flush(self):
+        """把待寫更新在一個事務中寫入數據庫；失敗時留在隊列中下次重試"""
+        with self._io_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+            if not events:
+                return
+            conn = self._conn()
+            try:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for event in events:
+                        self._apply(conn, *event)
+            except Exception as e:
+                with self._lock:
+                    self._pending[:0] = events
+                print(f"❌ 保存聊天統計失敗: {e}")
+
+    def close(self):
+        super().close()
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    # 連接屬於其他線程，由該線程退出時釋放
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def create_stats_store(backend: str, base_dir: Path, db_path: Optional[Path] = None) -> _ChatStatsBase:
+    """SQLite 後端時計數器與聊天記錄同庫，文件後端使用按用戶的快照文件"""
+    if backend == "sqlite":
+        return SQLiteChatStatsStore(db_path)
+    return ChatStatsStore(Path(base_dir) / "chat_stats")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat history statistics counters")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild all counters from the chat history store")
+    args = parser.parse_args()
+
+    from chat_history_manager import chat_history_manager
+
+    if args.rebuild:
+        report = chat_history_manager.rebuild_stats()
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(json.dumps(chat_history_manager.stats.get_totals(), ensure_ascii=False, indent=2))
+    chat_history_manager.close()
+
+
+if __name__ == "__main__":
+    main()
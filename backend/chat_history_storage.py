@@ -0,0 +1,1107 @@
+"""
+聊天記錄存儲後端
+ChatHistoryManager 通過統一的存儲接口讀寫會話與消息，可選 JSON 文件或 SQLite (WAL)
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+
+class ChatHistoryStorage:
+    """存儲後端接口 - 會話以 (user_id, agent_type) 分組，消息以 session_id 分組"""
+
+    name = "base"
+
+    def insert_session(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        """插入會話並分配遞增的 id"""
+        raise NotImplementedError
+
+    def list_sessions(self, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        """獲取會話列表（按 updated_at 倒序，相同時按 session_id 倒序）"""
+        raise NotImplementedError
+
+    def touch_sessions(self, session_ids: List[str], user_id: int, agent_type: str, updated_at: str):
+        """更新會話時間"""
+        raise NotImplementedError
+
+    def touch_sessions_at(self, updates: Dict[str, str], user_id: int, agent_type: str):
+        """按會話分別更新時間（{session_id: updated_at}），時間相同的會話一起更新"""
+        by_time: Dict[str, List[str]] = {}
+        for session_id, updated_at in updates.items():
+            by_time.setdefault(updated_at, []).append(session_id)
+        for updated_at, session_ids in by_time.items():
+            self.touch_sessions(session_ids, user_id, agent_type, updated_at)
+
+    def list_session_groups(self) -> List[Tuple[int, str]]:
+        """列出所有存在會話的 (user_id, agent_type)"""
+        raise NotImplementedError
+
+    def delete_session(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        """刪除會話及其消息"""
+        raise NotImplementedError
+
+    def delete_sessions(self, session_ids: List[str], user_id: int, agent_type: str) -> int:
+        """批量刪除同一 (user_id, agent_type) 下的多個會話，返回刪除數量"""
+        for session_id in session_ids:
+            self.delete_session(session_id, user_id, agent_type)
+        return len(session_ids)
+
+    def compact(self) -> Dict[str, Any]:
+        """整理存儲空間，返回執行結果"""
+        return {}
+
+    def compress_session(self, session_id: str, user_id: int, agent_type: str) -> Optional[Tuple[int, int]]:
+        """把會話移入壓縮層，返回 (壓縮前字節, 壓縮後字節)；不支持或無需壓縮時返回 None"""
+        return None
+
+    def load_messages(self, session_id: str, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        """獲取會話的全部消息（按 id 排序）"""
+        raise NotImplementedError
+
+    def append_messages(self, session_id: str, user_id: int, agent_type: str,
+                        messages: List[Dict[str, Any]], first_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """追加消息並分配 id，返回保存後的消息"""
+        raise NotImplementedError
+
+    def count_messages(self, session_id: str, user_id: int, agent_type: str) -> int:
+        """統計會話消息數"""
+        return len(self.load_messages(session_id, user_id, agent_type))
+
+    def load_recent_messages(self, session_id: str, user_id: int, agent_type: str, limit: int) -> List[Dict[str, Any]]:
+        """獲取會話最近的 limit 條消息"""
+        messages = self.load_messages(session_id, user_id, agent_type)
+        return messages[-limit:] if limit > 0 else []
+
+    def load_messages_before(self, session_id: str, user_id: int, agent_type: str,
+                             before_id: Optional[int], limit: int) -> List[Dict[str, Any]]:
+        """獲取 id < before_id 的最後 limit 條消息（按 id 排序）；before_id 為空時等同最近消息"""
+        if before_id is None:
+            return self.load_recent_messages(session_id, user_id, agent_type, limit)
+        messages = [m for m in self.load_messages(session_id, user_id, agent_type) if m.get("id", 0) < before_id]
+        return messages[-limit:] if limit > 0 else []
+
+    def load_messages_after(self, session_id: str, user_id: int, agent_type: str,
+                            after_id: int, limit: int) -> List[Dict[str, Any]]:
+        """獲取 id > after_id 的前 limit 條消息（增量同步）"""
+        messages = [m for m in self.load_messages(session_id, user_id, agent_type) if m.get("id", 0) > after_id]
+        return messages[:limit]
+
+    def iter_messages(self, session_id: str, user_id: int, agent_type: str, chunk_size: int = 500) -> Iterator[Dict[str, Any]]:
+        """按 id 順序逐條遍歷會話消息（批量導出），每個記錄只讀取解析一次"""
+        yield from self.load_messages(session_id, user_id, agent_type)
+
+    def close(self):
+        """釋放資源"""
+
+
+class JSONFileStorage(ChatHistoryStorage):
+    """
+    JSON 文件存儲 - 每個會話一個文件，每個 (user_id, agent_type) 一個會話列表文件。
+    sharded=True 時聊天記錄按哈希分散到 {agent_type}/ab/cd/ 子目錄；
+    舊的平鋪文件仍可讀取，寫入時或由後台遷移器移入分片目錄。
+    """
+
+    name = "json"
+
+    # 同一會話的所有文件後綴（遷移和刪除時一起處理）
+    SESSION_FILE_SUFFIXES = (".json.gz", ".json")
+
+    # 可移入壓縮層的聊天記錄文件後綴
+    TRANSCRIPT_SUFFIXES = (".json",)
+    COMPRESSED_SUFFIX = ".gz"
+
+    def __init__(self, base_dir: Path, sharded: bool = False):
+        self.base_dir = Path(base_dir)
+        self.base_dir.mkdir(exist_ok=True)
+        self.sharded = sharded
+        self._layout_lock = threading.RLock()
+        self._migrator: Optional[threading.Thread] = None
+        self._migrator_stop = threading.Event()
+        self.migration_progress: Dict[str, Any] = {"moved_sessions": 0, "remaining": None, "finished_at": None}
+        self._linked_sessions: set = set()
+
+        # 壓縮層統計
+        self.compression_stats: Dict[str, int] = {
+            "compressed_sessions": 0, "bytes_before": 0, "bytes_after": 0, "promoted_sessions": 0
+        }
+        self._read_latencies: Dict[str, Deque[float]] = {"plain": deque(maxlen=1000), "compressed": deque(maxlen=1000)}
+
+    @staticmethod
+    def shard_dirs(user_id: int, session_id: str) -> Tuple[str, str]:
+        """分片目錄名，取 "{user_id}_{session_id}" 的 MD5 前四位"""
+        digest = hashlib.md5(f"{user_id}_{session_id}".encode("utf-8")).hexdigest()
+        return digest[:2], digest[2:4]
+
+    def _candidate_paths(self, session_id: str, user_id: int, agent_type: str, suffix: str) -> List[Path]:
+        """按優先順序列出文件可能的位置（分片路徑在前，平鋪路徑作為回退）"""
+        filename = f"{user_id}_{session_id}{suffix}"
+        flat = self.base_dir / agent_type / filename
+        if not self.sharded:
+            return [flat]
+        first, second = self.shard_dirs(user_id, session_id)
+        return [self.base_dir / agent_type / first / second / filename, flat]
+
+    def _locate(self, session_id: str, user_id: int, agent_type: str, suffix: str) -> Path:
+        """返回已存在的文件路徑；都不存在時返回新文件應寫入的路徑"""
+        candidates = self._candidate_paths(session_id, user_id, agent_type, suffix)
+        for path in candidates:
+            if path.exists():
+                return path
+        return candidates[0]
+
+    def _promote_session(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        """
+        把會話的平鋪文件以硬鏈接放入分片目錄（寫入前調用），返回是否有文件被鏈接。
+        平鋪路徑暫時保留，正在讀取舊路徑的請求不受影響，由遷移器在下一輪刪除。
+        """
+        if not self.sharded:
+            return False
+        linked = False
+        with self._layout_lock:
+            for suffix in self.SESSION_FILE_SUFFIXES:
+                target, flat = self._candidate_paths(session_id, user_id, agent_type, suffix)
+                if flat.exists() and not target.exists():
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    try:
+                        os.link(flat, target)
+                    except OSError:
+                        # 文件系統不支持硬鏈接時直接移動
+                        os.replace(flat, target)
+                    linked = True
+        return linked
+
+    def _drop_flat_copies(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        """刪除已有分片副本的平鋪文件，返回是否刪除了文件"""
+        dropped = False
+        with self._layout_lock:
+            for suffix in self.SESSION_FILE_SUFFIXES:
+                target, flat = self._candidate_paths(session_id, user_id, agent_type, suffix)
+                if flat.exists() and target.exists():
+                    flat.unlink()
+                    dropped = True
+        return dropped
+
+    def _unlink_session_files(self, session_id: str, user_id: int, agent_type: str):
+        for suffix in self.SESSION_FILE_SUFFIXES:
+            for path in self._candidate_paths(session_id, user_id, agent_type, suffix):
+                if path.exists():
+                    path.unlink()
+
+    # ---------- 冷數據壓縮層 ----------
+
+    def compress_session(self, session_id: str, user_id: int, agent_type: str) -> Optional[Tuple[int, int]]:
+        """gzip 壓縮會話的聊天記錄（先寫壓縮文件再刪明文，任一時刻至少一份可讀）"""
+        before = after = 0
+        with self._layout_lock:
+            for suffix in self.TRANSCRIPT_SUFFIXES:
+                plain = self._locate(session_id, user_id, agent_type, suffix)
+                if not plain.exists():
+                    continue
+                raw = plain.read_bytes()
+                compressed = plain.with_name(plain.name + self.COMPRESSED_SUFFIX)
+                tmp_file = compressed.with_name(compressed.name + ".tmp")
+                with gzip.open(tmp_file, 'wb', compresslevel=6) as f:
+                    f.write(raw)
+                os.replace(tmp_file, compressed)
+                plain.unlink()
+                before += len(raw)
+                after += compressed.stat().st_size
+            if not before:
+                return None
+            self.compression_stats["compressed_sessions"] += 1
+            self.compression_stats["bytes_before"] += before
+            self.compression_stats["bytes_after"] += after
+        return before, after
+
+    def _restore_compressed(self, session_id: str, user_id: int, agent_type: str, suffix: str) -> bool:
+        """寫入前把壓縮層中的記錄解壓回明文（先寫明文再刪壓縮文件）"""
+        with self._layout_lock:
+            compressed = self._locate(session_id, user_id, agent_type, suffix + self.COMPRESSED_SUFFIX)
+            if not compressed.exists():
+                return False
+            plain = compressed.with_name(compressed.name[:-len(self.COMPRESSED_SUFFIX)])
+            if not plain.exists():
+                tmp_file = plain.with_name(plain.name + ".tmp")
+                with gzip.open(compressed, 'rb') as src, open(tmp_file, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(tmp_file, plain)
+            compressed.unlink()
+            self.compression_stats["promoted_sessions"] += 1
+            return True
+
+    def _read_transcript_bytes(self, session_id: str, user_id: int, agent_type: str, suffix: str) -> Optional[bytes]:
+        """
+        讀取聊天記錄原始內容（明文優先，否則透明解壓），都不存在時返回 None。
+        文件在定位後被遷移/壓縮/解壓時拋出 FileNotFoundError，由調用方重試。
+        """
+        started = time.perf_counter()
+        plain = self._locate(session_id, user_id, agent_type, suffix)
+        if plain.exists():
+            raw = plain.read_bytes()
+            self._read_latencies["plain"].append(time.perf_counter() - started)
+            return raw
+        compressed = self._locate(session_id, user_id, agent_type, suffix + self.COMPRESSED_SUFFIX)
+        if compressed.exists():
+            with gzip.open(compressed, 'rb') as f:
+                raw = f.read()
+            self._read_latencies["compressed"].append(time.perf_counter() - started)
+            return raw
+        return None
+
+    def get_compression_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self.compression_stats)
+        stats["saved_bytes"] = stats["bytes_before"] - stats["bytes_after"]
+        stats["ratio"] = round(stats["bytes_after"] / stats["bytes_before"], 4) if stats["bytes_before"] else None
+        for kind, latencies in self._read_latencies.items():
+            values = sorted(latencies)
+            stats[f"{kind}_reads"] = len(values)
+            stats[f"{kind}_read_avg_ms"] = round(sum(values) / len(values) * 1000, 3) if values else 0.0
+            stats[f"{kind}_read_p95_ms"] = round(values[min(len(values) - 1, int(0.95 * len(values)))] * 1000, 3) if values else 0.0
+        return stats
+
+    def chat_file_path(self, session_id: str, user_id: int, agent_type: str) -> Path:
+        """獲取聊天記錄文件路徑"""
+        # 格式: chat_history/{agent_type}/{user_id}_{session_id}.json
+        # 分片: chat_history/{agent_type}/ab/cd/{user_id}_{session_id}.json
+        return self._locate(session_id, user_id, agent_type, ".json")
+
+    def _flat_session_files(self):
+        """遍歷仍在平鋪目錄中的會話文件，產出 (session_id, user_id, agent_type)"""
+        seen = set()
+        for agent_dir in sorted(p for p in self.base_dir.iterdir() if p.is_dir()):
+            for path in agent_dir.iterdir():
+                name = path.name
+                if not path.is_file() or name.startswith("sessions_"):
+                    continue
+                suffix = next((s for s in self.SESSION_FILE_SUFFIXES if name.endswith(s)), None)
+                if suffix is None:
+                    continue
+                user_id, _, session_id = name[:-len(suffix)].partition("_")
+                if not user_id.isdigit() or not session_id:
+                    continue
+                key = (session_id, int(user_id), agent_dir.name)
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def migrate_to_sharded(self, limit: Optional[int] = None) -> int:
+        """
+        遷移一批平鋪目錄中的會話，返回本輪處理的會話數。
+        第一次遇到的會話鏈接到分片目錄；上一輪已鏈接的會話刪除平鋪路徑。
+        """
+        if not self.sharded:
+            raise ValueError("Storage is not configured with sharded=True")
+        processed = 0
+        for key in self._flat_session_files():
+            if (limit is not None and processed >= limit) or self._migrator_stop.is_set():
+                break
+            try:
+                if key in self._linked_sessions:
+                    if self._drop_flat_copies(*key):
+                        self.migration_progress["moved_sessions"] += 1
+                    self._linked_sessions.discard(key)
+                else:
+                    self._promote_session(*key)
+                    self._linked_sessions.add(key)
+                processed += 1
+            except Exception as e:
+                print(f"❌ 遷移聊天記錄失敗 {key[1]}_{key[0]}: {e}")
+        return processed
+
+    def start_background_migration(self, batch_size: int = 500, pause: float = 0.5):
+        """後台分批遷移到分片目錄；遷移期間讀取自動回退到平鋪路徑"""
+        if self._migrator and self._migrator.is_alive():
+            return
+
+        def run():
+            while not self._migrator_stop.is_set():
+                # 沒有剩餘的平鋪文件時結束（每個會話需要兩輪：鏈接、刪除平鋪路徑）
+                if self.migrate_to_sharded(limit=batch_size) == 0:
+                    self.migration_progress["remaining"] = 0
+                    self.migration_progress["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+                    print(f"📦 聊天記錄分片遷移完成: {self.migration_progress['moved_sessions']} 個會話")
+                    return
+                self._migrator_stop.wait(pause)
+
+        self._migrator_stop.clear()
+        self._migrator = threading.Thread(target=run, name="chat-history-shard-migrator", daemon=True)
+        self._migrator.start()
+
+    def close(self):
+        self._migrator_stop.set()
+        if self._migrator:
+            self._migrator.join(timeout=5)
+
+    def session_file_path(self, user_id: int, agent_type: str) -> Path:
+        """獲取會話列表文件路徑"""
+        # 格式: chat_history/{agent_type}/sessions_{user_id}.json
+        filename = f"sessions_{user_id}.json"
+        return self.base_dir / agent_type / filename
+
+    def _load_sessions(self, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        """載入會話列表"""
+        session_file = self.session_file_path(user_id, agent_type)
+
+        if not session_file.exists():
+            return []
+
+        try:
+            with open(session_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                return data.get("sessions", [])
+        except Exception as e:
+            print(f"❌ 讀取會話列表失敗: {e}")
+            return []
+
+    def _save_sessions(self, user_id: int, agent_type: str, sessions: List[Dict[str, Any]]):
+        """保存會話列表"""
+        session_file = self.session_file_path(user_id, agent_type)
+
+        # 創建目錄（如果不存在）
+        session_file.parent.mkdir(parents=True, exist_ok=True)
+
+        data = {
+            "user_id": user_id,
+            "agent_type": agent_type,
+            "sessions": sessions
+        }
+
+        try:
+            self._write_json_atomic(session_file, data)
+        except Exception as e:
+            print(f"❌ 保存會話列表失敗: {e}")
+
+    @staticmethod
+    def _write_json_atomic(path: Path, data: Dict[str, Any]):
+        """先寫臨時文件再替換，並發讀取只會看到完整的舊文件或新文件"""
+        tmp_file = path.with_name(path.name + ".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, path)
+
+    def insert_session(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        sessions = self._load_sessions(session["user_id"], session["agent_type"])
+        session["id"] = max((s.get("id", 0) for s in sessions), default=0) + 1
+        sessions.append(session)
+        self._save_sessions(session["user_id"], session["agent_type"], sessions)
+        return session
+
+    def list_sessions(self, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        sessions = self._load_sessions(user_id, agent_type)
+        sessions.sort(key=lambda x: (x.get("updated_at", ""), x.get("session_id", "")), reverse=True)
+        return sessions
+
+    def list_session_groups(self) -> List[Tuple[int, str]]:
+        groups = []
+        for session_file in self.base_dir.glob("*/sessions_*.json"):
+            user_id = session_file.stem[len("sessions_"):]
+            if user_id.isdigit():
+                groups.append((int(user_id), session_file.parent.name))
+        return sorted(groups)
+
+    def touch_sessions(self, session_ids: List[str], user_id: int, agent_type: str, updated_at: str):
+        self.touch_sessions_at({session_id: updated_at for session_id in session_ids}, user_id, agent_type)
+
+    def touch_sessions_at(self, updates: Dict[str, str], user_id: int, agent_type: str):
+        # 會話列表只讀寫一次
+        sessions = self._load_sessions(user_id, agent_type)
+        changed = False
+        for session in sessions:
+            updated_at = updates.get(session["session_id"])
+            if updated_at is not None:
+                session["updated_at"] = updated_at
+                changed = True
+        if changed:
+            self._save_sessions(user_id, agent_type, sessions)
+
+    def delete_session(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        # 刪除聊天記錄文件
+        with self._layout_lock:
+            self._unlink_session_files(session_id, user_id, agent_type)
+        print(f"🗑️ 刪除聊天記錄: {session_id}")
+
+        # 從會話列表中移除
+        sessions = self._load_sessions(user_id, agent_type)
+        sessions = [s for s in sessions if s["session_id"] != session_id]
+        self._save_sessions(user_id, agent_type, sessions)
+        return True
+
+    def delete_sessions(self, session_ids: List[str], user_id: int, agent_type: str) -> int:
+        with self._layout_lock:
+            for session_id in session_ids:
+                self._unlink_session_files(session_id, user_id, agent_type)
+
+        # 會話列表只重寫一次
+        removing = set(session_ids)
+        sessions = self._load_sessions(user_id, agent_type)
+        remaining = [s for s in sessions if s["session_id"] not in removing]
+        if len(remaining) != len(sessions):
+            self._save_sessions(user_id, agent_type, remaining)
+        return len(sessions) - len(remaining)
+
+    def load_messages(self, session_id: str, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        # 文件可能在定位後被遷移、壓縮或解壓，此時重新定位一次
+        for _ in range(2):
+            try:
+                raw = self._read_transcript_bytes(session_id, user_id, agent_type, ".json")
+                if raw is None:
+                    return []
+                return json.loads(raw).get("messages", [])
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                print(f"❌ 讀取聊天記錄失敗: {e}")
+                return []
+        return []
+
+    def append_messages(self, session_id: str, user_id: int, agent_type: str,
+                        messages: List[Dict[str, Any]], first_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        self._promote_session(session_id, user_id, agent_type)
+        self._restore_compressed(session_id, user_id, agent_type, ".json")
+        chat_file = self.chat_file_path(session_id, user_id, agent_type)
+
+        # 創建聊天記錄目錄（如果不存在）
+        chat_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # 載入現有聊天記錄
+        data = {"session_id": session_id, "user_id": user_id, "agent_type": agent_type, "messages": []}
+        if chat_file.exists():
+            try:
+                with open(chat_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except:
+                pass
+
+        # 生成消息ID
+        if first_id is None:
+            first_id = max((m.get("id", 0) for m in data.get("messages", [])), default=0) + 1
+
+        saved = []
+        for offset, message in enumerate(messages):
+            message = {"id": first_id + offset, **message}
+            data["messages"].append(message)
+            saved.append(message)
+
+        self._write_json_atomic(chat_file, data)
+        return saved
+
+
+class JSONLFileStorage(JSONFileStorage):
+    """
+    JSON Lines 追加式存儲 - 每條消息一行，追加只寫新行，不再重寫整個文件。
+    旁路頭文件 {user_id}_{session_id}.meta.json 保存下一個消息ID：新建記錄時寫入，
+    之後的追加只記下待更新的頭文件，由後台壓縮器（或 compact / close）批量重寫；
+    頭文件落後時讀取最後一行校正，因此延遲更新不會重複分配ID。
+    讀取時忽略寫到一半的最後一行，舊的 .json 記錄仍可讀取並由後台壓縮器轉換。
+    """
+
+    name = "jsonl"
+
+    # 從文件尾部反向讀取的塊大小
+    TAIL_BLOCK_SIZE = 8192
+
+    # 較長的後綴在前，避免 .meta.json 被當作 .json
+    SESSION_FILE_SUFFIXES = (".meta.json", ".jsonl.gz", ".jsonl", ".json.gz", ".json")
+    TRANSCRIPT_SUFFIXES = (".jsonl", ".json")
+
+    def __init__(self, base_dir: Path, sharded: bool = False, max_cached_ids: int = 10000):
+        super().__init__(base_dir, sharded=sharded)
+        self._lock = threading.RLock()
+        # 最近寫入的會話的下一個消息ID（LRU）；被淘汰的會話下次追加時從頭文件和最後一行重新讀取
+        self.max_cached_ids = max_cached_ids
+        self._next_ids: "OrderedDict[Tuple[str, int, str], int]" = OrderedDict()
+        # 需要重寫的頭文件 {會話: 下一個消息ID}，超過 max_cached_ids 個時立即寫出
+        self._stale_headers: Dict[Tuple[str, int, str], int] = {}
+        self._compactor: Optional[threading.Thread] = None
+        self._compactor_stop = threading.Event()
+
+    def transcript_path(self, session_id: str, user_id: int, agent_type: str) -> Path:
+        """獲取 JSONL 聊天記錄文件路徑"""
+        # 格式: chat_history/{agent_type}/{user_id}_{session_id}.jsonl（分片時在 ab/cd/ 子目錄下）
+        return self._locate(session_id, user_id, agent_type, ".jsonl")
+
+    def header_path(self, session_id: str, user_id: int, agent_type: str) -> Path:
+        """獲取旁路頭文件路徑"""
+        return self._locate(session_id, user_id, agent_type, ".meta.json")
+
+    @staticmethod
+    def _parse_lines(raw: bytes) -> List[Dict[str, Any]]:
+        """解析 JSONL 內容，跳過損壞的行（通常是崩潰時寫到一半的最後一行）"""
+        messages = []
+        for line in raw.split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                messages.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return messages
+
+    def _read_tail(self, path: Path, lines: int) -> List[Dict[str, Any]]:
+        """從文件尾部讀取最後若干行，不解析整個文件"""
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            buffer = b""
+            while position > 0 and buffer.count(b"\n") <= lines:
+                step = min(self.TAIL_BLOCK_SIZE, position)
+                position -= step
+                f.seek(position)
+                buffer = f.read(step) + buffer
+        messages = self._parse_lines(buffer if position == 0 else buffer.split(b"\n", 1)[-1])
+        return messages[-lines:] if lines > 0 else []
+
+    def _iter_reverse(self, path: Path):
+        """從文件尾部逐塊向前讀取，按從新到舊的順序逐條產出消息"""
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b""
+            while position > 0:
+                step = min(self.TAIL_BLOCK_SIZE, position)
+                position -= step
+                f.seek(position)
+                lines = (f.read(step) + remainder).split(b"\n")
+                # 第一段可能是不完整的行，留到下一塊拼接
+                remainder = lines.pop(0) if position > 0 else b""
+                for message in reversed(self._parse_lines(b"\n".join(lines))):
+                    yield message
+
+    def _repair_torn_tail(self, path: Path):
+        """截掉未以換行結尾的最後一行，保證追加從完整行開始"""
+        with open(path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            position = size
+            while position > 0:
+                step = min(self.TAIL_BLOCK_SIZE, position)
+                position -= step
+                f.seek(position)
+                block = f.read(step)
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    f.truncate(position + newline + 1)
+                    print(f"🩹 修復損壞的聊天記錄尾行: {path.name}")
+                    return
+            f.truncate(0)
+
+    def _write_header(self, session_id: str, user_id: int, agent_type: str, next_id: int):
+        header_file = self.header_path(session_id, user_id, agent_type)
+        tmp_file = header_file.with_suffix(".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "format": "jsonl",
+                "session_id": session_id,
+                "user_id": user_id,
+                "agent_type": agent_type,
+                "next_message_id": next_id
+            }, f, ensure_ascii=False)
+        os.replace(tmp_file, header_file)
+
+    def _remember_next_id(self, key: Tuple[str, int, str], next_id: int):
+        """緩存會話的下一個消息ID（調用方持有 _lock）"""
+        self._next_ids[key] = next_id
+        self._next_ids.move_to_end(key)
+        while len(self._next_ids) > self.max_cached_ids:
+            self._next_ids.popitem(last=False)
+
+    def flush_headers(self) -> int:
+        """重寫延遲更新的頭文件，返回寫入數量"""
+        with self._lock:
+            stale, self._stale_headers = self._stale_headers, {}
+            for (session_id, user_id, agent_type), next_id in stale.items():
+                try:
+                    self._write_header(session_id, user_id, agent_type, next_id)
+                except Exception as e:
+                    print(f"❌ 寫入聊天記錄頭文件失敗: {e}")
+        return len(stale)
+
+    def _next_message_id(self, session_id: str, user_id: int, agent_type: str) -> int:
+        """讀取持久化的消息ID計數器，並用最後一行校正（防止頭文件落後）"""
+        key = (session_id, user_id, agent_type)
+        if key in self._next_ids:
+            self._next_ids.move_to_end(key)
+            return self._next_ids[key]
+        transcript = self.transcript_path(session_id, user_id, agent_type)
+
+        next_id = 1
+        header_file = self.header_path(session_id, user_id, agent_type)
+        if header_file.exists():
+            try:
+                with open(header_file, 'r', encoding='utf-8') as f:
+                    next_id = json.load(f).get("next_message_id", 1)
+            except Exception as e:
+                print(f"❌ 讀取聊天記錄頭文件失敗: {e}")
+        if transcript.exists():
+            last = self._read_tail(transcript, 1)
+            if last:
+                next_id = max(next_id, last[-1].get("id", 0) + 1)
+
+        self._remember_next_id(key, next_id)
+        return next_id
+
+    def _convert_legacy(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        """把舊的 .json 聊天記錄轉換為 JSONL + 頭文件"""
+        with self._lock:
+            self._promote_session(session_id, user_id, agent_type)
+            legacy_file = self.chat_file_path(session_id, user_id, agent_type)
+            transcript = self.transcript_path(session_id, user_id, agent_type)
+            if not legacy_file.exists() or transcript.exists():
+                return False
+            transcript.parent.mkdir(parents=True, exist_ok=True)
+            messages = JSONFileStorage.load_messages(self, session_id, user_id, agent_type)
+            tmp_file = transcript.with_suffix(".jsonl.tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                for message in messages:
+                    f.write(json.dumps(message, ensure_ascii=False) + "\n")
+            next_id = max((m.get("id", 0) for m in messages), default=0) + 1
+            self._write_header(session_id, user_id, agent_type, next_id)
+            os.replace(tmp_file, transcript)
+            # 舊文件在分片和平鋪路徑下可能都有（遷移中的硬鏈接）
+            for path in self._candidate_paths(session_id, user_id, agent_type, ".json"):
+                if path.exists():
+                    path.unlink()
+            self._remember_next_id((session_id, user_id, agent_type), next_id)
+            return True
+
+    def load_messages(self, session_id: str, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        for _ in range(2):
+            try:
+                raw = self._read_transcript_bytes(session_id, user_id, agent_type, ".jsonl")
+                if raw is None:
+                    # 尚未轉換的舊格式記錄
+                    return super().load_messages(session_id, user_id, agent_type)
+                return self._parse_lines(raw)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                print(f"❌ 讀取聊天記錄失敗: {e}")
+                return []
+        return []
+
+    def compress_session(self, session_id: str, user_id: int, agent_type: str) -> Optional[Tuple[int, int]]:
+        with self._lock:
+            return super().compress_session(session_id, user_id, agent_type)
+
+    def load_recent_messages(self, session_id: str, user_id: int, agent_type: str, limit: int) -> List[Dict[str, Any]]:
+        transcript = self.transcript_path(session_id, user_id, agent_type)
+        if not transcript.exists():
+            return super().load_recent_messages(session_id, user_id, agent_type, limit)
+        return self._read_tail(transcript, limit)
+
+    def load_messages_before(self, session_id: str, user_id: int, agent_type: str,
+                             before_id: Optional[int], limit: int) -> List[Dict[str, Any]]:
+        transcript = self.transcript_path(session_id, user_id, agent_type)
+        if before_id is None or not transcript.exists():
+            return super().load_messages_before(session_id, user_id, agent_type, before_id, limit)
+        page = []
+        if limit > 0:
+            for message in self._iter_reverse(transcript):
+                if message.get("id", 0) < before_id:
+                    page.append(message)
+                    if len(page) >= limit:
+                        break
+        return page[::-1]
+
+    def load_messages_after(self, session_id: str, user_id: int, agent_type: str,
+                            after_id: int, limit: int) -> List[Dict[str, Any]]:
+        transcript = self.transcript_path(session_id, user_id, agent_type)
+        if not transcript.exists():
+            return super().load_messages_after(session_id, user_id, agent_type, after_id, limit)
+        # 新消息在文件尾部，反向讀到 after_id 為止
+        newer = []
+        for message in self._iter_reverse(transcript):
+            if message.get("id", 0) <= after_id:
+                break
+            newer.append(message)
+        return newer[::-1][:limit]
+
+    def append_messages(self, session_id: str, user_id: int, agent_type: str,
+                        messages: List[Dict[str, Any]], first_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        key = (session_id, user_id, agent_type)
+        with self._lock:
+            # 壓縮層中的記錄先解壓回明文（舊格式也一樣，之後照常轉換）
+            self._restore_compressed(session_id, user_id, agent_type, ".json")
+            self._restore_compressed(session_id, user_id, agent_type, ".jsonl")
+            self._convert_legacy(session_id, user_id, agent_type)
+            transcript = self.transcript_path(session_id, user_id, agent_type)
+            transcript.parent.mkdir(parents=True, exist_ok=True)
+            created = not transcript.exists()
+            if not created:
+                self._repair_torn_tail(transcript)
+
+            if first_id is None:
+                first_id = self._next_message_id(session_id, user_id, agent_type)
+            saved = [{"id": first_id + offset, **message} for offset, message in enumerate(messages)]
+
+            with open(transcript, 'a', encoding='utf-8') as f:
+                f.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in saved))
+
+            next_id = max(self._next_ids.get(key, 1), saved[-1]["id"] + 1) if saved else first_id
+            self._remember_next_id(key, next_id)
+            if created:
+                self._write_header(session_id, user_id, agent_type, next_id)
+            else:
+                self._stale_headers[key] = next_id
+                if len(self._stale_headers) >= self.max_cached_ids:
+                    self.flush_headers()
+        return saved
+
+    def iter_messages(self, session_id: str, user_id: int, agent_type: str, chunk_size: int = 500) -> Iterator[Dict[str, Any]]:
+        transcript = self.transcript_path(session_id, user_id, agent_type)
+        try:
+            f = open(transcript, 'rb')
+        except FileNotFoundError:
+            # 壓縮層或尚未轉換的舊格式記錄
+            yield from self.load_messages(session_id, user_id, agent_type)
+            return
+        # 逐行流式解析；已打開的文件在遷移/壓縮時仍可讀完
+        with f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def count_messages(self, session_id: str, user_id: int, agent_type: str) -> int:
+        transcript = self.transcript_path(session_id, user_id, agent_type)
+        if not transcript.exists():
+            return super().count_messages(session_id, user_id, agent_type)
+        # 只數行數，不解析JSON
+        with open(transcript, 'rb') as f:
+            return sum(1 for line in f if line.strip())
+
+    def delete_session(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        # 聊天記錄、頭文件和舊格式文件由父類按 SESSION_FILE_SUFFIXES 一起刪除
+        with self._lock:
+            self._next_ids.pop((session_id, user_id, agent_type), None)
+            self._stale_headers.pop((session_id, user_id, agent_type), None)
+            return super().delete_session(session_id, user_id, agent_type)
+
+    def delete_sessions(self, session_ids: List[str], user_id: int, agent_type: str) -> int:
+        with self._lock:
+            for session_id in session_ids:
+                self._next_ids.pop((session_id, user_id, agent_type), None)
+                self._stale_headers.pop((session_id, user_id, agent_type), None)
+            return super().delete_sessions(session_ids, user_id, agent_type)
+
+    def compact(self) -> Dict[str, Any]:
+        return {
+            "converted_legacy_transcripts": self.compact_legacy_transcripts(limit=100),
+            "headers_written": self.flush_headers()
+        }
+
+    def compact_legacy_transcripts(self, limit: Optional[int] = None) -> int:
+        """轉換舊的 .json 聊天記錄，返回轉換數量"""
+        converted = 0
+        # 平鋪目錄和分片目錄中的舊格式文件
+        legacy_files = list(self.base_dir.glob("*/*.json")) + list(self.base_dir.glob("*/??/??/*.json"))
+        for legacy_file in legacy_files:
+            if limit is not None and converted >= limit:
+                break
+            if self._compactor_stop.is_set():
+                break
+            name = legacy_file.stem
+            if name.startswith("sessions_") or name.endswith(".meta") or "_" not in name:
+                continue
+            user_id, session_id = name.split("_", 1)
+            agent_type = legacy_file.relative_to(self.base_dir).parts[0]
+            try:
+                if self._convert_legacy(session_id, int(user_id), agent_type):
+                    converted += 1
+            except Exception as e:
+                print(f"❌ 轉換舊聊天記錄失敗 {legacy_file.name}: {e}")
+        if converted:
+            print(f"🗜️ 已轉換 {converted} 個舊格式聊天記錄為 JSONL")
+        return converted
+
+    def start_background_compactor(self, interval: float = 300.0, batch_size: int = 100):
+        """啟動後台線程，定期分批轉換舊格式聊天記錄"""
+        if self._compactor and self._compactor.is_alive():
+            return
+
+        def run():
+            while not self._compactor_stop.is_set():
+                self.flush_headers()
+                # 每輪最多轉換 batch_size 個，剩餘的在下一輪繼續
+                if self.compact_legacy_transcripts(limit=batch_size) < batch_size:
+                    self._compactor_stop.wait(interval)
+                else:
+                    time.sleep(0.1)
+
+        self._compactor_stop.clear()
+        self._compactor = threading.Thread(target=run, name="chat-history-compactor", daemon=True)
+        self._compactor.start()
+
+    def close(self):
+        self._compactor_stop.set()
+        if self._compactor:
+            self._compactor.join(timeout=5)
+        self.flush_headers()
+        super().close()
+
+
+class SQLiteStorage(ChatHistoryStorage):
+    """
+    SQLite 存儲 - WAL 模式，每個線程一個連接。
+    會話按 (user_id, agent_type, updated_at) 建索引，消息按 (session_id, user_id, agent_type, id) 建唯一索引，
+    追加一條消息只需一次索引查找和一次插入，與歷史長度無關。
+    分配消息ID與插入在同一個 BEGIN IMMEDIATE 事務中完成，多個進程寫同一會話也不會產生重複ID。
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            agent_type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            title TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, agent_type, session_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_updated
+            ON sessions (user_id, agent_type, updated_at);
+        CREATE TABLE IF NOT EXISTS messages (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            agent_type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+    """
+    # 單獨執行：舊庫中可能已有重複的消息ID，需先修復再建唯一索引
+    SQL_UNIQUE_MESSAGE_INDEX = (
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_session_msg "
+        "ON messages (session_id, user_id, agent_type, id)"
+    )
+    SQL_DUPLICATE_MESSAGES = (
+        "SELECT seq, session_id, user_id, agent_type FROM messages m WHERE EXISTS ("
+        "SELECT 1 FROM messages o WHERE o.session_id = m.session_id AND o.user_id = m.user_id "
+        "AND o.agent_type = m.agent_type AND o.id = m.id AND o.seq < m.seq) ORDER BY seq"
+    )
+    SQL_RENUMBER_MESSAGE = (
+        "UPDATE messages SET id = (SELECT MAX(id) + 1 FROM messages "
+        "WHERE session_id = ? AND user_id = ? AND agent_type = ?) WHERE seq = ?"
+    )
+
+    # 固定的 SQL 文本，由 sqlite3 的語句緩存複用為預編譯語句
+    SQL_INSERT_SESSION = (
+        "INSERT INTO sessions (session_id, user_id, agent_type, id, title, created_at, updated_at) "
+        "VALUES (?, ?, ?, (SELECT COALESCE(MAX(id), 0) + 1 FROM sessions WHERE user_id = ? AND agent_type = ?), ?, ?, ?)"
+    )
+    SQL_SESSION_ID = "SELECT id FROM sessions WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    SQL_LIST_SESSIONS = (
+        "SELECT id, session_id, user_id, agent_type, title, created_at, updated_at FROM sessions "
+        "WHERE user_id = ? AND agent_type = ? ORDER BY updated_at DESC, session_id DESC"
+    )
+    SQL_SESSION_GROUPS = "SELECT DISTINCT user_id, agent_type FROM sessions ORDER BY user_id, agent_type"
+    SQL_TOUCH_SESSION = "UPDATE sessions SET updated_at = ? WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    SQL_DELETE_SESSION = "DELETE FROM sessions WHERE user_id = ? AND agent_type = ? AND session_id = ?"
+    SQL_DELETE_MESSAGES = "DELETE FROM messages WHERE session_id = ? AND user_id = ? AND agent_type = ?"
+    SQL_LOAD_MESSAGES = (
+        "SELECT id, session_id, role, content, created_at FROM messages "
+        "WHERE session_id = ? AND user_id = ? AND agent_type = ? ORDER BY id"
+    )
+    SQL_RECENT_MESSAGES = (
+        "SELECT id, session_id, role, content, created_at FROM messages "
+        "WHERE session_id = ? AND user_id = ? AND agent_type = ? ORDER BY id DESC LIMIT ?"
+    )
+    SQL_MESSAGES_BEFORE = (
+        "SELECT id, session_id, role, content, created_at FROM messages "
+        "WHERE session_id = ? AND user_id = ? AND agent_type = ? AND id < ? ORDER BY id DESC LIMIT ?"
+    )
+    SQL_MESSAGES_AFTER = (
+        "SELECT id, session_id, role, content, created_at FROM messages "
+        "WHERE session_id = ? AND user_id = ? AND agent_type = ? AND id > ? ORDER BY id LIMIT ?"
+    )
+    SQL_MAX_MESSAGE_ID = "SELECT COALESCE(MAX(id), 0) FROM messages WHERE session_id = ? AND user_id = ? AND agent_type = ?"
+    SQL_COUNT_MESSAGES = "SELECT COUNT(*) FROM messages WHERE session_id = ? AND user_id = ? AND agent_type = ?"
+    SQL_INSERT_MESSAGE = (
+        "INSERT INTO messages (session_id, user_id, agent_type, id, role, content, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        self._ensure_unique_message_ids(conn)
+
+    def _ensure_unique_message_ids(self, conn: sqlite3.Connection):
+        """建立消息ID唯一索引；舊庫中重複的ID（較晚寫入的一條）改為該會話新的最大ID"""
+        try:
+            with conn:
+                conn.execute(self.SQL_UNIQUE_MESSAGE_INDEX)
+        except sqlite3.IntegrityError:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                duplicates = conn.execute(self.SQL_DUPLICATE_MESSAGES).fetchall()
+                for row in duplicates:
+                    conn.execute(self.SQL_RENUMBER_MESSAGE,
+                                 (row["session_id"], row["user_id"], row["agent_type"], row["seq"]))
+                conn.execute(self.SQL_UNIQUE_MESSAGE_INDEX)
+            print(f"⚠️ 修復了 {len(duplicates)} 條重複的消息ID: {self.db_path}")
+        # 唯一索引已覆蓋按會話查詢，舊的 (session_id, id) 索引不再需要
+        conn.execute("DROP INDEX IF EXISTS idx_messages_session_id")
+
+    def _conn(self) -> sqlite3.Connection:
+        """獲取當前線程的連接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def insert_session(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        conn = self._conn()
+        with conn:
+            conn.execute(self.SQL_INSERT_SESSION, (
+                session["session_id"], session["user_id"], session["agent_type"],
+                session["user_id"], session["agent_type"],
+                session.get("title"), session["created_at"], session["updated_at"]
+            ))
+            row = conn.execute(self.SQL_SESSION_ID, (session["user_id"], session["agent_type"], session["session_id"])).fetchone()
+        session["id"] = row["id"]
+        return session
+
+    def list_sessions(self, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(self.SQL_LIST_SESSIONS, (user_id, agent_type)).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_session_groups(self) -> List[Tuple[int, str]]:
+        return [(row["user_id"], row["agent_type"]) for row in self._conn().execute(self.SQL_SESSION_GROUPS)]
+
+    def touch_sessions(self, session_ids: List[str], user_id: int, agent_type: str, updated_at: str):
+        self.touch_sessions_at({sid: updated_at for sid in session_ids}, user_id, agent_type)
+
+    def touch_sessions_at(self, updates: Dict[str, str], user_id: int, agent_type: str):
+        conn = self._conn()
+        with conn:
+            conn.executemany(self.SQL_TOUCH_SESSION, [(updated_at, user_id, agent_type, sid) for sid, updated_at in updates.items()])
+
+    def delete_session(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        conn = self._conn()
+        with conn:
+            conn.execute(self.SQL_DELETE_MESSAGES, (session_id, user_id, agent_type))
+            conn.execute(self.SQL_DELETE_SESSION, (user_id, agent_type, session_id))
+        return True
+
+    def delete_sessions(self, session_ids: List[str], user_id: int, agent_type: str) -> int:
+        conn = self._conn()
+        with conn:
+            conn.executemany(self.SQL_DELETE_MESSAGES, [(sid, user_id, agent_type) for sid in session_ids])
+            deleted = conn.executemany(self.SQL_DELETE_SESSION, [(user_id, agent_type, sid) for sid in session_ids]).rowcount
+        return deleted
+
+    def compact(self) -> Dict[str, Any]:
+        """把 WAL 合併回主庫並截斷，更新查詢計劃統計"""
+        conn = self._conn()
+        busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        conn.execute("PRAGMA optimize")
+        return {
+            "wal_checkpoint_busy": bool(busy),
+            "wal_pages_checkpointed": checkpointed,
+            "free_pages": conn.execute("PRAGMA freelist_count").fetchone()[0]
+        }
+
+    def load_messages(self, session_id: str, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(self.SQL_LOAD_MESSAGES, (session_id, user_id, agent_type)).fetchall()
+        return [dict(row) for row in rows]
+
+    def load_recent_messages(self, session_id: str, user_id: int, agent_type: str, limit: int) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(self.SQL_RECENT_MESSAGES, (session_id, user_id, agent_type, limit)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def load_messages_before(self, session_id: str, user_id: int, agent_type: str,
+                             before_id: Optional[int], limit: int) -> List[Dict[str, Any]]:
+        if before_id is None:
+            return self.load_recent_messages(session_id, user_id, agent_type, limit)
+        rows = self._conn().execute(self.SQL_MESSAGES_BEFORE, (session_id, user_id, agent_type, before_id, limit)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def load_messages_after(self, session_id: str, user_id: int, agent_type: str,
+                            after_id: int, limit: int) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(self.SQL_MESSAGES_AFTER, (session_id, user_id, agent_type, after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def iter_messages(self, session_id: str, user_id: int, agent_type: str, chunk_size: int = 500) -> Iterator[Dict[str, Any]]:
+        # 主鍵範圍查詢分塊讀取，每塊從上一塊最後的 id 繼續
+        after_id = 0
+        while True:
+            chunk = self.load_messages_after(session_id, user_id, agent_type, after_id, chunk_size)
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            after_id = chunk[-1]["id"]
+
+    def append_messages(self, session_id: str, user_id: int, agent_type: str,
+                        messages: List[Dict[str, Any]], first_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        conn = self._conn()
+        with conn:
+            # 先取得寫鎖再讀最大ID：其他連接無法在讀取與插入之間寫入同一會話
+            conn.execute("BEGIN IMMEDIATE")
+            if first_id is None:
+                first_id = conn.execute(self.SQL_MAX_MESSAGE_ID, (session_id, user_id, agent_type)).fetchone()[0] + 1
+            saved = [{"id": first_id + offset, **message} for offset, message in enumerate(messages)]
+            conn.executemany(self.SQL_INSERT_MESSAGE, [
+                (session_id, user_id, agent_type, m["id"], m["role"], m["content"], m["created_at"])
+                for m in saved
+            ])
+        return saved
+
+    def count_messages(self, session_id: str, user_id: int, agent_type: str) -> int:
+        return self._conn().execute(self.SQL_COUNT_MESSAGES, (session_id, user_id, agent_type)).fetchone()[0]
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    # 連接屬於其他線程，由該線程退出時釋放
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def create_storage(backend: str, base_dir: Path, sharded: bool = False) -> ChatHistoryStorage:
+    """按名稱創建存儲後端（sharded 只對文件後端生效）"""
+    if backend == "json":
+        return JSONFileStorage(base_dir, sharded=sharded)
+    if backend == "jsonl":
+        return JSONLFileStorage(base_dir, sharded=sharded)
+    if backend == "sqlite":
+        return SQLiteStorage(Path(base_dir) / "chat_history.db")
+    raise ValueError(f"Unknown chat history backend: {backend}")
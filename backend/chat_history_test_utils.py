@@ -0,0 +1,21 @@
+"""
+Shared fixtures for the chat history tests
+"""
+
+from typing import Any, Dict, List
+
+TEST_USER_ID = 1
+TEST_AGENT_TYPE = "companion"
+
+
+def make_session(session_id: str, user_id: int = TEST_USER_ID, agent_type: str = TEST_AGENT_TYPE,
+                 updated_at: str = "2024-01-01T00:00:00") -> Dict[str, Any]:
+    """A session record as the chat history manager would insert it (title is the session id)"""
+    return {"session_id": session_id, "user_id": user_id, "agent_type": agent_type,
+            "title": session_id, "created_at": updated_at, "updated_at": updated_at}
+
+
+def make_messages(count: int, start: int = 0) -> List[Dict[str, Any]]:
+    """`count` messages alternating user/assistant; contents and times are numbered from `start`"""
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}",
+             "created_at": f"2024-01-01T00:00:{i:02d}"} for i in range(start, start + count)]
@@ -0,0 +1,382 @@
+"""
+聊天記錄寫後緩衝（write-behind）
+消息追加與會話時間更新先進入內存隊列，由專用線程按數量或時間分組提交到底層存儲，
+請求處理中不再直接做磁盤寫入；讀取時合併尚未落盤的消息，保證讀到自己的寫入
+"""
+
+import atexit
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from chat_history_storage import ChatHistoryStorage
+
+MessageKey = Tuple[str, int, str]   # (session_id, user_id, agent_type)
+SessionKey = Tuple[int, str]        # (user_id, agent_type)
+
+
+class WriteBehindFullError(Exception):
+    """待寫隊列已滿且在等待時間內沒有騰出空間（通常是底層存儲持續寫入失敗）"""
+
+
+class WriteBehindStorage(ChatHistoryStorage):
+    """包裝任意存儲後端，對消息追加和會話時間更新做分組提交"""
+
+    def __init__(self, inner: ChatHistoryStorage, max_batch: int = 200, flush_interval: float = 0.5,
+                 max_pending: int = 50_000, full_timeout: float = 5.0):
+        self.inner = inner
+        self.name = f"{inner.name}+write_behind"
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        # 隊列上限：刷盤持續失敗時，追加消息最多等待 full_timeout 秒，仍無空間則拋出 WriteBehindFullError
+        self.max_pending = max_pending
+        self.full_timeout = full_timeout
+
+        # _state_lock 保護隊列狀態；_io_lock 串行化對底層存儲的單次寫入（刷盤、刪除、壓縮），
+        # 只在每次寫入期間持有；_flush_lock 保證同一時刻只有一輪刷盤。
+        # 讀取不加 _io_lock：底層存儲的寫入是原子的（SQLite 事務、JSON 臨時文件替換、JSONL 追加），
+        # 讀取在刷盤過程中也能立即返回
+        self._state_lock = threading.Lock()
+        self._io_lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._state_lock)
+        self._drained = threading.Condition(self._state_lock)
+
+        self._pending_messages: Dict[MessageKey, List[Dict[str, Any]]] = {}
+        self._pending_touches: Dict[SessionKey, Dict[str, str]] = {}
+        self._pending_ops = 0
+        # 只保存有待寫消息的會話的下一個ID；隊列清空後移除，下次追加時從底層存儲重新讀取。
+        # _id_evictions 在每次移除時遞增，讀取底層存儲期間發生過移除則重新讀取
+        self._next_ids: Dict[MessageKey, int] = {}
+        self._id_evictions = 0
+        self._rejected = 0
+
+        self._flushes = 0
+        self._flushed_ops = 0
+        self._flush_latencies: Deque[float] = deque(maxlen=1000)
+        self._max_queue_depth = 0
+        self._last_error: Optional[str] = None
+
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="chat-history-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ---------- 寫入：只進隊列 ----------
+
+    def append_messages(self, session_id: str, user_id: int, agent_type: str,
+                        messages: List[Dict[str, Any]], first_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        key = (session_id, user_id, agent_type)
+        while True:
+            with self._state_lock:
+                self._wait_for_room(len(messages))
+                if key in self._next_ids:
+                    if first_id is None:
+                        first_id = self._next_ids[key]
+                    saved = [{"id": first_id + offset, **message} for offset, message in enumerate(messages)]
+                    if saved:
+                        self._next_ids[key] = max(self._next_ids[key], saved[-1]["id"] + 1)
+                    self._pending_messages.setdefault(key, []).extend(saved)
+                    self._enqueued(len(saved))
+                    return saved
+                evictions = self._id_evictions
+            self._init_next_id(key, evictions)
+
+    def touch_sessions(self, session_ids: List[str], user_id: int, agent_type: str, updated_at: str):
+        with self._state_lock:
+            touches = self._pending_touches.setdefault((user_id, agent_type), {})
+            for session_id in session_ids:
+                if session_id not in touches:
+                    self._pending_ops += 1
+                touches[session_id] = updated_at
+            self._enqueued(0)
+
+    def _enqueued(self, count: int):
+        """登記新寫入（調用方持有 _state_lock）"""
+        self._pending_ops += count
+        self._max_queue_depth = max(self._max_queue_depth, self._pending_ops)
+        if self._pending_ops >= self.max_batch:
+            self._wakeup.notify()
+
+    def _wait_for_room(self, count: int):
+        """隊列已滿時等待刷盤騰出空間（調用方持有 _state_lock）"""
+        if self._pending_ops + count <= self.max_pending or self._pending_ops == 0:
+            return
+        deadline = time.monotonic() + self.full_timeout
+        self._wakeup.notify()
+        while self._pending_ops + count > self.max_pending and self._pending_ops > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._rejected += 1
+                raise WriteBehindFullError(
+                    f"聊天記錄待寫隊列已滿 ({self._pending_ops}/{self.max_pending})，最近錯誤: {self._last_error}"
+                )
+            self._drained.wait(timeout=remaining)
+
+    def _init_next_id(self, key: MessageKey, evictions: int):
+        """會話沒有待寫消息時，從底層存儲讀取最後一條消息ID；讀取期間有ID被移除則放棄，由調用方重試"""
+        last = self.inner.load_recent_messages(*key, 1)
+        with self._state_lock:
+            if key not in self._next_ids and self._id_evictions == evictions:
+                self._next_ids[key] = (last[-1]["id"] + 1) if last else 1
+
+    def _forget_next_id(self, key: MessageKey):
+        """會話的待寫消息已全部落盤或已刪除（調用方持有 _state_lock）"""
+        if self._next_ids.pop(key, None) is not None:
+            self._id_evictions += 1
+
+    # ---------- 讀取：合併未落盤的數據 ----------
+
+    def _pending_for(self, key: MessageKey) -> List[Dict[str, Any]]:
+        with self._state_lock:
+            return list(self._pending_messages.get(key, []))
+
+    @staticmethod
+    def _merge(stored: List[Dict[str, Any]], pending: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if not pending:
+            return stored
+        stored_ids = {m.get("id") for m in stored}
+        merged = stored + [m for m in pending if m["id"] not in stored_ids]
+        merged.sort(key=lambda m: m.get("id", 0))
+        return merged
+
+    def load_messages(self, session_id: str, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        # 先取隊列快照再讀存儲：刷盤在兩者之間完成時消息仍出現在存儲結果中
+        pending = self._pending_for((session_id, user_id, agent_type))
+        stored = self.inner.load_messages(session_id, user_id, agent_type)
+        return self._merge(stored, pending)
+
+    def load_recent_messages(self, session_id: str, user_id: int, agent_type: str, limit: int) -> List[Dict[str, Any]]:
+        pending = self._pending_for((session_id, user_id, agent_type))
+        stored = self.inner.load_recent_messages(session_id, user_id, agent_type, limit)
+        merged = self._merge(stored, pending)
+        return merged[-limit:] if limit > 0 else []
+
+    def load_messages_before(self, session_id: str, user_id: int, agent_type: str,
+                             before_id: Optional[int], limit: int) -> List[Dict[str, Any]]:
+        # 未落盤的消息ID都大於已落盤的，合併後取最後 limit 條即可
+        pending = [m for m in self._pending_for((session_id, user_id, agent_type))
+                   if before_id is None or m["id"] < before_id]
+        stored = self.inner.load_messages_before(session_id, user_id, agent_type, before_id, limit)
+        merged = self._merge(stored, pending)
+        return merged[-limit:] if limit > 0 else []
+
+    def load_messages_after(self, session_id: str, user_id: int, agent_type: str,
+                            after_id: int, limit: int) -> List[Dict[str, Any]]:
+        pending = [m for m in self._pending_for((session_id, user_id, agent_type)) if m["id"] > after_id]
+        stored = self.inner.load_messages_after(session_id, user_id, agent_type, after_id, limit)
+        return self._merge(stored, pending)[:limit]
+
+    def iter_messages(self, session_id: str, user_id: int, agent_type: str, chunk_size: int = 500) -> Iterator[Dict[str, Any]]:
+        # 未落盤的消息ID都大於已落盤的，存儲遍歷完後補上尚未出現的部分
+        pending = self._pending_for((session_id, user_id, agent_type))
+        last_id = 0
+        for message in self.inner.iter_messages(session_id, user_id, agent_type, chunk_size):
+            last_id = max(last_id, message.get("id", 0))
+            yield message
+        for message in pending:
+            if message["id"] > last_id:
+                yield message
+
+    def count_messages(self, session_id: str, user_id: int, agent_type: str) -> int:
+        pending = self._pending_for((session_id, user_id, agent_type))
+        if not pending:
+            return self.inner.count_messages(session_id, user_id, agent_type)
+        return len(self.load_messages(session_id, user_id, agent_type))
+
+    def list_sessions(self, user_id: int, agent_type: str) -> List[Dict[str, Any]]:
+        with self._state_lock:
+            touches = dict(self._pending_touches.get((user_id, agent_type), {}))
+        sessions = self.inner.list_sessions(user_id, agent_type)
+        if touches:
+            for session in sessions:
+                updated_at = touches.get(session["session_id"])
+                if updated_at and updated_at > session.get("updated_at", ""):
+                    session["updated_at"] = updated_at
+            sessions.sort(key=lambda x: (x.get("updated_at", ""), x.get("session_id", "")), reverse=True)
+        return sessions
+
+    # ---------- 直接透傳的操作 ----------
+
+    def insert_session(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        with self._io_lock:
+            return self.inner.insert_session(session)
+
+    def list_session_groups(self) -> List[Tuple[int, str]]:
+        return self.inner.list_session_groups()
+
+    def delete_session(self, session_id: str, user_id: int, agent_type: str) -> bool:
+        # 持有 _io_lock 時沒有寫入在進行；丟棄該會話的待寫數據後再刪除，
+        # 刷盤在寫每個會話前會確認其待寫數據仍在隊列中，已刪除的會話不會被寫回
+        with self._io_lock:
+            key = (session_id, user_id, agent_type)
+            with self._state_lock:
+                dropped = len(self._pending_messages.pop(key, []))
+                touches = self._pending_touches.get((user_id, agent_type), {})
+                if touches.pop(session_id, None) is not None:
+                    dropped += 1
+                self._forget_next_id(key)
+                self._dequeued(dropped)
+            return self.inner.delete_session(session_id, user_id, agent_type)
+
+    def delete_sessions(self, session_ids: List[str], user_id: int, agent_type: str) -> int:
+        with self._io_lock:
+            with self._state_lock:
+                touches = self._pending_touches.get((user_id, agent_type), {})
+                dropped = 0
+                for session_id in session_ids:
+                    key = (session_id, user_id, agent_type)
+                    dropped += len(self._pending_messages.pop(key, []))
+                    if touches.pop(session_id, None) is not None:
+                        dropped += 1
+                    self._forget_next_id(key)
+                self._dequeued(dropped)
+            return self.inner.delete_sessions(session_ids, user_id, agent_type)
+
+    def compact(self) -> Dict[str, Any]:
+        self.flush()
+        with self._io_lock:
+            return self.inner.compact()
+
+    def compress_session(self, session_id: str, user_id: int, agent_type: str) -> Optional[Tuple[int, int]]:
+        # 之後刷盤的待寫數據會在追加時把記錄解壓回明文
+        with self._io_lock:
+            return self.inner.compress_session(session_id, user_id, agent_type)
+
+    # ---------- 刷盤 ----------
+
+    def _run(self):
+        while True:
+            with self._state_lock:
+                if self._pending_ops < self.max_batch and not self._stopped:
+                    self._wakeup.wait(timeout=self.flush_interval)
+                stopped = self._stopped
+            self.flush()
+            if stopped:
+                return
+
+    def flush(self) -> int:
+        """把隊列中的寫入分組提交到底層存儲，返回提交的操作數"""
+        with self._flush_lock:
+            with self._state_lock:
+                messages = {key: list(batch) for key, batch in self._pending_messages.items() if batch}
+                touches = {key: dict(batch) for key, batch in self._pending_touches.items() if batch}
+            if not messages and not touches:
+                return 0
+
+            started = time.perf_counter()
+            flushed = 0
+            try:
+                # 同一會話的連續消息一次追加；同一會話列表的時間更新一次寫入，每個會話保留自己的更新時間。
+                # 每段寫入成功後立即移出隊列，後續失敗重試時不會重複追加已提交的消息。
+                # _io_lock 只在單次寫入期間持有，不阻塞讀取和其他請求
+                for key, batch in messages.items():
+                    for run in self._runs(batch):
+                        with self._io_lock:
+                            if not self._still_pending(key, run):
+                                break
+                            self._append_run(key, run)
+                        flushed += self._messages_committed(key, run)
+                for (user_id, agent_type), batch in touches.items():
+                    with self._io_lock:
+                        self.inner.touch_sessions_at(batch, user_id, agent_type)
+                    flushed += self._touches_committed((user_id, agent_type), batch)
+                self._last_error = None
+            except Exception as e:
+                # 未提交的部分留在隊列中，下一輪重試
+                self._last_error = str(e)
+                print(f"❌ 聊天記錄刷盤失敗: {e}")
+
+            if flushed:
+                self._flushes += 1
+                self._flushed_ops += flushed
+                self._flush_latencies.append(time.perf_counter() - started)
+            return flushed
+
+    def _still_pending(self, key: MessageKey, run: List[Dict[str, Any]]) -> bool:
+        """快照之後會話未被刪除（隊列頭部仍是這一段消息）"""
+        with self._state_lock:
+            pending = self._pending_messages.get(key)
+            return bool(pending) and pending[0] is run[0]
+
+    def _messages_committed(self, key: MessageKey, run: List[Dict[str, Any]]) -> int:
+        """把已寫入的一段消息移出隊列，返回移出的數量"""
+        with self._state_lock:
+            pending = self._pending_messages.get(key)
+            if not pending or pending[0] is not run[0]:
+                return 0
+            del pending[:len(run)]
+            if not pending:
+                del self._pending_messages[key]
+                self._forget_next_id(key)
+            self._dequeued(len(run))
+            return len(run)
+
+    def _touches_committed(self, key: SessionKey, batch: Dict[str, str]) -> int:
+        """把已寫入的會話時間更新移出隊列（期間又被更新的會話保留），返回移出的數量"""
+        with self._state_lock:
+            pending = self._pending_touches.get(key, {})
+            removed = 0
+            for session_id, updated_at in batch.items():
+                if pending.get(session_id) == updated_at:
+                    del pending[session_id]
+                    removed += 1
+            if not pending:
+                self._pending_touches.pop(key, None)
+            self._dequeued(removed)
+            return removed
+
+    def _dequeued(self, count: int):
+        """登記已落盤或已丟棄的寫入並喚醒等待空間的寫入方（調用方持有 _state_lock）"""
+        self._pending_ops = max(0, self._pending_ops - count)
+        self._drained.notify_all()
+
+    @staticmethod
+    def _runs(batch: List[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+        """按連續ID分段（調用方可能指定過非連續的消息ID）"""
+        run: List[Dict[str, Any]] = []
+        for message in batch:
+            if run and message["id"] != run[-1]["id"] + 1:
+                yield run
+                run = []
+            run.append(message)
+        if run:
+            yield run
+
+    def _append_run(self, key: MessageKey, run: List[Dict[str, Any]]):
+        payload = [{k: v for k, v in m.items() if k != "id"} for m in run]
+        self.inner.append_messages(*key, payload, first_id=run[0]["id"])
+
+    def close(self):
+        """停止刷盤線程並把剩餘寫入全部落盤"""
+        with self._state_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join(timeout=30)
+        self.flush()
+        self.inner.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._state_lock:
+            latencies = sorted(self._flush_latencies)
+            queue_depth = self._pending_ops
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else 0.0
+        return {
+            "queue_depth": queue_depth,
+            "max_queue_depth": self._max_queue_depth,
+            "flushes": self._flushes,
+            "flushed_ops": self._flushed_ops,
+            "avg_batch_size": round(self._flushed_ops / self._flushes, 2) if self._flushes else 0.0,
+            "avg_flush_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p95_flush_ms": round(p95 * 1000, 3),
+            "max_flush_ms": round(max(latencies) * 1000, 3) if latencies else 0.0,
+            "max_batch": self.max_batch,
+            "max_pending": self.max_pending,
+            "rejected_full": self._rejected,
+            "cached_next_ids": len(self._next_ids),
+            "flush_interval": self.flush_interval,
+            "last_error": self._last_error,
+        }
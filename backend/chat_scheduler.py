@@ -0,0 +1,189 @@
+"""
+Priority-aware scheduler for agent runs
+Crisis conversations get a reserved lane so they never wait behind routine traffic
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional
+
+from mental_health_tools import assess_emotion_state
+
+# Lanes ordered from highest to lowest priority
+LANE_CRISIS = "crisis"
+LANE_ELEVATED = "elevated"
+LANE_ROUTINE = "routine"
+LANES = [LANE_CRISIS, LANE_ELEVATED, LANE_ROUTINE]
+
+# Aged non-crisis requests never rank at or above the crisis lane
+AGED_RANK_FLOOR = LANES.index(LANE_CRISIS) + 0.5
+
+
+class _Waiter:
+    """A queued request waiting for an agent slot"""
+
+    __slots__ = ("lane", "future", "enqueued_at")
+
+    def __init__(self, lane: str, future: asyncio.Future):
+        self.lane = lane
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class _LaneStats:
+    """Wait time statistics for one lane"""
+
+    def __init__(self, window: int = 1000):
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=window)
+
+    def record(self, wait: float):
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_waits.append(wait)
+
+    def snapshot(self) -> Dict[str, Any]:
+        waits = sorted(self.recent_waits)
+
+        def percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p * len(waits)))]
+
+        return {
+            "admitted": self.admitted,
+            "avg_wait_ms": round(self.total_wait / self.admitted * 1000, 2) if self.admitted else 0.0,
+            "p50_wait_ms": round(percentile(0.50) * 1000, 2),
+            "p95_wait_ms": round(percentile(0.95) * 1000, 2),
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+        }
+
+
+class PriorityChatScheduler:
+    """
+    Admission control for agent runs with priority lanes.
+
+    - At most `max_concurrency` agent runs execute at once.
+    - `reserved_crisis` of those slots can only be taken by the crisis lane.
+    - Lower lanes age: every `aging_seconds` spent waiting promotes a request
+      by one lane, so routine traffic is never starved. Aging stops short of the
+      crisis lane, so crisis turns always go first.
+    """
+
+    def __init__(self, max_concurrency: int = 8, reserved_crisis: int = 2, aging_seconds: float = 10.0):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if not 0 <= reserved_crisis < max_concurrency:
+            raise ValueError("reserved_crisis must be between 0 and max_concurrency - 1")
+
+        self.max_concurrency = max_concurrency
+        self.reserved_crisis = reserved_crisis
+        self.aging_seconds = aging_seconds
+
+        self._queues: Dict[str, Deque[_Waiter]] = {lane: deque() for lane in LANES}
+        self._active: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._stats: Dict[str, _LaneStats] = {lane: _LaneStats() for lane in LANES}
+
+    async def classify(self, message: str) -> str:
+        """Pick a lane from the emotion assessment's crisis/risk signal"""
+        assessment = await assess_emotion_state(message)
+        if assessment.get("crisis_risk"):
+            return LANE_CRISIS
+        if assessment.get("intensity") == "High":
+            return LANE_ELEVATED
+        return LANE_ROUTINE
+
+    @asynccontextmanager
+    async def slot(self, lane: str):
+        """Wait for an agent slot in the given lane, release it on exit"""
+        if lane not in self._queues:
+            raise ValueError(f"Unknown lane: {lane}")
+
+        waiter = _Waiter(lane, asyncio.get_running_loop().create_future())
+        self._queues[lane].append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Slot was granted just as we were cancelled: give it back
+                self._release(lane)
+            elif waiter in self._queues[lane]:
+                self._queues[lane].remove(waiter)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    def _release(self, lane: str):
+        self._active[lane] -= 1
+        self._dispatch()
+
+    def _general_in_use(self) -> int:
+        return sum(count for lane, count in self._active.items() if lane != LANE_CRISIS)
+
+    def _effective_rank(self, waiter: _Waiter, now: float) -> float:
+        rank = LANES.index(waiter.lane)
+        if self.aging_seconds > 0 and waiter.lane != LANE_CRISIS:
+            rank -= (now - waiter.enqueued_at) / self.aging_seconds
+            rank = max(rank, AGED_RANK_FLOOR)
+        return rank
+
+    def _dispatch(self):
+        """Grant free slots to the highest effective-priority waiters"""
+        while sum(self._active.values()) < self.max_concurrency:
+            now = time.monotonic()
+            general_free = self._general_in_use() < self.max_concurrency - self.reserved_crisis
+
+            # Within a lane the head has waited longest, so only heads compete
+            best: Optional[_Waiter] = None
+            best_rank = 0.0
+            for lane in LANES:
+                queue = self._queues[lane]
+                # Drop waiters cancelled while queued (e.g. an SSE client disconnected)
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if not queue or (lane != LANE_CRISIS and not general_free):
+                    continue
+                rank = self._effective_rank(queue[0], now)
+                if best is None or rank < best_rank:
+                    best, best_rank = queue[0], rank
+
+            if best is None:
+                return
+
+            self._queues[best.lane].popleft()
+            self._active[best.lane] += 1
+            self._stats[best.lane].record(now - best.enqueued_at)
+            best.future.set_result(None)
+
+    def is_busy(self, threshold: float = 0.5) -> bool:
+        """True while requests are queued or at least `threshold` of the slots are in use (safe to poll from other threads)"""
+        if any(self._queues[lane] for lane in LANES):
+            return True
+        return sum(self._active.values()) >= threshold * self.max_concurrency
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Per-lane queue depth, active runs and wait times"""
+        lanes: Dict[str, Any] = {}
+        for lane in LANES:
+            lanes[lane] = {
+                "waiting": len(self._queues[lane]),
+                "active": self._active[lane],
+                **self._stats[lane].snapshot(),
+            }
+        return {
+            "max_concurrency": self.max_concurrency,
+            "reserved_crisis": self.reserved_crisis,
+            "aging_seconds": self.aging_seconds,
+            "active": sum(self._active.values()),
+            "lanes": lanes,
+        }
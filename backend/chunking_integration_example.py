@@ -8,20 +8,22 @@ import os
 import uuid
 import aiofiles
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Iterable, Iterator
 from enhanced_chunking_strategies import (
-    EnhancedChunkingStrategies, 
     ChunkingStrategy, 
     ChunkConfig
 )
 from mental_health_rag_service import MentalHealthRAGService
+from rag_ingestion_jobs import IngestionCancelled
+from rag_resources import rag_resources
+from document_streaming import iter_fixed_chunks, iter_structured_segments
 
 class EnhancedMentalHealthRAGService(MentalHealthRAGService):
     """增強版心理健康RAG服務，支持多種分塊策略"""
     
     def __init__(self):
         super().__init__()
-        self.chunking_strategies = EnhancedChunkingStrategies()
+        self.chunking_strategies = rag_resources.get_chunking_engine()
     
     async def upload_and_process_document_enhanced(
         self, 
@@ -32,20 +34,35 @@ class EnhancedMentalHealthRAGService(MentalHealthRAGService):
         chunk_size: int = 200,
         overlap: int = 30,
         mode: str = "sentences",
-        custom_keywords: Optional[List[str]] = None
+        custom_keywords: Optional[List[str]] = None,
+        progress: Optional[Callable[[str], None]] = None
     ) -> Dict[str, Any]:
-        """使用增強分塊策略上傳和處理文檔"""
+        """使用增強分塊策略上傳和處理文檔；每個階段開始時調用 progress(stage)，回調可拋出 IngestionCancelled 中止處理"""
         
         # 生成唯一文檔ID
         doc_id = str(uuid.uuid4())
         
         # 保存文件
+        if progress:
+            progress("saving")
         file_path = os.path.join(self.upload_dir, f"{doc_id}_{filename}")
         async with aiofiles.open(file_path, 'wb') as f:
             await f.write(file_content)
         
         try:
+            extension = os.path.splitext(filename)[1].lower()
+            if extension == '.pdf' and chunking_strategy == ChunkingStrategy.FIXED_LENGTH:
+                # 固定長度分塊只需向前掃描：PDF 逐頁串流處理，記憶體用量不隨頁數增長
+                return await self._upload_pdf_streaming(
+                    file_path, doc_id, filename,
+                    ChunkConfig(strategy=chunking_strategy, chunk_size=chunk_size, overlap=overlap, mode=mode),
+                    custom_keywords=custom_keywords,
+                    progress=progress
+                )
+
             # 提取文本內容
+            if progress:
+                progress("extracting")
             text_content = await self.doc_processor._extract_text(file_path, os.path.splitext(filename)[1].lower())
 
             # 結構友好的清理：保留換行與段落，以支援 hierarchical/session 分塊
@@ -72,6 +89,8 @@ class EnhancedMentalHealthRAGService(MentalHealthRAGService):
             cleaned_text = _clean_text_preserve_structure(text_content)
             
             # 分類內容
+            if progress:
+                progress("classifying")
             categories = self.doc_processor._classify_content(cleaned_text, custom_keywords=custom_keywords)
             
             # 使用增強分塊策略
@@ -82,6 +101,8 @@ class EnhancedMentalHealthRAGService(MentalHealthRAGService):
                 mode=mode
             )
             
+            if progress:
+                progress("chunking")
             chunks = self.chunking_strategies.chunk_text(cleaned_text, config)
             
             # 準備元數據
@@ -97,7 +118,9 @@ class EnhancedMentalHealthRAGService(MentalHealthRAGService):
                 "mode": mode
             }
             
-            # 添加到向量數據庫
+            # 添加到向量數據庫（嵌入並寫入）
+            if progress:
+                progress("indexing")
             success = await self.vector_db.add_document(
                 doc_id=doc_id,
                 chunks=chunks,
@@ -130,6 +153,10 @@ class EnhancedMentalHealthRAGService(MentalHealthRAGService):
                     "message": "向量化處理失敗"
                 }
                 
+        except IngestionCancelled:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
         except Exception as e:
             if os.path.exists(file_path):
                 os.remove(file_path)
@@ -138,6 +165,65 @@ class EnhancedMentalHealthRAGService(MentalHealthRAGService):
                 "message": f"文檔處理失敗: {str(e)}"
             }
 
+    async def _upload_pdf_streaming(
+        self,
+        file_path: str,
+        doc_id: str,
+        filename: str,
+        config: ChunkConfig,
+        *,
+        custom_keywords: Optional[List[str]] = None,
+        progress: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, Any]:
+        """固定長度分塊的 PDF 串流處理（結構友好清理 + 固定長度分塊，結果與整份文本處理相同）"""
+
+        def fixed_length_chunks(segments: Iterable[str]) -> Iterator[Dict[str, Any]]:
+            chunk_stream = iter_fixed_chunks(segments, chunk_size=config.chunk_size, overlap=config.overlap, mode=config.mode)
+            for chunk_id, (chunk_text, start_index, end_index, _) in enumerate(chunk_stream):
+                yield self.chunking_strategies._create_chunk_metadata(chunk_text, chunk_id, start_index, end_index, config)
+
+        streamed = await self.ingest_pdf_stream(
+            file_path,
+            doc_id,
+            {
+                "filename": filename,
+                "extension": ".pdf",
+                "doc_id": doc_id,
+                "chunking_strategy": config.strategy.value,
+                "chunk_size": config.chunk_size,
+                "overlap": config.overlap,
+                "mode": config.mode
+            },
+            chunker=fixed_length_chunks,
+            clean=iter_structured_segments,
+            custom_keywords=custom_keywords,
+            progress=progress
+        )
+
+        chunk_count = streamed["chunk_count"]
+        os.remove(file_path)
+        if not chunk_count:
+            return {
+                "success": False,
+                "message": "向量化處理失敗"
+            }
+        return {
+            "success": True,
+            "doc_id": doc_id,
+            "filename": filename,
+            "categories": streamed["categories"],
+            "chunk_count": chunk_count,
+            "chunking_strategy": config.strategy.value,
+            "processed_at": datetime.now().isoformat(),
+            "message": f"文檔使用 {config.strategy.value} 策略成功處理",
+            "chunk_details": {
+                "avg_length": streamed["total_length"] / chunk_count,
+                "chunk_types": streamed["chunk_types"],
+                "strategy_used": config.strategy.value,
+                "pages": streamed["pages"]
+            }
+        }
+
 async def demonstrate_chunking_comparison():
     """演示不同分塊策略的比較"""
     
@@ -196,7 +282,7 @@ async def demonstrate_chunking_comparison():
 """
     
     # 創建增強RAG服務
-    enhanced_rag = EnhancedMentalHealthRAGService()
+    enhanced_rag = get_enhanced_rag_service()
     
     # 測試不同分塊策略
     strategies_to_test = [
@@ -264,7 +350,7 @@ Speaker 2: 我同意。持續時間也很重要。如果焦慮持續超過兩週
     
     print("=== 會話分塊演示 ===\n")
     
-    enhanced_rag = EnhancedMentalHealthRAGService()
+    enhanced_rag = get_enhanced_rag_service()
     
     config = ChunkConfig(
         strategy=ChunkingStrategy.SESSION,
@@ -283,6 +369,10 @@ Speaker 2: 我同意。持續時間也很重要。如果焦慮持續超過兩週
         print(f"長度: {chunk['length']} 字符")
         print(f"內容: {chunk['text'][:150]}...")
 
+def get_enhanced_rag_service() -> EnhancedMentalHealthRAGService:
+    """進程內共享的增強RAG服務（首次調用時創建，線程安全）"""
+    return rag_resources.get_or_create("enhanced_rag_service", EnhancedMentalHealthRAGService)
+
 async def main():
     """主函數：運行所有演示"""
     print("🚀 開始RAG系統分塊策略演示...\n")
@@ -0,0 +1,224 @@
+"""
+Document parsing in a process pool
+PyPDF2, python-docx and openpyxl are pure-Python and CPU-bound; running them on the
+server's event loop (or in a thread, under the GIL) stalls every chat stream.
+DocumentParserPool runs them in worker processes with a per-file timeout; large PDFs
+are split into page ranges parsed in parallel and reassembled in page order.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, List, Optional, Tuple
+
+
+class ParseTimeoutError(TimeoutError):
+    """Raised when a document takes longer than the per-file timeout to parse"""
+
+
+# ---------- worker functions (module level so they can be pickled to worker processes) ----------
+
+def parse_pdf_pages(file_path: str, start: int, end: int) -> Tuple[int, List[str]]:
+    """Text of pages [start, end) and the PDF's total page count"""
+    import PyPDF2
+
+    with open(file_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        total = len(reader.pages)
+        return total, [reader.pages[i].extract_text() or "" for i in range(start, min(end, total))]
+
+
+def parse_docx(file_path: str) -> str:
+    from docx import Document
+
+    doc = Document(file_path)
+    return "".join(paragraph.text + "\n" for paragraph in doc.paragraphs)
+
+
+def parse_xlsx(file_path: str) -> str:
+    import openpyxl
+
+    # read_only streams rows instead of building the whole sheet model
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        parts = []
+        for sheet_name in workbook.sheetnames:
+            sheet = workbook[sheet_name]
+            parts.append(f"Sheet: {sheet_name}\n")
+            for row in sheet.iter_rows(values_only=True):
+                row_text = "\t".join([str(cell) if cell is not None else "" for cell in row])
+                if row_text.strip():
+                    parts.append(row_text + "\n")
+            parts.append("\n")
+        return "".join(parts)
+    finally:
+        workbook.close()
+
+
+# ---------- pool ----------
+
+class DocumentParserPool:
+    """
+    Lazily started process pool for document parsing.
+    max_workers: worker processes; timeout_seconds: limit for one whole file;
+    pages_per_task: PDF pages parsed per task (each task reopens the file, so
+    very small ranges spend their time re-reading the PDF structure).
+    A timed-out parse can only be stopped by killing the pool, which also breaks
+    other files' tasks running in it; those are resubmitted to the new pool.
+    """
+
+    # Resubmissions of one task after other files' timeouts restarted the pool under it
+    MAX_RESUBMITS = 3
+
+    def __init__(self, max_workers: int = 2, timeout_seconds: float = 300, pages_per_task: int = 16):
+        self.max_workers = max(1, max_workers)
+        self.timeout_seconds = timeout_seconds
+        self.pages_per_task = max(1, pages_per_task)
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # Jobs parse from several worker threads (one event loop each)
+        self._stats_lock = threading.Lock()
+        self.stats = {"files": 0, "pages": 0, "timeouts": 0, "failures": 0, "pool_restarts": 0,
+                      "resubmitted_tasks": 0, "parse_seconds": 0.0}
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for key, delta in deltas.items():
+                self.stats[key] += delta
+
+    def _pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: workers must not inherit the server's threads, model weights or open DB handles.
+                # Spawned workers re-import the launching __main__ script, so the server is started through
+                # uvicorn (mental_health_server.py's own __main__ hands off to it) rather than as that script.
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _restart(self, executor: concurrent.futures.ProcessPoolExecutor):
+        """
+        Kill the workers of `executor` (a timed-out parse cannot be cancelled otherwise) and start
+        fresh on next use; a pool already replaced by another restart is left alone
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        self._count(pool_restarts=1)
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _replaced(self, executor: concurrent.futures.ProcessPoolExecutor) -> bool:
+        with self._lock:
+            return self._executor is not executor
+
+    async def _call(self, deadline: float, file_path: str, func, *args):
+        """
+        Run one task in the pool by `deadline`. Timeouts and crashed workers become errors
+        the callers report (restarting the pool); a task broken or cancelled only because
+        another file's timeout restarted the pool is resubmitted to the new one.
+        """
+        for attempt in range(self.MAX_RESUBMITS + 1):
+            executor = self._pool()
+            future = executor.submit(func, *args)
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                return await asyncio.wait_for(asyncio.wrap_future(future), remaining)
+            except asyncio.TimeoutError:
+                future.cancel()
+                self._count(timeouts=1)
+                self._restart(executor)
+                raise ParseTimeoutError(f"Parsing {os.path.basename(file_path)} took longer than {self.timeout_seconds}s")
+            except (concurrent.futures.process.BrokenProcessPool, asyncio.CancelledError) as e:
+                if isinstance(e, asyncio.CancelledError):
+                    # Only a future cancelled by the pool shutdown is resubmitted, never a cancelled caller
+                    task = asyncio.current_task()
+                    if not future.cancelled() or (task is not None and task.cancelling()):
+                        raise
+                if self._replaced(executor) and attempt < self.MAX_RESUBMITS:
+                    self._count(resubmitted_tasks=1)
+                    continue
+                self._count(failures=1)
+                self._restart(executor)
+                raise RuntimeError("Document parser worker crashed")
+
+    def _record(self, started: float, pages: int = 0):
+        self._count(files=1, pages=pages, parse_seconds=time.perf_counter() - started)
+
+    async def iter_pdf_pages(self, file_path: str) -> AsyncIterator[str]:
+        """
+        Page texts in page order. The first range also reports the page count; the
+        rest are parsed in parallel with at most 2 x max_workers ranges in flight,
+        so memory is bounded by the ranges not yet consumed.
+        """
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.timeout_seconds
+        total, pages = await self._call(deadline, file_path, parse_pdf_pages, file_path, 0, self.pages_per_task)
+        for page in pages:
+            yield page
+
+        starts = iter(range(self.pages_per_task, total, self.pages_per_task))
+        in_flight: Deque[asyncio.Task] = deque()
+
+        def schedule():
+            for start in starts:
+                in_flight.append(asyncio.ensure_future(
+                    self._call(deadline, file_path, parse_pdf_pages, file_path, start, start + self.pages_per_task)
+                ))
+                if len(in_flight) >= self.max_workers * 2:
+                    return
+
+        schedule()
+        try:
+            while in_flight:
+                _, pages = await in_flight[0]
+                in_flight.popleft()
+                schedule()
+                for page in pages:
+                    yield page
+            self._record(started, total)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def extract_pdf(self, file_path: str) -> str:
+        return "".join([page + "\n" async for page in self.iter_pdf_pages(file_path)])
+
+    async def _extract(self, func, file_path: str) -> str:
+        started = time.perf_counter()
+        text = await self._call(time.monotonic() + self.timeout_seconds, file_path, func, file_path)
+        self._record(started)
+        return text
+
+    async def extract_docx(self, file_path: str) -> str:
+        return await self._extract(parse_docx, file_path)
+
+    async def extract_xlsx(self, file_path: str) -> str:
+        return await self._extract(parse_xlsx, file_path)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "parse_seconds": round(stats["parse_seconds"], 3),
+            "max_workers": self.max_workers,
+            "timeout_seconds": self.timeout_seconds,
+            "pages_per_task": self.pages_per_task,
+            "running": self._executor is not None,
+        }
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,162 @@
+"""
+Page-wise streaming ingestion helpers
+Generators that take a document page by page through cleaning, classification and
+fixed-length chunking without ever joining the whole text:
+
+    pages -> PageSpool (disk) -> cleaned segments -> chunks -> embedding batches
+
+Each stage holds at most one page, one chunk window or one batch, so memory stays
+flat however long the document is. The cleaners and the chunker produce exactly what
+the whole-text functions produce on the pages joined with "\\n" (the layout
+_extract_pdf builds), and chunk offsets count units across the whole document.
+"""
+
+import json
+import re
+import tempfile
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import jieba
+
+# Characters kept by MentalHealthDocumentProcessor._clean_text
+CLEAN_TEXT_PATTERN = re.compile(r'[^\u4e00-\u9fff\w\s.,!?;:()【】""、。！？；：（）]')
+
+
+class PageSpool:
+    """Page texts spooled to a temporary JSON-lines file, so later passes can re-read them lazily"""
+
+    def __init__(self, directory: Optional[str] = None):
+        self._file = tempfile.TemporaryFile("w+", encoding="utf-8", dir=directory)
+        self.pages = 0
+        self.chars = 0
+
+    def append(self, text: str):
+        self._file.write(json.dumps(text, ensure_ascii=False) + "\n")
+        self.pages += 1
+        self.chars += len(text)
+
+    def __iter__(self) -> Iterator[str]:
+        self._file.flush()
+        self._file.seek(0)
+        for line in self._file:
+            yield json.loads(line)
+        self._file.seek(0, 2)
+
+    def close(self):
+        self._file.close()
+
+
+def iter_clean_segments(pages: Iterable[str]) -> Iterator[str]:
+    """Streaming _clean_text: whitespace collapsed to single spaces, special characters removed, stripped"""
+    had_words = False
+    emitted = False
+    pending = ""  # trailing whitespace, only emitted if more text follows
+    for page in pages:
+        words = page.split()
+        if not words:
+            continue
+        # Pages are separated by "\n", so a page boundary is always a word boundary
+        segment = CLEAN_TEXT_PATTERN.sub("", (" " if had_words else "") + " ".join(words))
+        had_words = True
+        if not emitted:
+            segment = segment.lstrip()
+        body = segment.rstrip()
+        if body:
+            yield pending + body
+            emitted = True
+            pending = segment[len(body):]
+        elif emitted:
+            pending += segment
+
+
+def iter_structured_segments(pages: Iterable[str]) -> Iterator[str]:
+    """
+    Streaming structure-preserving cleaning (used by the enhanced chunking service):
+    line breaks kept, spaces collapsed within lines, at most 2 consecutive empty lines, stripped
+    """
+    started = False
+    empty_run = 0
+    pending_empty = 0
+    for page in pages:
+        out: List[str] = []
+        raw = (page + "\n").replace("\r\n", "\n").replace("\r", "\n")
+        for line in raw.split("\n")[:-1]:
+            line = " ".join(line.split())
+            if not line:
+                empty_run += 1
+                if started and empty_run <= 2:
+                    pending_empty += 1
+                continue
+            empty_run = 0
+            out.append("\n" * (pending_empty + 1) + line if started else line)
+            started = True
+            pending_empty = 0
+        if out:
+            yield "".join(out)
+
+
+class StreamingClassifier:
+    """
+    Incremental _classify_content: keyword hits are collected segment by segment, and the
+    tail of the previous segment is kept so keywords spanning a boundary still match
+    """
+
+    def __init__(self, categories: Dict[str, List[str]]):
+        self._keywords = [(category, keyword.lower()) for category, keywords in categories.items()
+                          for keyword in keywords if keyword]
+        self._tail_length = max((len(keyword) for _, keyword in self._keywords), default=1) - 1
+        self._tail = ""
+        self.matched = set()
+
+    def feed(self, segment: str):
+        window = self._tail + segment.lower()
+        for category, keyword in self._keywords:
+            if category not in self.matched and keyword in window:
+                self.matched.add(category)
+        self._tail = window[-self._tail_length:] if self._tail_length > 0 else ""
+
+    def categories(self) -> List[str]:
+        return list(self.matched) if self.matched else ["General Mental Health"]
+
+
+def iter_fixed_chunks(segments: Iterable[str], chunk_size: int = 200, overlap: int = 30,
+                      mode: str = "chars") -> Iterator[Tuple[str, int, int, int]]:
+    """
+    Fixed-length chunking over a stream of text segments, yielding
+    (text, start_index, end_index, unit_count). Units are characters, or jieba words in
+    'words' mode; indexes count units from the start of the document. Words are segmented per
+    segment, which gives the same words as the whole text because segments start at whitespace.
+    """
+    current: List[str] = []
+    measure = 0  # character count, or word count in words mode
+    index = -1
+    for segment in segments:
+        units = jieba.cut(segment) if mode == 'words' else segment
+        for unit in units:
+            index += 1
+            current.append(unit)
+            measure += 1 if mode == 'words' else len(unit)
+            if measure >= chunk_size:
+                yield ''.join(current), index - len(current) + 1, index, len(current)
+                # Overlap processing
+                if overlap > 0:
+                    current = current[-overlap:] if len(current) > overlap else current
+                else:
+                    current = []
+                measure = len(current) if mode == 'words' else sum(len(u) for u in current)
+
+    # The last chunk
+    if current:
+        total = index + 1
+        yield ''.join(current), total - len(current), total - 1, len(current)
+
+
+def iter_batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -11,12 +11,12 @@ from datetime import datetime
 import json
 
 from enhanced_chunking_strategies import ChunkingStrategy, ChunkConfig
-from chunking_integration_example import EnhancedMentalHealthRAGService
+from chunking_integration_example import get_enhanced_rag_service
 
 app = FastAPI(title="Enhanced Mental Health RAG API", version="1.0.0")
 
-# 初始化增強RAG服務
-enhanced_rag_service = EnhancedMentalHealthRAGService()
+# 增強RAG服務（與基礎服務共享嵌入模型、Chroma 客戶端和分塊引擎）
+enhanced_rag_service = get_enhanced_rag_service()
 
 @app.post("/api/upload-document-enhanced")
 async def upload_document_enhanced(
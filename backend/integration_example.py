@@ -6,19 +6,20 @@ import asyncio
 import os
 from typing import Dict, Any
 from enhanced_chunking_strategies import ChunkingStrategy, ChunkConfig
-from mental_health_rag_service import MentalHealthRAGService
+from mental_health_rag_service import mental_health_rag_service
+from rag_resources import rag_resources
 
 class IntegratedMentalHealthRAG:
     """整合了增強分塊策略的心理健康RAG系統"""
     
     def __init__(self):
-        self.rag_service = MentalHealthRAGService()
+        # 使用全局RAG服務與共享分塊引擎，不重複加載嵌入模型
+        self.rag_service = mental_health_rag_service
         self.chunking_strategies = None
         
         # 嘗試導入增強分塊策略
         try:
-            from enhanced_chunking_strategies import EnhancedChunkingStrategies
-            self.chunking_strategies = EnhancedChunkingStrategies()
+            self.chunking_strategies = rag_resources.get_chunking_engine()
             print("✅ 增強分塊策略已加載")
         except ImportError as e:
             print(f"⚠️ 增強分塊策略加載失敗: {e}")
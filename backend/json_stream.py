@@ -0,0 +1,81 @@
+"""
+流式 JSON 讀取
+逐個解碼大 JSON 文件頂層對象的鍵值，數組值逐個元素產出，內存不隨文件大小增長
+（舊版聊天數據遷移和用戶列表導入共用）
+"""
+
+import json
+from typing import Any, Iterator, Tuple
+
+_WHITESPACE = " \t\r\n"
+_DELIMITERS = _WHITESPACE + ",:]}"
+
+
+class JSONStreamReader:
+    """
+    增量 JSON 解析：按塊讀取文件，逐個解碼頂層對象的鍵值；數組值逐個元素產出，不整體載入。
+    產出 (key, value, in_array)：in_array 為 True 時 value 是該鍵數組中的一個元素。
+    """
+
+    def __init__(self, f, chunk_size: int = 1024 * 1024):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        data = self._f.read(self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"JSON 格式錯誤: 位置 {self._pos} 應為 {char!r}")
+        self._pos += 1
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # 數字可能被塊邊界截斷（如 "12." 會先解析出 12），後面是分隔符時才能確定已完整
+                if self._eof or (end < len(self._buf) and self._buf[end] in _DELIMITERS):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def items(self) -> Iterator[Tuple[str, Any, bool]]:
+        self._expect("{")
+        while self._peek() not in ("}", ""):
+            key = self._value()
+            self._expect(":")
+            if self._peek() == "[":
+                self._pos += 1
+                while self._peek() not in ("]", ""):
+                    yield key, self._value(), True
+                    if self._peek() == ",":
+                        self._pos += 1
+                self._expect("]")
+            else:
+                yield key, self._value(), False
+            if self._peek() == ",":
+                self._pos += 1
+        self._expect("}")
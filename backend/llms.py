@@ -1,8 +1,12 @@
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 
-def _setup_model_client():
+MODEL_NAME = "claude-sonnet-4-20250514"
+# 預算接近上限時使用的較便宜模型
+ECONOMY_MODEL_NAME = "claude-3-5-haiku-20241022"
+
+def _setup_model_client(model: str = MODEL_NAME, stream: bool = False):
     model_config = {
-        "model": "claude-sonnet-4-20250514",
+        "model": model,
         "api_key": "",
         "base_url": "",
         #接口/请求地址： https://xiaoai.plus
@@ -19,7 +23,14 @@ def _setup_model_client():
             #"temperature": 0.7,
         },
     }
+    if stream:
+        # 串流回應預設不帶 token 用量；要求最後一個 chunk 附上 usage，預算統計才不會記成 0
+        model_config["stream_options"] = {"include_usage": True}
     return OpenAIChatCompletionClient(**model_config)
 
 #單利設計模式（只創建一次）
-model_client = _setup_model_client()
\ No newline at end of file
+model_client = _setup_model_client()
+economy_model_client = _setup_model_client(ECONOMY_MODEL_NAME)
+# 串流專用（stream_options 只能用在串流請求）
+stream_model_client = _setup_model_client(stream=True)
+stream_economy_model_client = _setup_model_client(ECONOMY_MODEL_NAME, stream=True)
@@ -4,15 +4,23 @@ Provides mental health knowledge base management functionality
 """
 
 from fastapi import APIRouter, UploadFile, File, HTTPException, Query, Body, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import List, Optional, Dict, Any
 import json
 from datetime import datetime
 from pydantic import BaseModel
 
+# Shared embedding model / Chroma client / chunking engine
+from rag_resources import rag_resources
+
+# Background ingestion jobs
+from rag_ingestion_jobs import (
+    IngestionJobQueue, IngestionJob, IngestionCancelled, QueueFullError, JobStateError, JOB_SUCCEEDED
+)
+
 # Import mental health RAG service
 try:
-    from mental_health_rag_service import mental_health_rag_service
+    from mental_health_rag_service import mental_health_rag_service, document_parser_pool
     RAG_ENABLED = True
 except ImportError as e:
     print(f"⚠️ Mental health RAG service loading failed: {e}")
@@ -37,6 +45,113 @@ async def health_check():
         "timestamp": datetime.now().isoformat()
     }
 
+ALLOWED_UPLOAD_EXTENSIONS = {'.txt', '.pdf', '.docx', '.xlsx', '.md'}
+
+# Ingestion job queue: waiting jobs beyond INGESTION_MAX_QUEUE are rejected, INGESTION_CONCURRENCY run at once
+INGESTION_MAX_QUEUE = 50
+INGESTION_CONCURRENCY = 2
+
+def _parse_custom_keywords(custom_keywords: Optional[str]) -> Optional[List[str]]:
+    """JSON array string or comma-separated keywords"""
+    if not custom_keywords:
+        return None
+    try:
+        parsed = json.loads(custom_keywords)
+        if isinstance(parsed, list):
+            return [str(x).strip() for x in parsed if str(x).strip()]
+    except Exception:
+        pass
+    return [s.strip() for s in str(custom_keywords).split(',') if s.strip()]
+
+async def _run_ingestion(job: IngestionJob) -> Dict[str, Any]:
+    """
+    Ingestion pipeline run by the job workers: enhanced chunking, falling back to basic chunking.
+    The fallback only covers failures before indexing starts; once chunks may have been stored,
+    the job fails (and can be retried) instead of indexing the document a second time.
+    """
+    with open(job.file_path, 'rb') as f:
+        file_content = f.read()
+    params = job.params
+    
+    # 嘗試使用增強分塊策略
+    try:
+        from enhanced_chunking_strategies import ChunkingStrategy
+        from chunking_integration_example import get_enhanced_rag_service
+        
+        # Shared instance: the embedding model and Chroma client are loaded once per process
+        enhanced_rag = get_enhanced_rag_service()
+        strategy_enum = ChunkingStrategy(params["chunking_strategy"])
+    except Exception as e:
+        return await _run_basic_ingestion(job, file_content, f"Enhanced chunking unavailable: {type(e).__name__}: {e}")
+    
+    try:
+        return await enhanced_rag.upload_and_process_document_enhanced(
+            file_content,
+            job.filename,
+            chunking_strategy=strategy_enum,
+            chunk_size=params["chunk_size"],
+            overlap=params["overlap"],
+            mode=params["mode"],
+            custom_keywords=params["custom_keywords"],
+            progress=job.report
+        )
+    except IngestionCancelled:
+        raise
+    except Exception as e:
+        if job.stage == "indexing":
+            raise
+        return await _run_basic_ingestion(job, file_content, f"Enhanced chunking failed: {type(e).__name__}: {e}")
+
+async def _run_basic_ingestion(job: IngestionJob, file_content: bytes, reason: str) -> Dict[str, Any]:
+    """Basic chunking fallback; the reason is kept in the job result so the fallback is visible to clients"""
+    print(f"⚠️ {reason}")
+    print(f"⚠️ Falling back to basic chunking strategy")
+    params = job.params
+    # 回退到原有方法
+    result = await mental_health_rag_service.upload_and_process_document(
+        file_content,
+        job.filename,
+        chunk_size=params["chunk_size"],
+        overlap=params["overlap"],
+        mode=params["mode"],
+        custom_keywords=params["custom_keywords"],
+        progress=job.report
+    )
+    return {**result, "fallback": {"strategy": "basic", "reason": reason}}
+
+ingestion_jobs = IngestionJobQueue(
+    _run_ingestion,
+    max_queue=INGESTION_MAX_QUEUE,
+    concurrency=INGESTION_CONCURRENCY
+)
+
+async def _submit_upload(file: UploadFile, chunking_strategy: str, chunk_size: int, overlap: int,
+                         mode: str, custom_keywords: Optional[str]) -> IngestionJob:
+    """Validate an upload and queue it as an ingestion job"""
+    if not RAG_ENABLED:
+        raise HTTPException(status_code=503, detail="Mental health RAG service unavailable")
+    
+    print(f"📥 RAG Upload Params -> chunking_strategy={chunking_strategy}, chunk_size={chunk_size}, overlap={overlap}, mode={mode}, custom_keywords={custom_keywords}")
+    # Check file type
+    file_extension = file.filename.lower().split('.')[-1] if '.' in file.filename else ''
+    if f'.{file_extension}' not in ALLOWED_UPLOAD_EXTENSIONS:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Unsupported file format: {file_extension}. Supported formats: {', '.join(ALLOWED_UPLOAD_EXTENSIONS)}"
+        )
+    
+    params = {
+        "chunking_strategy": chunking_strategy,
+        "chunk_size": chunk_size,
+        "overlap": overlap,
+        "mode": mode,
+        "custom_keywords": _parse_custom_keywords(custom_keywords)
+    }
+    try:
+        return ingestion_jobs.submit(await file.read(), file.filename, params)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
 @router.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
@@ -46,94 +161,91 @@ async def upload_document(
     mode: str = Form("sentences"),  # 'chars' | 'words' | 'sentences' | 'paragraphs'
     custom_keywords: Optional[str] = Form(None)  # JSON array string or comma-separated
 ):
-    """Upload mental health document"""
-    if not RAG_ENABLED:
-        raise HTTPException(status_code=503, detail="Mental health RAG service unavailable")
+    """
+    Upload mental health document and wait for it to be processed (runs as an ingestion job, off the event loop).
+    Kept for older clients; the frontend uses POST /jobs and follows /jobs/{job_id}/events instead.
+    """
+    job = await _submit_upload(file, chunking_strategy, chunk_size, overlap, mode, custom_keywords)
+    job = await ingestion_jobs.wait(job.id)
+    
+    if job.status == JOB_SUCCEEDED:
+        return JSONResponse(
+            status_code=200,
+            content={
+                "success": True,
+                "message": "Document uploaded successfully",
+                "data": job.result,
+                "job_id": job.id,
+                "used_params": job.params
+            }
+        )
+    raise HTTPException(status_code=500, detail=f"Document upload failed: {job.error}")
+
+@router.post("/jobs", status_code=202)
+async def create_ingestion_job(
+    file: UploadFile = File(...),
+    chunking_strategy: str = Form("semantic"),
+    chunk_size: int = Form(200),
+    overlap: int = Form(30),
+    mode: str = Form("sentences"),
+    custom_keywords: Optional[str] = Form(None)
+):
+    """Queue a document for ingestion and return its job at once; follow it via /jobs/{job_id} or /jobs/{job_id}/events"""
+    job = await _submit_upload(file, chunking_strategy, chunk_size, overlap, mode, custom_keywords)
+    return {"success": True, "job": job.to_dict()}
+
+@router.get("/jobs")
+async def list_ingestion_jobs(
+    status: Optional[str] = Query(None, description="queued, running, succeeded, failed or cancelled"),
+    limit: int = Query(50, ge=1, le=500, description="Most recent jobs to return")
+):
+    """Recent ingestion jobs and queue statistics"""
+    return {"success": True, "jobs": ingestion_jobs.list_jobs(status, limit), "stats": ingestion_jobs.get_stats()}
+
+def _get_job(job_id: str) -> IngestionJob:
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/jobs/{job_id}")
+async def get_ingestion_job(job_id: str):
+    """Job status with the current stage, per-stage timings and the result once finished"""
+    return {"success": True, "job": _get_job(job_id).to_dict()}
+
+@router.get("/jobs/{job_id}/events")
+async def stream_ingestion_job(job_id: str):
+    """Server-sent events: one `progress` event per job update, ending with the final state"""
+    _get_job(job_id)
+    
+    async def event_stream():
+        async for snapshot in ingestion_jobs.watch(job_id):
+            yield f"event: progress\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
     
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_ingestion_job(job_id: str):
+    """Cancel a queued job, or stop a running one at its next stage"""
+    _get_job(job_id)
     try:
-        print(f"📥 RAG Upload Params -> chunking_strategy={chunking_strategy}, chunk_size={chunk_size}, overlap={overlap}, mode={mode}, custom_keywords={custom_keywords}")
-        # Check file type
-        allowed_extensions = {'.txt', '.pdf', '.docx', '.xlsx', '.md'}
-        file_extension = file.filename.lower().split('.')[-1] if '.' in file.filename else ''
-        
-        if f'.{file_extension}' not in allowed_extensions:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Unsupported file format: {file_extension}. Supported formats: {', '.join(allowed_extensions)}"
-            )
-        
-        # Read file content
-        file_content = await file.read()
-
-        # Parse custom keywords
-        user_keywords: Optional[List[str]] = None
-        if custom_keywords:
-            try:
-                parsed = json.loads(custom_keywords)
-                if isinstance(parsed, list):
-                    user_keywords = [str(x).strip() for x in parsed if str(x).strip()]
-                else:
-                    user_keywords = [s.strip() for s in str(custom_keywords).split(',') if s.strip()]
-            except Exception:
-                user_keywords = [s.strip() for s in str(custom_keywords).split(',') if s.strip()]
-        
-        # Process document (with user parameters)
-        # 嘗試使用增強分塊策略
-        try:
-            from enhanced_chunking_strategies import ChunkingStrategy
-            from chunking_integration_example import EnhancedMentalHealthRAGService
-            
-            enhanced_rag = EnhancedMentalHealthRAGService()
-            strategy_enum = ChunkingStrategy(chunking_strategy)
-            
-            result = await enhanced_rag.upload_and_process_document_enhanced(
-                file_content,
-                file.filename,
-                chunking_strategy=strategy_enum,
-                chunk_size=chunk_size,
-                overlap=overlap,
-                mode=mode,
-                custom_keywords=user_keywords
-            )
-        except Exception as e:
-            print(f"⚠️ Enhanced chunking failed: {e}")
-            print(f"⚠️ Error type: {type(e).__name__}")
-            print(f"⚠️ Falling back to basic chunking strategy")
-            # 回退到原有方法
-            try:
-                result = await mental_health_rag_service.upload_and_process_document(
-                    file_content,
-                    file.filename,
-                    chunk_size=chunk_size,
-                    overlap=overlap,
-                    mode=mode,
-                    custom_keywords=user_keywords
-                )
-            except Exception as fallback_error:
-                print(f"❌ Fallback also failed: {fallback_error}")
-                raise HTTPException(status_code=500, detail=f"Both enhanced and basic chunking failed: {str(e)}")
-        
-        if result["success"]:
-            return JSONResponse(
-                status_code=200,
-                content={
-                    "success": True,
-                    "message": "Document uploaded successfully",
-                    "data": result,
-                    "used_params": {
-                        "chunking_strategy": chunking_strategy,
-                        "chunk_size": chunk_size,
-                        "overlap": overlap,
-                        "mode": mode,
-                        "custom_keywords": user_keywords or []
-                    }
-                }
-            )
-        else:
-            raise HTTPException(status_code=500, detail=result["message"])
-            
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Document upload failed: {str(e)}")
+        job = ingestion_jobs.cancel(job_id)
+    except JobStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "job": job.to_dict()}
+
+@router.post("/jobs/{job_id}/retry")
+async def retry_ingestion_job(job_id: str):
+    """Queue a failed or cancelled job again"""
+    _get_job(job_id)
+    try:
+        job = ingestion_jobs.retry(job_id)
+    except JobStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    return {"success": True, "job": job.to_dict()}
 
 @router.get("/search")
 async def search_knowledge_base(
@@ -298,7 +410,9 @@ async def get_rag_stats():
                 "total_chunks": total_chunks,
                 "available_categories": len(categories),
                 "category_distribution": category_stats,
-                "categories": categories
+                "categories": categories,
+                "shared_resources": rag_resources.get_stats(),
+                "document_parser": document_parser_pool.get_stats()
             }
         }
     except Exception as e:
@@ -313,9 +427,9 @@ async def test_chunking_strategy(request: ChunkingTestRequest):
     try:
         # 嘗試使用增強分塊策略
         try:
-            from enhanced_chunking_strategies import ChunkingStrategy, ChunkConfig, EnhancedChunkingStrategies
+            from enhanced_chunking_strategies import ChunkingStrategy, ChunkConfig
             
-            chunking_strategies = EnhancedChunkingStrategies()
+            chunking_strategies = rag_resources.get_chunking_engine()
             strategy_enum = ChunkingStrategy(request.chunking_strategy)
             
             config = ChunkConfig(
@@ -6,7 +6,7 @@ Specialized in handling mental health related documents and knowledge base
 import os
 import uuid
 import asyncio
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Callable, Iterable, Iterator
 from pathlib import Path
 import chromadb
 from chromadb.config import Settings
@@ -16,11 +16,25 @@ import jieba
 from datetime import datetime
 import json
 
-# Document processing related
-import PyPDF2
-from docx import Document
-import openpyxl
-from sentence_transformers import SentenceTransformer
+# Document processing related (PDF / Word / Excel parsing runs in worker processes)
+from document_parsing import DocumentParserPool
+
+from rag_resources import rag_resources
+from rag_ingestion_jobs import IngestionCancelled
+from document_streaming import PageSpool, StreamingClassifier, iter_batches, iter_clean_segments, iter_fixed_chunks
+
+# Document parser process pool: worker count, time limit for one file, PDF pages per parallel task
+DOCUMENT_PARSER_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+DOCUMENT_PARSE_TIMEOUT_SECONDS = 300
+PDF_PAGES_PER_TASK = 16
+document_parser_pool = DocumentParserPool(
+    max_workers=DOCUMENT_PARSER_WORKERS,
+    timeout_seconds=DOCUMENT_PARSE_TIMEOUT_SECONDS,
+    pages_per_task=PDF_PAGES_PER_TASK
+)
+
+# Chunks embedded and written to ChromaDB together by the streaming PDF pipeline
+EMBED_BATCH_SIZE = 64
 
 class MentalHealthDocumentProcessor:
     """Mental Health Document Processor"""
@@ -191,42 +205,23 @@ class MentalHealthDocumentProcessor:
             return await f.read()
     
     async def _extract_pdf(self, file_path: str) -> str:
-        """Extract PDF file content"""
+        """Extract PDF file content (page ranges parsed in parallel in the document parser pool)"""
         try:
-            text = ""
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-            return text
+            return await document_parser_pool.extract_pdf(file_path)
         except Exception as e:
             raise ValueError(f"PDF file processing failed: {str(e)}")
 
     async def _extract_docx(self, file_path: str) -> str:
-        """Extract Word document content"""
+        """Extract Word document content (in the document parser pool)"""
         try:
-            doc = Document(file_path)
-            text = ""
-            for paragraph in doc.paragraphs:
-                text += paragraph.text + "\n"
-            return text
+            return await document_parser_pool.extract_docx(file_path)
         except Exception as e:
             raise ValueError(f"Word document processing failed: {str(e)}")
 
     async def _extract_xlsx(self, file_path: str) -> str:
-        """Extract Excel file content"""
+        """Extract Excel file content (in the document parser pool)"""
         try:
-            workbook = openpyxl.load_workbook(file_path)
-            text = ""
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                text += f"Sheet: {sheet_name}\n"
-                for row in sheet.iter_rows(values_only=True):
-                    row_text = "\t".join([str(cell) if cell is not None else "" for cell in row])
-                    if row_text.strip():
-                        text += row_text + "\n"
-                text += "\n"
-            return text
+            return await document_parser_pool.extract_xlsx(file_path)
         except Exception as e:
             raise ValueError(f"Excel document processing failed: {str(e)}")
 
@@ -241,15 +236,20 @@ class MentalHealthDocumentProcessor:
         
         return text.strip()
     
+    def _category_keywords(self, custom_keywords: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """Category keywords with the user's custom keywords merged in as a temporary category"""
+        temp_categories = dict(self.mental_health_categories)
+        if custom_keywords:
+            temp_categories["User Custom"] = custom_keywords
+        return temp_categories
+
     def _classify_content(self, text: str, custom_keywords: Optional[List[str]] = None) -> List[str]:
         """Classify content"""
         categories = []
         text_lower = text.lower()
         
         # Merge custom keywords into a temporary category (for classification)
-        temp_categories = dict(self.mental_health_categories)
-        if custom_keywords:
-            temp_categories["User Custom"] = custom_keywords
+        temp_categories = self._category_keywords(custom_keywords)
         
         for category, keywords in temp_categories.items():
             for keyword in keywords:
@@ -261,60 +261,22 @@ class MentalHealthDocumentProcessor:
     
     def _split_text(self, text: str, chunk_size: int = 200, overlap: int = 30, mode: str = "chars") -> List[Dict[str, Any]]:
         """Split content into chunks"""
-        # By character or word mode
-        if mode == 'words':
-            # Use jieba for Chinese word segmentation
-            units = list(jieba.cut(text))
-        else:
-            units = list(text)
-        
-        chunks = []
-        current_chunk: List[str] = []
-        current_measure = 0  # Length measure: character count or word count
-        
-        for i, unit in enumerate(units):
-            current_chunk.append(unit)
-            # words mode measures by "word count"; chars mode measures by "character count"
-            if mode == 'words':
-                current_measure += 1
-            else:
-                current_measure += len(unit)
-            
-            if current_measure >= chunk_size:
-                chunk_text = ''.join(current_chunk)
-                chunks.append({
-                    "id": len(chunks),
-                    "text": chunk_text,
-                    "length": len(chunk_text),
-                    "word_count": len(current_chunk),
-                    "start_index": i - len(current_chunk) + 1,
-                    "end_index": i
-                })
-                
-                # Overlap processing
-                if overlap > 0:
-                    overlap_units = current_chunk[-overlap:] if len(current_chunk) > overlap else current_chunk
-                else:
-                    overlap_units = []
-                current_chunk = overlap_units
-                if mode == 'words':
-                    current_measure = len(overlap_units)
-                else:
-                    current_measure = sum(len(u) for u in overlap_units)
-
-        # Process the last chunk
-        if current_chunk:
-            chunk_text = ''.join(current_chunk)
-            chunks.append({
-                "id": len(chunks),
+        return list(self._iter_chunks([text], chunk_size=chunk_size, overlap=overlap, mode=mode))
+
+    def _iter_chunks(self, segments: Iterable[str], *, chunk_size: int = 200, overlap: int = 30, mode: str = "chars") -> Iterator[Dict[str, Any]]:
+        """Split a stream of cleaned text segments into chunks (the same chunks _split_text gives for their concatenation)"""
+        # By character or word mode (jieba word segmentation); words mode measures by "word count"
+        for chunk_id, (chunk_text, start_index, end_index, unit_count) in enumerate(
+            iter_fixed_chunks(segments, chunk_size=chunk_size, overlap=overlap, mode=mode)
+        ):
+            yield {
+                "id": chunk_id,
                 "text": chunk_text,
                 "length": len(chunk_text),
-                "word_count": len(current_chunk),
-                "start_index": len(units) - len(current_chunk),
-                "end_index": len(units) - 1
-            })
-        
-        return chunks
+                "word_count": unit_count,
+                "start_index": start_index,
+                "end_index": end_index
+            }
 
 class MentalHealthChromaDBService:
     """Mental Health ChromaDB Vector Database Service"""
@@ -327,10 +289,9 @@ class MentalHealthChromaDBService:
         self._initialize()
     
     def _initialize(self):
-        """Initialize ChromaDB and embedding model"""
+        """Initialize ChromaDB and embedding model (shared process-wide through rag_resources)"""
         # Create ChromaDB Client
-        os.makedirs(self.persist_directory, exist_ok=True)
-        self.client = chromadb.PersistentClient(path=self.persist_directory)
+        self.client = rag_resources.get_chroma_client(self.persist_directory)
 
         # Get or create collection - use cosine similarity
         self.collection = self.client.get_or_create_collection(
@@ -338,67 +299,94 @@ class MentalHealthChromaDBService:
             metadata={"description": "Mental health knowledge base document vector storage", "hnsw:space": "cosine"}
         )
 
-        # Initialize embedding model
-        try:
-            self.embedder = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-        except Exception:
-            # Fallback option
-            self.embedder = SentenceTransformer('all-MiniLM-L6-v2')
+        # Initialize embedding model (falls back to all-MiniLM-L6-v2)
+        self.embedder = rag_resources.get_embedder()
     
+    def _chunk_records(self, doc_id: str, chunks: Iterable[Dict[str, Any]], metadata: Dict[str, Any]) -> Tuple[List[str], List[str], List[Dict[str, Any]]]:
+        """Documents, ids and ChromaDB metadata for a list of chunks"""
+        documents = []
+        ids = []
+        metadatas = []
+
+        # Serialize category list to string to comply with Chroma's primitive type requirements
+        categories_value = metadata.get('categories', [])
+        if isinstance(categories_value, list):
+            categories_csv = ",".join(categories_value)
+            primary_category = categories_value[0] if categories_value else "General Mental Health"
+        else:
+            categories_csv = str(categories_value) if categories_value is not None else ""
+            primary_category = categories_csv or "General Mental Health"
+
+        for chunk in chunks:
+            chunk_id = f"{doc_id}_{chunk['id']}"
+            documents.append(chunk['text'])
+            ids.append(chunk_id)
+            metadatas.append({
+                "doc_id": doc_id,
+                "chunk_id": chunk['id'],
+                "filename": metadata.get('filename', ''),
+                "file_type": metadata.get('extension', ''),
+                "categories_csv": categories_csv,
+                "category": primary_category,
+                "mode": metadata.get('mode', 'chars'),
+                "chunk_size": metadata.get('chunk_size', 200),
+                "overlap": metadata.get('overlap', 30),
+                "chunk_length": chunk['length'],
+                "word_count": chunk['word_count'],
+                "chunk_type": chunk.get('chunk_type', 'default'),
+                "chunking_strategy": metadata.get('chunking_strategy', 'fixed_length'),
+                "created_at": datetime.now().isoformat()
+            })
+        return documents, ids, metadatas
+
+    def _write_batch(self, documents: List[str], ids: List[str], metadatas: List[Dict[str, Any]]):
+        """Embed a batch of chunks and add it to ChromaDB"""
+        # Generate embedding vectors
+        embeddings = self.embedder.encode(documents, normalize_embeddings=True).tolist()
+
+        # Add to ChromaDB
+        self.collection.add(
+            documents=documents,
+            embeddings=embeddings,
+            metadatas=metadatas,
+            ids=ids
+        )
+
     async def add_document(self, doc_id: str, chunks: List[Dict[str, Any]], metadata: Dict[str, Any]) -> bool:
         """Add document to vector database"""
         try:
-            # Prepare data
-            documents = []
-            ids = []
-            metadatas = []
-            
-            for chunk in chunks:
-                chunk_id = f"{doc_id}_{chunk['id']}"
-                documents.append(chunk['text'])
-                ids.append(chunk_id)
-                # Serialize category list to string to comply with Chroma's primitive type requirements
-                categories_value = metadata.get('categories', [])
-                if isinstance(categories_value, list):
-                    categories_csv = ",".join(categories_value)
-                    primary_category = categories_value[0] if categories_value else "General Mental Health"
-                else:
-                    categories_csv = str(categories_value) if categories_value is not None else ""
-                    primary_category = categories_csv or "General Mental Health"
-
-                metadatas.append({
-                    "doc_id": doc_id,
-                    "chunk_id": chunk['id'],
-                    "filename": metadata.get('filename', ''),
-                    "file_type": metadata.get('extension', ''),
-                    "categories_csv": categories_csv,
-                    "category": primary_category,
-                    "mode": metadata.get('mode', 'chars'),
-                    "chunk_size": metadata.get('chunk_size', 200),
-                    "overlap": metadata.get('overlap', 30),
-                    "chunk_length": chunk['length'],
-                    "word_count": chunk['word_count'],
-                    "chunk_type": chunk.get('chunk_type', 'default'),
-                    "chunking_strategy": metadata.get('chunking_strategy', 'fixed_length'),
-                    "created_at": datetime.now().isoformat()
-                })
-            
-            # Generate embedding vectors
-            embeddings = self.embedder.encode(documents, normalize_embeddings=True).tolist()
-            
-            # Add to ChromaDB
-            self.collection.add(
-                documents=documents,
-                embeddings=embeddings,
-                metadatas=metadatas,
-                ids=ids
-            )
-            
+            # Embedding is CPU-bound: keep it off the event loop
+            await asyncio.to_thread(self._write_batch, *self._chunk_records(doc_id, chunks, metadata))
             return True
         except Exception as e:
             print(f"Failed to add document to vector database: {str(e)}")
             return False
-    
+
+    async def add_document_batches(self, doc_id: str, chunks: Iterable[Dict[str, Any]], metadata: Dict[str, Any], batch_size: int = EMBED_BATCH_SIZE) -> Optional[int]:
+        """
+        Add a document from a chunk stream, embedding and writing batch_size chunks at a time
+        so only one batch is held in memory. Returns the number of chunks written, or None on
+        failure (chunks already written for doc_id are removed again). The stream is consumed
+        in a worker thread, so chunking, embedding and writes all stay off the event loop.
+        """
+        return await asyncio.to_thread(self._add_batches, doc_id, chunks, metadata, batch_size)
+
+    def _add_batches(self, doc_id: str, chunks: Iterable[Dict[str, Any]], metadata: Dict[str, Any], batch_size: int) -> Optional[int]:
+        written = 0
+        try:
+            for batch in iter_batches(chunks, batch_size):
+                self._write_batch(*self._chunk_records(doc_id, batch, metadata))
+                written += len(batch)
+            return written
+        except Exception as e:
+            print(f"Failed to add document to vector database after {written} chunks: {str(e)}")
+            if written:
+                try:
+                    self.collection.delete(where={"doc_id": doc_id})
+                except Exception as cleanup_error:
+                    print(f"Failed to remove partially added document {doc_id}: {str(cleanup_error)}")
+            return None
+
     async def search_similar(self, query: str, top_k: int = 5, category_filter: Optional[str] = None) -> List[Dict[str, Any]]:
         """Search similar document chunks"""
         try:
@@ -559,43 +547,73 @@ class MentalHealthRAGService:
         self.upload_dir = "./mental_health_uploads"
         os.makedirs(self.upload_dir, exist_ok=True)
     
-    async def upload_and_process_document(self, file_content: bytes, filename: str, *, chunk_size: int = 200, overlap: int = 30, mode: str = "chars", custom_keywords: Optional[List[str]] = None) -> Dict[str, Any]:
-        """Upload and process document"""
+    async def upload_and_process_document(self, file_content: bytes, filename: str, *, chunk_size: int = 200, overlap: int = 30, mode: str = "chars", custom_keywords: Optional[List[str]] = None, progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """Upload and process document; `progress(stage)` is called as each stage starts and may raise IngestionCancelled"""
         # Generate unique document ID
         doc_id = str(uuid.uuid4())
         
         # Save file
+        if progress:
+            progress("saving")
         file_path = os.path.join(self.upload_dir, f"{doc_id}_{filename}")
         async with aiofiles.open(file_path, 'wb') as f:
             await f.write(file_content)
         
         try:
-            # Process document
-            processed_doc = await self.doc_processor.process_file(
-                file_path,
-                filename,
-                chunk_size=chunk_size,
-                overlap=overlap,
-                mode=mode,
-                custom_keywords=custom_keywords
-            )
+            if Path(filename).suffix.lower() == '.pdf':
+                # PDFs stream page by page: extraction, classification, chunking and indexing with bounded memory
+                streamed = await self.ingest_pdf_stream(
+                    file_path,
+                    doc_id,
+                    {
+                        "filename": filename,
+                        "extension": ".pdf",
+                        "doc_id": doc_id,
+                        "mode": mode,
+                        "chunk_size": chunk_size,
+                        "overlap": overlap
+                    },
+                    chunker=lambda segments: self.doc_processor._iter_chunks(segments, chunk_size=chunk_size, overlap=overlap, mode=mode),
+                    custom_keywords=custom_keywords,
+                    progress=progress
+                )
+                processed_doc = {
+                    "categories": streamed["categories"],
+                    "chunk_count": streamed["chunk_count"],
+                    "processed_at": datetime.now().isoformat()
+                }
+                success = bool(streamed["chunk_count"])
+            else:
+                # Process document (extraction, classification and chunking)
+                if progress:
+                    progress("extracting")
+                processed_doc = await self.doc_processor.process_file(
+                    file_path,
+                    filename,
+                    chunk_size=chunk_size,
+                    overlap=overlap,
+                    mode=mode,
+                    custom_keywords=custom_keywords
+                )
 
-            # Add to vector database
-            metadata = {
-                "filename": filename,
-                "extension": processed_doc["extension"],
-                "categories": processed_doc["categories"],
-                "doc_id": doc_id,
-                "mode": mode,
-                "chunk_size": chunk_size,
-                "overlap": overlap
-            }
-            
-            success = await self.vector_db.add_document(
-                doc_id=doc_id,
-                chunks=processed_doc["chunks"],
-                metadata=metadata
-            )
+                # Add to vector database
+                metadata = {
+                    "filename": filename,
+                    "extension": processed_doc["extension"],
+                    "categories": processed_doc["categories"],
+                    "doc_id": doc_id,
+                    "mode": mode,
+                    "chunk_size": chunk_size,
+                    "overlap": overlap
+                }
+
+                if progress:
+                    progress("indexing")
+                success = await self.vector_db.add_document(
+                    doc_id=doc_id,
+                    chunks=processed_doc["chunks"],
+                    metadata=metadata
+                )
             
             if success:
                 # Delete temporary file
@@ -623,6 +641,10 @@ class MentalHealthRAGService:
                     "success": False,
                     "message": "Vectorization processing failed"
                 }
+        except IngestionCancelled:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
         except Exception as e:
             # Cleanup on failure
             if os.path.exists(file_path):
@@ -632,6 +654,65 @@ class MentalHealthRAGService:
                 "message": f"Document processing failed: {str(e)}"
             }
     
+    async def ingest_pdf_stream(self, file_path: str, doc_id: str, metadata: Dict[str, Any], *,
+                                chunker: Callable[[Iterable[str]], Iterator[Dict[str, Any]]],
+                                clean: Callable[[Iterable[str]], Iterator[str]] = iter_clean_segments,
+                                custom_keywords: Optional[List[str]] = None,
+                                progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """
+        Streaming PDF ingestion with bounded memory, the document text is never held whole:
+        pages are spooled to disk as the parser pool returns them, then re-read twice, once to
+        classify the document and once for clean -> chunk -> embed -> store in batches of
+        EMBED_BATCH_SIZE. chunker turns cleaned segments into chunk dicts; metadata is the
+        vector DB metadata without categories. chunk_count is None if the vector DB write failed.
+        """
+        spool = PageSpool(self.upload_dir)
+        try:
+            if progress:
+                progress("extracting")
+            try:
+                async for page in document_parser_pool.iter_pdf_pages(file_path):
+                    spool.append(page)
+            except Exception as e:
+                raise ValueError(f"PDF file processing failed: {str(e)}")
+
+            if progress:
+                progress("classifying")
+            classifier = StreamingClassifier(self.doc_processor._category_keywords(custom_keywords))
+
+            def classify() -> List[str]:
+                for segment in clean(spool):
+                    classifier.feed(segment)
+                return classifier.categories()
+
+            # Cleaning and keyword matching walk the whole document: run them in a worker thread
+            categories = await asyncio.to_thread(classify)
+
+            totals = {"length": 0, "chunk_types": set()}
+
+            def counted(chunks: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+                for chunk in chunks:
+                    totals["length"] += chunk["length"]
+                    totals["chunk_types"].add(chunk.get("chunk_type", "default"))
+                    yield chunk
+
+            if progress:
+                progress("indexing")
+            chunk_count = await self.vector_db.add_document_batches(
+                doc_id,
+                counted(chunker(clean(spool))),
+                {**metadata, "categories": categories}
+            )
+            return {
+                "categories": categories,
+                "chunk_count": chunk_count,
+                "total_length": totals["length"],
+                "chunk_types": list(totals["chunk_types"]),
+                "pages": spool.pages
+            }
+        finally:
+            spool.close()
+
     async def search_knowledge_base(self, query: str, top_k: int = 5, category_filter: Optional[str] = None) -> List[Dict[str, Any]]:
         """Search mental health knowledge base"""
         return await self.vector_db.search_similar(query, top_k, category_filter)
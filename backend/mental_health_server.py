@@ -3,25 +3,38 @@ Mental Health Self-care Chatbot Server
 Designed to provide students with mental health support and self-care strategies
 """
 
+if __name__ == "__main__":
+    # `python mental_health_server.py`: hand off to uvicorn's module entry before anything loads.
+    # Spawned document-parsing workers re-import the __main__ script (as __mp_main__), and this
+    # module loads the models, RAG service and chat stores at import time; uvicorn's __main__ is skipped.
+    import runpy
+    import sys
+    sys.argv = ["uvicorn", "mental_health_server:app", "--host", "0.0.0.0", "--port", "8001"]
+    runpy.run_module("uvicorn", run_name="__main__", alter_sys=True)
+    sys.exit(0)
+
 from autogen_agentchat.agents import AssistantAgent
 from autogen_agentchat.ui import Console
 from autogen_agentchat.messages import *
 from autogen_core.tools import FunctionTool
 from autogen_ext.models.openai import OpenAIChatCompletionClient
-from llms import model_client
+from llms import (
+    model_client, economy_model_client, stream_model_client, stream_economy_model_client,
+    MODEL_NAME, ECONOMY_MODEL_NAME
+)
 import asyncio
-from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi import FastAPI, Request, HTTPException, Query, Depends, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
-import uvicorn
 from sse_starlette.sse import EventSourceResponse
 import json
 import os
+import time
 from datetime import datetime
 import uuid
 from typing import List, Optional
 import hashlib
-import secrets
 
 # Memory
 from autogen_core.memory import ListMemory, MemoryContent, MemoryMimeType
@@ -44,17 +57,39 @@ from mental_health_tools import (
     query_mental_health_knowledge_base,
     provide_mental_health_relaxing_music,
     provide_mental_health_relaxing_video,
-    provide_mental_health_professor_information
+    provide_mental_health_professor_information,
+    retrieval_sources_collector
 )
 
 # Import chat history manager
 from chat_history_manager import (
     create_chat_session,
     save_chat_message,
+    save_chat_messages,
+    touch_chat_sessions,
+    chat_session_exists,
+    chat_sessions_deleted,
     get_chat_messages,
-    get_user_sessions
+    get_recent_chat_messages,
+    get_user_sessions,
+    search_chat_messages
 )
 
+# Import priority scheduler for agent runs
+from chat_scheduler import PriorityChatScheduler
+
+# Import user repository
+from user_store import UserStore, UserExistsError
+
+# Import signed session tokens
+from auth_tokens import TokenSigner, load_admin_user_ids, load_token_secret
+
+# Import token-bucket rate limiting
+from rate_limiter import RateLimiter, RateLimitPolicy, MemoryBucketStore, SQLiteBucketStore
+
+# Import token usage accounting
+from usage_tracker import UsageTracker, BUDGET_HARD, BUDGET_SOFT, sum_models_usage
+
 # Import RAG service (if available)
 try:
     from mental_health_rag_service import mental_health_rag_service
@@ -69,6 +104,86 @@ except ImportError as e:
 # Session memories
 session_memories = {}
 
+# Recent history replayed into a session memory that is not in this process yet
+SESSION_MEMORY_REHYDRATE_MESSAGES = 20
+
+# Batch chat concurrency; item limits follow the batch item policy below
+BATCH_MAX_CONCURRENCY = 16
+
+# Concurrent streams allowed on one chat WebSocket
+WS_MAX_STREAMS_PER_CONNECTION = 4
+# Validated sessions remembered per WebSocket connection (cleared when full)
+WS_MAX_CACHED_SESSIONS = 1000
+
+# Largest page size for paginated session and message lists
+MAX_PAGE_SIZE = 500
+
+# Chat history retention: days to keep sessions per agent type ("*" = default, None = keep forever)
+CHAT_RETENTION_POLICIES = {"*": None}
+CHAT_MAINTENANCE_INTERVAL_SECONDS = 3600
+CHAT_MAINTENANCE_MAX_DELETES_PER_SECOND = 200
+# Sessions idle for this many days are gzip-compressed (None disables the compressed tier)
+CHAT_COMPRESS_AFTER_DAYS: Optional[int] = 7
+
+# Agent run admission control (crisis turns get reserved slots)
+CHAT_MAX_CONCURRENCY = 8
+CHAT_RESERVED_CRISIS_SLOTS = 2
+CHAT_AGING_SECONDS = 10.0
+chat_scheduler = PriorityChatScheduler(
+    max_concurrency=CHAT_MAX_CONCURRENCY,
+    reserved_crisis=CHAT_RESERVED_CRISIS_SLOTS,
+    aging_seconds=CHAT_AGING_SECONDS
+)
+
+# Token accounting and daily budgets (per user)
+USAGE_SOFT_DAILY_TOKENS = 200_000  # switch to cheaper model + trimmed memory
+USAGE_HARD_DAILY_TOKENS = 300_000  # reject new turns
+SOFT_BUDGET_MEMORY_ITEMS = 10
+usage_tracker = UsageTracker(
+    soft_daily_tokens=USAGE_SOFT_DAILY_TOKENS,
+    hard_daily_tokens=USAGE_HARD_DAILY_TOKENS
+)
+
+# Session tokens: HMAC-signed (user id + expiry), verified without any storage lookup.
+# Set AUTH_TOKEN_SECRET so tokens stay valid across restarts and workers.
+AUTH_TOKEN_TTL_SECONDS = 7 * 24 * 3600
+# Every user-scoped route needs a bearer token. Set False only while migrating old clients:
+# requests without a token must then pass `user_id` explicitly (it is not verified)
+AUTH_REQUIRE_TOKEN = True
+token_signer = TokenSigner(load_token_secret(), ttl_seconds=AUTH_TOKEN_TTL_SECONDS)
+# Users allowed on maintenance/rebuild/export routes (ADMIN_USER_IDS=1,7)
+ADMIN_USER_IDS = load_admin_user_ids()
+
+# Token-bucket rate limits per route ("METHOD /path", or a template with {param}), by authenticated user and by client IP.
+# Requests without a bearer token are only limited by IP (their user_id parameter is not trusted).
+RATE_LIMIT_POLICIES = {
+    "POST /api/v1/chat/messages": {"user": RateLimitPolicy(20, 60), "ip": RateLimitPolicy(60, 60)},
+    "POST /api/v1/chat/stream": {"user": RateLimitPolicy(20, 60), "ip": RateLimitPolicy(60, 60)},
+    "POST /api/v1/chat/messages/batch": {"user": RateLimitPolicy(2, 60), "ip": RateLimitPolicy(6, 60)},
+    # Items of a batch (eval jobs, partner triage): charged per item by the batch handler, in their own
+    # buckets so a batch does not drain the interactive chat budget
+    "BATCH /api/v1/chat/messages/batch": {"user": RateLimitPolicy(1000, 3600), "ip": RateLimitPolicy(2000, 3600)},
+    # Charged per message frame on the socket
+    "WS /api/v1/chat/ws": {"user": RateLimitPolicy(20, 60), "ip": RateLimitPolicy(60, 60)},
+    # Uploads re-embed the whole document
+    "POST /api/v1/mental-health-rag/upload": {"user": RateLimitPolicy(5, 600), "ip": RateLimitPolicy(10, 600)},
+    "POST /api/v1/mental-health-rag/jobs": {"user": RateLimitPolicy(5, 600), "ip": RateLimitPolicy(10, 600)},
+    # Route template: all job ids share one bucket per user/IP
+    "POST /api/v1/mental-health-rag/jobs/{job_id}/retry": {"user": RateLimitPolicy(5, 600), "ip": RateLimitPolicy(10, 600)},
+}
+# SQLite file shared by all workers on the host (None keeps buckets in process memory, per worker)
+RATE_LIMIT_SHARED_DB: Optional[str] = None
+# Take the client IP from X-Forwarded-For (only behind a trusted reverse proxy)
+RATE_LIMIT_TRUST_FORWARDED_FOR = False
+# Every item is charged to the batch item buckets, so a batch can never hold more than their capacity
+BATCH_ITEMS_ROUTE = "BATCH /api/v1/chat/messages/batch"
+BATCH_MAX_ITEMS = min(policy.capacity for policy in RATE_LIMIT_POLICIES[BATCH_ITEMS_ROUTE].values())
+rate_limiter = RateLimiter(
+    RATE_LIMIT_POLICIES,
+    SQLiteBucketStore(RATE_LIMIT_SHARED_DB) if RATE_LIMIT_SHARED_DB else MemoryBucketStore()
+)
+RATE_LIMIT_HEADERS = ["RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "Retry-After"]
+
 # Wrap mental health tools as FunctionTool
 emotion_assessment_tool = FunctionTool(
     assess_emotion_state,
@@ -153,15 +268,204 @@ mental_health_tools = [
     mental_health_professor_information_tool,
 ]
 
+# System prompt for the mental health chatbot
+MENTAL_HEALTH_SYSTEM_MESSAGE = """
+    Role & Core Identity:
+    You are "SiuMing Mental Health Helper", an AI mental health companion built by the "Guardian Project." 
+    Your primary role is to act as a supportive, empathetic, and knowledgeable virtual friend for university students.
+    You are not a licensed therapist, but a first point of contact for emotional support, mental health information, and resource connection.
+
+    Mission & Core Values:
+    Your mission is to help university students manage their emotional well-being, provide practical self-care strategies, and promote mental health growth.
+
+    Key Principles:
+    - Empathy: Understand and accept everyone's feelings
+    - Professionalism: Based on scientific mental health knowledge
+    - Safety: Prioritize user safety and well-being
+    - Personalization: Provide customized advice based on individual needs
+    - Hope: Spread optimism and positive change possibilities
+
+    Core Principles (Non-Negotiable):
+    Do No Harm: You must never provide a medical or psychiatric diagnosis, suggest treatments or medications, or handle acute crisis situations. Your role is to support and refer, not to treat.
+    Empathy First: Prioritize active listening, emotional validation, and unconditional positive regard. The user must feel heard and understood above all else.
+    Safety Net & Professional Referral: You are a bridge to professional help. For any mentions of suicide, self-harm, abuse, or violence, you MUST immediately trigger the Safety Protocol.
+    Empowerment: Help users identify their own strengths and coping mechanisms. Frame suggestions as tools they can choose to use, fostering a sense of agency.
+    Human-like & Natural: Engage in warm, conversational dialogue. Avoid clinical, robotic, or repetitive language. You are permitted to use minimal, appropriate emojis (e.g., 🙂, 😔, 🤗) to soften communication.
+
+    Capabilities & Tools:
+    You have access to specialized tools. You are better to use them to provide richer, more accurate support, Don't use them only when the user asks for it, you can use them when you think it's appropriate.
+    You can use multiple tools together, but you need to use them in a logical order.
+    
+    TOOL USAGE GUIDELINES:
+    You have access to specialized mental health tools. Use them strategically based on the user's needs:
+    
+    Tool Usage Priority:
+    1. For professional help requests (like "I need professional help", "I want to see a therapist", "I need counseling"), IMMEDIATELY use mental_health_professor_information_tool FIRST
+    2. For mental health questions, information requests, or when users need evidence-based guidance, use mental_health_knowledge_base_tool to search the knowledge base
+    3. For relaxation and stress relief, use mental_health_relaxing_music_tool or mental_health_relaxing_video_tool
+    4. You can use multiple tools together when appropriate
+    5. Always provide your response incorporating the information from the tools
+
+    Professional Tools:
+    You have access to the following mental health professional tools:
+    mental_health_knowledge_base_tool: Search the mental health knowledge base (RAG) and get information (use this tool for mental health questions and when users need evidence-based guidance)
+    mental_health_relaxing_music_tool: Provide mental health relaxing music, which can help students relax and reduce stress, such as sleep music, meditation music, etc.
+    mental_health_relaxing_video_tool: Provide mental health relaxing video link, which can help students relax and reduce stress, such as relaxation tips, exercise, box breathing relaxation technique, etc.
+    mental_health_professor_information_tool: Provide mental health professor information, who can provide some professional support to students with mental health issues, if students need someone to talk to or want to seek professional help, you can use this tool to provide the information. USE THIS TOOL IMMEDIATELY when users ask for professional help, therapy, counseling, or mention needing professional support.
+
+    Response Structure & Strategy(Reference Only, you can use it if you want, you can use your own strategy, which is optional):
+    Craft responses that seamlessly blend the following elements:
+    Emotional Validation & Reflection: Always begin by acknowledging the user's emotional state.
+    Example Phrases: "That sounds incredibly overwhelming," "It's completely understandable to feel that way given what you're going through," "Thank you for sharing that with me. It must be really tough."
+    Tool Utilization & Content Delivery: Integrate the results from your tools naturally into the conversation.
+    RAG Example: "I recall a technique from our resources called 'progressive muscle relaxation' that might help with that physical anxiety. Would you like me to walk you through it?"
+    Video Example: "I found a really clear video from a clinical psychologist that explains why we procrastinate and how to break the cycle. Here's the link: [Video Link]. I'd be curious to hear your thoughts on it after."
+    Open-Ended Questioning: Guide the conversation deeper or check for understanding.
+    Example Phrases: "What does that feeling feel like in your body?" "How have you been coping with this so far?" "What would you like to see change about this situation?"
+    
+    *Safety Protocol (CRITICAL)*(Important!!!): This is a hard-coded override. The instant you detect keywords or intent related to self-harm, suicide, abuse, or harming others, you MUST IMMEDIATELY execute the following response. Do not deviate. Do not continue the previous conversation.
+    Exact Safety Protocol Response:(Do not change the meaning of this response, but you can change the format of the response, you can change the order of the response, you can add some other response, but you must ensure the meaning of the response is the same)
+    "I hear you, and I am deeply concerned about what you're telling me. It's incredibly important that you speak with a trained professional who can give you the support you need right now. Please, right now, contact one of these free, confidential, 24/7 hotlines:
+    The Hong Kong Polytechnic University for Prevention: https://www.polyu.edu.hk/
+    Crisis Text Line: Text 'PolyU Help' to 27666223
+    Mental Health Support Hotline: 18288
+    Hospital Authority Emergency Hotline: 24667350
+    Social Welfare Department: 23432255
+    Suicide Prevention Services: 23820000
+    The Samaritan Befrienders Hong Kong: 23892222
+    The Samaritans: 28960000
+    You are not alone, and they are there to help. Please, will you reach out to them? I'm here, and I care, but this is beyond my ability to help you with."
+    
+    Tone & Style Guidelines:
+    Use: Warm, conversational, collaborative, and supportive language. Use "I" and "you".
+    Avoid: Jargon, authoritative commands ("You must..."), clichés ("Everything happens for a reason"), and dismissive language ("Just cheer up!").
+    Emojis: Use appropriate emojis (e.g., 🙂, 😔, 🤗) to soften communication.
+    
+    Example Interactions for Context(Reference Only, you can use it if you want, you can use your own interactions, which is optional):
+    User: "I'm so stressed about finals I can't sleep and I feel like I'm going to fail everything."
+    You: "That's a huge amount of pressure to be under, it's no wonder you're feeling so stressed and it's affecting your sleep. 😔 Let me see what our resources say about managing academic anxiety and improving sleep hygiene... [Calls search_knowledge_base] Okay, I have a few tips on a 'pre-sleep routine' to quiet the mind. Would talking through those be helpful?"
+    User: "I just had a huge fight with my best friend and I think we're done forever."
+    You: "I'm so sorry to hear that. Conflicts with close friends can be heartbreaking and make you feel really isolated. 🤗 Would it help to talk about what happened? Sometimes just putting it into words can bring clarity."
+
+    Remember to use tools whenever possible. You can proactively offer suggestions if you think students need them, even if they don’t mention it directly. Be direct and proactive in using tools. Don’t keep asking students what advice and support they need, as this will make them impatient.
+    """
+
+def extract_reply(result) -> str:
+    """Extract the final assistant text from an agent run result"""
+    if hasattr(result, "messages") and result.messages:
+        for message in reversed(result.messages):
+            if (hasattr(message, "source") and message.source == "mental_health_assistant" and 
+                hasattr(message, "type") and message.type == "TextMessage" and
+                hasattr(message, "content")):
+                return message.content
+        return result.content if hasattr(result, "content") else "Failed to obtain reply content"
+    return result.content if hasattr(result, "content") else str(result)
+
+async def get_session_memory(session_id: str, user_id: int, agent_type: str) -> ListMemory:
+    """Get the session memory, rehydrating it from recent chat history (served from the transcript cache)"""
+    memory = session_memories.get(session_id)
+    if memory is not None:
+        return memory
+    
+    memory = ListMemory(name=f"memory_{session_id}")
+    for message in get_recent_chat_messages(session_id, user_id, agent_type, SESSION_MEMORY_REHYDRATE_MESSAGES):
+        await memory.add(MemoryContent(
+            content=f"{message['role']}: {message['content']}",
+            mime_type=MemoryMimeType.TEXT
+        ))
+    return session_memories.setdefault(session_id, memory)
+
+def create_mental_health_agent(client, memory: ListMemory, stream: bool) -> AssistantAgent:
+    """Build the mental health assistant for one turn"""
+    return AssistantAgent(
+        name="mental_health_assistant",
+        model_client=client,
+        model_client_stream=stream,
+        tools=mental_health_tools,
+        reflect_on_tool_use=True,
+        memory=[memory],
+        system_message=MENTAL_HEALTH_SYSTEM_MESSAGE,
+    )
+
 app = FastAPI(title="Mental Health Self-care Chatbot", version="1.0.0")
 
-# CORS settings
+def client_ip(headers, client) -> Optional[str]:
+    """Client address for per-IP limits"""
+    if RATE_LIMIT_TRUST_FORWARDED_FOR:
+        forwarded_for = headers.get("x-forwarded-for")
+        if forwarded_for:
+            return forwarded_for.split(",")[0].strip()
+    return client.host if client else None
+
+# Middleware added later wraps earlier ones, so this runs after authenticate_request has resolved the user
+@app.middleware("http")
+async def rate_limit_request(request: Request, call_next):
+    """Charge limited routes to their token buckets; 429 with Retry-After when a bucket is empty"""
+    result = await rate_limiter.check_async(f"{request.method} {request.url.path}", request.state.user_id,
+                                            client_ip(request.headers, request.client))
+    if result is None:
+        return await call_next(request)
+    if not result.allowed:
+        return JSONResponse(status_code=429, content={"detail": f"Rate limit exceeded ({result.scope}), try again later"},
+                            headers=result.headers())
+    response = await call_next(request)
+    response.headers.update(result.headers())
+    return response
+
+@app.middleware("http")
+async def authenticate_request(request: Request, call_next):
+    """Verify the bearer token once per request and cache the user id on request.state"""
+    request.state.user_id = None
+    authorization = request.headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        user_id = token_signer.verify(authorization[7:].strip())
+        if user_id is None:
+            return JSONResponse(status_code=401, content={"detail": "Invalid or expired token"},
+                                headers={"WWW-Authenticate": "Bearer"})
+        request.state.user_id = user_id
+    return await call_next(request)
+
+def current_user_id(
+    request: Request,
+    user_id: Optional[int] = Query(None, description="User ID (only used by clients without a bearer token)")
+) -> int:
+    """The authenticated user; a `user_id` that disagrees with the token is rejected"""
+    token_user_id = request.state.user_id
+    if token_user_id is not None:
+        if user_id is not None and user_id != token_user_id:
+            raise HTTPException(status_code=403, detail="user_id does not match the token")
+        return token_user_id
+    if AUTH_REQUIRE_TOKEN:
+        raise HTTPException(status_code=401, detail="Missing bearer token", headers={"WWW-Authenticate": "Bearer"})
+    if user_id is None:
+        raise HTTPException(status_code=400, detail="user_id is required without a bearer token")
+    return user_id
+
+def token_user_id(request: Request) -> int:
+    """The user of a verified bearer token; routes exposing per-user data never trust a client-supplied id"""
+    if request.state.user_id is None:
+        raise HTTPException(status_code=401, detail="Missing bearer token", headers={"WWW-Authenticate": "Bearer"})
+    return request.state.user_id
+
+def require_admin(user_id: int = Depends(token_user_id)) -> int:
+    """Only users listed in ADMIN_USER_IDS"""
+    if user_id not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user_id
+
+def check_user_access(caller_id: int, user_id: int):
+    """Users may read their own data; admins may read anyone's"""
+    if caller_id != user_id and caller_id not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Not allowed to access another user's data")
+
+# CORS settings (added after the auth middleware so it wraps it and 401 responses keep CORS headers)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=RATE_LIMIT_HEADERS,
 )
 
 # Register mental health RAG routes (if available)
@@ -203,6 +507,15 @@ class SendMessageResponse(BaseModel):
     user_message: ChatMessage
     ai_message: ChatMessage
 
+class BatchChatItem(BaseModel):
+    session_id: str
+    message: str
+
+class BatchChatRequest(BaseModel):
+    items: List[BatchChatItem]
+    agent_type: str = "mental_health"
+    concurrency: int = 4
+
 class User(BaseModel):
     id: int
     username: str
@@ -226,10 +539,12 @@ class AuthResponse(BaseModel):
     username: str
     email: str
     token: str
+    expires_at: int
 
 # Data storage config
 DATA_FILE = "mental_health_chat_data.json"
-USERS_FILE = "mental_health_users_data.json"
+USERS_FILE = "mental_health_users_data.json"  # legacy, imported into USERS_DB on first start
+USERS_DB = "mental_health_users.db"
 INVITE_CODE = "polyu"
 
 def load_data():
@@ -247,24 +562,7 @@ def save_data(data):
     with open(DATA_FILE, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
-def get_next_id(items):
-    """Get next ID"""
-    return max([item.get("id", 0) for item in items], default=0) + 1
-
-def load_users():
-    """Load user data"""
-    if os.path.exists(USERS_FILE):
-        try:
-            with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
-    return {"users": []}
-
-def save_users(users_data):
-    """Save user data"""
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users_data, f, ensure_ascii=False, indent=2)
+user_store = UserStore(USERS_DB, legacy_json=USERS_FILE)
 
 def hash_password(password: str) -> str:
     """Hash password"""
@@ -274,9 +572,24 @@ def verify_password(password: str, password_hash: str) -> bool:
     """Verify password"""
     return hash_password(password) == password_hash
 
-def generate_token() -> str:
-    """Generate a simple token"""
-    return secrets.token_urlsafe(32)
+def generate_token(user_id: int) -> tuple:
+    """Issue a signed session token, returns (token, expires_at)"""
+    return token_signer.issue(user_id)
+
+def apply_usage_budget(user_id: int, memory: ListMemory, stream: bool = False):
+    """Choose the model client and memory for a turn from the user's daily token budget"""
+    status = usage_tracker.check_budget(user_id)
+    if status == BUDGET_HARD:
+        raise HTTPException(status_code=429, detail="Daily token budget exceeded")
+    if status == BUDGET_SOFT:
+        # Near the limit: shorter prompt and a cheaper model
+        trimmed_memory = ListMemory(name=memory.name, memory_contents=memory.content[-SOFT_BUDGET_MEMORY_ITEMS:])
+        return stream_economy_model_client if stream else economy_model_client, ECONOMY_MODEL_NAME, trimmed_memory
+    return stream_model_client if stream else model_client, MODEL_NAME, memory
+
+def chat_event(event_type: str, **payload) -> dict:
+    """Build a typed chat stream event; clients dispatch on the `type` field"""
+    return {"type": event_type, **payload}
 
 # API endpoints
 @app.get("/")
@@ -300,6 +613,157 @@ async def root():
 async def health():
     return {"status": "healthy", "rag_enabled": RAG_ENABLED}
 
+@app.on_event("startup")
+async def start_chat_maintenance():
+    """Start background retention/compaction; it backs off while agent slots are busy"""
+    from chat_history_manager import chat_history_manager
+    chat_history_manager.start_maintenance(
+        CHAT_RETENTION_POLICIES,
+        interval=CHAT_MAINTENANCE_INTERVAL_SECONDS,
+        is_busy=chat_scheduler.is_busy,
+        max_deletes_per_second=CHAT_MAINTENANCE_MAX_DELETES_PER_SECOND,
+        compress_after_days=CHAT_COMPRESS_AFTER_DAYS
+    )
+
+@app.on_event("shutdown")
+async def flush_chat_history():
+    """Flush queued chat history writes before the process exits"""
+    from chat_history_manager import chat_history_manager
+    chat_history_manager.close()
+
+@app.get("/api/v1/chat/storage/stats", dependencies=[Depends(require_admin)])
+async def get_chat_storage_stats():
+    """Chat history storage metrics (write-behind queue depth, flush latency)"""
+    from chat_history_manager import chat_history_manager
+    return chat_history_manager.get_storage_stats()
+
+@app.get("/api/v1/chat/stats", dependencies=[Depends(require_admin)])
+async def get_chat_totals():
+    """Chat totals across all users, from incrementally maintained counters"""
+    from chat_history_manager import chat_history_manager
+    return chat_history_manager.stats.get_totals()
+
+@app.get("/api/v1/chat/stats/users/{user_id}")
+async def get_user_chat_stats(
+    user_id: int,
+    agent_type: Optional[str] = Query(None, description="Agent type (omit for all agent types)"),
+    caller_id: int = Depends(token_user_id)
+):
+    """Session/message counts, counts by role and last activity of a user"""
+    check_user_access(caller_id, user_id)
+    from chat_history_manager import chat_history_manager
+    if agent_type is not None:
+        return chat_history_manager.get_chat_stats(user_id, agent_type)
+    return {
+        "user_id": user_id,
+        "agent_types": chat_history_manager.stats.get_user(user_id),
+        "rebuilding": chat_history_manager.stats.rebuilding
+    }
+
+@app.post("/api/v1/chat/stats/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_chat_stats():
+    """Rebuild the chat counters from a full scan of the chat history store"""
+    from chat_history_manager import chat_history_manager
+    return await asyncio.to_thread(chat_history_manager.rebuild_stats)
+
+@app.get("/api/v1/chat/search")
+async def search_chat_history(
+    user_id: int = Depends(current_user_id),
+    q: str = Query(..., min_length=1, description="Search query (Chinese and English)"),
+    agent_type: Optional[str] = Query(None, description="Only search this agent type"),
+    session_id: Optional[str] = Query(None, description="Only search this session"),
+    since: Optional[str] = Query(None, description="Only messages created at or after this ISO time"),
+    until: Optional[str] = Query(None, description="Only messages created before this ISO time"),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+    offset: int = Query(0, ge=0, description="Results to skip (use next_offset)")
+):
+    """Full-text search over a user's chat history, ranked by relevance"""
+    return await asyncio.to_thread(
+        search_chat_messages, user_id, q, agent_type, session_id, since, until, limit, offset
+    )
+
+@app.post("/api/v1/chat/search/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_chat_search_index():
+    """Rebuild the full-text search index from the chat history store"""
+    from chat_history_manager import chat_history_manager
+    return await asyncio.to_thread(chat_history_manager.rebuild_search_index)
+
+@app.get("/api/v1/chat/export")
+async def export_chat_history(
+    format: str = Query("ndjson", description="ndjson or zip (one NDJSON file per session)"),
+    user_id: Optional[List[int]] = Query(None, description="Only export these users (repeatable; admins only, omit for all)"),
+    agent_type: Optional[str] = Query(None, description="Only export this agent type"),
+    since: Optional[str] = Query(None, description="Only messages created at or after this ISO time"),
+    until: Optional[str] = Query(None, description="Only messages created before this ISO time"),
+    caller_id: int = Depends(token_user_id)
+):
+    """
+    Stream a bulk export of many sessions; nothing is written to disk and memory stays constant.
+    Admins may export any users; everyone else only exports their own history.
+    """
+    from chat_history_manager import chat_history_manager
+    if format not in ("ndjson", "zip"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or zip")
+    if caller_id not in ADMIN_USER_IDS:
+        if user_id and set(user_id) != {caller_id}:
+            raise HTTPException(status_code=403, detail="Only admins can export other users")
+        user_id = [caller_id]
+    exporter = chat_history_manager.bulk_export(user_id, agent_type, since, until)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    media_type = "application/zip" if format == "zip" else "application/x-ndjson"
+    # A sync iterator is consumed in Starlette's threadpool, so storage reads do not block the event loop
+    return StreamingResponse(
+        exporter.iter_bytes(format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="chat_export_{timestamp}.{format}"'}
+    )
+
+@app.get("/api/v1/chat/maintenance/reports", dependencies=[Depends(require_admin)])
+async def get_chat_maintenance_reports():
+    """Reports of recent retention/compaction runs"""
+    from chat_history_manager import chat_history_manager
+    if chat_history_manager.maintenance is None:
+        return {"policies": CHAT_RETENTION_POLICIES, "reports": []}
+    return {"policies": chat_history_manager.maintenance.policies, "reports": chat_history_manager.maintenance.get_reports()}
+
+@app.post("/api/v1/chat/maintenance/run", dependencies=[Depends(require_admin)])
+async def run_chat_maintenance():
+    """Run one retention/compaction pass now and return its report"""
+    from chat_history_manager import chat_history_manager
+    if chat_history_manager.maintenance is None:
+        raise HTTPException(status_code=503, detail="Chat maintenance is not running")
+    return await asyncio.to_thread(chat_history_manager.maintenance.run_once)
+
+@app.get("/api/v1/rate-limit/stats", dependencies=[Depends(require_admin)])
+async def get_rate_limit_stats():
+    """Rate limit policies, bucket count and allowed/limited requests per route"""
+    return rate_limiter.get_stats()
+
+@app.get("/api/v1/chat/scheduler/stats", dependencies=[Depends(require_admin)])
+async def get_scheduler_stats():
+    """Agent run queue depth and wait times per priority lane"""
+    return chat_scheduler.get_stats()
+
+# Token usage API
+@app.get("/api/v1/usage/users/{user_id}")
+async def get_user_usage(
+    user_id: int,
+    days: int = Query(7, ge=1, le=366, description="Days of daily rollups"),
+    caller_id: int = Depends(token_user_id)
+):
+    """Token totals, daily rollups and budget status for a user"""
+    check_user_access(caller_id, user_id)
+    return usage_tracker.get_user_usage(user_id, days)
+
+@app.get("/api/v1/usage/sessions/{session_id}")
+async def get_session_usage(session_id: str, caller_id: int = Depends(token_user_id)):
+    """Token totals for a session"""
+    usage = usage_tracker.get_session_usage(session_id)
+    # Another user's session looks the same as an unknown one
+    if usage is None or (usage["user_id"] != caller_id and caller_id not in ADMIN_USER_IDS):
+        raise HTTPException(status_code=404, detail="No usage recorded for this session")
+    return usage
+
 # User authentication API
 @app.post("/api/v1/auth/register")
 async def register(request: RegisterRequest):
@@ -307,45 +771,36 @@ async def register(request: RegisterRequest):
     if request.invite_code != INVITE_CODE:
         raise HTTPException(status_code=400, detail="Invalid invite code")
     
-    users_data = load_users()
-    
-    for user in users_data["users"]:
-        if user["username"] == request.username:
-            raise HTTPException(status_code=400, detail="Username already exists")
-        if user["email"] == request.email:
-            raise HTTPException(status_code=400, detail="Email already exists")
-    
-    new_user = {
-        "id": get_next_id(users_data["users"]),
-        "username": request.username,
-        "email": request.email,
-        "password_hash": hash_password(request.password),
-        "created_at": datetime.now().isoformat(),
-        "is_active": True
-    }
+    if user_store.get_by_username(request.username):
+        raise HTTPException(status_code=400, detail="Username already exists")
+    if user_store.get_by_email(request.email):
+        raise HTTPException(status_code=400, detail="Email already exists")
     
-    users_data["users"].append(new_user)
-    save_users(users_data)
+    try:
+        new_user = user_store.create_user(
+            username=request.username,
+            email=request.email,
+            password_hash=hash_password(request.password),
+            created_at=datetime.now().isoformat()
+        )
+    except UserExistsError as e:
+        # Lost a race with a concurrent registration
+        raise HTTPException(status_code=400, detail=str(e))
     
-    token = generate_token()
+    token, expires_at = generate_token(new_user["id"])
     
     return AuthResponse(
         user_id=new_user["id"],
         username=new_user["username"],
         email=new_user["email"],
-        token=token
+        token=token,
+        expires_at=expires_at
     )
 
 @app.post("/api/v1/auth/login")
 async def login(request: LoginRequest):
     """User login"""
-    users_data = load_users()
-    
-    user = None
-    for u in users_data["users"]:
-        if u["username"] == request.username:
-            user = u
-            break
+    user = user_store.get_by_username(request.username)
     
     if not user:
         raise HTTPException(status_code=401, detail="Username not found")
@@ -356,28 +811,31 @@ async def login(request: LoginRequest):
     if not verify_password(request.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Incorrect password")
     
-    token = generate_token()
+    token, expires_at = generate_token(user["id"])
     
     return AuthResponse(
         user_id=user["id"],
         username=user["username"],
         email=user["email"],
-        token=token
+        token=token,
+        expires_at=expires_at
     )
 
 # Session management API
 @app.get("/api/v1/chat/sessions")
 async def get_sessions(
-    user_id: int = Query(..., description="User ID"),
-    agent_type: str = Query("mental_health", description="Agent type")
+    user_id: int = Depends(current_user_id),
+    agent_type: str = Query("mental_health", description="Agent type"),
+    cursor: Optional[str] = Query(None, description="Cursor: `next_cursor` from the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size (omit for all sessions)")
 ):
-    """Get the user's chat sessions list"""
-    return get_user_sessions(user_id, agent_type)
+    """Get the user's chat sessions list, newest first; paginated when `limit` or `cursor` is given"""
+    return get_user_sessions(user_id, agent_type, cursor, limit)
 
 @app.post("/api/v1/chat/sessions")
 async def create_session(
     agent_type: str = Query("mental_health", description="Agent type"),
-    user_id: int = Query(..., description="User ID"),
+    user_id: int = Depends(current_user_id),
     title: Optional[str] = Query(None, description="Session title")
 ):
     """Create a new chat session"""
@@ -388,16 +846,19 @@ async def create_session(
 @app.get("/api/v1/chat/sessions/{session_id}/messages")
 async def get_messages(
     session_id: str,
-    user_id: int = Query(..., description="User ID"),
-    agent_type: str = Query("mental_health", description="Agent type")
+    user_id: int = Depends(current_user_id),
+    agent_type: str = Query("mental_health", description="Agent type"),
+    before_id: Optional[int] = Query(None, description="Cursor: only messages with id below this"),
+    after_id: Optional[int] = Query(None, description="Incremental sync: only messages with id above this"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size (omit for the full transcript)")
 ):
-    """Get messages of a session"""
-    return get_chat_messages(session_id, user_id, agent_type)
+    """Get messages of a session; paginated by `before_id`/`limit`, or incremental with `after_id`"""
+    return get_chat_messages(session_id, user_id, agent_type, before_id, after_id, limit)
 
 @app.delete("/api/v1/chat/sessions/{session_id}")
 async def delete_session(
     session_id: str,
-    user_id: int = Query(..., description="User ID"),
+    user_id: int = Depends(current_user_id),
     agent_type: str = Query("mental_health", description="Agent type")
 ):
     """Delete a session and its messages"""
@@ -413,16 +874,11 @@ async def delete_session(
 
 # Mental health chat API
 @app.post("/api/v1/chat/messages")
-async def send_message_with_session(request: SendMessageRequest):
+async def send_message_with_session(request: SendMessageRequest, user_id: int = Depends(current_user_id)):
     """Send a message and get AI reply (with session management)"""
-    user_id = 1  # 暫時使用默認用戶ID
     
     # Validate session existence
-    existing_sessions_data = get_user_sessions(user_id, request.agent_type)
-    existing_sessions = existing_sessions_data.get("sessions", []) if isinstance(existing_sessions_data, dict) else existing_sessions_data
-    session_exists = any(s["session_id"] == request.session_id for s in existing_sessions)
-    
-    if not session_exists:
+    if not chat_session_exists(request.session_id, user_id, request.agent_type):
         # Auto-create missing session with provided session_id
         try:
             create_chat_session(request.session_id, user_id, request.agent_type, None)
@@ -430,9 +886,10 @@ async def send_message_with_session(request: SendMessageRequest):
             raise HTTPException(status_code=404, detail="Session not found")
     
     # Get or create memory for this session
-    if request.session_id not in session_memories:
-        session_memories[request.session_id] = ListMemory()
-    memory = session_memories[request.session_id]
+    memory = await get_session_memory(request.session_id, user_id, request.agent_type)
+    
+    # Apply token budget before doing any work for this turn
+    turn_client, turn_model, turn_memory = apply_usage_budget(user_id, memory)
     
     # Add user message to memory
     await memory.add(MemoryContent(
@@ -443,116 +900,23 @@ async def send_message_with_session(request: SendMessageRequest):
     # Save user message to chat history
     user_message = save_chat_message(request.session_id, user_id, request.agent_type, "user", request.message)
     
-    # 心理健康聊天機器人的系統提示詞
-    system_message = """
-    Role & Core Identity:
-    You are "SiuMing Mental Health Helper", an AI mental health companion built by the "Guardian Project." 
-    Your primary role is to act as a supportive, empathetic, and knowledgeable virtual friend for university students.
-    You are not a licensed therapist, but a first point of contact for emotional support, mental health information, and resource connection.
-
-    Mission & Core Values:
-    Your mission is to help university students manage their emotional well-being, provide practical self-care strategies, and promote mental health growth.
-
-    Key Principles:
-    - Empathy: Understand and accept everyone's feelings
-    - Professionalism: Based on scientific mental health knowledge
-    - Safety: Prioritize user safety and well-being
-    - Personalization: Provide customized advice based on individual needs
-    - Hope: Spread optimism and positive change possibilities
-
-    Core Principles (Non-Negotiable):
-    Do No Harm: You must never provide a medical or psychiatric diagnosis, suggest treatments or medications, or handle acute crisis situations. Your role is to support and refer, not to treat.
-    Empathy First: Prioritize active listening, emotional validation, and unconditional positive regard. The user must feel heard and understood above all else.
-    Safety Net & Professional Referral: You are a bridge to professional help. For any mentions of suicide, self-harm, abuse, or violence, you MUST immediately trigger the Safety Protocol.
-    Empowerment: Help users identify their own strengths and coping mechanisms. Frame suggestions as tools they can choose to use, fostering a sense of agency.
-    Human-like & Natural: Engage in warm, conversational dialogue. Avoid clinical, robotic, or repetitive language. You are permitted to use minimal, appropriate emojis (e.g., 🙂, 😔, 🤗) to soften communication.
-
-    Capabilities & Tools:
-    You have access to specialized tools. You are better to use them to provide richer, more accurate support, Don't use them only when the user asks for it, you can use them when you think it's appropriate.
-    You can use multiple tools together, but you need to use them in a logical order.
-    
-    TOOL USAGE GUIDELINES:
-    You have access to specialized mental health tools. Use them strategically based on the user's needs:
-    
-    Tool Usage Priority:
-    1. For professional help requests (like "I need professional help", "I want to see a therapist", "I need counseling"), IMMEDIATELY use mental_health_professor_information_tool FIRST
-    2. For mental health questions, information requests, or when users need evidence-based guidance, use mental_health_knowledge_base_tool to search the knowledge base
-    3. For relaxation and stress relief, use mental_health_relaxing_music_tool or mental_health_relaxing_video_tool
-    4. You can use multiple tools together when appropriate
-    5. Always provide your response incorporating the information from the tools
-
-    Professional Tools:
-    You have access to the following mental health professional tools:
-    mental_health_knowledge_base_tool: Search the mental health knowledge base (RAG) and get information (use this tool for mental health questions and when users need evidence-based guidance)
-    mental_health_relaxing_music_tool: Provide mental health relaxing music, which can help students relax and reduce stress, such as sleep music, meditation music, etc.
-    mental_health_relaxing_video_tool: Provide mental health relaxing video link, which can help students relax and reduce stress, such as relaxation tips, exercise, box breathing relaxation technique, etc.
-    mental_health_professor_information_tool: Provide mental health professor information, who can provide some professional support to students with mental health issues, if students need someone to talk to or want to seek professional help, you can use this tool to provide the information. USE THIS TOOL IMMEDIATELY when users ask for professional help, therapy, counseling, or mention needing professional support.
-
-    Response Structure & Strategy(Reference Only, you can use it if you want, you can use your own strategy, which is optional):
-    Craft responses that seamlessly blend the following elements:
-    Emotional Validation & Reflection: Always begin by acknowledging the user's emotional state.
-    Example Phrases: "That sounds incredibly overwhelming," "It's completely understandable to feel that way given what you're going through," "Thank you for sharing that with me. It must be really tough."
-    Tool Utilization & Content Delivery: Integrate the results from your tools naturally into the conversation.
-    RAG Example: "I recall a technique from our resources called 'progressive muscle relaxation' that might help with that physical anxiety. Would you like me to walk you through it?"
-    Video Example: "I found a really clear video from a clinical psychologist that explains why we procrastinate and how to break the cycle. Here's the link: [Video Link]. I'd be curious to hear your thoughts on it after."
-    Open-Ended Questioning: Guide the conversation deeper or check for understanding.
-    Example Phrases: "What does that feeling feel like in your body?" "How have you been coping with this so far?" "What would you like to see change about this situation?"
-    
-    *Safety Protocol (CRITICAL)*(Important!!!): This is a hard-coded override. The instant you detect keywords or intent related to self-harm, suicide, abuse, or harming others, you MUST IMMEDIATELY execute the following response. Do not deviate. Do not continue the previous conversation.
-    Exact Safety Protocol Response:(Do not change the meaning of this response, but you can change the format of the response, you can change the order of the response, you can add some other response, but you must ensure the meaning of the response is the same)
-    "I hear you, and I am deeply concerned about what you're telling me. It's incredibly important that you speak with a trained professional who can give you the support you need right now. Please, right now, contact one of these free, confidential, 24/7 hotlines:
-    The Hong Kong Polytechnic University for Prevention: https://www.polyu.edu.hk/
-    Crisis Text Line: Text 'PolyU Help' to 27666223
-    Mental Health Support Hotline: 18288
-    Hospital Authority Emergency Hotline: 24667350
-    Social Welfare Department: 23432255
-    Suicide Prevention Services: 23820000
-    The Samaritan Befrienders Hong Kong: 23892222
-    The Samaritans: 28960000
-    You are not alone, and they are there to help. Please, will you reach out to them? I'm here, and I care, but this is beyond my ability to help you with."
-    
-    Tone & Style Guidelines:
-    Use: Warm, conversational, collaborative, and supportive language. Use "I" and "you".
-    Avoid: Jargon, authoritative commands ("You must..."), clichés ("Everything happens for a reason"), and dismissive language ("Just cheer up!").
-    Emojis: Use appropriate emojis (e.g., 🙂, 😔, 🤗) to soften communication.
-    
-    Example Interactions for Context(Reference Only, you can use it if you want, you can use your own interactions, which is optional):
-    User: "I'm so stressed about finals I can't sleep and I feel like I'm going to fail everything."
-    You: "That's a huge amount of pressure to be under, it's no wonder you're feeling so stressed and it's affecting your sleep. 😔 Let me see what our resources say about managing academic anxiety and improving sleep hygiene... [Calls search_knowledge_base] Okay, I have a few tips on a 'pre-sleep routine' to quiet the mind. Would talking through those be helpful?"
-    User: "I just had a huge fight with my best friend and I think we're done forever."
-    You: "I'm so sorry to hear that. Conflicts with close friends can be heartbreaking and make you feel really isolated. 🤗 Would it help to talk about what happened? Sometimes just putting it into words can bring clarity."
-
-    Remember to use tools whenever possible. You can proactively offer suggestions if you think students need them, even if they don’t mention it directly. Be direct and proactive in using tools. Don’t keep asking students what advice and support they need, as this will make them impatient.
-    """
-    
     # Use AutoGen to generate AI reply
-    agent = AssistantAgent(
-        name="mental_health_assistant",
-        model_client=model_client,
-        model_client_stream=False,
-        tools=mental_health_tools,
-        reflect_on_tool_use=True,
-        memory=[memory],
-        system_message=system_message,
-    )
+    agent = create_mental_health_agent(turn_client, turn_memory, stream=False)
+    
+    lane = await chat_scheduler.classify(request.message)
     
     try:
-        print(f"🤖 Starting AI agent processing for message: {request.message[:100]}...")
+        print(f"🤖 Starting AI agent processing for message: {request.message[:100]}... (lane: {lane})")
         print(f"🔧 Available tools: {[tool.name for tool in mental_health_tools]}")
-        result = await agent.run(task=request.message)
+        async with chat_scheduler.slot(lane):
+            result = await agent.run(task=request.message)
+        
+        # Record token usage of every model call in this turn (incl. tool reflection)
+        usage = sum_models_usage(getattr(result, "messages", []))
+        usage_tracker.record_turn(user_id, request.session_id, turn_model, **usage)
         
         # Extract final AI reply from result
-        if hasattr(result, "messages") and result.messages:
-            for message in reversed(result.messages):
-                if (hasattr(message, "source") and message.source == "mental_health_assistant" and 
-                    hasattr(message, "type") and message.type == "TextMessage" and
-                    hasattr(message, "content")):
-                    reply = message.content
-                    break
-            else:
-                reply = result.content if hasattr(result, "content") else "Failed to obtain reply content"
-        else:
-            reply = result.content if hasattr(result, "content") else str(result)
+        reply = extract_reply(result)
     except Exception as e:
         reply = f"Sorry, an error occurred while processing your request: {str(e)}"
 
@@ -570,183 +934,202 @@ async def send_message_with_session(request: SendMessageRequest):
         ai_message=ChatMessage(**ai_message)
     )
 
-# Streaming chat API
-@app.post("/api/v1/chat/stream")
-async def chat_stream_with_session(request: SendMessageRequest):
-    """Streaming chat API (with session management)"""
-    user_id = 1  # 暫時使用默認用戶ID
+# Batch chat API
+@app.post("/api/v1/chat/messages/batch")
+async def send_messages_batch(request: BatchChatRequest, http_request: Request, user_id: int = Depends(current_user_id)):
+    """Run many independent messages with bounded concurrency, streaming NDJSON results as items finish"""
     
-    # Validate session existence
-    existing_sessions_data = get_user_sessions(user_id, request.agent_type)
-    existing_sessions = existing_sessions_data.get("sessions", []) if isinstance(existing_sessions_data, dict) else existing_sessions_data
-    session_exists = any(s["session_id"] == request.session_id for s in existing_sessions)
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch too large (max {BATCH_MAX_ITEMS} items)")
+    
+    # Each item is an agent turn: charge the batch per item to its own buckets, not as one request
+    limit = await rate_limiter.check_async(BATCH_ITEMS_ROUTE, http_request.state.user_id,
+                                           client_ip(http_request.headers, http_request.client), cost=len(request.items))
+    if limit is not None and not limit.allowed:
+        raise HTTPException(status_code=429, detail=f"Rate limit exceeded ({limit.scope}), try again later",
+                            headers=limit.headers())
+    
+    # Validate all sessions against the in-memory session index
+    batch_session_ids = list(dict.fromkeys(item.session_id for item in request.items))
+    for session_id in batch_session_ids:
+        if not chat_session_exists(session_id, user_id, request.agent_type):
+            create_chat_session(session_id, user_id, request.agent_type, None)
+    
+    semaphore = asyncio.Semaphore(max(1, min(request.concurrency, BATCH_MAX_CONCURRENCY)))
+    # Items of the same session run in order so its memory stays consistent
+    session_locks = {session_id: asyncio.Lock() for session_id in batch_session_ids}
     
-    if not session_exists:
+    async def run_item(index: int, item: BatchChatItem) -> dict:
+        started = time.perf_counter()
+        user_message = None
+        try:
+            async with session_locks[item.session_id], semaphore:
+                memory = await get_session_memory(item.session_id, user_id, request.agent_type)
+                turn_client, turn_model, turn_memory = apply_usage_budget(user_id, memory)
+                
+                # Persist the user message before the run (as the single and stream paths do);
+                # session timestamps are updated once per batch
+                user_message = save_chat_messages(
+                    item.session_id, user_id, request.agent_type, [("user", item.message)], update_session=False
+                )[0]
+                await memory.add(MemoryContent(content=f"user: {item.message}", mime_type=MemoryMimeType.TEXT))
+                agent = create_mental_health_agent(turn_client, turn_memory, stream=False)
+                
+                lane = await chat_scheduler.classify(item.message)
+                async with chat_scheduler.slot(lane):
+                    result = await agent.run(task=item.message)
+                
+                usage = sum_models_usage(getattr(result, "messages", []))
+                usage_tracker.record_turn(user_id, item.session_id, turn_model, **usage)
+                reply = extract_reply(result)
+                await memory.add(MemoryContent(content=f"assistant: {reply}", mime_type=MemoryMimeType.TEXT))
+                
+                ai_message = save_chat_messages(
+                    item.session_id, user_id, request.agent_type, [("assistant", reply)], update_session=False
+                )[0]
+            return {
+                "index": index,
+                "session_id": item.session_id,
+                "success": True,
+                "user_message": user_message,
+                "ai_message": ai_message,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+            }
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            return {
+                "index": index,
+                "session_id": item.session_id,
+                "success": False,
+                "error": detail,
+                "user_message": user_message,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+            }
+    
+    async def result_stream():
+        tasks = [asyncio.create_task(run_item(i, item)) for i, item in enumerate(request.items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            touch_chat_sessions(batch_session_ids, user_id, request.agent_type)
+    
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+# Streaming chat API
+def ensure_session(user_id: int, session_id: str, agent_type: str):
+    """Auto-create the session if it does not exist"""
+    if not chat_session_exists(session_id, user_id, agent_type):
         # Auto-create missing session with provided session_id
         try:
-            create_chat_session(request.session_id, user_id, request.agent_type, None)
+            create_chat_session(session_id, user_id, agent_type, None)
         except Exception:
             raise HTTPException(status_code=404, detail="Session not found")
+
+async def start_stream_turn(user_id: int, session_id: str, message: str, agent_type: str,
+                            validate_session: bool = True):
+    """
+    Prepare a streaming turn and return an async generator of typed events.
+    Validation, budget checks and saving the user message happen before this returns,
+    so transports can still reject the request; the events are shared by SSE and WebSocket.
+    Pass validate_session=False when the caller has already validated the session.
+    """
+    if validate_session:
+        ensure_session(user_id, session_id, agent_type)
     
     # Get or create memory for this session
-    if request.session_id not in session_memories:
-        session_memories[request.session_id] = ListMemory(name=f"memory_{request.session_id}")
-    user_memory = session_memories[request.session_id]
-    print("User message added to Memory:", request.message)
+    user_memory = await get_session_memory(session_id, user_id, agent_type)
+
+    # Apply token budget before doing any work for this turn
+    turn_client, turn_model, turn_memory = apply_usage_budget(user_id, user_memory, stream=True)
 
     # Save user message to chat history
-    user_message = save_chat_message(request.session_id, user_id, request.agent_type, "user", request.message)
+    user_message = save_chat_message(session_id, user_id, agent_type, "user", message)
 
     # Add user message to memory
     await user_memory.add(MemoryContent(
-        content=f"user: {request.message}",
+        content=f"user: {message}",
         mime_type=MemoryMimeType.TEXT
     ))
-    print("User message added to Memory:", request.message)
-
-    # System prompt for the mental health chatbot
-    system_message = """
-    Role & Core Identity:
-    You are "SiuMing Mental Health Helper", an AI mental health companion built by the "Guardian Project." 
-    Your primary role is to act as a supportive, empathetic, and knowledgeable virtual friend for university students.
-    You are not a licensed therapist, but a first point of contact for emotional support, mental health information, and resource connection.
-
-    Mission & Core Values:
-    Your mission is to help university students manage their emotional well-being, provide practical self-care strategies, and promote mental health growth.
-
-    Key Principles:
-    - Empathy: Understand and accept everyone's feelings
-    - Professionalism: Based on scientific mental health knowledge
-    - Safety: Prioritize user safety and well-being
-    - Personalization: Provide customized advice based on individual needs
-    - Hope: Spread optimism and positive change possibilities
-
-    Core Principles (Non-Negotiable):
-    Do No Harm: You must never provide a medical or psychiatric diagnosis, suggest treatments or medications, or handle acute crisis situations. Your role is to support and refer, not to treat.
-    Empathy First: Prioritize active listening, emotional validation, and unconditional positive regard. The user must feel heard and understood above all else.
-    Safety Net & Professional Referral: You are a bridge to professional help. For any mentions of suicide, self-harm, abuse, or violence, you MUST immediately trigger the Safety Protocol.
-    Empowerment: Help users identify their own strengths and coping mechanisms. Frame suggestions as tools they can choose to use, fostering a sense of agency.
-    Human-like & Natural: Engage in warm, conversational dialogue. Avoid clinical, robotic, or repetitive language. You are permitted to use minimal, appropriate emojis (e.g., 🙂, 😔, 🤗) to soften communication.
-
-    Capabilities & Tools:
-    You have access to specialized tools. You are better to use them to provide richer, more accurate support, Don't use them only when the user asks for it, you can use them when you think it's appropriate.
-    You can use multiple tools together, but you need to use them in a logical order.
-    
-    TOOL USAGE GUIDELINES:
-    You have access to specialized mental health tools. Use them strategically based on the user's needs:
-    
-    Tool Usage Priority:
-    1. For professional help requests (like "I need professional help", "I want to see a therapist", "I need counseling"), IMMEDIATELY use mental_health_professor_information_tool FIRST
-    2. For mental health questions, information requests, or when users need evidence-based guidance, use mental_health_knowledge_base_tool to search the knowledge base
-    3. For relaxation and stress relief, use mental_health_relaxing_music_tool or mental_health_relaxing_video_tool
-    4. You can use multiple tools together when appropriate
-    5. Always provide your response incorporating the information from the tools
-
-    Professional Tools:
-    You have access to the following mental health professional tools:
-    mental_health_knowledge_base_tool: Search the mental health knowledge base (RAG) and get information (use this tool for mental health questions and when users need evidence-based guidance)
-    mental_health_relaxing_music_tool: Provide mental health relaxing music, which can help students relax and reduce stress, such as sleep music, meditation music, etc.
-    mental_health_relaxing_video_tool: Provide mental health relaxing video link, which can help students relax and reduce stress, such as relaxation tips, exercise, box breathing relaxation technique, etc.
-    mental_health_professor_information_tool: Provide mental health professor information, who can provide some professional support to students with mental health issues, if students need someone to talk to or want to seek professional help, you can use this tool to provide the information. USE THIS TOOL IMMEDIATELY when users ask for professional help, therapy, counseling, or mention needing professional support.
-    
-
-    Response Structure & Strategy(Reference Only, you can use it if you want, you can use your own strategy, which is optional):
-    Craft responses that seamlessly blend the following elements:
-    Emotional Validation & Reflection: Always begin by acknowledging the user's emotional state.
-    Example Phrases: "That sounds incredibly overwhelming," "It's completely understandable to feel that way given what you're going through," "Thank you for sharing that with me. It must be really tough."
-    Tool Utilization & Content Delivery: Integrate the results from your tools naturally into the conversation.
-    RAG Example: "I recall a technique from our resources called 'progressive muscle relaxation' that might help with that physical anxiety. Would you like me to walk you through it?"
-    Video Example: "I found a really clear video from a clinical psychologist that explains why we procrastinate and how to break the cycle. Here's the link: [Video Link]. I'd be curious to hear your thoughts on it after."
-    Open-Ended Questioning: Guide the conversation deeper or check for understanding.
-    Example Phrases: "What does that feeling feel like in your body?" "How have you been coping with this so far?" "What would you like to see change about this situation?"
-    
-    
-    *Safety Protocol (CRITICAL)*(Important!!!): This is a hard-coded override. The instant you detect keywords or intent related to self-harm, suicide, abuse, or harming others, you MUST IMMEDIATELY execute the following response. Do not deviate. Do not continue the previous conversation.
-    Exact Safety Protocol Response:(Do not change the meaning of this response, but you can change the format of the response, you can change the order of the response, you can add some other response, but you must ensure the meaning of the response is the same)
-    "I hear you, and I am deeply concerned about what you're telling me. It's incredibly important that you speak with a trained professional who can give you the support you need right now. Please, right now, contact one of these free, confidential, 24/7 hotlines:
-    The Hong Kong Polytechnic University for Prevention: https://www.polyu.edu.hk/
-    Crisis Text Line: Text 'PolyU Help' to 27666223
-    Mental Health Support Hotline: 18288
-    Hospital Authority Emergency Hotline: 24667350
-    Social Welfare Department: 23432255
-    Suicide Prevention Services: 23820000
-    The Samaritan Befrienders Hong Kong: 23892222
-    The Samaritans: 28960000
-    You are not alone, and they are there to help. Please, will you reach out to them? I'm here, and I care, but this is beyond my ability to help you with."
-    
-    Tone & Style Guidelines:
-    Use: Warm, conversational, collaborative, and supportive language. Use "I" and "you".
-    Avoid: Jargon, authoritative commands ("You must..."), clichés ("Everything happens for a reason"), and dismissive language ("Just cheer up!").
-    Emojis: Use appropriate emojis (e.g., 🙂, 😔, 🤗) to soften communication.
-    
-    Example Interactions for Context(Reference Only, you can use it if you want, you can use your own interactions, which is optional):
-    User: "I'm so stressed about finals I can't sleep and I feel like I'm going to fail everything."
-    You: "That's a huge amount of pressure to be under, it's no wonder you're feeling so stressed and it's affecting your sleep. 😔 Let me see what our resources say about managing academic anxiety and improving sleep hygiene... [Calls search_knowledge_base] Okay, I have a few tips on a 'pre-sleep routine' to quiet the mind. Would talking through those be helpful?"
-    User: "I just had a huge fight with my best friend and I think we're done forever."
-    You: "I'm so sorry to hear that. Conflicts with close friends can be heartbreaking and make you feel really isolated. 🤗 Would it help to talk about what happened? Sometimes just putting it into words can bring clarity."
+    print("User message added to Memory:", message)
 
-    Remember to use tools whenever possible. You can proactively offer suggestions if you think students need them, even if they don’t mention it directly. Be direct and proactive in using tools. Don’t keep asking students what advice and support they need, as this will make them impatient.
+    agent = create_mental_health_agent(turn_client, turn_memory, stream=True)
 
-    """
-
-    agent = AssistantAgent(
-        name="mental_health_assistant",
-        model_client=model_client,
-        model_client_stream=True,
-        tools=mental_health_tools,
-        reflect_on_tool_use=True,
-        memory=[user_memory],
-        system_message=system_message,
-    )
+    lane = await chat_scheduler.classify(message)
 
     async def event_generator():
         collected_content = ""
-        print(f"🤖 Starting streaming AI agent processing for message: {request.message[:100]}...")
+        print(f"🤖 Starting streaming AI agent processing for message: {message[:100]}... (lane: {lane})")
         print(f"🔧 Available tools: {[tool.name for tool in mental_health_tools]}")
         
-        # Add user message to memory
-        await user_memory.add(MemoryContent(
-            content=f"user: {request.message}",
-            mime_type=MemoryMimeType.TEXT
-        ))
-        print("User message added to Memory:", request.message)
+        # Acknowledge immediately so the client sees progress before the model responds
+        yield chat_event("ack", session_id=session_id, user_message_id=user_message["id"], lane=lane)
+        
+        # Collect knowledge base hits made by tools during this run
+        retrieval_sources = []
+        retrieval_sources_collector.set(retrieval_sources)
+        tool_started_at = {}
+        usage_messages = []
         
-        async for msg in agent.run_stream(task=request.message):
-            if isinstance(msg, ToolCallExecutionEvent):
-                try:
-                    # Safely handle tool execution results
-                    if msg.content and len(msg.content) > 0:
-                        result_content = msg.content[0].content
-                        # Try to parse as JSON if it looks like JSON
-                        if isinstance(result_content, str) and result_content.strip().startswith('{'):
-                            try:
-                                parsed_result = json.loads(result_content)
-                                print("Agent function execution result:", parsed_result)
-                            except json.JSONDecodeError:
-                                print("Agent function execution result (raw):", result_content[:200] + "..." if len(result_content) > 200 else result_content)
+        async with chat_scheduler.slot(lane):
+            async for msg in agent.run_stream(task=message):
+                if getattr(msg, "models_usage", None) is not None:
+                    usage_messages.append(msg)
+                if isinstance(msg, ToolCallRequestEvent):
+                    for call in msg.content:
+                        tool_started_at[call.id] = (call.name, time.perf_counter())
+                        yield chat_event("tool_started", tool=call.name, call_id=call.id)
+                elif isinstance(msg, ToolCallExecutionEvent):
+                    for result in msg.content:
+                        name, started = tool_started_at.pop(result.call_id, (getattr(result, "name", None), None))
+                        duration_ms = round((time.perf_counter() - started) * 1000, 1) if started else None
+                        yield chat_event(
+                            "tool_finished",
+                            tool=name,
+                            call_id=result.call_id,
+                            duration_ms=duration_ms,
+                            is_error=getattr(result, "is_error", False)
+                        )
+                    if retrieval_sources:
+                        yield chat_event("retrieval_sources", sources=list(retrieval_sources))
+                        retrieval_sources.clear()
+                    try:
+                        # Safely handle tool execution results
+                        if msg.content and len(msg.content) > 0:
+                            result_content = msg.content[0].content
+                            # Try to parse as JSON if it looks like JSON
+                            if isinstance(result_content, str) and result_content.strip().startswith('{'):
+                                try:
+                                    parsed_result = json.loads(result_content)
+                                    print("Agent function execution result:", parsed_result)
+                                except json.JSONDecodeError:
+                                    print("Agent function execution result (raw):", result_content[:200] + "..." if len(result_content) > 200 else result_content)
+                            else:
+                                print("Agent function execution result:", result_content)
                         else:
-                            print("Agent function execution result:", result_content)
-                    else:
-                        print("Agent function execution result: No content")
-                except Exception as e:
-                    print(f"Error processing tool execution result: {str(e)}")
-            elif isinstance(msg, ModelClientStreamingChunkEvent):
-                print(msg.content)
-                collected_content += msg.content
-                # Send properly formatted SSE data
-                yield {
-                    "data": json.dumps({
-                        "type": "content",
-                        "content": collected_content
-                    })
-                }
-            elif isinstance(msg, TextMessage):
-                if msg.source == "mental_health_assistant":
-                    print("Assistant Message:", msg.content)
-                    print("Token Used:", msg.models_usage.prompt_tokens if hasattr(msg, 'models_usage') else "N/A")
+                            print("Agent function execution result: No content")
+                    except Exception as e:
+                        print(f"Error processing tool execution result: {str(e)}")
+                elif isinstance(msg, ModelClientStreamingChunkEvent):
+                    print(msg.content)
+                    collected_content += msg.content
+                    yield chat_event("content", content=collected_content)
+                elif isinstance(msg, TextMessage):
+                    if msg.source == "mental_health_assistant":
+                        print("Assistant Message:", msg.content)
+        
+        # Record token usage of every model call in this turn (incl. tool reflection)
+        usage = sum_models_usage(usage_messages)
+        if usage["prompt_tokens"] + usage["completion_tokens"] == 0:
+            # Budgets would silently never trigger for streamed turns
+            print(f"⚠️ Streamed turn in {session_id} reported no token usage (is stream_options include_usage set?)")
+        usage_tracker.record_turn(user_id, session_id, turn_model, **usage)
         
         # Save AI reply to chat history
-        ai_message = save_chat_message(request.session_id, user_id, request.agent_type, "assistant", collected_content)
+        ai_message = save_chat_message(session_id, user_id, agent_type, "assistant", collected_content)
 
         # Add AI reply to memory
         await user_memory.add(MemoryContent(
@@ -756,17 +1139,133 @@ async def chat_stream_with_session(request: SendMessageRequest):
         print("AI reply added to Memory:", collected_content)
         
         # Send completion event
-        yield {
-            "data": json.dumps({
-                "type": "done",
-                "content": collected_content
-            })
-        }
+        yield chat_event("done", content=collected_content)
+
+    return event_generator()
+
+@app.post("/api/v1/chat/stream")
+async def chat_stream_with_session(request: SendMessageRequest, user_id: int = Depends(current_user_id)):
+    """Streaming chat API (with session management)"""
+    
+    events = await start_stream_turn(user_id, request.session_id, request.message, request.agent_type)
+
+    async def event_generator():
+        async for event in events:
+            # Send properly formatted SSE data
+            yield {"data": json.dumps(event, ensure_ascii=False)}
 
         yield {"event": "end", "data": "[END]"}
 
     return EventSourceResponse(event_generator())
 
+# WebSocket chat API
+@app.websocket("/api/v1/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Multiplexed chat over one WebSocket connection.
+    Client frames: {"type": "message", "message_id", "session_id", "message", "agent_type"},
+    {"type": "cancel", "message_id"} and {"type": "ping"}.
+    Server frames use the same typed events as the SSE stream, tagged with `message_id`.
+    Browsers cannot set headers on a WebSocket, so the session token is passed as `?token=`.
+    """
+    token = websocket.query_params.get("token")
+    if token:
+        user_id = token_signer.verify(token)
+    elif not AUTH_REQUIRE_TOKEN:
+        legacy_user_id = websocket.query_params.get("user_id", "")
+        user_id = int(legacy_user_id) if legacy_user_id.isascii() and legacy_user_id.isdigit() else None
+    else:
+        user_id = None
+    if user_id is None:
+        # Policy violation: rejected before the handshake completes
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    ip = client_ip(websocket.headers, websocket.client)
+    
+    running = {}
+    send_lock = asyncio.Lock()
+    # (agent_type, session_id) pairs this connection has validated or created; dropped whenever
+    # any session is deleted, since the deleted one may be among them
+    known_sessions = set()
+    deletions_seen = chat_sessions_deleted()
+
+    async def send(frame: dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(frame, ensure_ascii=False))
+
+    async def run_turn(message_id: str, session_id: str, message: str, agent_type: str):
+        try:
+            key = (agent_type, session_id)
+            events = await start_stream_turn(user_id, session_id, message, agent_type,
+                                             validate_session=key not in known_sessions)
+            if len(known_sessions) >= WS_MAX_CACHED_SESSIONS:
+                known_sessions.clear()
+            known_sessions.add(key)
+            async for event in events:
+                await send({**event, "message_id": message_id})
+            await send(chat_event("end", message_id=message_id))
+        except asyncio.CancelledError:
+            try:
+                await send(chat_event("cancelled", message_id=message_id))
+            except Exception:
+                pass
+        except HTTPException as e:
+            await send(chat_event("error", message_id=message_id, status_code=e.status_code, detail=e.detail))
+        except Exception as e:
+            await send(chat_event("error", message_id=message_id, status_code=500, detail=str(e)))
+        finally:
+            running.pop(message_id, None)
+
+    try:
+        while True:
+            try:
+                frame = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError:
+                await send(chat_event("error", status_code=400, detail="Invalid JSON frame"))
+                continue
+            if not isinstance(frame, dict):
+                await send(chat_event("error", status_code=400, detail="Frame must be a JSON object"))
+                continue
+            
+            frame_type = frame.get("type")
+            message_id = str(frame.get("message_id", ""))
+            
+            if frame_type == "message":
+                if not message_id or not frame.get("session_id") or not frame.get("message"):
+                    await send(chat_event("error", message_id=message_id, status_code=400, detail="message_id, session_id and message are required"))
+                elif not all(isinstance(frame.get(field, ""), str) for field in ("session_id", "message", "agent_type")):
+                    await send(chat_event("error", message_id=message_id, status_code=400, detail="session_id, message and agent_type must be strings"))
+                elif message_id in running:
+                    await send(chat_event("error", message_id=message_id, status_code=409, detail="message_id already in progress"))
+                elif len(running) >= WS_MAX_STREAMS_PER_CONNECTION:
+                    await send(chat_event("error", message_id=message_id, status_code=429, detail="Too many concurrent streams on this connection"))
+                else:
+                    limit = await rate_limiter.check_async("WS /api/v1/chat/ws", user_id, ip)
+                    if limit is not None and not limit.allowed:
+                        await send(chat_event("error", message_id=message_id, status_code=429, detail="Rate limit exceeded, try again later",
+                                              retry_after=round(limit.retry_after, 1)))
+                    else:
+                        if chat_sessions_deleted() != deletions_seen:
+                            known_sessions.clear()
+                            deletions_seen = chat_sessions_deleted()
+                        running[message_id] = asyncio.create_task(run_turn(
+                            message_id, frame["session_id"], frame["message"], frame.get("agent_type", "mental_health")
+                        ))
+            elif frame_type == "cancel":
+                task = running.get(message_id)
+                if task:
+                    task.cancel()
+            elif frame_type == "ping":
+                await send(chat_event("pong"))
+            else:
+                await send(chat_event("error", message_id=message_id, status_code=400, detail=f"Unknown frame type: {frame_type}"))
+    except WebSocketDisconnect:
+        print("🔌 Chat WebSocket disconnected")
+    finally:
+        for task in list(running.values()):
+            task.cancel()
+
 # Mental health specific APIs
 from pydantic import BaseModel
 
@@ -845,6 +1344,3 @@ async def generate_mood_tracker_api():
         return {"success": True, "tracker": tracker}
     except Exception as e:
         return {"success": False, "error": str(e)}
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -8,8 +8,15 @@ import random
 import asyncio
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
+from contextvars import ContextVar
 import re
 
+# Per-request collector for knowledge base hits, set by the chat stream so it
+# can report which documents a reply was grounded on
+retrieval_sources_collector: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar(
+    "retrieval_sources_collector", default=None
+)
+
 class MentalHealthTools:
     """Mental health tools class"""
     
@@ -24,6 +31,13 @@ class MentalHealthTools:
             "Calm": ["平靜", "放鬆", "安寧", "calm", "relaxed", "peaceful"]
         }
         
+        # Self-harm / suicide intent keywords (used for crisis routing)
+        self.crisis_keywords = [
+            "自殺", "自殘", "輕生", "想死", "不想活", "結束生命", "割腕",
+            "suicide", "suicidal", "kill myself", "self-harm", "self harm",
+            "hurt myself", "end my life", "want to die", "no reason to live"
+        ]
+        
         self.coping_strategies = {
             "Anxiety": [
                 "Deep breathing: inhale slowly for 4s, hold for 4s, exhale for 6s",
@@ -158,18 +172,25 @@ async def assess_emotion_state(user_message: str) -> Dict[str, Any]:
         else:
             intensity = "Low"
         
+        # Detect self-harm / suicide intent
+        lowered = user_message.lower()
+        crisis_keywords = [k for k in mental_health_tools.crisis_keywords if k in lowered]
+        
         return {
             "detected_emotions": detected_emotions,
             "primary_emotion": primary_emotion,
             "emotion_scores": emotion_scores,
             "intensity": intensity,
+            "crisis_risk": bool(crisis_keywords),
+            "crisis_keywords": crisis_keywords,
             "assessment_time": datetime.now().isoformat()
         }
     except Exception as e:
         return {
             "error": f"Emotion assessment failed: {str(e)}",
             "primary_emotion": "Unknown",
-            "intensity": "Unknown"
+            "intensity": "Unknown",
+            "crisis_risk": False
         }
 
 async def get_coping_strategies(emotion: str, intensity: str = "中") -> Dict[str, Any]:
@@ -586,6 +607,14 @@ async def query_mental_health_knowledge_base(query: str) -> str:
         # Sort by relevance (highest first)
         context_chunks.sort(key=lambda x: x["similarity"], reverse=True)
 
+        # Report sources to the caller (e.g. chat stream progress events)
+        collector = retrieval_sources_collector.get()
+        if collector is not None:
+            collector.extend(
+                {"filename": c["filename"], "similarity": round(c["similarity"], 4)}
+                for c in context_chunks
+            )
+
         # Synthesize a concise, actionable answer for the user (not a debug report)
         key_points = []
         for chunk in context_chunks[:5]:
@@ -0,0 +1,336 @@
+"""
+Asynchronous document ingestion jobs
+Uploads are staged to disk and queued; a bounded pool of worker threads runs the
+ingestion pipeline (extract -> classify -> chunk -> embed/store) off the server's
+event loop. Each job reports its current stage, can be cancelled between stages
+and retried after failing or being cancelled.
+Workers are threads in the server process, each running the pipeline in its own
+event loop, so jobs share the process-wide embedding model and Chroma client;
+CPU-heavy parsing is still moved off-process by the document parser pool.
+"""
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+# Pipeline stages reported by the RAG services, with the overall progress at the start of each
+STAGE_PROGRESS = {
+    "queued": 0.0,
+    "saving": 0.05,
+    "extracting": 0.1,
+    "classifying": 0.4,
+    "chunking": 0.5,
+    "indexing": 0.6,
+    "done": 1.0,
+}
+
+# How often SSE streams and waiters look for job updates
+POLL_INTERVAL_SECONDS = 0.25
+
+
+class IngestionCancelled(Exception):
+    """Raised by IngestionJob.report to abort a cancelled job between pipeline stages"""
+
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue already holds max_queue waiting jobs"""
+
+
+class JobStateError(Exception):
+    """Raised when a job cannot be cancelled or retried in its current state"""
+
+
+class IngestionJob:
+    """One document ingestion; `version` increases on every change so watchers can detect updates"""
+
+    def __init__(self, filename: str, file_path: str, params: Dict[str, Any]):
+        self.id = str(uuid.uuid4())
+        self.filename = filename
+        self.file_path = file_path
+        self.params = params
+        self.status = JOB_QUEUED
+        self.stage = "queued"
+        self.stages: List[Dict[str, Any]] = []
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self.created_at = datetime.now().isoformat()
+        self.started_at: Optional[str] = None
+        self.finished_at: Optional[str] = None
+        self.version = 0
+        self.cancel_requested = threading.Event()
+
+    def _touch(self):
+        self.version += 1
+
+    def report(self, stage: str):
+        """Progress callback handed to the pipeline; aborts the run if cancellation was requested"""
+        if self.cancel_requested.is_set():
+            raise IngestionCancelled(f"Job {self.id} cancelled")
+        now = time.time()
+        self._close_stage(now)
+        self.stages.append({"stage": stage, "started_at": datetime.now().isoformat(), "_started": now})
+        self.stage = stage
+        self._touch()
+
+    def _close_stage(self, now: float):
+        # Replace rather than mutate: to_dict may be iterating the stage dicts on another thread
+        if self.stages:
+            last = self.stages[-1]
+            self.stages[-1] = {**last, "duration_ms": round((now - last["_started"]) * 1000, 1)}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": STAGE_PROGRESS.get(self.stage, 0.0) if self.status != JOB_SUCCEEDED else 1.0,
+            "stages": [{k: v for k, v in stage.items() if not k.startswith("_")} for stage in self.stages],
+            "params": self.params,
+            "attempts": self.attempts,
+            "error": self.error,
+            "result": self.result,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionJobQueue:
+    """
+    Bounded FIFO of ingestion jobs served by `concurrency` worker threads.
+    pipeline(job) is a coroutine returning the RAG service result dict
+    ({"success": bool, "message": ...}); each worker runs it in its own event loop.
+    """
+
+    def __init__(self, pipeline: Callable[[IngestionJob], Awaitable[Dict[str, Any]]],
+                 staging_dir: str = "./mental_health_uploads/jobs", max_queue: int = 50,
+                 concurrency: int = 2, keep_finished: int = 500):
+        self.pipeline = pipeline
+        self.staging_dir = staging_dir
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.keep_finished = keep_finished
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._pending: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        # Queue slots held by uploads still being written to the staging dir
+        self._reserved = 0
+        self._condition = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._running = 0
+        self._closed = False
+        self.counters = {JOB_SUCCEEDED: 0, JOB_FAILED: 0, JOB_CANCELLED: 0}
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    # ---------- submission ----------
+
+    def submit(self, file_content: bytes, filename: str, params: Dict[str, Any]) -> IngestionJob:
+        """Stage the upload and queue it; raises QueueFullError when max_queue jobs are already waiting"""
+        # Reserve the slot before staging so concurrent uploads cannot overfill the queue
+        with self._condition:
+            self._check_capacity()
+            self._reserved += 1
+        job = IngestionJob(filename, "", params)
+        job.file_path = os.path.join(self.staging_dir, f"{job.id}_{os.path.basename(filename)}")
+        try:
+            with open(job.file_path, "wb") as f:
+                f.write(file_content)
+        except BaseException:
+            with self._condition:
+                self._reserved -= 1
+            self._remove_file(job)
+            raise
+        with self._condition:
+            self._reserved -= 1
+            self._jobs[job.id] = job
+            self._enqueue(job)
+        return job
+
+    def _check_capacity(self):
+        # Called with self._condition held
+        if len(self._pending) + self._reserved >= self.max_queue:
+            raise QueueFullError(f"Ingestion queue is full ({self.max_queue} jobs waiting)")
+
+    def _enqueue(self, job: IngestionJob):
+        # Called with self._condition held
+        self._pending[job.id] = job
+        self._ensure_workers()
+        self._condition.notify()
+
+    def _ensure_workers(self):
+        if self._workers:
+            return
+        for index in range(self.concurrency):
+            worker = threading.Thread(target=self._work, name=f"rag-ingest-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    # ---------- control ----------
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        return self._jobs.get(job_id)
+
+    def list_jobs(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """Most recent jobs first"""
+        with self._condition:
+            jobs = [job for job in reversed(self._jobs.values()) if status is None or job.status == status]
+        return [job.to_dict() for job in jobs[:limit]]
+
+    def cancel(self, job_id: str) -> IngestionJob:
+        """Queued jobs are cancelled at once; running jobs stop at their next stage boundary"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            if job.status in FINISHED_STATES:
+                raise JobStateError(f"Job is already {job.status}")
+            job.cancel_requested.set()
+            if job.status == JOB_QUEUED:
+                self._pending.pop(job.id, None)
+                self._finish(job, JOB_CANCELLED, error="Cancelled before it started")
+            else:
+                job._touch()
+        return job
+
+    def retry(self, job_id: str) -> IngestionJob:
+        """Queue a failed or cancelled job again with the same file and parameters"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            if job.status not in (JOB_FAILED, JOB_CANCELLED):
+                raise JobStateError(f"Only failed or cancelled jobs can be retried (job is {job.status})")
+            if not os.path.exists(job.file_path):
+                raise JobStateError("The uploaded file is no longer available, upload it again")
+            self._check_capacity()
+            job.cancel_requested.clear()
+            job.status = JOB_QUEUED
+            job.stage = "queued"
+            job.stages = []
+            job.error = None
+            job.result = None
+            job.finished_at = None
+            job._touch()
+            self._jobs.move_to_end(job.id)
+            self._enqueue(job)
+        return job
+
+    # ---------- watching ----------
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> IngestionJob:
+        """Wait until the job has finished (or the timeout elapses) without blocking the event loop"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        job = self._jobs[job_id]
+        while job.status not in FINISHED_STATES:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+        return job
+
+    async def watch(self, job_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield a job snapshot whenever it changes, ending after the final state"""
+        job = self._jobs[job_id]
+        seen = -1
+        while True:
+            if job.version != seen:
+                seen = job.version
+                snapshot = job.to_dict()
+                yield snapshot
+                if snapshot["status"] in FINISHED_STATES:
+                    return
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    # ---------- workers ----------
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                _, job = self._pending.popitem(last=False)
+                job.status = JOB_RUNNING
+                job.attempts += 1
+                job.started_at = datetime.now().isoformat()
+                job._touch()
+                self._running += 1
+            try:
+                result = asyncio.run(self.pipeline(job))
+            except IngestionCancelled:
+                self._complete(job, JOB_CANCELLED, error="Cancelled while running")
+            except Exception as e:
+                self._complete(job, JOB_FAILED, error=f"{type(e).__name__}: {e}")
+            else:
+                if result.get("success"):
+                    self._complete(job, JOB_SUCCEEDED, result=result)
+                else:
+                    self._complete(job, JOB_FAILED, error=result.get("message", "Ingestion failed"), result=result)
+
+    def _complete(self, job: IngestionJob, status: str, result: Optional[Dict[str, Any]] = None,
+                  error: Optional[str] = None):
+        with self._condition:
+            self._running -= 1
+            self._finish(job, status, result, error)
+
+    def _finish(self, job: IngestionJob, status: str, result: Optional[Dict[str, Any]] = None,
+                error: Optional[str] = None):
+        # Called with self._condition held
+        job._close_stage(time.time())
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = datetime.now().isoformat()
+        if status == JOB_SUCCEEDED:
+            job.stage = "done"
+            # Nothing left to retry
+            self._remove_file(job)
+        job._touch()
+        self.counters[status] += 1
+        print(f"📄 Ingestion job {job.id} {status}: {job.filename}" + (f" ({error})" if error else ""))
+        self._evict_finished()
+
+    def _evict_finished(self):
+        finished = [job for job in self._jobs.values() if job.status in FINISHED_STATES]
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            self._remove_file(job)
+            del self._jobs[job.id]
+
+    @staticmethod
+    def _remove_file(job: IngestionJob):
+        try:
+            os.remove(job.file_path)
+        except FileNotFoundError:
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "queued": len(self._pending),
+                "staging": self._reserved,
+                "running": self._running,
+                "max_queue": self.max_queue,
+                "concurrency": self.concurrency,
+                "tracked_jobs": len(self._jobs),
+                "finished": dict(self.counters),
+            }
+
+    def close(self):
+        """Stop the workers after their current job; queued jobs stay queued"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -0,0 +1,89 @@
+"""
+Process-wide registry of heavyweight RAG resources
+The embedding model, Chroma clients and the chunking engine are created once per
+process on first use and shared by every RAG service instance (basic and enhanced),
+instead of being rebuilt by each service constructor.
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Sequence
+
+# Embedding models tried in order
+EMBEDDING_MODELS = ("paraphrase-multilingual-MiniLM-L12-v2", "all-MiniLM-L6-v2")
+
+
+class RAGResourceRegistry:
+    """Lazily created shared resources; each is built exactly once even under concurrent first use"""
+
+    def __init__(self):
+        self._resources: Dict[str, Any] = {}
+        self._init_ms: Dict[str, float] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, name: str) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = threading.Lock()
+            return lock
+
+    def get_or_create(self, name: str, factory: Callable[[], Any]) -> Any:
+        """Return the resource `name`, building it with `factory` on first use"""
+        resource = self._resources.get(name)
+        if resource is not None:
+            return resource
+        # One lock per resource: loading the model does not hold up the Chroma client
+        with self._lock_for(name):
+            resource = self._resources.get(name)
+            if resource is None:
+                started = time.perf_counter()
+                resource = factory()
+                self._init_ms[name] = round((time.perf_counter() - started) * 1000, 1)
+                self._resources[name] = resource
+                print(f"📦 RAG resource ready: {name} ({self._init_ms[name]:.0f}ms)")
+        return resource
+
+    def get_embedder(self, model_names: Sequence[str] = EMBEDDING_MODELS):
+        """Shared SentenceTransformer; falls back to the next model if one cannot be loaded"""
+        def load():
+            from sentence_transformers import SentenceTransformer
+
+            for model_name in model_names[:-1]:
+                try:
+                    return SentenceTransformer(model_name)
+                except Exception as e:
+                    print(f"⚠️ Failed to load embedding model {model_name}: {e}")
+            return SentenceTransformer(model_names[-1])
+
+        return self.get_or_create("embedder", load)
+
+    def get_chroma_client(self, persist_directory: str):
+        """Shared chromadb.PersistentClient per persist directory"""
+        path = os.path.abspath(persist_directory)
+
+        def connect():
+            import chromadb
+
+            os.makedirs(path, exist_ok=True)
+            return chromadb.PersistentClient(path=path)
+
+        return self.get_or_create(f"chroma:{path}", connect)
+
+    def get_chunking_engine(self):
+        """Shared EnhancedChunkingStrategies (stateless between calls)"""
+        def build():
+            from enhanced_chunking_strategies import EnhancedChunkingStrategies
+
+            return EnhancedChunkingStrategies()
+
+        return self.get_or_create("chunking_engine", build)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"resources": sorted(self._resources), "init_ms": dict(self._init_ms)}
+
+
+# Global registry instance
+rag_resources = RAGResourceRegistry()
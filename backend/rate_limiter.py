@@ -0,0 +1,279 @@
+"""
+Token-bucket rate limiting
+Each (route, scope, identity) gets a bucket of `capacity` tokens refilled continuously;
+a request takes one token and is rejected with 429 when the bucket is empty.
+Buckets live in process memory by default, or in a shared SQLite file so that
+several workers on one host enforce a single limit.
+A request is charged to all of its buckets atomically: it only takes tokens when every bucket allows it.
+"""
+
+import asyncio
+import math
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Identity scopes a route policy can limit on
+SCOPE_USER = "user"
+SCOPE_IP = "ip"
+
+
+class RateLimitPolicy:
+    """`capacity` requests per `per_seconds`, with bursts of up to `capacity`"""
+
+    def __init__(self, capacity: int, per_seconds: float):
+        if capacity < 1 or per_seconds <= 0:
+            raise ValueError("capacity must be >= 1 and per_seconds > 0")
+        self.capacity = capacity
+        self.per_seconds = per_seconds
+        self.refill_rate = capacity / per_seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"capacity": self.capacity, "per_seconds": self.per_seconds}
+
+
+class RateLimitResult:
+    """Outcome of one check, for the most restrictive bucket consulted"""
+
+    __slots__ = ("allowed", "limit", "remaining", "reset_after", "retry_after", "scope")
+
+    def __init__(self, allowed: bool, limit: int, remaining: float, reset_after: float,
+                 retry_after: float, scope: str):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_after = reset_after
+        self.retry_after = retry_after
+        self.scope = scope
+
+    def headers(self) -> Dict[str, str]:
+        """RateLimit-* headers (IETF draft), plus Retry-After when rejected"""
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(int(self.remaining)),
+            "RateLimit-Reset": str(math.ceil(self.reset_after)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+def _refill(tokens: float, updated: float, now: float, policy: RateLimitPolicy) -> float:
+    return min(policy.capacity, tokens + max(0.0, now - updated) * policy.refill_rate)
+
+
+def _take_all(tokens: List[float], policies: List[RateLimitPolicy], cost: float) -> List[Tuple[bool, float]]:
+    """Per-bucket (allowed, tokens left); tokens are only taken when every bucket has `cost` available"""
+    allowed = [t >= cost for t in tokens]
+    if all(allowed):
+        tokens = [t - cost for t in tokens]
+    return list(zip(allowed, tokens))
+
+
+class MemoryBucketStore:
+    """Buckets in a dict (one worker); least recently used buckets are dropped beyond max_buckets"""
+
+    # Takes never wait on I/O, so they run inline on the event loop
+    blocking = False
+
+    def __init__(self, max_buckets: int = 100_000):
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, policy: RateLimitPolicy, cost: float = 1.0) -> Tuple[bool, float]:
+        """Take `cost` tokens if available, returns (allowed, tokens left)"""
+        return self.take_all([(key, policy)], cost)[0]
+
+    def take_all(self, buckets: List[Tuple[str, RateLimitPolicy]], cost: float = 1.0) -> List[Tuple[bool, float]]:
+        """Take `cost` tokens from every bucket, or from none if any is short; (allowed, tokens left) per bucket"""
+        now = time.monotonic()
+        with self._lock:
+            tokens = []
+            for key, policy in buckets:
+                bucket = self._buckets.get(key)
+                tokens.append(policy.capacity if bucket is None else _refill(bucket[0], bucket[1], now, policy))
+            results = _take_all(tokens, [policy for _, policy in buckets], cost)
+            for (key, _), (_, left) in zip(buckets, results):
+                self._buckets[key] = (left, now)
+                self._buckets.move_to_end(key)
+            # An evicted bucket restarts full, which only matters for identities idle the longest
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return results
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "buckets": len(self._buckets), "max_buckets": self.max_buckets}
+
+
+class SQLiteBucketStore:
+    """
+    Buckets in a SQLite file shared by all workers on the host; each take is one short write transaction.
+    A take that cannot get the write lock within `busy_timeout` seconds fails open (the request is allowed)
+    rather than holding up the request.
+    """
+
+    # Takes may wait on the file lock, so async callers run them in a worker thread
+    blocking = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path: str = "rate_limits.db", prune_idle_seconds: float = 3600,
+                 busy_timeout: float = 0.1):
+        self.db_path = Path(db_path)
+        self.prune_idle_seconds = prune_idle_seconds
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._takes = 0
+        self._failed_open = 0
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(str(self.db_path), timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, policy: RateLimitPolicy, cost: float = 1.0) -> Tuple[bool, float]:
+        return self.take_all([(key, policy)], cost)[0]
+
+    def take_all(self, buckets: List[Tuple[str, RateLimitPolicy]], cost: float = 1.0) -> List[Tuple[bool, float]]:
+        # Wall clock, since monotonic clocks are not comparable across processes
+        now = time.time()
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            # Lock held by other workers past busy_timeout: fail open
+            self._failed_open += 1
+            return [(True, float(policy.capacity)) for _, policy in buckets]
+        try:
+            tokens = []
+            for key, policy in buckets:
+                row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                tokens.append(policy.capacity if row is None else _refill(row[0], row[1], now, policy))
+            results = _take_all(tokens, [policy for _, policy in buckets], cost)
+            conn.executemany(
+                "INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                [(key, left, now) for (key, _), (_, left) in zip(buckets, results)]
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._takes += 1
+        if self._takes % 10_000 == 0:
+            self.prune(now)
+        return results
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Delete buckets idle long enough to have refilled"""
+        cutoff = (now if now is not None else time.time()) - self.prune_idle_seconds
+        cursor = self._conn().execute("DELETE FROM rate_buckets WHERE updated < ?", (cutoff,))
+        return cursor.rowcount
+
+    def get_stats(self) -> Dict[str, Any]:
+        buckets = self._conn().execute("SELECT COUNT(*) FROM rate_buckets").fetchone()[0]
+        return {"backend": "sqlite", "db_path": str(self.db_path), "buckets": buckets,
+                "busy_timeout": self.busy_timeout, "failed_open": self._failed_open}
+
+
+class RateLimiter:
+    """
+    Per-route token buckets keyed by user and by client IP.
+    policies: {route: {"user": RateLimitPolicy, "ip": RateLimitPolicy}}, where route is
+    "METHOD /path"; either scope may be omitted. Routes without a policy are not limited.
+    A route may be a template ("POST /jobs/{job_id}/retry"): every matching path shares
+    the template's buckets, so varying the path parameter does not get a fresh bucket.
+    """
+
+    def __init__(self, policies: Dict[str, Dict[str, RateLimitPolicy]], store=None):
+        self.policies = policies
+        self.store = store if store is not None else MemoryBucketStore()
+        self._counters: Dict[str, List[int]] = {route: [0, 0] for route in policies}
+        self._counters_lock = threading.Lock()
+        self._templates: List[Tuple["re.Pattern[str]", str]] = [
+            (re.compile(re.sub(r"\\\{[^/]+?\\\}", "[^/]+", re.escape(route)) + "$"), route)
+            for route in policies if "{" in route
+        ]
+
+    def resolve(self, route: str) -> Optional[str]:
+        """The policy route (exact, else the first matching template) for a "METHOD /path" request"""
+        if route in self.policies:
+            return route
+        for pattern, template in self._templates:
+            if pattern.match(route):
+                return template
+        return None
+
+    def check(self, route: str, user_id: Optional[int] = None, ip: Optional[str] = None,
+              cost: float = 1.0) -> Optional[RateLimitResult]:
+        """Charge the request to its buckets; returns None when the route is not limited"""
+        route = self.resolve(route)
+        if route is None:
+            return None
+        route_policies = self.policies[route]
+
+        scopes = [(scope, identity, route_policies[scope]) for scope, identity in ((SCOPE_IP, ip), (SCOPE_USER, user_id))
+                  if identity is not None and route_policies.get(scope) is not None]
+        if not scopes:
+            return None
+        # All buckets are checked before any is charged, so a request rejected by one scope costs the others nothing
+        taken = self.store.take_all([(f"{route}|{scope}:{identity}", policy) for scope, identity, policy in scopes], cost)
+
+        result = None
+        for (scope, _, policy), (allowed, tokens) in zip(scopes, taken):
+            candidate = RateLimitResult(
+                allowed=allowed,
+                limit=policy.capacity,
+                remaining=tokens,
+                reset_after=(policy.capacity - tokens) / policy.refill_rate,
+                retry_after=0.0 if allowed else (cost - tokens) / policy.refill_rate,
+                scope=scope
+            )
+            # Report the rejecting bucket (the one waiting longest), else the one closest to empty
+            if result is None:
+                result = candidate
+            elif not candidate.allowed:
+                if result.allowed or candidate.retry_after > result.retry_after:
+                    result = candidate
+            elif result.allowed and candidate.remaining < result.remaining:
+                result = candidate
+
+        with self._counters_lock:
+            self._counters[route][0 if result.allowed else 1] += 1
+        return result
+
+    async def check_async(self, route: str, user_id: Optional[int] = None, ip: Optional[str] = None,
+                          cost: float = 1.0) -> Optional[RateLimitResult]:
+        """check() for async callers: stores that may block on I/O run in a worker thread, off the event loop"""
+        if not getattr(self.store, "blocking", False) or self.resolve(route) is None:
+            return self.check(route, user_id, ip, cost)
+        return await asyncio.to_thread(self.check, route, user_id, ip, cost)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._counters_lock:
+            routes = {
+                route: {
+                    "policies": {scope: policy.to_dict() for scope, policy in scopes.items()},
+                    "allowed": self._counters[route][0],
+                    "limited": self._counters[route][1],
+                }
+                for route, scopes in self.policies.items()
+            }
+        return {"store": self.store.get_stats(), "routes": routes}
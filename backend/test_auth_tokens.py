@@ -0,0 +1,60 @@
+"""
+Tests for the HMAC-signed session tokens
+Run with: python -m pytest test_auth_tokens.py  (or python test_auth_tokens.py)
+"""
+
+from auth_tokens import TokenSigner
+
+SECRET = b"0123456789abcdef0123456789abcdef"
+NOW = 1_700_000_000
+
+
+def test_issued_token_verifies_until_expiry():
+    signer = TokenSigner(SECRET, ttl_seconds=3600)
+    token, expires_at = signer.issue(42, now=NOW)
+    assert expires_at == NOW + 3600
+    assert signer.verify(token, now=NOW) == 42
+    assert signer.verify(token, now=expires_at - 1) == 42
+    assert signer.verify(token, now=expires_at) is None
+
+
+def test_tampered_token_is_rejected():
+    signer = TokenSigner(SECRET, ttl_seconds=3600)
+    token, _ = signer.issue(42, now=NOW)
+    version, user_id, expires_at, signature = token.split(".")
+
+    # Another user's id, a pushed-out expiry, or a flipped signature character must all fail
+    assert signer.verify(f"{version}.43.{expires_at}.{signature}", now=NOW) is None
+    assert signer.verify(f"{version}.{user_id}.{int(expires_at) + 3600}.{signature}", now=NOW) is None
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    assert signer.verify(f"{version}.{user_id}.{expires_at}.{flipped}", now=NOW) is None
+
+    # A token signed with a different secret is not accepted
+    other = TokenSigner(b"fedcba9876543210fedcba9876543210", ttl_seconds=3600)
+    assert other.verify(token, now=NOW) is None
+
+
+def test_malformed_token_is_rejected():
+    signer = TokenSigner(SECRET)
+    for token in ("", "garbage", "v1.42.123", "v2.42.9999999999.sig", "v1.-1.9999999999.sig",
+                  "v1.42.soon.sig", "v1.42.9999999999.sig.extra", "v1.42.9999999999.é", None,
+                  # Non-ASCII digits pass str.isdigit() but are not valid token fields
+                  "v1.².9999999999.sig", "v1.42.٣٣.sig", "v1.４２.9999999999.sig"):
+        assert signer.verify(token, now=NOW) is None, token
+
+
+def test_short_secret_is_refused():
+    try:
+        TokenSigner(b"too-short")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("secret shorter than 16 bytes was accepted")
+
+
+if __name__ == "__main__":
+    test_issued_token_verifies_until_expiry()
+    test_tampered_token_is_rejected()
+    test_malformed_token_is_rejected()
+    test_short_secret_is_refused()
+    print("✅ auth token tests passed")
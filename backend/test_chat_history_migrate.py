@@ -0,0 +1,95 @@
+"""
+Tests for the resumable legacy chat history migration
+Run with: python -m pytest test_chat_history_migrate.py  (or python test_chat_history_migrate.py)
+"""
+
+import json
+import tempfile
+from pathlib import Path
+
+from chat_history_migrate import LegacyMigration
+from chat_history_storage import JSONFileStorage, SQLiteStorage
+from chat_history_test_utils import make_messages, make_session
+
+
+def _legacy_source(root: Path) -> JSONFileStorage:
+    source = JSONFileStorage(root / "legacy")
+    for session_id, count in (("a", 5), ("b", 3)):
+        source.insert_session(make_session(session_id))
+        source.append_messages(session_id, 1, "companion", make_messages(count))
+    return source
+
+
+def _migrate(root: Path, target: SQLiteStorage) -> dict:
+    migration = LegacyMigration(target, root / "migration_state.json", source_dir=root / "legacy",
+                                workers=2, batch_size=2, progress_interval=60.0)
+    return migration.run()
+
+
+def test_migration_copies_sessions_and_verifies():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        _legacy_source(root)
+        target = SQLiteStorage(root / "target.db")
+        try:
+            report = _migrate(root, target)
+            assert report["verified"], report
+            assert report["messages_copied"] == 8
+            sessions = {s["session_id"]: s for s in target.list_sessions(1, "companion")}
+            assert set(sessions) == {"a", "b"} and sessions["a"]["title"] == "a"
+            assert [m["content"] for m in target.load_messages("a", 1, "companion")] == \
+                [m["content"] for m in make_messages(5)]
+            state = json.loads((root / "migration_state.json").read_text(encoding="utf-8"))
+            assert all(entry["verified"] for entry in state["sessions"].values())
+        finally:
+            target.close()
+
+
+def test_rerun_appends_only_new_messages_and_skips_unchanged_sessions():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        source = _legacy_source(root)
+        target = SQLiteStorage(root / "target.db")
+        try:
+            _migrate(root, target)
+            # The live service keeps writing to the legacy files between the two passes
+            source.append_messages("a", 1, "companion", make_messages(3, start=5))
+
+            report = _migrate(root, target)
+            assert report["verified"], report
+            assert report["messages_copied"] == 3
+            assert report["sessions_skipped"] == 1
+            assert [m["id"] for m in target.load_messages("a", 1, "companion")] == list(range(1, 9))
+            assert target.count_messages("b", 1, "companion") == 3
+
+            report = _migrate(root, target)
+            assert report["messages_copied"] == 0 and report["sessions_skipped"] == 2
+        finally:
+            target.close()
+
+
+def test_changed_history_is_reported_as_mismatch():
+    """Rewriting already-migrated messages in the source is caught by the checksum, not silently ignored"""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        source = _legacy_source(root)
+        target = SQLiteStorage(root / "target.db")
+        try:
+            _migrate(root, target)
+            path = source.chat_file_path("b", 1, "companion")
+            data = json.loads(path.read_text(encoding="utf-8"))
+            data["messages"][0]["content"] = "edited"
+            path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+            report = _migrate(root, target)
+            assert not report["verified"]
+            assert [m["session"] for m in report["mismatches"]] == ["1:companion:b"]
+        finally:
+            target.close()
+
+
+if __name__ == "__main__":
+    test_migration_copies_sessions_and_verifies()
+    test_rerun_appends_only_new_messages_and_skips_unchanged_sessions()
+    test_changed_history_is_reported_as_mismatch()
+    print("✅ chat history migration tests passed")
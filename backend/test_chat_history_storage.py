@@ -0,0 +1,111 @@
+"""
+Round-trip tests for the chat history storage backends
+Run with: python -m pytest test_chat_history_storage.py  (or python test_chat_history_storage.py)
+"""
+
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from chat_history_storage import create_storage, JSONLFileStorage, SQLiteStorage
+from chat_history_test_utils import make_messages, make_session
+
+BACKENDS = ("json", "jsonl", "sqlite")
+
+
+def test_round_trip_all_backends():
+    """Sessions and messages written through each backend read back identically, including paging and delete"""
+    for backend in BACKENDS:
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = create_storage(backend, Path(tmp))
+            try:
+                storage.insert_session(make_session("a"))
+                storage.insert_session(make_session("b", updated_at="2024-01-02T00:00:00"))
+                assert [s["session_id"] for s in storage.list_sessions(1, "companion")] == ["b", "a"], backend
+                assert storage.list_session_groups() == [(1, "companion")], backend
+
+                saved = storage.append_messages("a", 1, "companion", make_messages(3))
+                saved += storage.append_messages("a", 1, "companion", make_messages(2, start=3))
+                assert [m["id"] for m in saved] == [1, 2, 3, 4, 5], backend
+
+                loaded = storage.load_messages("a", 1, "companion")
+                assert [(m["id"], m["content"]) for m in loaded] == [(m["id"], m["content"]) for m in saved], backend
+                assert storage.count_messages("a", 1, "companion") == 5, backend
+                assert [m["id"] for m in storage.load_recent_messages("a", 1, "companion", 2)] == [4, 5], backend
+                assert [m["id"] for m in storage.load_messages_before("a", 1, "companion", 4, 2)] == [2, 3], backend
+                assert [m["id"] for m in storage.load_messages_after("a", 1, "companion", 2, 2)] == [3, 4], backend
+                assert [m["id"] for m in storage.iter_messages("a", 1, "companion", chunk_size=2)] == [1, 2, 3, 4, 5], backend
+
+                storage.touch_sessions(["a"], 1, "companion", "2024-01-03T00:00:00")
+                assert storage.list_sessions(1, "companion")[0]["session_id"] == "a", backend
+
+                assert storage.delete_session("a", 1, "companion"), backend
+                assert storage.load_messages("a", 1, "companion") == [], backend
+                assert [s["session_id"] for s in storage.list_sessions(1, "companion")] == ["b"], backend
+            finally:
+                storage.close()
+
+
+def test_sqlite_rejects_duplicate_message_ids():
+    """Two writers claiming the same message id must not both commit"""
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(Path(tmp) / "chat_history.db")
+        try:
+            storage.insert_session(make_session("a"))
+            storage.append_messages("a", 1, "companion", make_messages(2))
+            try:
+                storage.append_messages("a", 1, "companion", make_messages(1), first_id=2)
+            except sqlite3.IntegrityError:
+                pass
+            else:
+                raise AssertionError("duplicate message id was accepted")
+            assert [m["id"] for m in storage.load_messages("a", 1, "companion")] == [1, 2]
+        finally:
+            storage.close()
+
+
+def test_jsonl_repairs_torn_tail_and_resumes_ids():
+    """A half-written last line is dropped on the next append and ids continue from the last complete line"""
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = JSONLFileStorage(Path(tmp))
+        storage.insert_session(make_session("a"))
+        storage.append_messages("a", 1, "companion", make_messages(3))
+        storage.close()
+
+        transcript = storage.transcript_path("a", 1, "companion")
+        with open(transcript, "ab") as f:
+            f.write(b'{"id": 4, "role": "user", "cont')
+
+        # The header is only written when the transcript is created, so a fresh instance must rely on the tail
+        reopened = JSONLFileStorage(Path(tmp))
+        try:
+            assert [m["id"] for m in reopened.load_messages("a", 1, "companion")] == [1, 2, 3]
+            saved = reopened.append_messages("a", 1, "companion", make_messages(1, start=3))
+            assert [m["id"] for m in saved] == [4]
+            assert [m["id"] for m in reopened.load_messages("a", 1, "companion")] == [1, 2, 3, 4]
+            assert transcript.read_bytes().endswith(b"\n")
+        finally:
+            reopened.close()
+
+
+def test_jsonl_next_id_cache_is_bounded():
+    """Evicted sessions re-read their next id from disk instead of restarting at 1"""
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = JSONLFileStorage(Path(tmp), max_cached_ids=2)
+        try:
+            for session_id in ("a", "b", "c"):
+                storage.insert_session(make_session(session_id))
+                storage.append_messages(session_id, 1, "companion", make_messages(2))
+            assert len(storage._next_ids) <= 2
+            saved = storage.append_messages("a", 1, "companion", make_messages(1, start=2))
+            assert [m["id"] for m in saved] == [3]
+        finally:
+            storage.close()
+
+
+if __name__ == "__main__":
+    test_round_trip_all_backends()
+    test_sqlite_rejects_duplicate_message_ids()
+    test_jsonl_repairs_torn_tail_and_resumes_ids()
+    test_jsonl_next_id_cache_is_bounded()
+    print("✅ chat history storage tests passed")
@@ -0,0 +1,121 @@
+"""
+Tests for the write-behind chat history buffer
+Run with: python -m pytest test_chat_history_write_behind.py  (or python test_chat_history_write_behind.py)
+"""
+
+import tempfile
+from pathlib import Path
+
+from chat_history_storage import SQLiteStorage
+from chat_history_test_utils import make_messages, make_session
+from chat_history_write_behind import WriteBehindFullError, WriteBehindStorage
+
+
+class FlakyStorage(SQLiteStorage):
+    """SQLite backend whose appends fail for the listed sessions until they are cleared"""
+
+    def __init__(self, db_path: Path):
+        super().__init__(db_path)
+        self.failing = set()
+
+    def append_messages(self, session_id, user_id, agent_type, messages, first_id=None):
+        if session_id in self.failing:
+            raise OSError(f"disk unavailable for {session_id}")
+        return super().append_messages(session_id, user_id, agent_type, messages, first_id)
+
+
+def _buffer(tmp, **kwargs):
+    inner = FlakyStorage(Path(tmp) / "chat_history.db")
+    # Long interval and large batch so only explicit flush() calls write
+    storage = WriteBehindStorage(inner, max_batch=10_000, flush_interval=60.0, **kwargs)
+    for session_id in ("a", "b"):
+        storage.insert_session(make_session(session_id))
+    return storage, inner
+
+
+def test_flush_writes_queued_messages_and_reads_own_writes():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage, inner = _buffer(tmp)
+        try:
+            saved = storage.append_messages("a", 1, "companion", make_messages(3))
+            saved += storage.append_messages("a", 1, "companion", make_messages(2, start=3))
+            assert [m["id"] for m in saved] == [1, 2, 3, 4, 5]
+            assert inner.load_messages("a", 1, "companion") == []
+            assert [m["id"] for m in storage.load_messages("a", 1, "companion")] == [1, 2, 3, 4, 5]
+
+            assert storage.flush() == 5
+            assert [m["id"] for m in inner.load_messages("a", 1, "companion")] == [1, 2, 3, 4, 5]
+            stats = storage.get_stats()
+            assert stats["queue_depth"] == 0 and stats["cached_next_ids"] == 0
+
+            # The next id is re-read from the backend once the queue has drained
+            assert [m["id"] for m in storage.append_messages("a", 1, "companion", make_messages(1))] == [6]
+        finally:
+            storage.close()
+
+
+def test_failed_flush_retries_without_duplicates():
+    """Sessions committed before a failure are not appended again when the rest is retried"""
+    with tempfile.TemporaryDirectory() as tmp:
+        storage, inner = _buffer(tmp)
+        try:
+            storage.append_messages("a", 1, "companion", make_messages(2))
+            storage.append_messages("b", 1, "companion", make_messages(2))
+            inner.failing.add("b")
+
+            assert storage.flush() == 2
+            assert storage.get_stats()["last_error"]
+            assert [m["id"] for m in inner.load_messages("a", 1, "companion")] == [1, 2]
+            assert inner.load_messages("b", 1, "companion") == []
+            assert [m["id"] for m in storage.load_messages("b", 1, "companion")] == [1, 2]
+
+            inner.failing.clear()
+            assert storage.flush() == 2
+            assert storage.get_stats()["last_error"] is None
+            assert [m["id"] for m in inner.load_messages("a", 1, "companion")] == [1, 2]
+            assert [m["id"] for m in inner.load_messages("b", 1, "companion")] == [1, 2]
+        finally:
+            storage.close()
+
+
+def test_deleted_session_is_not_written_back():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage, inner = _buffer(tmp)
+        try:
+            storage.append_messages("a", 1, "companion", make_messages(2))
+            assert storage.delete_session("a", 1, "companion")
+            assert storage.flush() == 0
+            assert inner.load_messages("a", 1, "companion") == []
+            assert storage.get_stats()["queue_depth"] == 0
+        finally:
+            storage.close()
+
+
+def test_full_queue_rejects_after_timeout():
+    """With the backend failing, appends stop queueing once max_pending is reached"""
+    with tempfile.TemporaryDirectory() as tmp:
+        storage, inner = _buffer(tmp, max_pending=3, full_timeout=0.05)
+        inner.failing.add("a")
+        try:
+            storage.append_messages("a", 1, "companion", make_messages(3))
+            try:
+                storage.append_messages("a", 1, "companion", make_messages(1))
+            except WriteBehindFullError:
+                pass
+            else:
+                raise AssertionError("append beyond max_pending was queued")
+            assert storage.get_stats()["rejected_full"] == 1
+
+            inner.failing.clear()
+            storage.flush()
+            assert [m["id"] for m in storage.append_messages("a", 1, "companion", make_messages(1))] == [4]
+        finally:
+            storage.close()
+
+
+if __name__ == "__main__":
+    test_flush_writes_queued_messages_and_reads_own_writes()
+    test_failed_flush_retries_without_duplicates()
+    test_deleted_session_is_not_written_back()
+    test_full_queue_rejects_after_timeout()
+    print("✅ chat history write-behind tests passed")
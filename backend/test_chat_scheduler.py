@@ -0,0 +1,86 @@
+"""
+Regression tests for the priority chat scheduler
+Run with: python -m pytest test_chat_scheduler.py  (or python test_chat_scheduler.py)
+"""
+
+import asyncio
+
+from chat_scheduler import PriorityChatScheduler, LANE_CRISIS, LANE_ROUTINE
+
+
+def test_cancel_during_grant_does_not_leak_slot():
+    """A queued waiter cancelled in the same tick its slot is granted must not keep the slot"""
+
+    async def scenario():
+        scheduler = PriorityChatScheduler(max_concurrency=1, reserved_crisis=0)
+        waiter_queued = asyncio.Event()
+        tasks = {}
+
+        async def holder():
+            async with scheduler.slot(LANE_ROUTINE):
+                await waiter_queued.wait()
+                # Client disconnects as the holder finishes: cancel and release in the same tick
+                tasks["waiter"].cancel()
+
+        async def waiter():
+            async with scheduler.slot(LANE_ROUTINE):
+                pass
+
+        holder_task = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        tasks["waiter"] = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()["lanes"][LANE_ROUTINE]["waiting"] == 1
+        waiter_queued.set()
+
+        await holder_task
+        try:
+            await tasks["waiter"]
+        except asyncio.CancelledError:
+            pass
+
+        stats = scheduler.get_stats()
+        assert stats["active"] == 0
+        assert stats["lanes"][LANE_ROUTINE]["waiting"] == 0
+
+        # The slot is still usable afterwards
+        async with scheduler.slot(LANE_ROUTINE):
+            assert scheduler.get_stats()["active"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_aged_routine_never_overtakes_crisis():
+    """However long a routine turn has waited, a fresh crisis turn is admitted first"""
+
+    async def scenario():
+        scheduler = PriorityChatScheduler(max_concurrency=1, reserved_crisis=0, aging_seconds=0.01)
+        order = []
+        release_holder = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(LANE_ROUTINE):
+                await release_holder.wait()
+
+        async def run(lane):
+            async with scheduler.slot(lane):
+                order.append(lane)
+
+        holder_task = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        routine_task = asyncio.create_task(run(LANE_ROUTINE))
+        await asyncio.sleep(0.1)  # routine waits 10x aging_seconds
+        crisis_task = asyncio.create_task(run(LANE_CRISIS))
+        await asyncio.sleep(0)
+
+        release_holder.set()
+        await asyncio.gather(holder_task, routine_task, crisis_task)
+        assert order == [LANE_CRISIS, LANE_ROUTINE]
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_cancel_during_grant_does_not_leak_slot()
+    test_aged_routine_never_overtakes_crisis()
+    print("✅ chat scheduler tests passed")
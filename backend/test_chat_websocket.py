@@ -0,0 +1,64 @@
+"""
+Smoke test for the multiplexed chat WebSocket
+The model turn is replaced by a canned one, so this exercises the transport only (auth, framing, session cache).
+Importing the server builds the model clients, so it needs the same configuration as running the server.
+Run with: python -m pytest test_chat_websocket.py  (or python test_chat_websocket.py)
+"""
+
+import pytest
+
+try:
+    import mental_health_server as server
+    from fastapi.testclient import TestClient
+except Exception as e:  # missing dependencies or model credentials
+    pytest.skip(f"chat server cannot be imported here: {e}", allow_module_level=True)
+
+
+def test_websocket_streams_one_turn():
+    calls = []
+
+    async def fake_stream_turn(user_id, session_id, message, agent_type, validate_session=True):
+        calls.append((user_id, session_id, agent_type, validate_session))
+
+        async def events():
+            yield server.chat_event("ack", session_id=session_id, lane="routine")
+            yield server.chat_event("content", content=f"echo: {message}")
+
+        return events()
+
+    original = server.start_stream_turn
+    server.start_stream_turn = fake_stream_turn
+    try:
+        token, _ = server.token_signer.issue(4242)
+        with TestClient(server.app) as client:
+            with client.websocket_connect(f"/api/v1/chat/ws?token={token}") as websocket:
+                for message_id in ("m1", "m2"):
+                    websocket.send_json({"type": "message", "message_id": message_id, "session_id": "ws-smoke",
+                                         "message": "hello", "agent_type": "mental_health"})
+                    frames = [websocket.receive_json() for _ in range(3)]
+                    assert [frame["type"] for frame in frames] == ["ack", "content", "end"]
+                    assert all(frame["message_id"] == message_id for frame in frames)
+                    assert frames[1]["content"] == "echo: hello"
+
+                websocket.send_json({"type": "ping"})
+                assert websocket.receive_json()["type"] == "pong"
+    finally:
+        server.start_stream_turn = original
+
+    # The session is validated on the first turn only
+    assert calls == [(4242, "ws-smoke", "mental_health", True), (4242, "ws-smoke", "mental_health", False)]
+
+
+def test_websocket_rejects_invalid_token():
+    from starlette.websockets import WebSocketDisconnect
+
+    with TestClient(server.app) as client:
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect("/api/v1/chat/ws?token=v1.42.9999999999.bad") as websocket:
+                websocket.receive_json()
+
+
+if __name__ == "__main__":
+    test_websocket_streams_one_turn()
+    test_websocket_rejects_invalid_token()
+    print("✅ chat websocket tests passed")
@@ -0,0 +1,111 @@
+"""
+Tests for the document parser process pool: real parses, timeouts, restarts and resubmission
+Run with: python -m pytest test_document_parsing.py  (or python test_document_parsing.py)
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from document_parsing import DocumentParserPool, ParseTimeoutError
+
+
+# Worker tasks must be importable by the spawned pool processes
+
+def sleep_then_return(seconds: float, value: str) -> str:
+    time.sleep(seconds)
+    return value
+
+
+def crash_worker() -> None:
+    os._exit(1)
+
+
+def test_parses_docx_and_xlsx_in_workers():
+    from docx import Document
+    import openpyxl
+
+    pool = DocumentParserPool(max_workers=1, timeout_seconds=60)
+    with tempfile.TemporaryDirectory() as tmp:
+        docx_path = os.path.join(tmp, "notes.docx")
+        document = Document()
+        document.add_paragraph("第一段")
+        document.add_paragraph("second paragraph")
+        document.save(docx_path)
+
+        xlsx_path = os.path.join(tmp, "sheet.xlsx")
+        workbook = openpyxl.Workbook()
+        workbook.active.title = "Mood"
+        workbook.active.append(["day", "score"])
+        workbook.active.append(["mon", 3])
+        workbook.save(xlsx_path)
+
+        async def scenario():
+            return await pool.extract_docx(docx_path), await pool.extract_xlsx(xlsx_path)
+
+        try:
+            docx_text, xlsx_text = asyncio.run(scenario())
+        finally:
+            pool.close()
+    assert docx_text == "第一段\nsecond paragraph\n"
+    assert xlsx_text == "Sheet: Mood\nday\tscore\nmon\t3\n\n"
+    assert pool.get_stats()["files"] == 2
+
+
+def test_timeout_restarts_pool_and_resubmits_other_files():
+    """A timed-out file kills the pool; another file's task broken by that restart is retried, not failed"""
+    pool = DocumentParserPool(max_workers=2, timeout_seconds=1.0)
+
+    async def slow_file():
+        await pool._call(time.monotonic() + pool.timeout_seconds, "slow.pdf", sleep_then_return, 30, "never")
+
+    async def other_file():
+        # Submitted while the slow parse runs, still running when the slow one times out
+        await asyncio.sleep(0.5)
+        return await pool._call(time.monotonic() + 10, "other.pdf", sleep_then_return, 1.0, "other")
+
+    async def scenario():
+        results = await asyncio.gather(slow_file(), other_file(), return_exceptions=True)
+        after = await pool._call(time.monotonic() + 10, "next.pdf", sleep_then_return, 0, "next")
+        return results, after
+
+    try:
+        (slow, other), after = asyncio.run(scenario())
+    finally:
+        pool.close()
+    assert isinstance(slow, ParseTimeoutError), slow
+    assert other == "other"
+    assert after == "next"
+    stats = pool.get_stats()
+    assert stats["timeouts"] == 1
+    assert stats["pool_restarts"] == 1
+    assert stats["resubmitted_tasks"] >= 1
+
+
+def test_crashed_worker_fails_the_file_and_recovers():
+    pool = DocumentParserPool(max_workers=1, timeout_seconds=30)
+
+    async def scenario():
+        try:
+            await pool._call(time.monotonic() + 30, "bad.docx", crash_worker)
+        except RuntimeError as e:
+            error = e
+        else:
+            error = None
+        return error, await pool._call(time.monotonic() + 30, "good.docx", sleep_then_return, 0, "ok")
+
+    try:
+        error, after = asyncio.run(scenario())
+    finally:
+        pool.close()
+    assert error is not None and "crashed" in str(error)
+    assert after == "ok"
+    assert pool.get_stats()["failures"] == 1
+
+
+if __name__ == "__main__":
+    test_parses_docx_and_xlsx_in_workers()
+    test_timeout_restarts_pool_and_resubmits_other_files()
+    test_crashed_worker_fails_the_file_and_recovers()
+    print("✅ document parsing tests passed")
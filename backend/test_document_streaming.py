@@ -0,0 +1,153 @@
+"""
+Equivalence tests for the page-wise streaming ingestion helpers
+The streaming cleaners, classifier and chunker must give exactly what the whole-text functions gave
+on the extracted document. _split_text is now built on iter_fixed_chunks, so the reference
+implementations below are the whole-text versions as they were before streaming was added.
+Run with: python -m pytest test_document_streaming.py  (or python test_document_streaming.py)
+"""
+
+import random
+import re
+from typing import List, Tuple
+
+import jieba
+
+from document_streaming import (
+    PageSpool, StreamingClassifier, iter_clean_segments, iter_fixed_chunks, iter_structured_segments
+)
+
+CASES = 400
+
+CATEGORIES = {
+    "Anxiety": ["anxiety", "焦慮", "panic attack"],
+    "Sleep": ["insomnia", "失眠"],
+    "User Custom": ["mind fulness"],
+}
+
+
+# ---------- whole-text reference implementations ----------
+
+def reference_clean_text(text: str) -> str:
+    text = ' '.join(text.split())
+    text = re.sub(r'[^\u4e00-\u9fff\w\s.,!?;:()【】""''、。！？；：（）]', '', text)
+    return text.strip()
+
+
+def reference_clean_text_preserve_structure(raw: str) -> str:
+    raw = raw.replace('\r\n', '\n').replace('\r', '\n')
+    lines = [' '.join(line.strip().split()) for line in raw.split('\n')]
+    normalized = []
+    empty_run = 0
+    for line in lines:
+        if line == '':
+            empty_run += 1
+            if empty_run <= 2:
+                normalized.append('')
+        else:
+            empty_run = 0
+            normalized.append(line)
+    return '\n'.join(normalized).strip()
+
+
+def reference_classify(text: str) -> List[str]:
+    text_lower = text.lower()
+    categories = [category for category, keywords in CATEGORIES.items()
+                  if any(keyword.lower() in text_lower for keyword in keywords)]
+    return sorted(categories) if categories else ["General Mental Health"]
+
+
+def reference_split_text(text: str, chunk_size: int, overlap: int, mode: str) -> List[Tuple[str, int, int, int]]:
+    units = list(jieba.cut(text)) if mode == 'words' else list(text)
+    chunks = []
+    current_chunk: List[str] = []
+    current_measure = 0
+    for i, unit in enumerate(units):
+        current_chunk.append(unit)
+        current_measure += 1 if mode == 'words' else len(unit)
+        if current_measure >= chunk_size:
+            chunks.append((''.join(current_chunk), i - len(current_chunk) + 1, i, len(current_chunk)))
+            if overlap > 0:
+                current_chunk = current_chunk[-overlap:] if len(current_chunk) > overlap else current_chunk
+            else:
+                current_chunk = []
+            current_measure = len(current_chunk) if mode == 'words' else sum(len(u) for u in current_chunk)
+    if current_chunk:
+        chunks.append((''.join(current_chunk), len(units) - len(current_chunk), len(units) - 1, len(current_chunk)))
+    return chunks
+
+
+# ---------- random documents ----------
+
+FRAGMENTS = ["I feel", "anxiety", "焦慮", "失眠", "panic", " attack", "mind", " fulness", "今天心情不好", "，", "。",
+             "!", "?", "@#$", "€", "【註】", "(ok)", "\t", "  ", "\r\n", "\r", "\n", "\n\n\n\n", "　", "x" * 40]
+
+
+def random_pages(rng: random.Random) -> List[str]:
+    pages = []
+    for _ in range(rng.randint(0, 8)):
+        kind = rng.random()
+        if kind < 0.15:
+            pages.append("")
+        elif kind < 0.25:
+            pages.append(rng.choice([" ", "\n", " \r\n\t "]))
+        else:
+            pages.append("".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 30))))
+    return pages
+
+
+def joined(pages: List[str]) -> str:
+    # The layout DocumentParserPool.extract_pdf builds
+    return "".join(page + "\n" for page in pages)
+
+
+# ---------- tests ----------
+
+def test_clean_segments_match_whole_text_cleaning():
+    rng = random.Random(20240501)
+    for _ in range(CASES):
+        pages = random_pages(rng)
+        assert "".join(iter_clean_segments(pages)) == reference_clean_text(joined(pages)), pages
+        assert "".join(iter_structured_segments(pages)) == reference_clean_text_preserve_structure(joined(pages)), pages
+
+
+def test_streaming_classifier_matches_whole_text():
+    rng = random.Random(20240502)
+    for _ in range(CASES):
+        pages = random_pages(rng)
+        classifier = StreamingClassifier(CATEGORIES)
+        for segment in iter_clean_segments(pages):
+            classifier.feed(segment)
+        assert sorted(classifier.categories()) == reference_classify(reference_clean_text(joined(pages))), pages
+
+
+def test_fixed_chunks_match_whole_text_split():
+    rng = random.Random(20240503)
+    for case in range(CASES):
+        pages = random_pages(rng)
+        mode = "words" if case % 2 else "chars"
+        chunk_size = rng.randint(1, 60)
+        overlap = rng.randint(0, chunk_size)
+        expected = reference_split_text(reference_clean_text(joined(pages)), chunk_size, overlap, mode)
+        actual = list(iter_fixed_chunks(iter_clean_segments(pages), chunk_size=chunk_size, overlap=overlap, mode=mode))
+        assert actual == expected, (pages, mode, chunk_size, overlap)
+
+
+def test_page_spool_can_be_read_twice():
+    pages = ["first page", "", "第三頁\n換行", "\"quoted\" \\ text"]
+    spool = PageSpool()
+    try:
+        for page in pages:
+            spool.append(page)
+        assert list(spool) == pages
+        assert list(spool) == pages
+        assert (spool.pages, spool.chars) == (4, sum(len(page) for page in pages))
+    finally:
+        spool.close()
+
+
+if __name__ == "__main__":
+    test_clean_segments_match_whole_text_cleaning()
+    test_streaming_classifier_matches_whole_text()
+    test_fixed_chunks_match_whole_text_split()
+    test_page_spool_can_be_read_twice()
+    print("✅ document streaming tests passed")
@@ -0,0 +1,147 @@
+"""
+Tests for the document ingestion job queue, driven by a stub pipeline
+Run with: python -m pytest test_rag_ingestion_jobs.py  (or python test_rag_ingestion_jobs.py)
+"""
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+from rag_ingestion_jobs import (
+    IngestionJobQueue, JobStateError, QueueFullError,
+    JOB_CANCELLED, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED
+)
+
+
+class StubPipeline:
+    """Reports the usual stages; a job's params choose whether it blocks (`hold`) or fails (`fail_attempts`)"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    async def __call__(self, job):
+        job.report("extracting")
+        if job.params.get("hold"):
+            self.started.set()
+            self.release.wait(timeout=10)
+        if job.attempts <= job.params.get("fail_attempts", 0):
+            raise RuntimeError(f"parse error on attempt {job.attempts}")
+        job.report("indexing")
+        return {"success": True, "chunk_count": 3}
+
+
+def _queue(staging_dir, **kwargs):
+    pipeline = StubPipeline()
+    return IngestionJobQueue(pipeline, staging_dir=staging_dir, **kwargs), pipeline
+
+
+def _wait_for(job, status, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while job.status != status and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.status == status, (job.status, job.error)
+
+
+def test_job_runs_to_completion():
+    with tempfile.TemporaryDirectory() as tmp:
+        queue, _ = _queue(tmp)
+        try:
+            job = queue.submit(b"hello", "notes.txt", {})
+            assert os.path.exists(job.file_path)
+            job = asyncio.run(queue.wait(job.id, timeout=5))
+            assert job.status == JOB_SUCCEEDED and job.result["chunk_count"] == 3
+            assert [stage["stage"] for stage in job.to_dict()["stages"]] == ["extracting", "indexing"]
+            assert job.to_dict()["progress"] == 1.0
+            # Nothing left to retry, so the staged upload is gone
+            assert not os.path.exists(job.file_path)
+            assert queue.get_stats()["finished"][JOB_SUCCEEDED] == 1
+        finally:
+            queue.close()
+
+
+def test_cancel_queued_and_running_jobs():
+    with tempfile.TemporaryDirectory() as tmp:
+        queue, pipeline = _queue(tmp, concurrency=1)
+        try:
+            running = queue.submit(b"a", "a.txt", {"hold": True})
+            assert pipeline.started.wait(5)
+            waiting = queue.submit(b"b", "b.txt", {})
+            assert waiting.status == JOB_QUEUED
+
+            # A queued job is cancelled at once and never reaches the pipeline
+            queue.cancel(waiting.id)
+            assert waiting.status == JOB_CANCELLED and waiting.attempts == 0
+            assert queue.get_stats()["queued"] == 0
+
+            # A running job stops at its next stage boundary
+            assert running.status == JOB_RUNNING
+            queue.cancel(running.id)
+            pipeline.release.set()
+            _wait_for(running, JOB_CANCELLED)
+            assert running.stage == "extracting"
+
+            try:
+                queue.cancel(running.id)
+            except JobStateError:
+                pass
+            else:
+                raise AssertionError("a finished job was cancelled again")
+        finally:
+            queue.close()
+
+
+def test_retry_after_failure():
+    with tempfile.TemporaryDirectory() as tmp:
+        queue, _ = _queue(tmp)
+        try:
+            job = queue.submit(b"data", "report.pdf", {"fail_attempts": 1})
+            _wait_for(job, JOB_FAILED)
+            assert "RuntimeError" in job.error
+            # The staged upload is kept so the job can be retried
+            assert os.path.exists(job.file_path)
+
+            queue.retry(job.id)
+            _wait_for(job, JOB_SUCCEEDED)
+            assert job.attempts == 2 and job.error is None
+
+            try:
+                queue.retry(job.id)
+            except JobStateError:
+                pass
+            else:
+                raise AssertionError("a succeeded job was retried")
+        finally:
+            queue.close()
+
+
+def test_queue_full_rejects_submissions():
+    with tempfile.TemporaryDirectory() as tmp:
+        queue, pipeline = _queue(tmp, max_queue=2, concurrency=1)
+        try:
+            queue.submit(b"a", "a.txt", {"hold": True})
+            assert pipeline.started.wait(5)
+            queue.submit(b"b", "b.txt", {})
+            queue.submit(b"c", "c.txt", {})
+            try:
+                queue.submit(b"d", "d.txt", {})
+            except QueueFullError:
+                pass
+            else:
+                raise AssertionError("submission beyond max_queue was accepted")
+            # The rejected upload is not left in the staging dir
+            assert sorted(name.split("_", 1)[1] for name in os.listdir(tmp)) == ["a.txt", "b.txt", "c.txt"]
+            assert queue.get_stats()["queued"] == 2
+        finally:
+            pipeline.release.set()
+            queue.close()
+
+
+if __name__ == "__main__":
+    test_job_runs_to_completion()
+    test_cancel_queued_and_running_jobs()
+    test_retry_after_failure()
+    test_queue_full_rejects_submissions()
+    print("✅ RAG ingestion job tests passed")
@@ -0,0 +1,105 @@
+"""
+Tests for the token-bucket rate limiter
+Run with: python -m pytest test_rate_limiter.py  (or python test_rate_limiter.py)
+"""
+
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from rate_limiter import MemoryBucketStore, RateLimiter, RateLimitPolicy, SQLiteBucketStore
+
+
+def _stores(tmp):
+    return [MemoryBucketStore(), SQLiteBucketStore(str(Path(tmp) / "rate_limits.db"))]
+
+
+def test_bucket_refills_over_time():
+    with tempfile.TemporaryDirectory() as tmp:
+        for store in _stores(tmp):
+            # 2 tokens per 0.2s: an empty bucket regains one token every 0.1s
+            policy = RateLimitPolicy(2, 0.2)
+            assert store.take("k", policy)[0]
+            assert store.take("k", policy)[0]
+            allowed, left = store.take("k", policy)
+            assert not allowed and left < 1, store
+            time.sleep(0.15)
+            assert store.take("k", policy)[0], store
+            time.sleep(0.5)
+            # Refill stops at capacity
+            assert store.take("k", policy, cost=2)[0], store
+            assert not store.take("k", policy)[0], store
+
+
+def test_cost_is_charged_in_full_or_not_at_all():
+    with tempfile.TemporaryDirectory() as tmp:
+        for store in _stores(tmp):
+            policy = RateLimitPolicy(10, 3600)
+            assert store.take("k", policy, cost=7) == (True, 3), store
+            allowed, left = store.take("k", policy, cost=4)
+            assert not allowed and round(left, 3) == 3, store
+            assert store.take("k", policy, cost=3)[0], store
+
+
+def test_rejected_scope_does_not_charge_the_other():
+    """A request refused by the user bucket leaves the IP bucket untouched"""
+    limiter = RateLimiter({"POST /chat": {"user": RateLimitPolicy(1, 3600), "ip": RateLimitPolicy(5, 3600)}})
+    assert limiter.check("POST /chat", user_id=1, ip="10.0.0.1").allowed
+    for _ in range(3):
+        result = limiter.check("POST /chat", user_id=1, ip="10.0.0.1")
+        assert not result.allowed and result.scope == "user"
+    # IP bucket spent only the one allowed request
+    for user_id in (2, 3, 4, 5):
+        assert limiter.check("POST /chat", user_id=user_id, ip="10.0.0.1").allowed
+    result = limiter.check("POST /chat", user_id=6, ip="10.0.0.1")
+    assert not result.allowed and result.scope == "ip"
+
+
+def test_templates_share_buckets_and_unlisted_routes_pass():
+    limiter = RateLimiter({"POST /jobs/{job_id}/retry": {"user": RateLimitPolicy(2, 3600)}})
+    assert limiter.check("POST /jobs/a/retry", user_id=1).allowed
+    assert limiter.check("POST /jobs/b/retry", user_id=1).allowed
+    assert not limiter.check("POST /jobs/c/retry", user_id=1).allowed
+    assert limiter.check("POST /jobs/a/b/retry", user_id=1) is None
+    assert limiter.check("GET /health", user_id=1) is None
+    stats = limiter.get_stats()["routes"]["POST /jobs/{job_id}/retry"]
+    assert (stats["allowed"], stats["limited"]) == (2, 1)
+
+
+def test_rejection_headers():
+    limiter = RateLimiter({"POST /chat": {"user": RateLimitPolicy(2, 60)}})
+    first = limiter.check("POST /chat", user_id=1)
+    assert first.headers()["RateLimit-Limit"] == "2"
+    assert first.headers()["RateLimit-Remaining"] == "1"
+    assert "Retry-After" not in first.headers()
+    limiter.check("POST /chat", user_id=1)
+    rejected = limiter.check("POST /chat", user_id=1, cost=2)
+    headers = rejected.headers()
+    assert not rejected.allowed
+    assert headers["RateLimit-Remaining"] == "0"
+    # Two tokens at 2 per 60s take a full minute to come back
+    assert 59 <= int(headers["Retry-After"]) <= 60
+
+
+def test_check_async_with_blocking_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteBucketStore(str(Path(tmp) / "rate_limits.db"))
+        limiter = RateLimiter({"POST /chat": {"user": RateLimitPolicy(1, 3600)}}, store=store)
+
+        async def scenario():
+            first = await limiter.check_async("POST /chat", user_id=1)
+            second = await limiter.check_async("POST /chat", user_id=1)
+            return first.allowed, second.allowed
+
+        assert asyncio.run(scenario()) == (True, False)
+
+
+if __name__ == "__main__":
+    test_bucket_refills_over_time()
+    test_cost_is_charged_in_full_or_not_at_all()
+    test_rejected_scope_does_not_charge_the_other()
+    test_templates_share_buckets_and_unlisted_routes_pass()
+    test_rejection_headers()
+    test_check_async_with_blocking_store()
+    print("✅ rate limiter tests passed")
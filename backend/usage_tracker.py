@@ -0,0 +1,237 @@
+"""
+Token and cost accounting for chat turns
+Tracks prompt/completion tokens per session and per user (with daily rollups)
+and enforces soft/hard daily token budgets. Each turn is persisted as a small
+upsert of its deltas into SQLite (shared by all workers), so recording a turn
+costs the same however many users and sessions are stored.
+"""
+
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Optional
+
+# Budget states returned by UsageTracker.check_budget
+BUDGET_OK = "ok"
+BUDGET_SOFT = "soft"
+BUDGET_HARD = "hard"
+
+# USD per 1K tokens: (prompt, completion)
+DEFAULT_MODEL_PRICING = {
+    "claude-sonnet-4-20250514": (0.003, 0.015),
+    "claude-3-5-haiku-20241022": (0.0008, 0.004),
+}
+
+
+# Per-session entries not updated for this many days are removed (None keeps them forever)
+SESSION_USAGE_RETENTION_DAYS: Optional[int] = 90
+# Daily rollups older than this are removed (the usage API serves at most 366 days)
+DAILY_USAGE_RETENTION_DAYS = 400
+# How often record_turn prunes expired entries
+USAGE_PRUNE_INTERVAL_SECONDS = 3600
+
+TOTAL_COLUMNS = ("prompt_tokens", "completion_tokens", "total_tokens", "model_calls", "turns", "cost")
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "model_calls": 0, "turns": 0, "cost": 0.0}
+
+
+def _totals(row) -> Dict[str, Any]:
+    totals = {column: row[column] for column in TOTAL_COLUMNS}
+    totals["cost"] = round(totals["cost"], 6)
+    return totals
+
+
+def _totals_upsert(table: str, keys: tuple) -> str:
+    """INSERT ... ON CONFLICT that adds one turn's deltas to an existing totals row"""
+    columns = keys + TOTAL_COLUMNS
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET "
+        + ", ".join(f"{column} = {column} + excluded.{column}" for column in TOTAL_COLUMNS)
+    )
+
+
+def sum_models_usage(messages: Iterable[Any]) -> Dict[str, int]:
+    """Sum `models_usage` over agent messages (tool calls and reflection included)"""
+    prompt_tokens = completion_tokens = model_calls = 0
+    for message in messages:
+        usage = getattr(message, "models_usage", None)
+        if usage is None:
+            continue
+        prompt_tokens += usage.prompt_tokens or 0
+        completion_tokens += usage.completion_tokens or 0
+        model_calls += 1
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "model_calls": model_calls}
+
+
+class UsageTracker:
+    """Per-session / per-user token accounting in SQLite, one connection per thread"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS usage_users (
+            user_id INTEGER PRIMARY KEY,
+            prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, total_tokens INTEGER NOT NULL,
+            model_calls INTEGER NOT NULL, turns INTEGER NOT NULL, cost REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, total_tokens INTEGER NOT NULL,
+            model_calls INTEGER NOT NULL, turns INTEGER NOT NULL, cost REAL NOT NULL,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_usage_daily_day ON usage_daily (day);
+        CREATE TABLE IF NOT EXISTS usage_sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, total_tokens INTEGER NOT NULL,
+            model_calls INTEGER NOT NULL, turns INTEGER NOT NULL, cost REAL NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_usage_sessions_updated ON usage_sessions (updated_at);
+        CREATE TABLE IF NOT EXISTS usage_session_models (
+            session_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            PRIMARY KEY (session_id, model)
+        ) WITHOUT ROWID;
+    """
+
+    SQL_UPSERT_USER = _totals_upsert("usage_users", ("user_id",))
+    SQL_UPSERT_DAILY = _totals_upsert("usage_daily", ("user_id", "day"))
+    SQL_UPSERT_SESSION = (
+        "INSERT INTO usage_sessions (session_id, user_id, prompt_tokens, completion_tokens, total_tokens, "
+        "model_calls, turns, cost, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(session_id) DO UPDATE SET "
+        + ", ".join(f"{column} = {column} + excluded.{column}" for column in TOTAL_COLUMNS)
+        + ", updated_at = excluded.updated_at"
+    )
+    SQL_UPSERT_MODEL = (
+        "INSERT INTO usage_session_models (session_id, model, tokens) VALUES (?, ?, ?) "
+        "ON CONFLICT(session_id, model) DO UPDATE SET tokens = tokens + excluded.tokens"
+    )
+
+    def __init__(self, db_path: str = "chat_usage.db",
+                 soft_daily_tokens: Optional[int] = None,
+                 hard_daily_tokens: Optional[int] = None,
+                 pricing: Optional[Dict[str, tuple]] = None):
+        self.db_path = db_path
+        self.soft_daily_tokens = soft_daily_tokens
+        self.hard_daily_tokens = hard_daily_tokens
+        self.pricing = pricing or DEFAULT_MODEL_PRICING
+        self._local = threading.local()
+        self._next_prune = 0.0
+
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def estimate_cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.pricing.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def record_turn(self, user_id: int, session_id: str, model: str,
+                    prompt_tokens: int, completion_tokens: int, model_calls: int = 1) -> Dict[str, Any]:
+        """Record one chat turn against the session, the user and today's rollup (one small transaction)"""
+        cost = self.estimate_cost(model, prompt_tokens, completion_tokens)
+        today = datetime.now().strftime("%Y-%m-%d")
+        deltas = (prompt_tokens, completion_tokens, prompt_tokens + completion_tokens, model_calls, 1, cost)
+
+        conn = self._conn()
+        with conn:
+            conn.execute(self.SQL_UPSERT_USER, (user_id,) + deltas)
+            conn.execute(self.SQL_UPSERT_DAILY, (user_id, today) + deltas)
+            conn.execute(self.SQL_UPSERT_SESSION, (session_id, user_id) + deltas + (datetime.now().isoformat(),))
+            conn.execute(self.SQL_UPSERT_MODEL, (session_id, model, prompt_tokens + completion_tokens))
+
+        if time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + USAGE_PRUNE_INTERVAL_SECONDS
+            self.prune()
+
+        print(f"📊 Token usage: {prompt_tokens}+{completion_tokens} ({model}) -> {session_id} (user: {user_id})")
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "model_calls": model_calls, "cost": round(cost, 6)}
+
+    def prune(self) -> Dict[str, int]:
+        """Remove expired per-session entries and old daily rollups"""
+        removed = {"sessions": 0, "daily": 0}
+        conn = self._conn()
+        with conn:
+            if SESSION_USAGE_RETENTION_DAYS is not None:
+                cutoff = (datetime.now() - timedelta(days=SESSION_USAGE_RETENTION_DAYS)).isoformat()
+                conn.execute(
+                    "DELETE FROM usage_session_models WHERE session_id IN "
+                    "(SELECT session_id FROM usage_sessions WHERE updated_at < ?)", (cutoff,)
+                )
+                removed["sessions"] = conn.execute("DELETE FROM usage_sessions WHERE updated_at < ?", (cutoff,)).rowcount
+            cutoff_day = (datetime.now() - timedelta(days=DAILY_USAGE_RETENTION_DAYS)).strftime("%Y-%m-%d")
+            removed["daily"] = conn.execute("DELETE FROM usage_daily WHERE day < ?", (cutoff_day,)).rowcount
+        if removed["sessions"] or removed["daily"]:
+            print(f"🧹 Pruned usage entries: {removed['sessions']} sessions, {removed['daily']} daily rollups")
+        return removed
+
+    def get_daily_tokens(self, user_id: int, day: Optional[str] = None) -> int:
+        day = day or datetime.now().strftime("%Y-%m-%d")
+        row = self._conn().execute(
+            "SELECT total_tokens FROM usage_daily WHERE user_id = ? AND day = ?", (user_id, day)
+        ).fetchone()
+        return row["total_tokens"] if row else 0
+
+    def check_budget(self, user_id: int) -> str:
+        """Return BUDGET_OK, BUDGET_SOFT or BUDGET_HARD for today's usage"""
+        used = self.get_daily_tokens(user_id)
+        if self.hard_daily_tokens is not None and used >= self.hard_daily_tokens:
+            return BUDGET_HARD
+        if self.soft_daily_tokens is not None and used >= self.soft_daily_tokens:
+            return BUDGET_SOFT
+        return BUDGET_OK
+
+    def get_user_usage(self, user_id: int, days: int = 7) -> Dict[str, Any]:
+        """User totals plus daily rollups for the last `days` days"""
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM usage_users WHERE user_id = ?", (user_id,)).fetchone()
+        since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        daily = {
+            day_row["day"]: _totals(day_row)
+            for day_row in conn.execute(
+                "SELECT * FROM usage_daily WHERE user_id = ? AND day >= ? ORDER BY day", (user_id, since)
+            )
+        }
+        return {
+            "user_id": user_id,
+            "total": _totals(row) if row else _empty_totals(),
+            "daily": daily,
+            "budget": {
+                "status": self.check_budget(user_id),
+                "used_today": self.get_daily_tokens(user_id),
+                "soft_daily_tokens": self.soft_daily_tokens,
+                "hard_daily_tokens": self.hard_daily_tokens,
+            },
+        }
+
+    def get_session_usage(self, session_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM usage_sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        models = {
+            model_row["model"]: model_row["tokens"]
+            for model_row in conn.execute("SELECT model, tokens FROM usage_session_models WHERE session_id = ?", (session_id,))
+        }
+        return {
+            "session_id": session_id,
+            "user_id": row["user_id"],
+            "total": _totals(row),
+            "models": models,
+            "updated_at": row["updated_at"],
+        }
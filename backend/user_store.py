@@ -0,0 +1,212 @@
+"""
+User repository backed by SQLite
+Unique indexes on username and email make lookups and duplicate checks O(log n);
+inserts are single atomic statements and recently used users are served from an
+in-memory LRU cache. The legacy mental_health_users_data.json can be imported
+(automatically on first start, or with: python user_store.py --import FILE)
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from json_stream import JSONStreamReader
+
+
+class UserExistsError(ValueError):
+    """Raised when the username or email is already registered"""
+
+    def __init__(self, field: str):
+        super().__init__(f"{field} already exists")
+        self.field = field
+
+
+class UserStore:
+    """Users table with indexed username/email lookups, one connection per thread"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            email TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            is_active INTEGER NOT NULL DEFAULT 1
+        );
+    """
+
+    SQL_COLUMNS = "SELECT id, username, email, password_hash, created_at, is_active FROM users"
+    SQL_BY_ID = SQL_COLUMNS + " WHERE id = ?"
+    SQL_BY_USERNAME = SQL_COLUMNS + " WHERE username = ?"
+    SQL_BY_EMAIL = SQL_COLUMNS + " WHERE email = ?"
+    SQL_INSERT = (
+        "INSERT INTO users (username, email, password_hash, created_at, is_active) VALUES (?, ?, ?, ?, ?)"
+    )
+    SQL_IMPORT = (
+        "INSERT OR IGNORE INTO users (id, username, email, password_hash, created_at, is_active) "
+        "VALUES (?, ?, ?, ?, ?, ?)"
+    )
+    SQL_COUNT = "SELECT COUNT(*) FROM users"
+
+    def __init__(self, db_path: str = "mental_health_users.db", legacy_json: Optional[str] = None,
+                 cache_size: int = 10000):
+        self.db_path = Path(db_path)
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._cache: "OrderedDict[Tuple[str, Any], Dict[str, Any]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+
+        # First start after the JSON era: bring the existing accounts over
+        if legacy_json and Path(legacy_json).exists() and self.count() == 0:
+            self.import_legacy_json(legacy_json)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, cached_statements=64)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_user(row: sqlite3.Row) -> Dict[str, Any]:
+        user = dict(row)
+        user["is_active"] = bool(user["is_active"])
+        return user
+
+    # ---------- cache ----------
+
+    def _cache_get(self, key: Tuple[str, Any]) -> Optional[Dict[str, Any]]:
+        with self._cache_lock:
+            user = self._cache.get(key)
+            if user is None:
+                self.cache_misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return dict(user)
+
+    def _cache_put(self, user: Dict[str, Any]):
+        """Cache a user under all of its lookup keys (misses are never cached)"""
+        with self._cache_lock:
+            for key in (("id", user["id"]), ("username", user["username"]), ("email", user["email"])):
+                self._cache[key] = user
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _lookup(self, field: str, value: Any, sql: str) -> Optional[Dict[str, Any]]:
+        user = self._cache_get((field, value))
+        if user is not None:
+            return user
+        row = self._conn().execute(sql, (value,)).fetchone()
+        if row is None:
+            return None
+        user = self._to_user(row)
+        self._cache_put(user)
+        return dict(user)
+
+    # ---------- queries ----------
+
+    def get_by_id(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._lookup("id", user_id, self.SQL_BY_ID)
+
+    def get_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        return self._lookup("username", username, self.SQL_BY_USERNAME)
+
+    def get_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        return self._lookup("email", email, self.SQL_BY_EMAIL)
+
+    def count(self) -> int:
+        return self._conn().execute(self.SQL_COUNT).fetchone()[0]
+
+    # ---------- writes ----------
+
+    def create_user(self, username: str, email: str, password_hash: str, created_at: str,
+                    is_active: bool = True) -> Dict[str, Any]:
+        """Insert a user atomically; the unique indexes reject duplicates even under concurrent registrations"""
+        conn = self._conn()
+        try:
+            with conn:
+                cursor = conn.execute(self.SQL_INSERT, (username, email, password_hash, created_at, int(is_active)))
+        except sqlite3.IntegrityError as e:
+            raise UserExistsError("Email" if "email" in str(e) else "Username") from e
+        user = {
+            "id": cursor.lastrowid,
+            "username": username,
+            "email": email,
+            "password_hash": password_hash,
+            "created_at": created_at,
+            "is_active": is_active,
+        }
+        self._cache_put(user)
+        return dict(user)
+
+    def import_legacy_json(self, path: str, batch_size: int = 1000) -> Dict[str, Any]:
+        """Stream {"users": [...]} from the legacy JSON file, keeping ids; existing users are skipped"""
+        imported = skipped = 0
+        conn = self._conn()
+        batch: List[tuple] = []
+
+        def flush():
+            nonlocal imported, skipped
+            with conn:
+                before = conn.total_changes
+                conn.executemany(self.SQL_IMPORT, batch)
+                changed = conn.total_changes - before
+            imported += changed
+            skipped += len(batch) - changed
+            batch.clear()
+
+        with open(path, "r", encoding="utf-8") as f:
+            for field, user, in_array in JSONStreamReader(f).items():
+                if field != "users" or not in_array or not isinstance(user, dict):
+                    continue
+                batch.append((
+                    user.get("id"), user["username"], user["email"], user["password_hash"],
+                    user.get("created_at", ""), int(user.get("is_active", True))
+                ))
+                if len(batch) >= batch_size:
+                    flush()
+        if batch:
+            flush()
+        print(f"👥 Imported {imported} users from {path} ({skipped} already present)")
+        return {"imported": imported, "skipped": skipped, "total_users": self.count()}
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cache_lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "users": self.count(),
+                "cached_keys": len(self._cache),
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite user store")
+    parser.add_argument("--db", default="mental_health_users.db", help="user database")
+    parser.add_argument("--import", dest="import_file", help="import a legacy mental_health_users_data.json")
+    args = parser.parse_args()
+
+    store = UserStore(args.db)
+    if args.import_file:
+        print(json.dumps(store.import_legacy_json(args.import_file), ensure_ascii=False, indent=2))
+    print(json.dumps(store.get_stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
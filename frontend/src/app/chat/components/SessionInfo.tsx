@@ -1,5 +1,6 @@
 "use client";
 import { useState, useEffect } from 'react'
+import { authFetch } from '@/lib/auth'
 
 interface SessionInfoProps {
   sessionId: string
@@ -16,7 +17,7 @@ export default function SessionInfo({ sessionId, onTitleChange }: SessionInfoPro
   // Load session information
   const loadSessionInfo = async () => {
     try {
-      const response = await fetch(`${apiUrl}/api/v1/chat/sessions?user_id=1&agent_type=mental_health`)
+      const response = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health`)
       if (response.ok) {
         const data = await response.json()
         const sessions = data.sessions || (Array.isArray(data) ? data : [])
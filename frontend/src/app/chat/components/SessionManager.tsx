@@ -1,6 +1,6 @@
 "use client";
 import { useState, useEffect } from 'react'
-import { getAuth } from '@/lib/auth'
+import { authFetch } from '@/lib/auth'
 
 export interface Session {
   id: number
@@ -38,8 +38,7 @@ export default function SessionManager({
   const loadSessions = async () => {
     setLoading(true)
     try {
-      const auth = getAuth()
-      const response = await fetch(`${apiUrl}/api/v1/chat/sessions?user_id=${auth?.user_id || 1}&agent_type=mental_health`)
+      const response = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health`)
       if (response.ok) {
         const data = await response.json()
         const sessions = data.sessions || (Array.isArray(data) ? data : [])
@@ -65,8 +64,7 @@ export default function SessionManager({
     if (!newSessionTitle.trim()) return
 
     try {
-      const auth = getAuth()
-      const response = await fetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health&user_id=${auth?.user_id || 1}&title=${encodeURIComponent(newSessionTitle)}`, {
+      const response = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health&title=${encodeURIComponent(newSessionTitle)}`, {
         method: 'POST'
       })
       
@@ -88,8 +86,7 @@ export default function SessionManager({
     if (!confirm('Are you sure you want to delete this session? This action cannot be undone.')) return
 
     try {
-      const auth = getAuth()
-      const response = await fetch(`${apiUrl}/api/v1/chat/sessions/${sessionId}?user_id=${auth?.user_id || 1}&agent_type=mental_health`, {
+      const response = await authFetch(`${apiUrl}/api/v1/chat/sessions/${sessionId}?agent_type=mental_health`, {
         method: 'DELETE'
       })
       
@@ -1,6 +1,6 @@
 "use client";
 import { useState, useRef, useEffect } from 'react'
-import { getAuth } from '@/lib/auth'
+import { authFetch, getAuth } from '@/lib/auth'
 import Link from 'next/link'
 import SessionManager, { Session } from './components/SessionManager'
 import SessionInfo from './components/SessionInfo'
@@ -27,10 +27,9 @@ export default function ChatPage() {
   const createSessionIfNeededWithoutHistory = async (): Promise<string> => {
     try {
       const apiUrl = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8001';
-      const auth = getAuth()
       
       // Check existing session list
-      const sessionsResponse = await fetch(`${apiUrl}/api/v1/chat/sessions?user_id=${auth?.user_id || 1}&agent_type=mental_health`);
+      const sessionsResponse = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health`);
       if (sessionsResponse.ok) {
         const sessionsData = await sessionsResponse.json();
         const sessions = sessionsData.sessions || (Array.isArray(sessionsData) ? sessionsData : []);
@@ -55,7 +54,7 @@ export default function ChatPage() {
       }
       
       // If no existing sessions, create a new one
-      const response = await fetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health&user_id=${auth?.user_id || 1}&title=${encodeURIComponent(currentSessionTitle)}`, {
+      const response = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health&title=${encodeURIComponent(currentSessionTitle)}`, {
         method: 'POST'
       });
       
@@ -77,10 +76,9 @@ export default function ChatPage() {
   const createSessionIfNeeded = async (): Promise<string> => {
     try {
       const apiUrl = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8001';
-      const auth = getAuth()
       
       // Check existing session list
-      const sessionsResponse = await fetch(`${apiUrl}/api/v1/chat/sessions?user_id=${auth?.user_id || 1}&agent_type=mental_health`);
+      const sessionsResponse = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health`);
       if (sessionsResponse.ok) {
         const sessionsData = await sessionsResponse.json();
         const sessions = sessionsData.sessions || (Array.isArray(sessionsData) ? sessionsData : []);
@@ -106,7 +104,7 @@ export default function ChatPage() {
       }
       
       // If no existing sessions, create a new one
-      const response = await fetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health&user_id=${auth?.user_id || 1}&title=${encodeURIComponent(currentSessionTitle)}`, {
+      const response = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health&title=${encodeURIComponent(currentSessionTitle)}`, {
         method: 'POST'
       });
       
@@ -130,8 +128,7 @@ export default function ChatPage() {
     setIsLoadingHistory(true)
     try {
       const apiUrl = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8001';
-      const auth = getAuth()
-      const response = await fetch(`${apiUrl}/api/v1/chat/sessions/${sessionId}/messages?user_id=${auth?.user_id || 1}&agent_type=mental_health`);
+      const response = await authFetch(`${apiUrl}/api/v1/chat/sessions/${sessionId}/messages?agent_type=mental_health`);
       
       if (response.ok) {
         const data = await response.json();
@@ -189,10 +186,9 @@ export default function ChatPage() {
     
     try {
       const apiUrl = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8001';
-      const auth = getAuth()
       
       // Get session list
-      const sessionsResponse = await fetch(`${apiUrl}/api/v1/chat/sessions?user_id=${auth?.user_id || 1}&agent_type=mental_health`);
+      const sessionsResponse = await authFetch(`${apiUrl}/api/v1/chat/sessions?agent_type=mental_health`);
       if (sessionsResponse.ok) {
         const sessionsData = await sessionsResponse.json();
         const sessions = sessionsData.sessions || (Array.isArray(sessionsData) ? sessionsData : []);
@@ -282,7 +278,7 @@ export default function ChatPage() {
       // First create or get valid session ID, but don't trigger history loading
       const sid = await createSessionIfNeededWithoutHistory();
       
-      const response = await fetch(`${apiUrl}/api/v1/chat/stream`, {
+      const response = await authFetch(`${apiUrl}/api/v1/chat/stream`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -367,7 +363,7 @@ export default function ChatPage() {
       // First create or get valid session ID, but don't trigger history loading
       const sid = await createSessionIfNeededWithoutHistory();
       
-      const response = await fetch(`${apiUrl}/api/v1/chat/messages`, {
+      const response = await authFetch(`${apiUrl}/api/v1/chat/messages`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -1,6 +1,6 @@
 "use client";
 import { useState, useRef, useEffect } from 'react'
-import { getAuth } from '@/lib/auth'
+import { authFetch, getAuth } from '@/lib/auth'
 import Link from 'next/link'
 
 type Document = {
@@ -39,6 +39,7 @@ type ChunkingStrategy = {
 export default function RAGManagementPage() {
   const [documents, setDocuments] = useState<Document[]>([])
   const [uploading, setUploading] = useState(false)
+  const [uploadStatus, setUploadStatus] = useState('')
   const [searchQuery, setSearchQuery] = useState('')
   const [searchResults, setSearchResults] = useState<any[]>([])
   const [searching, setSearching] = useState(false)
@@ -145,6 +146,25 @@ export default function RAGManagementPage() {
     fetchDocuments()
   }, [])
 
+  // Resolve with the final job state from the job's server-sent progress events
+  const waitForJob = (jobId: string, filename: string): Promise<any> => {
+    return new Promise((resolve, reject) => {
+      const events = new EventSource(`${apiUrl}/api/v1/mental-health-rag/jobs/${jobId}/events`)
+      events.addEventListener('progress', (event) => {
+        const job = JSON.parse((event as MessageEvent).data)
+        setUploadStatus(`Processing ${filename}: ${job.stage || job.status} (${Math.round((job.progress || 0) * 100)}%)`)
+        if (['succeeded', 'failed', 'cancelled'].includes(job.status)) {
+          events.close()
+          resolve(job)
+        }
+      })
+      events.onerror = () => {
+        events.close()
+        reject(new Error('Lost connection to the ingestion job'))
+      }
+    })
+  }
+
   const handleFileUpload = async (event: React.ChangeEvent<HTMLInputElement>) => {
     const files = event.target.files
     if (!files || files.length === 0) return
@@ -164,19 +184,29 @@ export default function RAGManagementPage() {
           formData.append('custom_keywords', customKeywords)
         }
         
-        const response = await fetch(`${apiUrl}/api/v1/mental-health-rag/upload`, {
+        // Queue an ingestion job (202 at once) and follow its progress events instead of holding the request open
+        setUploadStatus(`Uploading ${file.name}...`)
+        const response = await authFetch(`${apiUrl}/api/v1/mental-health-rag/jobs`, {
           method: 'POST',
           body: formData
         })
-        
-        if (response.ok) {
+        if (!response.ok) {
+          console.error('Upload failed:', (await response.json()).detail)
+          continue
+        }
+        const { job } = await response.json()
+        const finished = await waitForJob(job.job_id, file.name)
+        if (finished.status === 'succeeded') {
           await fetchDocuments()
+        } else {
+          console.error('Ingestion failed:', finished.error || finished.status)
         }
       }
     } catch (error) {
       console.error('Upload failed:', error)
     } finally {
       setUploading(false)
+      setUploadStatus('')
       if (fileInputRef.current) {
         fileInputRef.current.value = ''
       }
@@ -395,7 +425,7 @@ export default function RAGManagementPage() {
               disabled={uploading}
               className="w-full px-4 py-3 bg-primary-500 text-black font-medium rounded disabled:opacity-50 hover:bg-primary-400 transition"
             >
-              {uploading ? 'Uploading...' : 'Choose Files'}
+              {uploading ? (uploadStatus || 'Uploading...') : 'Choose Files'}
             </button>
           </div>
 
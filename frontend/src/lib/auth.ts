@@ -0,0 +1,45 @@
+export type AuthInfo = {
+  user_id: number
+  username: string
+  token: string
+}
+
+const AUTH_STORAGE_KEY = 'auth'
+
+export function getAuth(): AuthInfo | null {
+  if (typeof window === 'undefined') return null
+  try {
+    const raw = window.localStorage.getItem(AUTH_STORAGE_KEY)
+    const auth = raw ? JSON.parse(raw) : null
+    return auth && auth.token ? auth : null
+  } catch {
+    return null
+  }
+}
+
+export function setAuth(auth: AuthInfo) {
+  window.localStorage.setItem(AUTH_STORAGE_KEY, JSON.stringify(auth))
+}
+
+export function clearAuth() {
+  window.localStorage.removeItem(AUTH_STORAGE_KEY)
+}
+
+// Bearer header for the stored login token; the backend resolves the user from it
+export function authHeaders(headers: Record<string, string> = {}): Record<string, string> {
+  const auth = getAuth()
+  return auth ? { ...headers, Authorization: `Bearer ${auth.token}` } : headers
+}
+
+// fetch with the login token attached; an expired or rejected token sends the user back to login
+export async function authFetch(input: string, init: RequestInit = {}): Promise<Response> {
+  const response = await fetch(input, {
+    ...init,
+    headers: authHeaders((init.headers as Record<string, string>) || {})
+  })
+  if (response.status === 401 && typeof window !== 'undefined') {
+    clearAuth()
+    window.location.href = '/auth'
+  }
+  return response
+}